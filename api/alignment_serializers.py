@@ -0,0 +1,68 @@
+"""
+Output of a built common.alignment.Alignment for the alignment API, written straight from the alignment rows (instead
+of rendering alignment/alignment_fasta.html and parsing the text again). Output can be streamed as FASTA or JSON.
+"""
+from rest_framework.utils.encoders import JSONEncoder
+
+from common.definitions import AMINO_ACID_GROUPS, AMINO_ACIDS
+
+from collections import OrderedDict
+import json
+
+
+def iter_json(items):
+    """Stream a JSON object from (key, value) pairs"""
+    yield '{'
+    for i, (key, value) in enumerate(items):
+        yield '{}{}:{}'.format(',' if i else '', json.dumps(key), json.dumps(value, cls=JSONEncoder, ensure_ascii=False,
+            separators=(',', ':')))
+    yield '}'
+
+
+def iter_fasta(items):
+    """Stream FASTA records from (header, sequence) pairs"""
+    for header, sequence in items:
+        yield '>{}\n{}\n'.format(header, sequence)
+
+
+class AlignmentSerializer():
+    """Sequences, consensus and statistics of a built alignment"""
+    def __init__(self, alignment):
+        self.a = alignment
+
+    @staticmethod
+    def sequence(row):
+        return ''.join([r[2] for segment in row.alignment.values() for r in segment])
+
+    def sequences(self):
+        """(entry name, aligned sequence) for each protein in the alignment, the last row of a repeated entry name
+        at the position of the first (like the dictionary the views built)"""
+        rows = OrderedDict()
+        for row in self.a.proteins:
+            rows[row.protein.entry_name] = row
+        for entry_name, row in rows.items():
+            yield entry_name, self.sequence(row)
+
+    def consensus(self):
+        return ''.join([aa.amino_acid for aa in self.a.full_consensus])
+
+    def statistics(self):
+        """Per position feature and amino acid frequencies (requires calculate_statistics)"""
+        feat = {}
+        for i, feature in enumerate(AMINO_ACID_GROUPS):
+            feat[feature] = [x[0] for d in self.a.feature_stats[i] for x in d]
+        for i, aa in enumerate(AMINO_ACIDS):
+            feat[aa] = [x[0] for d in self.a.amino_acid_stats[i] for x in d]
+        return feat
+
+    def similarity(self):
+        """(entry name, sequence, identity, similarity) ordered by similarity to the reference (the first protein)"""
+        rows = OrderedDict()
+        for num, row in enumerate(self.a.proteins):
+            # add the query as 100 identical/similar (like on the website)
+            if num == 0:
+                row.identity = 100
+                row.similarity = 100
+            rows[row.protein.entry_name] = (self.sequence(row), int(str(row.identity).replace(" ","")),
+                int(str(row.similarity).replace(" ","")))
+        return sorted([(k,) + v for k, v in rows.items()], key=lambda x: x[3], reverse=True)
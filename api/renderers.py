@@ -7,4 +7,12 @@ class PDBRenderer(renderers.BaseRenderer):
     filename = 'output.pdb'
 
     def render(self, data, media_type=None, renderer_context=None):
-        return data
\ No newline at end of file
+        return data
+
+class FASTARenderer(renderers.BaseRenderer):
+    media_type = 'text/x-fasta'
+    format = 'fasta'
+    charset = 'utf-8'
+
+    def render(self, data, media_type=None, renderer_context=None):
+        return data
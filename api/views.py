@@ -3,14 +3,17 @@ from rest_framework import views, generics, viewsets
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, FileUploadParser
 from rest_framework.renderers import JSONRenderer
-from django.template.loader import render_to_string
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.settings import api_settings
+from django.http import HttpResponseNotModified, StreamingHttpResponse
 from django.db.models import Q
 from django.conf import settings
 
-from interaction.models import ResidueFragmentInteraction
+from interaction.models import ResidueFragmentInteraction, StructureLigandInteraction
 from mutation.models import MutationRaw
 from protein.models import Protein, ProteinConformation, ProteinFamily, Species, ProteinSegment
-from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent
+from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme
+from residue.numbering_index import generic_number_index
 from structure.models import Structure
 from structure.assign_generic_numbers_gpcr import GenericNumbering
 from structure.sequence_parser import SequenceParser
@@ -18,15 +21,19 @@ from api.serializers import (ProteinSerializer, ProteinFamilySerializer, Species
                              ResidueExtendedSerializer, StructureSerializer,
                              StructureLigandInteractionSerializer,
                              MutationSerializer)
-from api.renderers import PDBRenderer
+from api.renderers import PDBRenderer, FASTARenderer
+from api.alignment_serializers import AlignmentSerializer, iter_json, iter_fasta
 from common.alignment import Alignment
 from common.definitions import *
+from common.cache_keys import API_STRUCTURE_SUMMARIES
 from drugs.models import Drugs
 
 import json, os
+import hashlib
 from io import StringIO
 from Bio.PDB import PDBIO, parse_pdb_header
 from collections import OrderedDict
+from string import Template
 
 # FIXME add
 # getMutations
@@ -207,72 +214,91 @@ class NumberPDBStructureView(views.APIView):
     pass
 
 
+def get_structure_summaries():
+    """
+    Summaries of all (non refined) structures as served by the structure list API, together with the PDB codes of the
+    representative structures. Built from a few values() queries and cached until the structures are rebuilt.
+    """
+    summaries = API_STRUCTURE_SUMMARIES.get()
+    if summaries is not None:
+        return summaries
+
+    structures = Structure.objects.exclude(refined=True).order_by('id').values_list('id', 'pdb_code__index',
+        'protein_conformation__protein__parent__entry_name', 'protein_conformation__protein__parent__family__slug',
+        'protein_conformation__protein__parent__species__latin_name', 'preferred_chain', 'resolution',
+        'publication_date', 'structure_type__name', 'state__name', 'distance', 'publication__web_link__index',
+        'publication__web_link__web_resource__url', 'representative')
+
+    # annotated ligands of all structures at once (instead of a filtered query per structure)
+    ligands = {}
+    for structure_id, name, ligand_type, function in StructureLigandInteraction.objects.filter(annotated=True) \
+            .order_by('id').values_list('structure_id', 'ligand__name', 'ligand__properities__ligand_type__name', 'ligand_role__name'):
+        ligand = {}
+        if name:
+            ligand['name'] = name
+        if ligand_type:
+            ligand['type'] = ligand_type
+        if function:
+            ligand['function'] = function
+        if ligand:
+            ligands.setdefault(structure_id, []).append(ligand)
+
+    summaries = {'structures': [], 'representative': []}
+    for s in structures:
+        summaries['structures'].append({
+            'pdb_code': s[1],
+            'protein': s[2],
+            'family': s[3],
+            'species': s[4],
+            'preferred_chain': s[5],
+            'resolution': s[6],
+            'publication_date': s[7],
+            'type': s[8],
+            'state': s[9],
+            'distance': s[10],
+            'publication': Template(s[12]).substitute(index=s[11]) if s[11] is not None else None,
+            'ligands': ligands.get(s[0], []),
+            })
+        if s[13]:
+            summaries['representative'].append(s[1])
+
+    API_STRUCTURE_SUMMARIES.set(summaries)
+    return summaries
+
+
 class StructureList(views.APIView):
     """
     Get a list of structures
     \n/structure/
+    \n?fields= comma separated list of fields to return, e.g. pdb_code,resolution
+    \n?limit= and ?offset= return a page of the list
     """
 
+    pagination_class = LimitOffsetPagination
+
     def get(self, request, pdb_code=None, entry_name=None, representative=None):
+        summaries = get_structure_summaries()
+        s = summaries['structures']
+
         if pdb_code:
-            structures = Structure.objects.filter(pdb_code__index=pdb_code)
-        elif entry_name and representative:
-            structures = Structure.objects.filter(protein_conformation__protein__parent__entry_name=entry_name,
-                representative=True)
-        elif entry_name:
-            structures = Structure.objects.filter(protein_conformation__protein__parent__entry_name=entry_name)
-        elif representative:
-            structures = Structure.objects.filter(representative=True)
-        else:
-            structures = Structure.objects.all()
-
-        structures = structures.exclude(refined=True).prefetch_related('protein_conformation__protein__parent__species', 'pdb_code',
-            'protein_conformation__protein__parent__family', 'protein_conformation__protein__parent__species',
-            'publication__web_link', 'structureligandinteraction_set__ligand__properities', 'structure_type',
-            'structureligandinteraction_set__ligand__properities__ligand_type',
-            'structureligandinteraction_set__ligand_role')
-
-        # structures = self.get_structures(pdb_code, entry_name, representative)
-
-        # convert objects to a list of dictionaries
-        # normal serializers can not be used because of abstraction of tables (e.g. protein_conformation)
-        s = []
-        for structure in structures:
-            # essential fields
-            structure_data = {
-                'pdb_code': structure.pdb_code.index,
-                'protein': structure.protein_conformation.protein.parent.entry_name,
-                'family': structure.protein_conformation.protein.parent.family.slug,
-                'species': structure.protein_conformation.protein.parent.species.latin_name,
-                'preferred_chain': structure.preferred_chain,
-                'resolution': structure.resolution,
-                'publication_date': structure.publication_date,
-                'type': structure.structure_type.name,
-                'state': structure.state.name,
-                'distance': structure.distance,
-            }
-
-            # publication
-            if structure.publication:
-                structure_data['publication'] = structure.publication.web_link.__str__()
-            else:
-                structure_data['publication'] = None
-
-            # ligand
-            ligands = []
-            for interaction in structure.structureligandinteraction_set.filter(annotated=True):
-                ligand = {}
-                if interaction.ligand.name:
-                    ligand['name'] = interaction.ligand.name
-                if interaction.ligand.properities.ligand_type and interaction.ligand.properities.ligand_type.name:
-                    ligand['type'] = interaction.ligand.properities.ligand_type.name
-                if interaction.ligand_role and interaction.ligand_role.name:
-                    ligand['function'] = interaction.ligand_role.name
-                if ligand:
-                    ligands.append(ligand)
-            structure_data['ligands'] = ligands
-
-            s.append(structure_data)
+            s = [structure for structure in s if structure['pdb_code'] == pdb_code]
+        if entry_name:
+            s = [structure for structure in s if structure['protein'] == entry_name]
+        if representative:
+            representatives = set(summaries['representative'])
+            s = [structure for structure in s if structure['pdb_code'] in representatives]
+
+        # optional selection of fields
+        fields = request.GET.get('fields')
+        if fields:
+            fields = [field for field in fields.split(',') if field]
+            s = [OrderedDict((field, structure[field]) for field in fields if field in structure) for structure in s]
+
+        # optional pagination (only when a limit is given)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(s, request, view=self)
+        if page is not None:
+            return paginator.get_paginated_response(page)
 
         # if a structure is selected, return a single dict rather then a list of dicts
         if len(s) == 1:
@@ -315,7 +341,38 @@ class StructureDetail(StructureList):
         return Structure.objects.filter(pdb_code__index=pdb_code)
 
 
-class FamilyAlignment(views.APIView):
+class AlignmentAPIView(views.APIView):
+    """
+    Base view for the alignment API, the response is written straight from the alignment (FASTA with ?format=fasta)
+    and streamed for JSON and FASTA clients. The ETag is derived from the alignment hash, so clients can revalidate
+    with If-None-Match before the alignment is built.
+    """
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + [FASTARenderer]
+
+    def get_etag(self, request, a, *extra):
+        key = '|'.join([a.get_hash(), self.__class__.__name__, request.accepted_renderer.format] + [str(e) for e in extra])
+        return '"{}"'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def not_modified(self, request, etag):
+        if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+    def alignment_response(self, request, etag, items, fasta_items):
+        """JSON object of items ((key, value) pairs), FASTA records of fasta_items ((header, sequence) pairs)"""
+        if request.accepted_renderer.format == 'fasta':
+            response = StreamingHttpResponse(iter_fasta(fasta_items), content_type='text/x-fasta')
+        elif request.accepted_renderer.format == 'json':
+            response = StreamingHttpResponse(iter_json(items), content_type='application/json')
+        else:
+            # browsable API
+            response = Response(OrderedDict(items))
+        response['ETag'] = etag
+        return response
+
+
+class FamilyAlignment(AlignmentAPIView):
     """
     Get a full sequence alignment of a protein family including a consensus sequence
     \n/alignment/family/{slug}/
@@ -351,7 +408,7 @@ class FamilyAlignment(views.APIView):
                     # get generic numbering object for generic positions
                     else:
                         # make sure the query works for all positions
-                        gen_object = ResidueGenericNumberEquivalent.objects.get(label=s, scheme__id=s_slug)
+                        gen_object = generic_number_index().equivalent(s, s_slug)
                         gen_object.properties = {}
                         gen_list.append(gen_object)
 
@@ -379,52 +436,31 @@ class FamilyAlignment(views.APIView):
                 a.load_segments(gen_list)
             a.load_segments(ss)
 
+            etag = self.get_etag(request, a, statistics)
+            not_modified = self.not_modified(request, etag)
+            if not_modified:
+                return not_modified
+
             # build the alignment data matrix
             a.build_alignment()
 
             a.calculate_statistics()
 
-            residue_list = []
-            for aa in a.full_consensus:
-                residue_list.append(aa.amino_acid)
+            serializer = AlignmentSerializer(a)
+            consensus = serializer.consensus()
 
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
+            def items():
+                yield from serializer.sequences()
+                yield 'CONSENSUS', consensus
+                # statistics for output
+                if statistics == True:
+                    yield 'statistics', serializer.statistics()
 
-            # convert the list to a dict
-            ali_dict = OrderedDict({})
-            for row in response:
-                if row.startswith(">"):
-                    k = row[1:]
-                else:
-                    ali_dict[k] = row
-                    k = False
-            ali_dict['CONSENSUS'] = ''.join(residue_list)
+            def fasta_items():
+                yield from serializer.sequences()
+                yield 'CONSENSUS', consensus
 
-            # render statistics for output
-            if statistics == True:
-                feat = {}
-                for i, feature in enumerate(AMINO_ACID_GROUPS):
-                    feature_stats = a.feature_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
-
-                for i, AA in enumerate(AMINO_ACIDS):
-                    feature_stats = a.amino_acid_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
-
-                ali_dict["statistics"] = feat
-
-            return Response(ali_dict)
+            return self.alignment_response(request, etag, items(), fasta_items())
 
 class FamilyAlignmentPartial(FamilyAlignment):
     """
@@ -454,7 +490,7 @@ class FamilyAlignmentPartialSpecies(FamilyAlignment):
     """
 
 
-class ProteinSimilaritySearchAlignment(views.APIView):
+class ProteinSimilaritySearchAlignment(AlignmentAPIView):
     """
     Get a segment sequence alignment of two or more proteins ranked by similarity
     \n/alignment/similarity/{proteins}/{segments}/
@@ -489,7 +525,7 @@ class ProteinSimilaritySearchAlignment(views.APIView):
                     # get generic numbering object for generic positions
                     else:
                         # make sure the query works for all positions
-                        gen_object = ResidueGenericNumberEquivalent.objects.get(label=s, scheme__id=s_slug)
+                        gen_object = generic_number_index().equivalent(s, s_slug)
                         gen_object.properties = {}
                         gen_list.append(gen_object)
 
@@ -518,38 +554,25 @@ class ProteinSimilaritySearchAlignment(views.APIView):
                 a.load_segments(gen_list)
             a.load_segments(ss)
 
+            etag = self.get_etag(request, a, protein_list[0])
+            not_modified = self.not_modified(request, etag)
+            if not_modified:
+                return not_modified
+
             # build the alignment data matrix
             a.build_alignment()
 
             # calculate identity and similarity of each row compared to the reference
             a.calculate_similarity()
 
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
-
-            # convert the list to a dict
-            ali_dict = {}
-            k = False
-            num = 0
-            for i, row in enumerate(response):
-                if row.startswith(">"):
-                    k = row[1:]
-                elif k:
-                    # add the query as 100 identical/similar to the beginning (like on the website)
-                    if num == 0:
-                        a.proteins[num].identity = 100
-                        a.proteins[num].similarity = 100
-                    # order dict after custom list
-                    keyorder = ["similarity","identity","AA"]
-                    ali_dict[k] = {"AA": row, "identity": int(str(a.proteins[num].identity).replace(" ","")),
-                    "similarity": int(str(a.proteins[num].similarity).replace(" ",""))}
-                    ali_dict[k] = OrderedDict(sorted(ali_dict[k].items(), key=lambda t: keyorder.index(t[0])))
-                    num+=1
-                    k = False
-            ali_dict_ordered = OrderedDict(sorted(ali_dict.items(), key=lambda x: x[1]['similarity'], reverse=True))
-            return Response(ali_dict_ordered)
-
-class ProteinAlignment(views.APIView):
+            rows = AlignmentSerializer(a).similarity()
+            items = ((name, OrderedDict([("similarity", similarity), ("identity", identity), ("AA", sequence)]))
+                for name, sequence, identity, similarity in rows)
+            fasta_items = (("{} identity:{} similarity:{}".format(name, identity, similarity), sequence)
+                for name, sequence, identity, similarity in rows)
+            return self.alignment_response(request, etag, items, fasta_items)
+
+class ProteinAlignment(AlignmentAPIView):
     """
     Get a full sequence alignment of two or more proteins
     \n/alignment/protein/{proteins}/
@@ -580,7 +603,7 @@ class ProteinAlignment(views.APIView):
                         segment_list.append(s)
                     # get generic numbering object for generic positions
                     else:
-                        gen_object = ResidueGenericNumberEquivalent.objects.get(label=s, scheme__id=s_slug)
+                        gen_object = generic_number_index().equivalent(s, s_slug)
                         gen_object.properties = {}
                         gen_list.append(gen_object)
 
@@ -608,6 +631,11 @@ class ProteinAlignment(views.APIView):
                 a.load_segments(gen_list)
             a.load_segments(ss)
 
+            etag = self.get_etag(request, a, statistics)
+            not_modified = self.not_modified(request, etag)
+            if not_modified:
+                return not_modified
+
             # build the alignment data matrix
             a.build_alignment()
 
@@ -615,43 +643,15 @@ class ProteinAlignment(views.APIView):
             if statistics == True:
                 a.calculate_statistics()
 
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
+            serializer = AlignmentSerializer(a)
 
-            # convert the list to a dict
-            ali_dict = {}
-            k = False
-            for row in response:
-                if row.startswith(">"):
-                    k = row[1:]
-                elif k:
-                    ali_dict[k] = row
-                    k = False
+            def items():
+                yield from serializer.sequences()
+                # statistics for output
+                if statistics == True:
+                    yield 'statistics', serializer.statistics()
 
-            # render statistics for output
-            if statistics == True:
-                feat = {}
-                for i, feature in enumerate(AMINO_ACID_GROUPS):
-                    feature_stats = a.feature_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
-
-                for i, AA in enumerate(AMINO_ACIDS):
-                    feature_stats = a.amino_acid_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
-
-                ali_dict["statistics"] = feat
-
-            return Response(ali_dict)
+            return self.alignment_response(request, etag, items(), serializer.sequences())
 
 class ProteinAlignmentStatistics(ProteinAlignment):
     """
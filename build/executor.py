@@ -0,0 +1,220 @@
+"""
+Work-stealing execution of build tasks in worker processes.
+
+The parent hands out one item (typically a primary key or a file name) at a time, so a worker that finishes early
+takes the next item instead of idling while others work through a large static chunk. Workers keep their database
+connection for all their items and send the result of every item back. The parent collects the results for batched
+writes, retries failed items (on any worker) and reports throughput and the expected time left.
+"""
+from django.db import connection
+
+from collections import deque
+from multiprocessing.connection import wait
+import datetime
+import logging
+import multiprocessing
+import pickle
+import time
+import traceback
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def worker_loop(function, pipe):
+    """Run function on the items received from the parent until the stop signal (None)"""
+    while True:
+        try:
+            task = pipe.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        index, item = task
+        try:
+            result = ('done', index, pickle.dumps(function(item), pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            result = ('error', index, traceback.format_exc())
+        pipe.send(result)
+    connection.close()
+
+
+class BuildExecutor():
+    """
+    Run function(item) for all items in proc worker processes.
+
+    write           called in the parent with lists of (item, result) of at most batch_size successful items
+    retries         number of times a failed item is tried again
+    report_interval seconds between progress reports
+    """
+    def __init__(self, function, proc=1, write=None, batch_size=100, retries=1, report_interval=60, logger=None, label='items'):
+        self.function = function
+        self.proc = max(1, proc)
+        self.write = write
+        self.batch_size = batch_size
+        self.retries = retries
+        self.report_interval = report_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.label = label
+
+    def run(self, items):
+        """Process all items, returns the list of (item, error) of the items that failed on every attempt"""
+        items = list(items)
+        self.total = len(items)
+        self.done = 0
+        self.errors = []
+        self.batch = []
+        if not items:
+            return self.errors
+        self.start = self.last_report = time.time()
+
+        if self.proc == 1:
+            # no worker processes needed, keeps tracebacks and debugging simple
+            for item in items:
+                self.run_local(item)
+            self.flush_batch()
+            self.report(final=True)
+            return self.errors
+
+        self.context = multiprocessing.get_context('fork')
+        self.items = items
+        self.pending = deque(range(len(items)))
+        self.attempts = [0] * len(items)
+        self.workers = {}
+        for worker_id in range(min(self.proc, len(items))):
+            self.start_worker(worker_id)
+
+        try:
+            self.feed()
+            while self.done + len(self.errors) < self.total:
+                pipes = {worker['pipe']: worker_id for worker_id, worker in self.workers.items()}
+                sentinels = {worker['process'].sentinel: worker_id for worker_id, worker in self.workers.items()}
+                for ready in wait(list(pipes) + list(sentinels), timeout=self.report_interval):
+                    if ready in pipes:
+                        if self.workers[pipes[ready]]['pipe'] is not ready:
+                            # the worker died and was replaced earlier in this round, its pipe was read then
+                            continue
+                        try:
+                            self.receive(pipes[ready])
+                        except (EOFError, OSError):
+                            # the sentinel of the worker is ready as well
+                            pass
+                    elif self.workers[sentinels[ready]]['process'].sentinel == ready:
+                        self.replace_worker(sentinels[ready])
+                self.feed()
+                if time.time() - self.last_report > self.report_interval:
+                    self.report()
+        finally:
+            for worker in self.workers.values():
+                try:
+                    worker['pipe'].send(None)
+                except OSError:
+                    pass
+            for worker in self.workers.values():
+                worker['process'].join()
+
+        self.flush_batch()
+        self.report(final=True)
+        return self.errors
+
+    def start_worker(self, worker_id):
+        # every worker opens (and keeps) its own connection
+        connection.close()
+        pipe, child_pipe = self.context.Pipe()
+        process = self.context.Process(target=worker_loop, args=(self.function, child_pipe))
+        process.start()
+        child_pipe.close()
+        self.workers[worker_id] = {'process': process, 'pipe': pipe, 'assigned': deque()}
+
+    def feed(self):
+        """Hand out the next items, every worker has the item it works on and one waiting"""
+        for worker in self.workers.values():
+            while self.pending and len(worker['assigned']) < 2:
+                index = self.pending.popleft()
+                try:
+                    worker['pipe'].send((index, self.items[index]))
+                except OSError:
+                    # the worker died, the item waits for the worker replacing it
+                    self.pending.appendleft(index)
+                    break
+                self.attempts[index] += 1
+                worker['assigned'].append(index)
+
+    def receive(self, worker_id):
+        status, index, value = self.workers[worker_id]['pipe'].recv()
+        self.workers[worker_id]['assigned'].remove(index)
+        if status == 'done':
+            self.succeeded(self.items[index], pickle.loads(value))
+        else:
+            self.failed(index, value)
+
+    def replace_worker(self, worker_id):
+        """Replace a worker that died (e.g. killed for using too much memory), its current item counts as failed"""
+        worker = self.workers[worker_id]
+        worker['process'].join()
+        try:
+            while worker['pipe'].poll():
+                self.receive(worker_id)
+        except (EOFError, OSError):
+            pass
+        self.logger.error('Worker process exited with code {}'.format(worker['process'].exitcode))
+        if worker['assigned']:
+            index = worker['assigned'].popleft()
+            self.failed(index, 'Worker process exited with code {}'.format(worker['process'].exitcode))
+        for index in reversed(worker['assigned']):
+            self.attempts[index] -= 1
+            self.pending.appendleft(index)
+        worker['pipe'].close()
+        self.start_worker(worker_id)
+
+    def failed(self, index, error):
+        item = self.items[index]
+        if self.attempts[index] <= self.retries:
+            self.logger.warning('Retrying {} after error: {}'.format(item, error.strip().split('\n')[-1]))
+            self.pending.append(index)
+        else:
+            self.logger.error('Failed {}: {}'.format(item, error))
+            self.errors.append((item, error))
+
+    def run_local(self, item):
+        for attempt in range(self.retries + 1):
+            try:
+                result = self.function(item)
+            except Exception:
+                error = traceback.format_exc()
+                if attempt < self.retries:
+                    self.logger.warning('Retrying {} after error: {}'.format(item, error.strip().split('\n')[-1]))
+                    continue
+                self.logger.error('Failed {}: {}'.format(item, error))
+                self.errors.append((item, error))
+            else:
+                self.succeeded(item, result)
+            break
+        if time.time() - self.last_report > self.report_interval:
+            self.report()
+
+    def succeeded(self, item, result):
+        self.done += 1
+        if self.write is not None:
+            self.batch.append((item, result))
+            if len(self.batch) >= self.batch_size:
+                self.flush_batch()
+
+    def flush_batch(self):
+        if self.write is not None and self.batch:
+            self.write(self.batch)
+            self.batch = []
+
+    def report(self, final=False):
+        self.last_report = time.time()
+        elapsed = self.last_report - self.start
+        finished = self.done + len(self.errors)
+        rate = finished / elapsed if elapsed else 0
+        if final:
+            self.logger.info('Processed {} {} in {} ({:.2f}/s), {} failed'.format(self.total, self.label,
+                format_duration(elapsed), rate, len(self.errors)))
+        else:
+            eta = (self.total - finished) / rate if rate else 0
+            self.logger.info('Processed {}/{} {} ({:.2f}/s, {} failed), about {} left'.format(finished, self.total,
+                self.label, rate, len(self.errors), format_duration(eta)))
@@ -3,6 +3,9 @@ from django.core.management import call_command
 from django.conf import settings
 from django.db import connection
 
+from build.executor import BuildExecutor
+from common.cache_keys import bump_for_command
+
 import datetime
 import logging
 from multiprocessing import Queue, Process, Value, Lock
@@ -26,6 +29,17 @@ class Command(BaseCommand):
             default=False,
             help='Include only a subset of data for testing')
 
+    def execute(self, *args, **options):
+        output = super(Command, self).execute(*args, **options)
+        # invalidate the cached data derived from what this command built
+        bump_for_command(self.__module__.rsplit('.', 1)[-1])
+        return output
+
+    def run_tasks(self, proc, items, function, write=None, **kwargs):
+        """Run function(item) for all items in proc worker processes (see build.executor), the results are passed to
+        write in batches in this process. Returns the (item, error) of the items that failed."""
+        return BuildExecutor(function, proc, write=write, logger=self.logger, **kwargs).run(items)
+
     def prepare_input(self, proc, items, iteration=1):
         q = Queue()
         procs = list()
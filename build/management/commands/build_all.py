@@ -1,7 +1,10 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.core.management import call_command
 
+from build.scheduler import Step, BuildScheduler
+
 import datetime
+import os
 
 
 class Command(BaseCommand):
@@ -30,74 +33,100 @@ class Command(BaseCommand):
                             dest='phase',
                             default=None,
                             help='Specify build phase to run (1 or 2, default: None)')
+        parser.add_argument('-w', '--workers',
+                            type=int,
+                            action='store',
+                            dest='workers',
+                            default=os.cpu_count(),
+                            help='Number of processes used by all concurrently running build steps')
+        parser.add_argument('--run',
+                            action='store',
+                            dest='run',
+                            default='build_all',
+                            help='Name of the run in the build checkpoints')
+        parser.add_argument('--resume',
+                            action='store_true',
+                            dest='resume',
+                            default=False,
+                            help='Skip the steps that completed in the previous attempt of this run')
 
     def handle(self, *args, **options):
         if options['test']:
             print('Running in test mode')
 
+        proc = {'proc': options['proc']}
+        # the steps creating Ligand, LigandProperities, WebLink and Publication rows (get-or-create) run one after the
+        # other, in the order of the serial build: build_citations, build_links, build_structures,
+        # build_endogenous_ligands, build_g_proteins, build_g_protein_structures, build_construct_data,
+        # update_construct_mutations, build_ligands_from_cache, build_ligand_assays, build_mutant_data
+        # (build_human_proteins only creates the UniProt links of the human proteins)
         phase1 = [
-            ['build_common'],
-            ['build_citations'],
-            ['build_human_proteins'],
-            ['build_blast_database'],
-            ['build_other_proteins', {'constructs_only': options['test'] ,'proc': options['proc']}], # build only constructs in test mode
-            ['build_annotation', {'proc': options['proc']}],
-            ['build_blast_database'],
-            ['build_links'],
-            ['build_construct_proteins'],
-            ['build_structures', {'proc': options['proc']}],
-            ['build_endogenous_ligands'],
-            ['build_consensus_sequences', {'proc': options['proc']}],
-            ['build_g_proteins'],
-            ['build_consensus_sequences', {'proc': options['proc'], 'signprot': 'Alpha'}],
-            ['build_arrestins'],
-            ['build_consensus_sequences', {'proc': options['proc'], 'signprot': 'Arrestin'}],
-            ['build_signprot_complex'],
-            ['build_g_protein_structures'],
-            ['build_structure_extra_proteins'],
-            ['build_structure_model_rmsd']
+            Step('build_common'),
+            Step('build_citations', ['build_common']),
+            Step('build_human_proteins', ['build_common']),
+            Step('build_blast_database_human', ['build_human_proteins'], 'build_blast_database'),
+            Step('build_other_proteins', ['build_blast_database_human'], options={'constructs_only': options['test'] ,'proc': options['proc']}), # build only constructs in test mode
+            Step('build_annotation', ['build_other_proteins'], options=proc),
+            Step('build_blast_database_annotated', ['build_annotation'], 'build_blast_database'),
+            Step('build_links', ['build_other_proteins', 'build_citations']),
+            Step('build_construct_proteins', ['build_blast_database_annotated']),
+            Step('build_structures', ['build_construct_proteins', 'build_links'], options=proc),
+            Step('build_endogenous_ligands', ['build_annotation', 'build_structures']),
+            Step('build_consensus_sequences', ['build_annotation'], options=proc),
+            Step('build_g_proteins', ['build_annotation', 'build_endogenous_ligands']),
+            Step('build_consensus_sequences_alpha', ['build_g_proteins'], 'build_consensus_sequences', {'proc': options['proc'], 'signprot': 'Alpha'}),
+            Step('build_arrestins', ['build_g_proteins']),
+            Step('build_consensus_sequences_arrestin', ['build_arrestins'], 'build_consensus_sequences', {'proc': options['proc'], 'signprot': 'Arrestin'}),
+            Step('build_signprot_complex', ['build_structures', 'build_arrestins']),
+            Step('build_g_protein_structures', ['build_signprot_complex']),
+            Step('build_structure_extra_proteins', ['build_g_protein_structures']),
+            Step('build_structure_model_rmsd', ['build_structures']),
         ]
         phase2 = [
-            ['build_structure_angles', {'proc': options['proc']}],
-            # ['build_distance_representative'],
-            ['build_contact_representative'],
-            ['build_construct_data'],
-            ['update_construct_mutations'],
-            ['build_ligands_from_cache', {'proc': options['proc'], 'test_run': options['test']}],
-            ['build_ligand_assays', {'test_run': options['test']}],
-            ['build_mutant_data', {'proc': options['proc'], 'test_run': options['test']}],
-            ['build_protein_sets'],
-            ['build_drugs'],
-            ['build_nhs'],
-            ['build_mutational_landscape'],
-            ['build_residue_sets'],
-            ['build_dynamine_annotation', {'proc': options['proc']}],
-            ['build_blast_database'],
-            ['build_complex_interactions'],
-            ['assign_structure_states'],
-            ['build_mammalian_representative'],
-            # ['build_homology_models', ['--update', '-z'], {'proc': options['proc'], 'test_run': options['test']}],
-            ['build_text'],
-            ['build_release_notes'],
+            Step('build_structure_angles', ['build_structure_extra_proteins'], options=proc),
+            # Step('build_distance_representative', ['build_structure_angles']),
+            Step('build_contact_representative', ['build_structure_angles']),
+            Step('build_construct_data', ['build_endogenous_ligands', 'build_g_protein_structures']),
+            Step('update_construct_mutations', ['build_construct_data']),
+            Step('build_ligands_from_cache', ['build_structures', 'build_endogenous_ligands', 'update_construct_mutations'], options={'proc': options['proc'], 'test_run': options['test']}),
+            Step('build_ligand_assays', ['build_ligands_from_cache'], options={'test_run': options['test']}),
+            Step('build_mutant_data', ['build_ligands_from_cache', 'build_ligand_assays'], options={'proc': options['proc'], 'test_run': options['test']}),
+            Step('build_protein_sets', ['build_annotation']),
+            Step('build_drugs', ['build_annotation']),
+            Step('build_nhs', ['build_annotation']),
+            Step('build_mutational_landscape', ['build_annotation']),
+            Step('build_residue_sets', ['build_annotation']),
+            Step('build_dynamine_annotation', ['build_annotation'], options=proc),
+            Step('build_blast_database_final', ['build_structure_extra_proteins', 'build_construct_proteins'], 'build_blast_database'),
+            Step('build_complex_interactions', ['build_structure_extra_proteins']),
+            Step('build_contact_fingerprints', ['build_complex_interactions'], options=proc),
+            Step('assign_structure_states', ['build_structure_angles', 'build_structure_model_rmsd']),
+            Step('build_mammalian_representative', ['assign_structure_states']),
+            # Step('build_homology_models', ['build_blast_database_final'], options={'proc': options['proc'], 'test_run': options['test'], 'update': True, 'z': True}),
+            Step('build_text', ['build_common']),
         ]
+        # the release notes count everything that was built
+        release_notes = Step('build_release_notes', [step.name for step in phase1 + phase2])
+        # written for the new release
+        residue_matrix = Step('build_residue_matrix', ['build_release_notes'], options=proc)
 
         if options['phase']:
             if options['phase']==1:
-                commands = phase1
+                steps = phase1
             elif options['phase']==2:
-                commands = phase2
+                steps = phase2 + [release_notes, residue_matrix]
         else:
-            commands = phase1+phase2
+            steps = phase1 + phase2 + [release_notes, residue_matrix]
+
+        scheduler = BuildScheduler(steps, run=options['run'], workers=options['workers'], stdout=self.stdout)
+        failed, skipped = scheduler.execute(resume=options['resume'])
+        scheduler.report()
+        if failed:
+            raise CommandError('Failed build steps: {}{}. Fix them and continue with --resume --run {}'.format(', '.join(failed),
+                ' (not run: {})'.format(', '.join(skipped)) if skipped else '', options['run']))
 
-        for c in commands:
-            print('{} Running {}'.format(
-                datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'), c[0]))
-            if len(c) == 2:
-                call_command(c[0], **c[1])
-            elif len(c) == 3:
-                call_command(c[0], *c[1], **c[2])
-            else:
-                call_command(c[0])
+        print('{} Warming the cache'.format(datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S')))
+        call_command('warm_cache')
 
         print('{} Build completed'.format(datetime.datetime.strftime(
             datetime.datetime.now(), '%Y-%m-%d %H:%M:%S')))
@@ -3,6 +3,7 @@ from django.conf import settings
 from django.db import connection
 
 from protein.models import Protein
+from structure.sequence_index import write_index
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import IUPAC
@@ -59,6 +60,10 @@ class Command(BaseCommand):
         if os.path.exists(self.tmp_file_path):
             os.unlink(self.tmp_file_path)
 
+        # k-mer index for the in-process sequence search (does not need the BLAST binaries)
+        self.logger.info('Building sequence index')
+        write_index(self.db_file_path, proteins.values_list('id', 'entry_name', 'sequence'))
+
         self.logger.info('COMPLETED BUILDING BLAST DATABASE')
 
         # Human sequences only
@@ -97,4 +102,7 @@ class Command(BaseCommand):
         if os.path.exists(self.tmp_file_path):
             os.unlink(self.tmp_file_path)
 
+        self.logger.info('Building sequence index')
+        write_index(self.human_db_file_path, proteins.values_list('id', 'entry_name', 'sequence'))
+
         self.logger.info('COMPLETED BUILDING BLAST DATABASE WITH HUMAN SEQUENCES')
@@ -0,0 +1,50 @@
+from build.management.commands.base_build import Command as BaseBuild
+
+from django.db import transaction
+
+from contactnetwork.fingerprints import build_fingerprint
+from contactnetwork.models import ContactFingerprint
+from structure.models import Structure
+
+import logging
+
+
+class Command(BaseBuild):
+    help = 'Store the interactions of every structure as a bit-packed fingerprint for the interaction browser.'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--proc',
+            type=int,
+            action='store',
+            dest='proc',
+            default=1,
+            help='Number of processes to run')
+        parser.add_argument('-s', '--structures',
+            type=int,
+            nargs='*',
+            action='store',
+            dest='structures',
+            default=None,
+            help='Only (re)build the fingerprints of these structure ids')
+
+    def handle(self, *args, **options):
+        if options['structures'] is not None:
+            structure_ids = options['structures']
+        else:
+            ContactFingerprint.truncate()
+            structure_ids = list(Structure.objects.order_by('pk').values_list('pk', flat=True))
+
+        errors = self.run_tasks(options['proc'], structure_ids, build_fingerprint, write=self.write_fingerprints,
+                                label='structures')
+        for structure_id, error in errors:
+            self.logger.error('Error building the contact fingerprint of structure {}'.format(structure_id))
+        self.logger.info('Finished building contact fingerprints')
+
+    @transaction.atomic
+    def write_fingerprints(self, results):
+        structure_ids = [structure_id for structure_id, fields in results]
+        ContactFingerprint.objects.filter(structure_id__in=structure_ids).delete()
+        ContactFingerprint.objects.bulk_create([ContactFingerprint(structure_id=structure_id, **fields)
+                                                for structure_id, fields in results])
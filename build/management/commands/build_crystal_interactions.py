@@ -1,24 +1,40 @@
 from django.core.management.base import BaseCommand
+from django.core.management import call_command
 from build.management.commands.base_build import Command as BaseBuild
 
 from django.db import transaction
+from django.db.models import CharField, F, Func
+from django.db.models.functions import Coalesce
 
 from contactnetwork.models import *
-from residue.models import Residue
-
-import contactnetwork.interaction as ci
+from structure.models import Structure
+from common.tools import fetch_from_cache, save_to_cache
 
 import logging
 import datetime
+import time
+
+from contactnetwork.cube import calculate_interactions, interaction_rows
+
+from collections import OrderedDict
 
-from contactnetwork.cube import compute_interactions
 
-from django.contrib.contenttypes.models import ContentType
+def calculate_structure_interactions(structure):
+    """Worker: classify all interactions of one structure and return them as plain tuples"""
+    structure_id, entry_name = structure
+    struc, classified, classified_complex = calculate_interactions(entry_name)
+    return interaction_rows(classified + classified_complex)
+
 
 class Command(BaseBuild):
     help = 'Compute interactions for all available crystals.'
 
     logger = logging.getLogger(__name__)
+
+    # location of the pdb_data digests of the last run (for incremental builds)
+    state_path = ['contactnetwork']
+    state_file = 'crystal_interactions_pdb_data'
+
     def add_arguments(self, parser):
         parser.add_argument('-p', '--proc',
             type=int,
@@ -26,113 +42,103 @@ class Command(BaseBuild):
             dest='proc',
             default=1,
             help='Number of processes to run')
+        parser.add_argument('-i', '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help='Only process structures of which the pdb_data changed since the last run')
+        parser.add_argument('--batch-size',
+            type=int,
+            action='store',
+            dest='batch_size',
+            default=20000,
+            help='Number of residue pairs written per bulk insert')
 
     def handle(self, *args, **options):
-        self.delete_all()
-        self.structures = Structure.objects.all().exclude(refined=True)
-        self.prepare_input(options['proc'], self.structures)
+        self.batch_size = options['batch_size']
+
+        # digest of the coordinates per structure (calculated by the database for rows without a stored digest)
+        structures = list(Structure.objects.exclude(refined=True) \
+            .annotate(pdb_digest=Coalesce(F('pdb_data__digest'), Func(F('pdb_data__pdb'), function='MD5', output_field=CharField()))) \
+            .values_list('pk', 'protein_conformation__protein__entry_name', 'pdb_digest'))
+        digests = {s[0]: s[2] for s in structures}
+
+        if options['incremental']:
+            previous = fetch_from_cache(self.state_path, self.state_file) or {}
+            self.structures = [(s[0], s[1]) for s in structures if previous.get(s[0]) != s[2]]
+            self.logger.info('{} of {} structures changed since the last run'.format(len(self.structures), len(digests)))
+        else:
+            previous = {}
+            self.delete_all()
+            self.structures = [(s[0], s[1]) for s in structures]
+
+        done = self.build_interactions(options['proc'])
+        call_command('build_contact_fingerprints', proc=options['proc'], structures=done if options['incremental'] else None)
+
+        # remember which pdb_data has been processed
+        state = {pk: digest for pk, digest in previous.items() if pk in digests}
+        state.update({pk: digests[pk] for pk in done})
+        save_to_cache(self.state_path, self.state_file, state)
+
         self.logger.info('Finished building crystal interaction data for all PDBs!')
 
     def delete_all(self):
-        VanDerWaalsInteraction.objects.all().delete()
-        HydrophobicInteraction.objects.all().delete()
-        PolarBackboneSidechainInteraction.objects.all().delete()
-        PolarSidechainSidechainInteraction.objects.all().delete()
-        FaceToFaceInteraction.objects.all().delete()
-        FaceToEdgeInteraction.objects.all().delete()
-        PiCationInteraction.objects.all().delete()
-        InteractingResiduePair.objects.all().delete()
+        InteractingResiduePair.truncate()
+        Interaction.truncate()
         self.logger.info('Deleted crystal interactions data all PDBs...')
 
-    # @transaction.atomic
-    def main_func(self, positions, iteration,count,lock):
-        while count.value<len(self.structures):
-            with lock:
-                s = self.structures[count.value]
-                pdb_code = s.protein_conformation.protein.entry_name
-                count.value +=1 
-                self.logger.info('Generating crystal interactions data for PDB \'{}\'... ({} out of {})'.format(pdb_code, count.value, len(self.structures)))
-
-            try:
-                interacting_pairs = compute_interactions(pdb_code)
-            except:
-                self.logger.error('Error with computing interactions (%s)' % (pdb_code))
-                continue
-
-            for p in interacting_pairs:
-                # Create the pair
-                res1_seq_num = p.get_residue_1().id[1]
-                res2_seq_num = p.get_residue_2().id[1]
-                conformation = s.protein_conformation
-
-                # Get the residues
-                try:
-                    res1 = Residue.objects.get(sequence_number=res1_seq_num, protein_conformation=conformation)
-                    res2 = Residue.objects.get(sequence_number=res2_seq_num, protein_conformation=conformation)
-                except Residue.DoesNotExist:
-                    self.logger.warning('Error with pair between %s and %s (%s)' % (res1_seq_num,res2_seq_num,conformation))
-                    continue
-
-                # Save the pair
-                pair = InteractingResiduePair()
-                pair.res1 = res1
-                pair.res2 = res2
-                pair.referenced_structure = s
-                pair.save()
-
-                # Add the interactions to the pair
-                for i in p.get_interactions():
-                    if type(i) is ci.VanDerWaalsInteraction:
-                        ni = VanDerWaalsInteraction()
-                        ni.interacting_pair = pair
-                        ni.save()
-                    elif type(i) is ci.HydrophobicInteraction:
-                        ni = HydrophobicInteraction()
-                        ni.interacting_pair = pair
-                        ni.save()
-                    elif type(i) is ci.PolarSidechainSidechainInteraction:
-                        ni = PolarSidechainSidechainInteraction()
-                        ni.interacting_pair = pair
-                        ni.is_charged_res1 = i.is_charged_res1
-                        ni.is_charged_res2 = i.is_charged_res2
-                        ni.save()
-                    elif type(i) is ci.PolarBackboneSidechainInteraction:
-                        ni = PolarBackboneSidechainInteraction()
-                        ni.interacting_pair = pair
-                        ni.is_charged_res1 = i.is_charged_res1
-                        ni.is_charged_res2 = i.is_charged_res2
-                        ni.res1_is_sidechain = False
-                        ni.save()
-                    elif type(i) is ci.PolarSideChainBackboneInteraction:
-                        ni = PolarBackboneSidechainInteraction()
-                        ni.interacting_pair = pair
-                        ni.is_charged_res1 = i.is_charged_res1
-                        ni.is_charged_res2 = i.is_charged_res2
-                        ni.res1_is_sidechain = True
-                        ni.save()
-                    elif type(i) is ci.FaceToFaceInteraction:
-                        ni = FaceToFaceInteraction()
-                        ni.interacting_pair = pair
-                        ni.save()
-                    elif type(i) is ci.FaceToEdgeInteraction:
-                        ni = FaceToEdgeInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_face = True
-                        ni.save()
-                    elif type(i) is ci.EdgeToFaceInteraction:
-                        ni = FaceToEdgeInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_face = False
-                        ni.save()
-                    elif type(i) is ci.PiCationInteraction:
-                        ni = PiCationInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_pi = True
-                        ni.save()
-                    elif type(i) is ci.CationPiInteraction:
-                        ni = PiCationInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_pi = False
-                        ni.save()
-
-            self.logger.info('Generated crystal interactions data for PDB \'{}\'...'.format(pdb_code))
+    def build_interactions(self, proc):
+        """Calculate the interactions in worker processes and write the results in bulk from this process"""
+        self.done = []
+        self.pending = []
+        self.pending_pairs = 0
+        start = time.time()
+
+        errors = self.run_tasks(proc, self.structures, calculate_structure_interactions, write=self.collect_interactions,
+                                batch_size=1, label='structures')
+        for (structure_id, entry_name), error in errors:
+            self.logger.error('Error with computing interactions (%s)' % (entry_name))
+
+        self.done += self.write_interactions(self.pending)
+        self.logger.info('Wrote interactions of {} structures in {}'.format(len(self.done), datetime.timedelta(seconds=int(time.time()-start))))
+        return self.done
+
+    def collect_interactions(self, results):
+        """Write the calculated interactions once enough residue pairs are waiting"""
+        for (structure_id, entry_name), rows in results:
+            self.pending.append((structure_id, rows))
+            self.pending_pairs += len(rows)
+        if self.pending_pairs >= self.batch_size:
+            self.done += self.write_interactions(self.pending)
+            self.pending = []
+            self.pending_pairs = 0
+
+    @transaction.atomic
+    def write_interactions(self, results):
+        """Replace the interactions of a batch of structures"""
+        if not results:
+            return []
+
+        structure_ids = [structure_id for structure_id, rows in results]
+        InteractingResiduePair.objects.filter(referenced_structure_id__in=structure_ids).delete()
+
+        # merge duplicate residue pairs (as get_or_create would)
+        pairs = OrderedDict()
+        for structure_id, rows in results:
+            for res1_id, res2_id, interactions in rows:
+                key = (structure_id, res1_id, res2_id)
+                if key not in pairs:
+                    pairs[key] = []
+                pairs[key].extend(interactions)
+
+        bulk_pairs = [InteractingResiduePair(referenced_structure_id=key[0], res1_id=key[1], res2_id=key[2]) for key in pairs]
+        InteractingResiduePair.objects.bulk_create(bulk_pairs, batch_size=5000)
+
+        bulk_interactions = []
+        for pair, interactions in zip(bulk_pairs, pairs.values()):
+            for interaction_type, specific_type, atomname1, atomname2, level in interactions:
+                bulk_interactions.append(Interaction(interacting_pair=pair, interaction_type=interaction_type, specific_type=specific_type,
+                                                     atomname_residue1=atomname1, atomname_residue2=atomname2, interaction_level=level))
+        Interaction.objects.bulk_create(bulk_interactions, batch_size=5000)
+
+        return structure_ids
@@ -17,8 +17,7 @@ from Bio import pairwise2
 from collections import OrderedDict
 import logging
 import shlex, subprocess
-from io import StringIO
-from Bio.PDB import PDBParser,PPBuilder
+from Bio.PDB import PPBuilder
 from Bio import pairwise2
 import pprint
 import json
@@ -95,8 +94,7 @@ class Command(BaseBuild):
                         alpha_protconf.state = ProteinState.objects.get(slug="active")
                         alpha_protconf.save()
 
-                    pdbp = PDBParser(PERMISSIVE=True, QUIET=True)
-                    s = pdbp.get_structure("struct", StringIO(sc.structure.pdb_data.pdb))
+                    s = sc.structure.get_parsed_pdb().to_biopython("struct")
                     chain = s[0][sc.alpha]
                     nums = []
                     for res in chain:
@@ -167,9 +167,9 @@ class Command(BaseBuild):
         if self.revise_xtal!=False:
             try:
                 hommod = Structure.objects.get(pdb_code__index=main_structure+'_refined', refined=True)
-                hommod.pdb_data.pdb = pdb_data
+                hommod.pdb_data, created = PdbData.get_or_create_pdb(pdb_data)
                 hommod.stats_text.stats_text = ''.join(templates)
-                hommod.pdb_data.save()
+                hommod.save()
 
                 # original = Structure.objects.get(pdb_code__index=main_structure)
                 original = self.get_structures(main_structure)
@@ -181,7 +181,7 @@ class Command(BaseBuild):
                 # original = Structure.objects.get(pdb_code__index=main_structure)
                 original = self.get_structures(main_structure)
                 wl,created = WebLink.objects.get_or_create(index=main_structure+'_refined', web_resource=original.pdb_code.web_resource)
-                pdb,created = PdbData.objects.get_or_create(pdb=pdb_data)
+                pdb,created = PdbData.get_or_create_pdb(pdb_data)
                 stats_text,created = StatsText.objects.get_or_create(stats_text=''.join(templates))
                 prot_conf = ProteinConformation.objects.get(protein=original.protein_conformation.protein.parent)
                 hommod = Structure.objects.create(preferred_chain=original.preferred_chain, resolution=original.resolution, publication_date=original.publication_date,
@@ -237,7 +237,7 @@ class Command(BaseBuild):
             try:
                 hommod = StructureComplexModel.objects.get(receptor_protein=gpcr_prot, sign_prot=sign_prot)
                 hommod.main_template = m_s
-                hommod.pdb_data.pdb = pdb_data
+                hommod.pdb_data, created = PdbData.get_or_create_pdb(pdb_data)
                 hommod.version = build_date
                 # hommod.prot_signprot_pair = pair
                 hommod.stats_text.stats_text = ''.join(templates)
@@ -248,7 +248,7 @@ class Command(BaseBuild):
                 StructureComplexModelSeqSim.objects.filter(homology_model=hommod).delete()
             except Exception as msg:
                 stats_text = StatsText.objects.create(stats_text=''.join(templates))
-                pdb_data = PdbData.objects.create(pdb=pdb_data)
+                pdb_data, created = PdbData.get_or_create_pdb(pdb_data)
                 hommod = StructureComplexModel.objects.create(receptor_protein=r_prot, sign_protein=s_prot, 
                                                                 main_template=m_s, 
                                                                 pdb_data=pdb_data, 
@@ -315,7 +315,7 @@ class Command(BaseBuild):
             try:
                 hommod = StructureModel.objects.get(protein__entry_name=gpcr_prot, state=s_state)
                 hommod.main_template = m_s
-                hommod.pdb_data.pdb = pdb_data
+                hommod.pdb_data, created = PdbData.get_or_create_pdb(pdb_data)
                 hommod.version = build_date
                 hommod.stats_text.stats_text = ''.join(templates)
                 hommod.save()
@@ -325,7 +325,7 @@ class Command(BaseBuild):
                 StructureModelSeqSim.objects.filter(homology_model=hommod).delete()
             except Exception as msg:
                 stats_text = StatsText.objects.create(stats_text=''.join(templates))
-                pdb_data = PdbData.objects.create(pdb=pdb_data)
+                pdb_data, created = PdbData.get_or_create_pdb(pdb_data)
                 hommod = StructureModel.objects.create(protein=prot, state=s_state, 
                                                         main_template=m_s, 
                                                         pdb_data=pdb_data, 
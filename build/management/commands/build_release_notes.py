@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.core.cache import cache, caches
 
 from common.models import ReleaseNotes, ReleaseStatistics, ReleaseStatisticsType
 from drugs.models import Drugs
@@ -9,6 +10,7 @@ from mutation.models import MutationExperiment
 from mutational_landscape.models import NaturalMutations
 from protein.models import Protein, Species
 from structure.models import Structure, StructureModel, StructureComplexModel
+from common.tools import get_data_release
 
 import logging
 import shlex
@@ -87,4 +89,15 @@ class Command(BaseCommand):
             if created:
                 self.logger.info('Created release stat {} {}'.format(latest_release_notes, stat[1]))
 
+        self.set_cache_release()
+
         self.logger.info('COMPLETED CREATING RELEASE NOTES')
+
+    def set_cache_release(self):
+        """Switch the caches with a release namespace (TieredCache) to the latest release"""
+        cache.delete('data_release')
+        release = get_data_release()
+        for alias in settings.CACHES:
+            if hasattr(caches[alias], 'set_release'):
+                caches[alias].set_release(release)
+                self.logger.info('Cache {} switched to release {}'.format(alias, release))
@@ -0,0 +1,41 @@
+from build.management.commands.base_build import Command as BaseBuild
+
+from residue.models import ResidueGenericNumber
+from residue.residue_matrix import write_residue_matrix, matrix_directory
+
+import logging
+
+
+class Command(BaseBuild):
+    help = 'Write the memory mapped residue matrix (protein conformations x generic numbers) of every numbering ' \
+        + 'scheme for the current data release.'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--proc',
+            type=int,
+            action='store',
+            dest='proc',
+            default=1,
+            help='Number of processes to run')
+        parser.add_argument('-s', '--schemes',
+            nargs='*',
+            action='store',
+            dest='schemes',
+            default=None,
+            help='Only write the matrices of these numbering schemes (slugs)')
+
+    def handle(self, *args, **options):
+        schemes = options['schemes'] or list(ResidueGenericNumber.objects.order_by('scheme__slug')
+                                             .values_list('scheme__slug', flat=True).distinct())
+        self.logger.info('Writing residue matrices to {}'.format(matrix_directory()))
+
+        errors = self.run_tasks(options['proc'], schemes, self.write_matrix, label='schemes')
+        for scheme, error in errors:
+            self.logger.error('Error writing the residue matrix of scheme {}'.format(scheme))
+        self.logger.info('Finished writing residue matrices')
+
+    def write_matrix(self, scheme):
+        shape = write_residue_matrix(scheme)
+        self.logger.info('Residue matrix {}: {} protein conformations x {} generic numbers'.format(scheme, *shape))
@@ -34,6 +34,7 @@ import re
 import yaml
 import time
 from collections import OrderedDict
+from functools import partial
 import json
 from urllib.request import urlopen
 from Bio.PDB import parse_pdb_header
@@ -141,7 +142,7 @@ class Command(BaseBuild):
             # run the function twice (once for representative structures, once for non-representative)
             iterations = 2
             for i in range(1,iterations+1):
-                self.prepare_input(options['proc'], self.filenames, i)
+                self.run_tasks(options['proc'], self.filenames, partial(self.build_structure, iteration=i), label='structure files')
 
             self.logger.info('COMPLETED CREATING STRUCTURES')
         except Exception as msg:
@@ -778,16 +779,15 @@ class Command(BaseBuild):
                                 #print('inserted',residue.sequence_number) #sanity check
                                 # residue.save()
                                 residues_bulk.append(residue)
-                                rotamer_data, created = PdbData.objects.get_or_create(pdb=temp)
-                                #rotamer_data_bulk.append(PdbData(pdb=temp))
+                                # rotamer pdb data is resolved for the whole structure at once (PdbData.bulk_get_or_create)
                                 missing_atoms = False
-                                if rotamer_data.pdb.startswith('COMPND'):
-                                    lines = len(rotamer_data.pdb.split('\n'))-2
+                                if temp.startswith('COMPND'):
+                                    lines = len(temp.split('\n'))-2
                                 else:
-                                    lines = len(rotamer_data.pdb.split('\n'))
+                                    lines = len(temp.split('\n'))
                                 if lines<atom_num_dict[residue.amino_acid]:
                                     missing_atoms = True
-                                rotamer_data_bulk.append([rotamer_data, missing_atoms])
+                                rotamer_data_bulk.append([temp, missing_atoms])
                                 # rotamer, created = Rotamer.objects.get_or_create(residue=residue, structure=structure, pdbdata=rotamer_data)
                                 #rotamer_bulk.append(Rotamer(residue=residue, structure=structure, pdbdata=rotamer_data))
 
@@ -895,13 +895,12 @@ class Command(BaseBuild):
                     prev_segment = res.protein_segment
 
         bulked_res = Residue.objects.bulk_create(residues_bulk)
-        #bulked_rot = PdbData.objects.bulk_create(rotamer_data_bulk)
-        bulked_rot = rotamer_data_bulk
+        bulked_rot = PdbData.bulk_get_or_create([r[0] for r in rotamer_data_bulk])
 
         rotamer_bulk = []
         for i,res in enumerate(bulked_res):
-            rotamer_bulk.append(Rotamer(residue=res, structure=structure, pdbdata=bulked_rot[i][0],
-                                        missing_atoms=bulked_rot[i][1]))
+            rotamer_bulk.append(Rotamer(residue=res, structure=structure, pdbdata=bulked_rot[i],
+                                        missing_atoms=rotamer_data_bulk[i][1]))
 
         Rotamer.objects.bulk_create(rotamer_bulk)
         #
@@ -932,17 +931,12 @@ class Command(BaseBuild):
             return
 
 
-    def main_func(self, positions, iteration,count,lock):
-        # filenames
-        # if not positions[1]:
-        #     filenames = self.filenames[positions[0]:]
-        # else:
-        #     filenames = self.filenames[positions[0]:positions[1]]
-        filenames = self.filenames
-        while count.value<len(filenames):
-            with lock:
-                source_file = filenames[count.value]
-                count.value +=1
+    def build_structure(self, source_file, iteration):
+        """Create the structure of one yaml file (representative structures in iteration 1, others in iteration 2)"""
+        self.main_func([source_file], iteration)
+
+    def main_func(self, filenames, iteration):
+        for source_file in filenames:
             source_file_path = os.sep.join([self.structure_data_dir, source_file])
             # sbc = StructureBuildCheck()
             # if source_file != "2RH1.yaml":
@@ -1048,7 +1042,7 @@ class Command(BaseBuild):
                         with open(pdb_path, 'r') as pdb_file:
                             pdbdata_raw = pdb_file.read()
 
-                    pdbdata, created = PdbData.objects.get_or_create(pdb=pdbdata_raw)
+                    pdbdata, created = PdbData.get_or_create_pdb(pdbdata_raw)
                     s.pdb_data = pdbdata
 
                     # UPDATE HETSYN with its PDB reference instead + GRAB PUB DATE, PMID, DOI AND RESOLUTION
@@ -1566,12 +1560,9 @@ class Command(BaseBuild):
 
                         try:
                             current = time.time()
-                            mypath = '/tmp/interactions/results/' + sd['pdb'] + '/output'
-                            # if not os.path.isdir(mypath):
-                            #     #Only run calcs, if not already in temp
-                            runcalculation(sd['pdb'],peptide_chain)
+                            calculation = runcalculation(sd['pdb'],peptide_chain)
 
-                            parsecalculation(sd['pdb'],False)
+                            parsecalculation(sd['pdb'],calculation,False)
                             end = time.time()
                             diff = round(end - current,1)
                             self.logger.info('Interaction calculations done for {}. {} seconds.'.format(
@@ -1579,12 +1570,9 @@ class Command(BaseBuild):
                         except Exception as msg:
                             try:
                                 current = time.time()
-                                mypath = '/tmp/interactions/results/' + sd['pdb'] + '/output'
-                                # if not os.path.isdir(mypath):
-                                #     #Only run calcs, if not already in temp
-                                runcalculation(sd['pdb'], peptide_chain)
+                                calculation = runcalculation(sd['pdb'], peptide_chain)
 
-                                parsecalculation(sd['pdb'],False)
+                                parsecalculation(sd['pdb'],calculation,False)
                                 end = time.time()
                                 diff = round(end - current,1)
                                 self.logger.info('Interaction calculations done (again) for {}. {} seconds.'.format(
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.core.management import call_command
+
+import json
+
+
+class Command(BaseCommand):
+    help = 'Run a build command with its options as JSON (option destinations, as for call_command), used by build_all'
+
+    def add_arguments(self, parser):
+        parser.add_argument('step_command',
+                            action='store',
+                            help='Name of the build command')
+        parser.add_argument('step_options',
+                            nargs='?',
+                            action='store',
+                            default='{}',
+                            help='JSON object of the options of the build command')
+
+    def handle(self, *args, **options):
+        call_command(options['step_command'], **json.loads(options['step_options']))
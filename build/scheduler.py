@@ -0,0 +1,231 @@
+"""
+Parallel execution of build commands with declared dependencies.
+
+Every step runs as its own manage.py process (output in logs/build/<run>/<step>.log). Steps start as soon as their
+dependencies have finished, the longest remaining chain of steps first, as long as the process budget allows (a step
+with a 'proc' option uses that many processes). Completion and timing of the steps are stored in the build_checkpoint
+table, so a failed run can be resumed without repeating the steps that succeeded.
+"""
+from django.conf import settings
+from django.core.management import get_commands, load_command_class
+from django.db import connection
+from django.utils import timezone
+
+from build.management.commands.base_build import Command as BaseBuild
+from common.cache_keys import bump_for_command
+from common.models import BuildCheckpoint
+
+from collections import OrderedDict
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+class Step():
+    """A build command with its options and the steps it depends on"""
+    def __init__(self, name, depends=None, command=None, options=None):
+        self.name = name
+        self.command = command or name
+        self.depends = depends or []
+        self.options = options or {}
+
+    @property
+    def workers(self):
+        return max(1, self.options.get('proc', 1))
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds or 0)))
+
+
+class BuildScheduler():
+    def __init__(self, steps, run='default', workers=1, stdout=sys.stdout):
+        self.steps = OrderedDict()
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError('Duplicate build step {}'.format(step.name))
+            self.steps[step.name] = step
+        # dependencies outside the selected steps (e.g. another phase) are assumed to be built
+        for step in self.steps.values():
+            step.depends = [d for d in step.depends if d in self.steps]
+        self.order = self.topological_order()
+        self.run = run
+        self.workers = max(1, workers)
+        self.stdout = stdout
+        self.log_dir = os.path.join(settings.BASE_DIR, 'logs', 'build', run)
+
+    def topological_order(self):
+        order = []
+        state = {}
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError('Build steps depend on each other: {}'.format(' -> '.join(path + [name])))
+            state[name] = 'visiting'
+            for dependency in self.steps[name].depends:
+                visit(dependency, path + [name])
+            state[name] = 'done'
+            order.append(name)
+        for name in self.steps:
+            visit(name, [])
+        return order
+
+    def write(self, message):
+        self.stdout.write('{} {}\n'.format(datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'), message))
+        self.stdout.flush()
+
+    def save_checkpoint(self, step, status, started, finished=None, error=None):
+        BuildCheckpoint.objects.update_or_create(run=self.run, step=step.name, defaults={
+            'command': step.command,
+            'status': status,
+            'started': started,
+            'finished': finished,
+            'duration': (finished - started).total_seconds() if finished else None,
+            'error': error,
+            })
+        # the scheduler waits for hours between writes, do not keep the connection open
+        connection.close()
+
+    def estimates(self):
+        """Expected duration of every step (the last successful duration in any run, 1 second when unknown)"""
+        durations = {}
+        for step, duration in BuildCheckpoint.objects.filter(status='done', step__in=list(self.steps)) \
+                .order_by('finished').values_list('step', 'duration'):
+            durations[step] = duration
+        return {name: durations.get(name) or 1 for name in self.steps}
+
+    def remaining_path(self, durations):
+        """Longest chain of durations from each step to the end of the build"""
+        dependents = {name: [] for name in self.steps}
+        for step in self.steps.values():
+            for dependency in step.depends:
+                dependents[dependency].append(step.name)
+        remaining = {}
+        for name in reversed(self.order):
+            remaining[name] = durations[name] + max([remaining[d] for d in dependents[name]] or [0])
+        return remaining
+
+    def execute(self, resume=False):
+        """Run all steps, returns the names of the failed steps and of the steps that could not run because of them"""
+        checkpoints = {c.step: c for c in BuildCheckpoint.objects.filter(run=self.run)}
+        if resume:
+            done = set([name for name, c in checkpoints.items() if c.status == 'done' and name in self.steps])
+            if done:
+                self.write('Resuming run {}, skipping {} completed steps'.format(self.run, len(done)))
+        else:
+            BuildCheckpoint.objects.filter(run=self.run).delete()
+            done = set()
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        priority = self.remaining_path(self.estimates())
+        pending = [name for name in sorted(self.order, key=lambda n: -priority[n]) if name not in done]
+        running = {}
+        failed = set()
+        blocked = set()
+
+        try:
+            while pending or running:
+                used = sum(self.steps[name].workers for name in running)
+                for name in list(pending):
+                    step = self.steps[name]
+                    if any(d in failed or d in blocked for d in step.depends):
+                        pending.remove(name)
+                        blocked.add(name)
+                        self.write('Skipping {} (depends on a failed step)'.format(name))
+                        continue
+                    if not all(d in done for d in step.depends):
+                        continue
+                    if running and used + step.workers > self.workers:
+                        continue
+                    pending.remove(name)
+                    running[name] = self.start(step)
+                    used += step.workers
+
+                if not running:
+                    break
+
+                time.sleep(1)
+                for name, (process, log, started) in list(running.items()):
+                    if process.poll() is None:
+                        continue
+                    del running[name]
+                    log.close()
+                    if self.finish(self.steps[name], process.returncode, started):
+                        done.add(name)
+                    else:
+                        failed.add(name)
+        except KeyboardInterrupt:
+            for name, (process, log, started) in running.items():
+                process.terminate()
+                process.wait()
+                log.close()
+                self.save_checkpoint(self.steps[name], 'failed', started, timezone.now(), 'Interrupted')
+            raise
+
+        return sorted(failed), sorted(blocked | set(pending))
+
+    def start(self, step):
+        # the options are passed to call_command in the step process, which maps them to the command's parser
+        arguments = [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'run_build_step', step.command,
+                     json.dumps(step.options)]
+        log_path = os.path.join(self.log_dir, step.name + '.log')
+        log = open(log_path, 'w')
+        started = timezone.now()
+        self.save_checkpoint(step, 'running', started)
+        self.write('Running {} ({} process{}, log {})'.format(step.name, step.workers, 'es' if step.workers > 1 else '', log_path))
+        process = subprocess.Popen(arguments, stdout=log, stderr=subprocess.STDOUT, cwd=settings.BASE_DIR)
+        return process, log, started
+
+    def finish(self, step, returncode, started):
+        finished = timezone.now()
+        if returncode:
+            error = 'Exit code {}, see {}'.format(returncode, os.path.join(self.log_dir, step.name + '.log'))
+            self.save_checkpoint(step, 'failed', started, finished, error)
+            self.write('Failed {} after {} ({})'.format(step.name, format_duration((finished - started).total_seconds()), error))
+            return False
+
+        # build commands based on BaseBuild invalidate the cached data they affect themselves
+        if not isinstance(load_command_class(get_commands()[step.command], step.command), BaseBuild):
+            bump_for_command(step.command)
+        self.save_checkpoint(step, 'done', started, finished)
+        self.write('Finished {} in {}'.format(step.name, format_duration((finished - started).total_seconds())))
+        return True
+
+    def report(self):
+        """Timing of the steps of this run and the chain of steps that determined the total build time"""
+        checkpoints = {c.step: c for c in BuildCheckpoint.objects.filter(run=self.run, status='done', step__in=list(self.steps))}
+        if not checkpoints:
+            return
+        durations = {name: checkpoints[name].duration if name in checkpoints else 0 for name in self.steps}
+
+        # earliest finish of every step if each started as soon as its dependencies were done
+        finish = {}
+        previous = {}
+        for name in self.order:
+            dependencies = self.steps[name].depends
+            previous[name] = max(dependencies, key=lambda d: finish[d]) if dependencies else None
+            finish[name] = durations[name] + (finish[previous[name]] if previous[name] else 0)
+        path = []
+        name = max(finish, key=finish.get)
+        while name:
+            path.insert(0, name)
+            name = previous[name]
+
+        first = min(c.started for c in checkpoints.values())
+        last = max(c.finished for c in checkpoints.values())
+        self.stdout.write('\nStep timings (run {})\n'.format(self.run))
+        self.stdout.write('{:<45} {:>10} {:>10} {:>10}\n'.format('step', 'start', 'duration', 'critical'))
+        for c in sorted(checkpoints.values(), key=lambda c: c.started):
+            self.stdout.write('{:<45} {:>10} {:>10} {:>10}\n'.format(c.step, format_duration((c.started - first).total_seconds()),
+                format_duration(c.duration), '*' if c.step in path else ''))
+
+        total = sum(durations.values())
+        wall = (last - first).total_seconds()
+        self.stdout.write('\nCritical path ({}): {}\n'.format(format_duration(finish[path[-1]]),
+            ' -> '.join(['{} ({})'.format(name, format_duration(durations[name])) for name in path])))
+        self.stdout.write('Wall time {}, sum of step durations {} (parallelism {:.1f})\n'.format(format_duration(wall),
+            format_duration(total), total / wall if wall else 1))
@@ -0,0 +1,5 @@
+from build.management.commands.build_contact_fingerprints import Command as BuildContactFingerprints
+
+
+class Command(BuildContactFingerprints):
+    pass
\ No newline at end of file
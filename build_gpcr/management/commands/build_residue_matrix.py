@@ -0,0 +1,5 @@
+from build.management.commands.build_residue_matrix import Command as BuildResidueMatrix
+
+
+class Command(BuildResidueMatrix):
+    pass
\ No newline at end of file
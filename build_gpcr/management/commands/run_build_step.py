@@ -0,0 +1,5 @@
+from build.management.commands.run_build_step import Command as RunBuildStep
+
+
+class Command(RunBuildStep):
+    pass
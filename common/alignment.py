@@ -3,7 +3,7 @@ import json
 import logging
 import os
 import time
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from copy import deepcopy
 from operator import itemgetter
 
@@ -11,10 +11,14 @@ import numpy as np
 
 from alignment.functions import prepare_aa_group_preference
 from Bio.SubsMat import MatrixInfo
+from common.alignment_matrix import AlignmentMatrix
+from common.alignment_similarity import SequenceSimilarity, format_percentage
 from common.definitions import *
 from common.selection import Selection
+from common.cache_keys import namespace
 from django.conf import settings
 from django.core.cache import cache, caches
+from django.db.models import Q
 from protein.models import (Protein, ProteinConformation, ProteinFamily,
                             ProteinFusionProtein, ProteinSegment, ProteinState)
 from residue.functions import dgn, ggn
@@ -30,6 +34,12 @@ try:
 except:
     cache_alignments = cache
 
+# lightweight residue record used for building alignment rows, these are cached per protein conformation and segment
+# generic_number, display_generic_number: labels (or None), alternative_generic_numbers: tuple of (scheme slug, label)
+AlignedResidue = namedtuple('AlignedResidue', ['generic_number', 'display_generic_number', 'display_generic_number_id',
+                                               'display_scheme', 'amino_acid', 'sequence_number',
+                                               'alternative_generic_numbers'])
+
 
 class Alignment:
     """A class representing a protein sequence alignment, with or without a reference sequence"""
@@ -65,6 +75,15 @@ class Alignment:
         self.stats_done = False
         self.zscales = OrderedDict()
 
+        # calculate the statistics on a NumPy protein x position matrix instead of nested dicts
+        self.use_matrix_backend = getattr(settings, 'ALIGNMENT_MATRIX_BACKEND', True)
+
+        # maximum number of residues in an alignment (the matrix backend handles larger alignments)
+        if self.use_matrix_backend:
+            self.max_residues = getattr(settings, 'ALIGNMENT_MATRIX_MAX_RESIDUES', 300000)
+        else:
+            self.max_residues = getattr(settings, 'ALIGNMENT_MAX_RESIDUES', 120000)
+
         # refers to which ProteinConformation attribute to order by (identity, similarity or similarity score)
         self.order_by = 'similarity'
 
@@ -154,34 +173,25 @@ class Alignment:
 
     def load_proteins_from_selection(self, simple_selection):
         """Read user selection and add selected proteins"""
-        # local protein list
-        proteins = []
-
-        # flatten the selection into individual proteins
-        for target in simple_selection.targets:
-            if target.type == 'protein':
-                proteins.append(target.item)
-            elif target.type == 'family':
-                # species filter
-                species_list = []
-                for species in simple_selection.species:
-                    species_list.append(species.item)
-
-                # annotation filter
-                protein_source_list = []
-                for protein_source in simple_selection.annotation:
-                    protein_source_list.append(protein_source.item)
-
-                if species_list:
-                    family_proteins = Protein.objects.filter(family__slug__startswith=target.item.slug,
-                                                             species__in=(species_list), source__in=(protein_source_list)).select_related(
-                        'residue_numbering_scheme', 'species')
-                else:
-                    family_proteins = Protein.objects.filter(family__slug__startswith=target.item.slug,
-                                                             source__in=(protein_source_list)).select_related('residue_numbering_scheme', 'species')
-
-                for fp in family_proteins:
-                    proteins.append(fp)
+        # local protein list (ids, the conformations are loaded in one query)
+        proteins = simple_selection.ids('targets', 'protein')
+
+        # flatten the selected families into individual proteins
+        family_slugs = [target.item.slug for target in simple_selection.targets if target.type == 'family']
+        if family_slugs:
+            # species filter
+            species_list = simple_selection.ids('species')
+
+            # annotation filter
+            protein_source_list = simple_selection.ids('annotation')
+
+            family_filter = Q()
+            for slug in family_slugs:
+                family_filter |= Q(family__slug__startswith=slug)
+            family_proteins = Protein.objects.filter(family_filter, source__in=(protein_source_list))
+            if species_list:
+                family_proteins = family_proteins.filter(species__in=(species_list))
+            proteins.extend(family_proteins.values_list('pk', flat=True))
 
         # load protein list
         self.load_proteins(proteins)
@@ -217,7 +227,7 @@ class Alignment:
         for s in selected_segments:
             if hasattr(s, 'item'):
                 selected_segment = s.item
-                if hasattr(selected_segment, 'only_aligned_residues'):
+                if s.properties.get('only_aligned_residues') or hasattr(selected_segment, 'only_aligned_residues'):
                     self.segments_only_alignable.append(selected_segment.slug)
             else:
                 selected_segment = s
@@ -273,7 +283,8 @@ class Alignment:
         # local segment list
         segments = []
 
-        # read selection
+        # read selection (segments and residue positions are loaded with one query per type)
+        simple_selection.resolve('segments')
         for segment in simple_selection.segments:
             segments.append(segment)
 
@@ -316,7 +327,8 @@ class Alignment:
         # create unique hash key for alignment combo
         protein_ids = sorted(set([ str(protein.id) for protein in self.proteins ]))
         segment_ids = sorted(set( self.segments ))
-        hash_key = "|" + "-".join(protein_ids)
+        hash_key = namespace(['proteins', 'structures'])
+        hash_key += "|" + "-".join(protein_ids)
         hash_key += "|" + "-".join(segment_ids)
         if 'Custom' in self.segments:
             hash_key += "|" + "-".join(sorted(set( self.segments['Custom'] )))
@@ -328,6 +340,181 @@ class Alignment:
 
         return hashlib.md5(hash_key.encode('utf-8')).hexdigest()
 
+    def get_block_cache_key(self, pconf_id, segment):
+        """Cache key of the aligned residues of one protein conformation in one segment"""
+        alignable = segment in self.segments_only_alignable
+        return "ALIGNMENT_BLOCK_{}_{}_{}_{}".format(namespace(['proteins', 'structures']), pconf_id, segment, int(alignable))
+
+    def fetch_aligned_residues(self, rs):
+        """Fetch residues as AlignedResidue records, returns a list of (protein conformation id, segment, residue)"""
+        residues = rs.order_by('sequence_number').values_list('id', 'protein_conformation_id', 'protein_segment__slug',
+            'generic_number__label', 'display_generic_number_id', 'display_generic_number__label',
+            'display_generic_number__scheme__short_name', 'amino_acid', 'sequence_number')
+
+        # alternative generic numbers of residues with a generic number
+        alternative_generic_numbers = {}
+        arns = Residue.alternative_generic_numbers.through.objects.filter(
+            residue__in=rs.exclude(generic_number=None)).order_by('id').values_list(
+            'residue_id', 'residuegenericnumber__scheme__slug', 'residuegenericnumber__label')
+        for residue_id, scheme_slug, label in arns:
+            if residue_id not in alternative_generic_numbers:
+                alternative_generic_numbers[residue_id] = []
+            alternative_generic_numbers[residue_id].append((scheme_slug, label))
+
+        aligned_residues = []
+        for r in residues:
+            aligned_residues.append((r[1], r[2], AlignedResidue(r[3], r[5], r[4], r[6], r[7], r[8],
+                                                                tuple(alternative_generic_numbers.get(r[0], ())))))
+        return aligned_residues
+
+    def build_segment_block(self, ps, category, residues):
+        """Assign alignment position labels to the residues of one protein in one segment"""
+        block = {}
+        segment_counters = {}
+        aligned_residue_encountered = False
+        for r in residues:
+            # what part of the segment is this? There are 4 possibilities:
+            # 1. The aligned part (for both fully and partially aligned segments)
+            # 2. The part before the aligned part in a partially aligned segment
+            # 3. The part after the aligned part in a partially aligned segment
+            # 4. An unaligned segment (then there is only one part)
+            if r.generic_number:
+                segment_part = 1
+            elif ps in settings.REFERENCE_POSITIONS and not aligned_residue_encountered:
+                segment_part = 2
+            elif ps in settings.REFERENCE_POSITIONS and aligned_residue_encountered:
+                segment_part = 3
+            else:
+                segment_part = 4
+
+            # update segment counters
+            if segment_part == 3:
+                part_ps = ps + '_after'
+            else:
+                part_ps = ps
+            if part_ps not in segment_counters:
+                segment_counters[part_ps] = 1
+            else:
+                segment_counters[part_ps] += 1
+
+            # user generic numbers as keys for aligned segments
+            if r.generic_number:
+                block[r.generic_number] = r
+
+                # register the presence of an aligned residue
+                aligned_residue_encountered = True
+            # use custom keys for non-aligned segments
+            else:
+                # label prefix + index
+                # Unaligned segments should be split in the middle, with the first part "left aligned", and the second
+                # "right aligned". If there is an aligned part of the segment, it goes in the middle.
+                if segment_part == 2:
+                    prefix = '00-'
+                elif segment_part == 3:
+                    prefix = 'zz-'
+                else:
+                    prefix = '01-'
+
+                # Note that there is not enough information to assign correct indicies to "right aligned" residues, but
+                # those are corrected below
+                index = str("%04d" % (segment_counters[part_ps],))
+
+                # position label
+                block[prefix + ps + "-" + index] = r
+
+        # correct alignment of split segments
+        pos_num = 1
+        pos_num_after = 1
+        for pos_label in sorted(block):
+            right_align = False
+            # In a "normal", non split, unaligned segment, is this past the middle?
+            if (pos_label.startswith('01-')
+                    and category != 'terminus'
+                    and pos_num > (segment_counters[ps] / 2 + 0.5)):
+                right_align = True
+            # In an partially aligned segment (prefixed with 00), where conserved residues are lacking, treat
+            # as an unaligned segment
+            elif (pos_label.startswith('00-')
+                  and not aligned_residue_encountered
+                  and pos_num > (segment_counters[ps] / 2 + 0.5)
+                  or ps == 'N-term'):
+                right_align = True
+            # In an N-terminus, always right align everything
+            elif pos_label.startswith('01-') and ps == 'N-term':
+                right_align = True
+
+            if right_align:
+                # if so, "right align" from here using a zz prefixed label
+                updated_index = 'zz' + pos_label[2:]
+                block[updated_index] = block.pop(pos_label)
+                pos_label = updated_index
+
+            if pos_label.startswith('zz-'):
+                segment_label_after = ps + '_after' # parts after a partly aligned segment start with zz
+                if segment_label_after in segment_counters:
+                    segment_length = segment_counters[segment_label_after]
+                    counter = pos_num_after
+
+                # this might be the "second part" of an unaligned segment, e.g.
+                # AAAA----AAAAA
+                # AAAAAAAAAAAAA
+                else:
+                    segment_length = segment_counters[ps]
+                    counter = pos_num
+
+                updated_index = pos_label[:-4] + str(9999 - (segment_length - counter))
+                block[updated_index] = block.pop(pos_label)
+                pos_label = updated_index
+                pos_num_after += 1
+            pos_num += 1
+
+        return block
+
+    def load_segment_blocks(self):
+        """Collect the aligned residues of all selected proteins and segments. Blocks of one protein conformation and
+        one segment are cached per data release, so any selection is assembled from the cache and only missing blocks
+        are fetched from the DB."""
+        segments = [segment for segment in self.segments if segment != self.custom_segment_label]
+        pconf_ids = set([pc.id for pc in self.proteins])
+        block_keys = OrderedDict()
+        for pconf_id in pconf_ids:
+            for segment in segments:
+                block_keys[self.get_block_cache_key(pconf_id, segment)] = (pconf_id, segment)
+        blocks = cache_alignments.get_many(list(block_keys.keys()))
+
+        # fetch missing blocks from the DB
+        missing = [block_keys[key] for key in block_keys if key not in blocks]
+        if missing:
+            missing_pconfs = set([x[0] for x in missing])
+            missing_segments = set([x[1] for x in missing])
+            rs = Residue.objects.filter(protein_segment__slug__in=missing_segments,
+                                        protein_conformation_id__in=missing_pconfs)
+            segment_categories = dict(ProteinSegment.objects.filter(slug__in=missing_segments).values_list('slug', 'category'))
+
+            segment_residues = OrderedDict([(x, []) for x in missing])
+            for pconf_id, ps, r in self.fetch_aligned_residues(rs):
+                # If segment flagged to only include the alignable residues, exclude the ones with no GN
+                if (pconf_id, ps) in segment_residues and not (ps in self.segments_only_alignable and not r.generic_number):
+                    segment_residues[(pconf_id, ps)].append(r)
+
+            new_blocks = {}
+            for (pconf_id, ps), residues in segment_residues.items():
+                new_blocks[self.get_block_cache_key(pconf_id, ps)] = self.build_segment_block(ps,
+                    segment_categories.get(ps), residues)
+            cache_alignments.set_many(new_blocks, 60*60*24*14)
+            blocks.update(new_blocks)
+
+        # dict of proteins, segments and residues
+        proteins = {}
+        for key, (pconf_id, ps) in block_keys.items():
+            if pconf_id not in proteins:
+                proteins[pconf_id] = {}
+            proteins[pconf_id][ps] = dict(blocks[key])
+            for pos_label in sorted(proteins[pconf_id][ps]):
+                if pos_label not in self.segments[ps]:
+                    self.segments[ps].append(pos_label)
+        return proteins
+
     # AJK: point for optimization - primary bottleneck (#1 cleaning, #2 last for-loop in this function)
     def build_alignment(self):
         """Fetch selected residues from DB and build an alignment"""
@@ -336,8 +523,8 @@ class Alignment:
         rs = Residue.objects.filter(protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins)
 
 
-        self.number_of_residues_total = len(rs)
-        if self.number_of_residues_total>120000: #300 receptors, 400 residues limit
+        self.number_of_residues_total = rs.count()
+        if self.number_of_residues_total>self.max_residues: # e.g. 300 receptors, 400 residues limit
             return "Too large"
 
         # AJK: performance boost -> Internal caching (not for very small alignments)
@@ -346,195 +533,20 @@ class Alignment:
 
         #cache_alignments.set(cache_key, 0, 0)
         if self.number_of_residues_total < 2500 or not cache_alignments.has_key(cache_key):
-            # fetch segment residues
-            if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
-                rs = Residue.objects.filter(
-                    protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
-                    'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                    'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
-            else:
-                rs = Residue.objects.filter(
-                    protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
-                    'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                    'generic_number__scheme', 'display_generic_number__scheme')
-
-            # If segment flagged to only include the alignable residues, exclude the ones with no GN
-            for s in self.segments_only_alignable:
-                rs = rs.exclude(protein_segment__slug=s, generic_number=None)
-
-            # fetch individually selected residues (Custom segment)
-            crs = {}
-            for segment in self.segments:
-                if segment == self.custom_segment_label or self.use_residue_groups:
-                    if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
-                        crs[segment] = Residue.objects.filter(
-                            generic_number__label__in=self.segments[segment],
-                            protein_conformation__in=self.proteins).prefetch_related(
-                            'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                            'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
-                    else:
-                        crs[segment] = Residue.objects.filter(
-                            generic_number__label__in=self.segments[segment],
-                            protein_conformation__in=self.proteins).prefetch_related(
-                            'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                            'generic_number__scheme', 'display_generic_number__scheme')
-
-            # create a dict of proteins, segments and residues
-            proteins = {}
-            segment_counters = {}
-            aligned_residue_encountered = {}
-            fusion_protein_inserted = {}
-            for r in rs:
-                ps = r.protein_segment.slug
-
-                # identifiers for protein/state
-                pcid = r.protein_conformation.protein.entry_name + "-" + r.protein_conformation.state.slug
-
-                # update protein dict
-                if pcid not in proteins:
-                    proteins[pcid] = {}
-                if ps not in proteins[pcid]:
-                    proteins[pcid][ps] = {}
-
-                # update aligned residue tracker
-                if pcid not in aligned_residue_encountered:
-                    aligned_residue_encountered[pcid] = {}
-                if ps not in aligned_residue_encountered[pcid]:
-                    aligned_residue_encountered[pcid][ps] = False
-
-                # what part of the segment is this? There are 4 possibilities:
-                # 1. The aligned part (for both fully and partially aligned segments)
-                # 2. The part before the aligned part in a partially aligned segment
-                # 3. The part after the aligned part in a partially aligned segment
-                # 4. An unaligned segment (then there is only one part)
-                if r.generic_number:
-                    segment_part = 1
-                elif ps in settings.REFERENCE_POSITIONS and not aligned_residue_encountered[pcid][ps]:
-                    segment_part = 2
-                elif ps in settings.REFERENCE_POSITIONS and aligned_residue_encountered[pcid][ps]:
-                    segment_part = 3
-                else:
-                    segment_part = 4
-
-                # update segment counters
-                if pcid not in segment_counters:
-                    segment_counters[pcid] = {}
-                if segment_part == 3:
-                    part_ps = ps + '_after'
-                else:
-                    part_ps = ps
-                if part_ps not in segment_counters[pcid]:
-                    segment_counters[pcid][part_ps] = 1
-                else:
-                    segment_counters[pcid][part_ps] += 1
-
-
-                # update fusion protein tracker
-                if pcid not in fusion_protein_inserted:
-                    fusion_protein_inserted[pcid] = {}
-                if ps not in fusion_protein_inserted[pcid]:
-                    fusion_protein_inserted[pcid][ps] = False
-
-                # user generic numbers as keys for aligned segments
-                if r.generic_number:
-                    proteins[pcid][ps][r.generic_number.label] = r
-
-                    # register the presence of an aligned residue
-                    aligned_residue_encountered[pcid][ps] = True
-                # use custom keys for non-aligned segments
-                else:
-                    # label prefix + index
-                    # Unaligned segments should be split in the middle, with the first part "left aligned", and the second
-                    # "right aligned". If there is an aligned part of the segment, it goes in the middle.
-                    if segment_part == 2:
-                        prefix = '00-'
-                    elif segment_part == 3:
-                        prefix = 'zz-'
-                    else:
-                        prefix = '01-'
-
-                    # Note that there is not enough information to assign correct indicies to "right aligned" residues, but
-                    # those are corrected below
-                    index = str("%04d" % (segment_counters[pcid][part_ps],))
-
-                    # position label
-                    pos_label =  prefix + ps + "-" + index
-
-                    # insert fusion protein FIXME add this
-                    # if not fusion_protein_inserted[pcid][ps] and aligned_residue_encountered[pcid][ps]:
-                    #     fp = ProteinFusionProtein.objects.get(protein=r.protein_conformation.protein,
-                    #         segment_after=r.protein_segment)
-                    #     fusion_pos_label = ps + "-" + str("%04d" % (segment_counters[pcid][ps]-1,)) + "-fusion"
-                    #     proteins[pcid][ps][fusion_pos_label] = Residue(amino_acid=fp.protein_fusion.name)
-                    #     if fusion_pos_label not in self.segments[ps]:
-                    #         self.segments[ps].append(fusion_pos_label)
-                    #     fusion_protein_inserted[pcid][ps] = True
-
-                    # residue
-                    proteins[pcid][ps][pos_label] = r
-
-            # correct alignment of split segments
-            for pcid, segments in proteins.items():
-                for ps, positions in segments.items():
-                    pos_num = 1
-                    pos_num_after = 1
-                    for pos_label in sorted(positions):
-                        res_obj = proteins[pcid][ps][pos_label]
-                        right_align = False
-                        # In a "normal", non split, unaligned segment, is this past the middle?
-                        if (pos_label.startswith('01-')
-                                and res_obj.protein_segment.category != 'terminus'
-                                and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)):
-                            right_align = True
-                        # In an partially aligned segment (prefixed with 00), where conserved residues are lacking, treat
-                        # as an unaligned segment
-                        elif (pos_label.startswith('00-')
-                              and not aligned_residue_encountered[pcid][ps]
-                              and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)
-                              or res_obj.protein_segment.slug == 'N-term'):
-                            right_align = True
-                        # In an N-terminus, always right align everything
-                        elif pos_label.startswith('01-') and res_obj.protein_segment.slug == 'N-term':
-                            right_align = True
-
-                        if right_align:
-                            # if so, "right align" from here using a zz prefixed label
-                            updated_index = 'zz' + pos_label[2:]
-                            proteins[pcid][ps][updated_index] = proteins[pcid][ps].pop(pos_label)
-                            pos_label = updated_index
-
-                        if pos_label.startswith('zz-'):
-                            segment_label_after = ps + '_after' # parts after a partly aligned segment start with zz
-                            if segment_label_after in segment_counters[pcid]:
-                                segment_length = segment_counters[pcid][segment_label_after]
-                                counter = pos_num_after
-
-                            # this might be the "second part" of an unaligned segment, e.g.
-                            # AAAA----AAAAA
-                            # AAAAAAAAAAAAA
-                            else:
-                                segment_length = segment_counters[pcid][ps]
-                                counter = pos_num
-
-                            updated_index = pos_label[:-4] + str(9999 - (segment_length - counter))
-                            proteins[pcid][ps][updated_index] = proteins[pcid][ps].pop(pos_label)
-                            pos_label = updated_index
-                            pos_num_after += 1
-                        if pos_label not in self.segments[ps]:
-                            self.segments[ps].append(pos_label)
-                        pos_num += 1
+            # fetch the residues of each protein/segment combination, from the block cache where possible
+            proteins = self.load_segment_blocks()
 
             # individually selected residues (Custom segment)
             for segment in self.segments:
                 if segment == self.custom_segment_label or self.use_residue_groups:
-                    for r in crs[segment]:
-                        ps = segment
-                        pcid = r.protein_conformation.protein.entry_name + "-" + r.protein_conformation.state.slug
-                        if pcid not in proteins:
-                            proteins[pcid] = {}
-                        if ps not in proteins[pcid]:
-                            proteins[pcid][ps] = {}
-                        proteins[pcid][ps][r.generic_number.label] = r
+                    crs = Residue.objects.filter(generic_number__label__in=self.segments[segment],
+                                                 protein_conformation__in=self.proteins)
+                    for pconf_id, ps, r in self.fetch_aligned_residues(crs):
+                        if pconf_id not in proteins:
+                            proteins[pconf_id] = {}
+                        if segment not in proteins[pconf_id]:
+                            proteins[pconf_id][segment] = {}
+                        proteins[pconf_id][segment][r.generic_number] = r
 
             # remove split segments from segment list and order segment positions
             for segment, positions in self.segments.items():
@@ -549,6 +561,7 @@ class Alignment:
                     self.segments[segment] = sorted_segment
 
             self.unique_proteins = list(set(self.proteins))
+            display_generic_number_ids = OrderedDict()
             for pc in self.unique_proteins:
                 row = OrderedDict()
                 pc.alignment_list = []
@@ -567,8 +580,7 @@ class Alignment:
                     for pos in positions:
                         try:
                             # find the residue record from the dict defined above
-                            pcid = pc.protein.entry_name + "-" + pc.state.slug
-                            r = proteins[pcid][segment][pos]
+                            r = proteins[pc.id][segment][pos]
 
                             # add position to the list of positions that are not empty
                             if pos not in self.positions:
@@ -578,8 +590,8 @@ class Alignment:
                             if r.display_generic_number:
                                 if pos not in self.generic_numbers[ns_slug][segment]:
                                     self.generic_numbers[ns_slug][segment][pos] = []
-                                if r.display_generic_number.label not in self.generic_numbers[ns_slug][segment][pos]:
-                                    self.generic_numbers[ns_slug][segment][pos].append(r.display_generic_number.label)
+                                if r.display_generic_number not in self.generic_numbers[ns_slug][segment][pos]:
+                                    self.generic_numbers[ns_slug][segment][pos].append(r.display_generic_number)
                             else:
                                 if pos not in self.generic_numbers[ns_slug][segment]:
                                     self.generic_numbers[ns_slug][segment][pos] = []
@@ -587,10 +599,10 @@ class Alignment:
                             # add display numbers for other numbering schemes of selected proteins
                             if (not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1):
                                 if r.generic_number:
-                                    for arn in r.alternative_generic_numbers.all():
+                                    for arn_scheme, arn_label in r.alternative_generic_numbers:
                                         for ns in self.numbering_schemes:
-                                            if (arn.scheme.slug == ns[0] and arn.scheme.slug != ns_slug):
-                                                self.generic_numbers[arn.scheme.slug][segment][pos].append(arn.label)
+                                            if (arn_scheme == ns[0] and arn_scheme != ns_slug):
+                                                self.generic_numbers[arn_scheme][segment][pos].append(arn_label)
                                                 break
                                 else:
                                     for ns in self.numbering_schemes:
@@ -602,13 +614,13 @@ class Alignment:
                                 # s.append([pos, r.display_generic_number.label, r.amino_acid,
                                 #   r.display_generic_number.scheme.short_name, r.sequence_number])
 
-                                s.append([pos, r.display_generic_number.label, r.amino_acid,
-                                          r.display_generic_number.scheme.short_name, r.sequence_number, r.generic_number.label])
+                                s.append([pos, r.display_generic_number, r.amino_acid,
+                                          r.display_scheme, r.sequence_number, r.generic_number])
 
 
-                                # update generic residue object dict
-                                if pos not in self.generic_number_objs:
-                                    self.generic_number_objs[pos] = r.display_generic_number
+                                # update generic residue object dict (objects are fetched in bulk below)
+                                if pos not in display_generic_number_ids:
+                                    display_generic_number_ids[pos] = r.display_generic_number_id
                             else:
                                 s.append([pos, "", r.amino_acid, "", r.sequence_number])
 
@@ -643,6 +655,13 @@ class Alignment:
                 pc.alignment = row
             #                pc.alignment_list = row_list # FIXME redundant, remove when dependecies are removed
 
+            # generic residue objects of the display generic numbers
+            display_generic_numbers = ResidueGenericNumber.objects.filter(
+                pk__in=set(display_generic_number_ids.values())).select_related('scheme').in_bulk()
+            for pos, gn_id in display_generic_number_ids.items():
+                if pos not in self.generic_number_objs and gn_id in display_generic_numbers:
+                    self.generic_number_objs[pos] = display_generic_numbers[gn_id]
+
             self.sort_generic_numbers()
             self.merge_generic_numbers()
             self.clear_empty_positions()
@@ -803,7 +822,11 @@ class Alignment:
     def calculate_statistics(self, ignore={}):
         """Calculate consensus sequence and amino acid and feature frequency"""
 
-        if not self.stats_done:
+        if not self.stats_done and self.use_matrix_backend:
+            # the matrix is only kept by the statistics views, not on the alignment
+            AlignmentMatrix.from_alignment(self).calculate_statistics(self, ignore)
+            self.stats_done = True
+        elif not self.stats_done:
             feature_count = OrderedDict()
             most_freq_aa = OrderedDict()
             amino_acids = OrderedDict([(a, 0) for a in AMINO_ACIDS]) # from common.definitions
@@ -1051,6 +1074,40 @@ class Alignment:
 
     def calculate_similarity(self, normalized=False):
         """Calculate the sequence identity/similarity of every selected protein compared to a selected reference"""
+        if self.use_matrix_backend:
+            self.calculate_similarity_batched(normalized)
+        else:
+            self.calculate_similarity_pairwise(normalized)
+
+        # order protein list by similarity score
+        ref = self.proteins.pop(0)
+        order_by_value = int(getattr(self.proteins[0], self.order_by))
+        if order_by_value:
+            self.proteins.sort(key=lambda x: getattr(x, self.order_by), reverse=True)
+        self.proteins.insert(0, ref)
+
+    def calculate_similarity_batched(self, normalized=False):
+        """Calculate identity/similarity to the reference for all proteins at once with the BLOSUM62 array kernel"""
+        similarity = SequenceSimilarity.from_alignment(self.proteins, self.gaps)
+        if normalized:
+            identities, similarities, similarity_scores, totals = similarity.normalized_one_vs_many(0)
+
+            # columns where the reference is gapped are removed from all pairwise alignments
+            if len(self.proteins) > 1:
+                for column, reference_gap in zip(similarity.columns, similarity.gaps[0]):
+                    if reference_gap and column[1] not in self.residues_to_delete:
+                        self.residues_to_delete.append(column[1])
+        else:
+            identities, similarities, similarity_scores, totals = similarity.one_vs_many(0)
+
+        # skip the first row, as it is the reference
+        for i in range(1, len(self.proteins)):
+            self.proteins[i].identity = format_percentage(identities[i], totals[i])
+            self.proteins[i].similarity = format_percentage(similarities[i], totals[i])
+            self.proteins[i].similarity_score = int(similarity_scores[i])
+
+    def calculate_similarity_pairwise(self, normalized=False):
+        """Calculate identity/similarity to the reference one protein pair at a time"""
         for i, protein in enumerate(self.proteins):
             # skip the first row, as it is the reference
             if i == 0:
@@ -1086,13 +1143,6 @@ class Alignment:
                 self.proteins[i].similarity_score = similarity_score
                 i+=1
 
-        # order protein list by similarity score
-        ref = self.proteins.pop(0)
-        order_by_value = int(getattr(self.proteins[0], self.order_by))
-        if order_by_value:
-            self.proteins.sort(key=lambda x: getattr(x, self.order_by), reverse=True)
-        self.proteins.insert(0, ref)
-
     def calculate_similarity_matrix(self):
         """Calculate a matrix of sequence identity/similarity for every selected protein"""
 
@@ -1103,6 +1153,11 @@ class Alignment:
             protein_name = "[" + protein.protein.species.common_name + "] " + protein.protein.name
             self.similarity_matrix[protein_key] = {'name': protein_name, 'values': [None] * len(self.proteins)}
 
+        # all-vs-all comparison in one batch
+        if self.use_matrix_backend:
+            identities, similarities, similarity_scores, totals = SequenceSimilarity.from_alignment(
+                self.proteins, self.gaps).all_vs_all()
+
         # similarity comparisons
         for i, protein in enumerate(self.proteins):
             protein_key = protein.protein.entry_name
@@ -1110,7 +1165,12 @@ class Alignment:
 
             for k in range(i+1, len(self.proteins)):
                 # calculate identity, similarity and similarity score to the reference
-                calc_values = self.pairwise_similarity(self.proteins[i], self.proteins[k])
+                if self.use_matrix_backend:
+                    calc_values = (format_percentage(identities[i, k], totals[i, k]),
+                                   format_percentage(similarities[i, k], totals[i, k]),
+                                   int(similarity_scores[i, k]))
+                else:
+                    calc_values = self.pairwise_similarity(self.proteins[i], self.proteins[k])
 
                 # Identity
                 value = calc_values[1].strip()
@@ -0,0 +1,308 @@
+"""
+A NumPy backed representation of a protein sequence alignment.
+
+The alignment is encoded as a protein x column matrix of amino acid codes (int8) and all statistics used by
+common.alignment.Alignment are calculated with array reductions instead of nested dictionaries. The residue rows of
+the alignment stay the source for display, the matrix only lives as long as the lazy statistics views using it and
+these are pickled (cached) as the plain dictionaries they stand for.
+"""
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import numpy as np
+
+from common.definitions import (AA_ZSCALES, AMINO_ACID_GROUP_NAMES, AMINO_ACID_GROUP_PROPERTIES,
+                                AMINO_ACID_GROUPS, AMINO_ACIDS, ZSCALES)
+from residue.models import Residue
+
+
+# amino acid codes are stored as indices into AMINO_ACID_CODES, residues that are not counted (unknown amino acid
+# type, ignored positions, missing columns) are stored as SKIP_CODE
+AMINO_ACID_CODES = list(AMINO_ACIDS.keys())
+AMINO_ACID_INDEX = dict([(aa, i) for i, aa in enumerate(AMINO_ACID_CODES)])
+GAP_CODE = AMINO_ACID_INDEX['-']
+SKIP_CODE = -1
+
+# amino acid (rows) membership of the property groups (columns)
+FEATURE_KEYS = list(AMINO_ACID_GROUPS.keys())
+FEATURE_MEMBERSHIP = np.array(
+    [[aa in members for members in AMINO_ACID_GROUPS.values()] for aa in AMINO_ACID_CODES],
+    dtype=np.int64
+)
+
+# Z-scale values per amino acid code, only amino acids with Z-scales are taken into account
+ZSCALE_CODES = np.array([AMINO_ACID_INDEX[aa] for aa in AMINO_ACID_CODES if aa in AA_ZSCALES and aa != '-'])
+ZSCALE_VALUES = np.array([AA_ZSCALES[AMINO_ACID_CODES[code]] for code in ZSCALE_CODES])
+
+
+def frequency_interval(frequency):
+    """The intervals are defined as 0-10, where 0 is 0-9, 1 is 10-19 etc. Used for colors."""
+    return str(frequency // 10)
+
+
+class AlignmentMatrix:
+    """Protein x generic number column matrix of amino acid codes"""
+    def __init__(self, entry_names, segments, columns, codes):
+        # row labels (protein entry names)
+        self.entry_names = entry_names
+
+        # column labels, a list of (segment slug, position label) tuples
+        self.columns = columns
+        self.column_index = dict([(column, i) for i, column in enumerate(columns)])
+
+        # protein x column matrix
+        self.codes = codes
+
+        # column indices per segment, in alignment order
+        self.segment_columns = OrderedDict([(segment, []) for segment in segments])
+        for i, (segment, pos) in enumerate(columns):
+            if segment not in self.segment_columns:
+                self.segment_columns[segment] = []
+            self.segment_columns[segment].append(i)
+
+    def __len__(self):
+        return len(self.entry_names)
+
+    @classmethod
+    def from_alignment(cls, alignment):
+        """Encode the rows of a built common.alignment.Alignment"""
+        proteins = alignment.unique_proteins
+
+        # columns are collected in the order they appear in the rows (segments ordered by the first protein)
+        columns = []
+        seen = set()
+        for pc in proteins:
+            for segment, s in pc.alignment.items():
+                for p in s:
+                    if (segment, p[0]) not in seen:
+                        seen.add((segment, p[0]))
+                        columns.append((segment, p[0]))
+        column_index = dict([(column, i) for i, column in enumerate(columns)])
+
+        codes = np.full((len(proteins), len(columns)), SKIP_CODE, dtype=np.int8)
+        for i, pc in enumerate(proteins):
+            for segment, s in pc.alignment.items():
+                for p in s:
+                    j = column_index[(segment, p[0])]
+                    amino_acid = p[2]
+                    if amino_acid in alignment.gaps:
+                        codes[i, j] = GAP_CODE
+                    else:
+                        # unknown amino acid types ('X') are not counted
+                        codes[i, j] = AMINO_ACID_INDEX.get(amino_acid, SKIP_CODE)
+
+        entry_names = [pc.protein.entry_name for pc in proteins]
+        segments = list(proteins[0].alignment) if proteins else []
+        return cls(entry_names, segments, columns, codes)
+
+    def counted_codes(self, ignore={}):
+        """Return the code matrix where ignored residues are masked out"""
+        if not ignore:
+            return self.codes
+
+        codes = self.codes.copy()
+        # gaps are not counted when positions are ignored
+        codes[codes == GAP_CODE] = SKIP_CODE
+
+        row_index = dict([(entry_name, i) for i, entry_name in enumerate(self.entry_names)])
+        for j, (segment, pos) in enumerate(self.columns):
+            for entry_name in ignore.get(pos, []):
+                if entry_name in row_index:
+                    codes[row_index[entry_name], j] = SKIP_CODE
+        return codes
+
+    def count_amino_acids(self, codes):
+        """Count amino acid codes per column, returns a column x amino acid matrix"""
+        num_codes = len(AMINO_ACID_CODES)
+        counted = codes != SKIP_CODE
+        column_ids = np.broadcast_to(np.arange(codes.shape[1]), codes.shape)
+        flat_index = column_ids[counted] * num_codes + codes[counted].astype(np.int64)
+        return np.bincount(flat_index, minlength=codes.shape[1] * num_codes).reshape(codes.shape[1], num_codes)
+
+    def calculate_statistics(self, alignment, ignore={}):
+        """Populate the statistics of an Alignment (consensus, amino acid and feature frequency, Z-scales)"""
+        num_proteins = len(alignment.unique_proteins)
+        codes = self.counted_codes(ignore)
+        self.aa_counts = self.count_amino_acids(codes)
+        self.feature_counts = self.aa_counts.dot(FEATURE_MEMBERSHIP)
+
+        # columns with at least one counted residue, both in alignment order and sorted by position label
+        counted_columns = self.aa_counts.sum(axis=1) > 0
+        self.counted_segment_columns = OrderedDict()
+        self.sorted_segment_columns = OrderedDict()
+        for segment, column_ids in self.segment_columns.items():
+            column_ids = [j for j in column_ids if counted_columns[j]]
+            self.counted_segment_columns[segment] = column_ids
+            self.sorted_segment_columns[segment] = sorted(column_ids, key=lambda j: self.columns[j][1])
+
+        alignment.amino_acids = list(AMINO_ACIDS.keys())
+        alignment.aa_count = AminoAcidCountView(self)
+        alignment.aa_count_with_protein = AminoAcidProteinView(self, codes)
+        alignment.features_combo = [(x, y['display_name_short'], y['length']) for x,y in zip(list(AMINO_ACID_GROUP_NAMES.values()), list(AMINO_ACID_GROUP_PROPERTIES.values()))]
+        alignment.features = list(AMINO_ACID_GROUP_NAMES.values())
+
+        # frequencies in percent (rounded as the builtin round, i.e. half to even)
+        aa_frequency = np.rint(self.aa_counts / max(num_proteins, 1) * 100).astype(int)
+        feature_frequency = np.rint(self.feature_counts / max(num_proteins, 1) * 100).astype(int)
+
+        # consensus sequence, ties are resolved by amino acid order
+        max_counts = self.aa_counts.max(axis=1, initial=0)
+        max_frequency = np.rint(max_counts / max(num_proteins, 1) * 100).astype(int)
+        is_max = (self.aa_counts == max_counts[:, None]) & (self.aa_counts > 0)
+        sequence_counter = 1
+        for segment, column_ids in self.sorted_segment_columns.items():
+            alignment.consensus[segment] = OrderedDict()
+            alignment.forced_consensus[segment] = OrderedDict()
+            for j in column_ids:
+                pos = self.columns[j][1]
+                most_freq_aa = [AMINO_ACID_CODES[code] for code in np.flatnonzero(is_max[j])]
+                frequency = int(max_frequency[j])
+                cons_interval = frequency_interval(frequency)
+
+                # forced consensus sequence uses the first residue to break ties
+                alignment.forced_consensus[segment][pos] = most_freq_aa[0]
+
+                # consensus sequence displays + in tie situations
+                if len(most_freq_aa) == 1:
+                    alignment.consensus[segment][pos] = [most_freq_aa[0], cons_interval, frequency, ""]
+                elif ignore:
+                    alignment.consensus[segment][pos] = [most_freq_aa[0], cons_interval, frequency, ", ".join(most_freq_aa)]
+                else:
+                    alignment.consensus[segment][pos] = ['+', cons_interval, frequency, ", ".join(most_freq_aa)]
+
+                # create a residue object full consensus
+                res = Residue()
+                res.sequence_number = sequence_counter
+                if pos in alignment.generic_number_objs:
+                    res.display_generic_number = alignment.generic_number_objs[pos]
+                res.family_generic_number = pos
+                res.segment_slug = segment
+                res.amino_acid = most_freq_aa[0]
+                res.frequency = frequency
+                alignment.full_consensus.append(res)
+                sequence_counter += 1
+
+        # amino acid and feature frequency, [amino acid/feature][segment][position] = [frequency, interval]
+        alignment.amino_acid_stats = self.frequency_table(aa_frequency)
+        alignment.feature_stats = self.frequency_table(feature_frequency)
+
+        # process feature frequency
+        feats = OrderedDict()
+        alignment.feat_consensus = OrderedDict([(x, []) for x in alignment.segments])
+        counted_segments = list(self.sorted_segment_columns.values())
+        group_properties = list(AMINO_ACID_GROUP_PROPERTIES.values())
+        group_names = list(AMINO_ACID_GROUP_NAMES.values())
+        for sid, segment in enumerate(alignment.segments):
+            column_ids = counted_segments[sid] if sid < len(counted_segments) else []
+            feats[segment] = feature_frequency[column_ids].T.reshape(len(FEATURE_KEYS), len(column_ids))
+            feat_cons_tmp = feats[segment].argmax(axis=0)
+            feat_cons_tmp = alignment._assign_preferred_features(feat_cons_tmp, segment, feats)
+            for col, pos in enumerate(list(feat_cons_tmp)):
+                alignment.feat_consensus[segment].append([
+                    group_properties[pos]['display_name_short'],
+                    group_names[pos],
+                    feats[segment][pos][col],
+                    int(feats[segment][pos][col]/20)+5,
+                    group_properties[pos]['length'],
+                    FEATURE_KEYS[pos]
+                ])
+
+        alignment.zscales = self.calculate_zscales()
+
+    def frequency_table(self, frequency):
+        """Convert a column x item frequency matrix into the nested lists used by the alignment templates"""
+        table = []
+        for item in range(frequency.shape[1]):
+            item_stats = []
+            for segment, column_ids in self.sorted_segment_columns.items():
+                item_stats.append([[str(f), frequency_interval(f)] for f in frequency[column_ids, item].tolist()])
+            table.append(item_stats)
+        return table
+
+    def calculate_zscales(self):
+        """Calculate the Z-scales distribution (mean, sample standard deviation, count) per position"""
+        weights = self.aa_counts[:, ZSCALE_CODES]
+        counts = weights.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = weights.dot(ZSCALE_VALUES) / counts[:, None]
+            deviations = ZSCALE_VALUES[None, :, :] - means[:, None, :]
+            stds = (weights[:, :, None] * deviations ** 2).sum(axis=1) / (counts[:, None] - 1)
+            stds = np.sqrt(stds)
+        stds[counts < 2] = np.nan
+
+        zscales = OrderedDict([(zscale, OrderedDict()) for zscale in ZSCALES])
+        for segment, column_ids in self.counted_segment_columns.items():
+            for zscale in ZSCALES:
+                zscales[zscale][segment] = OrderedDict()
+            for j in column_ids:
+                pos = self.columns[j][1]
+                z_count = int(counts[j])
+                for key, zscale in enumerate(ZSCALES):
+                    if z_count == 1:
+                        z_value = ZSCALE_VALUES[weights[j] > 0][0][key].item()
+                        display = str(round(z_value, 2)) + " ± " + str(0) + " (1)"
+                        zscales[zscale][segment][pos] = [z_value, 0, 1, display]
+                    else:
+                        z_mean = means[j, key]
+                        z_std = stds[j, key]
+                        display = str(round(z_mean,2)) + " ± " + str(round(z_std, 2)) + " (" + str(z_count) + ")"
+                        zscales[zscale][segment][pos] = [z_mean, z_std, z_count, display]
+        return zscales
+
+
+class AminoAcidCountView(Mapping):
+    """Lazy aa_count adapter: segment -> position -> amino acid -> count"""
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self._segments = {}
+
+    def __getitem__(self, segment):
+        if segment not in self._segments:
+            column_ids = self.matrix.counted_segment_columns[segment]
+            positions = OrderedDict()
+            for j in column_ids:
+                positions[self.matrix.columns[j][1]] = OrderedDict(zip(AMINO_ACID_CODES, self.matrix.aa_counts[j].tolist()))
+            self._segments[segment] = positions
+        return self._segments[segment]
+
+    def __iter__(self):
+        return iter(self.matrix.counted_segment_columns)
+
+    def __len__(self):
+        return len(self.matrix.counted_segment_columns)
+
+    def __reduce__(self):
+        # pickled (cached) as the plain dictionary, without the matrix
+        return (OrderedDict, ([(segment, self[segment]) for segment in self],))
+
+
+class AminoAcidProteinView(Mapping):
+    """Lazy aa_count_with_protein adapter: position -> amino acid -> set of protein entry names"""
+    def __init__(self, matrix, codes):
+        self.matrix = matrix
+        self.codes = codes
+        self.position_columns = OrderedDict()
+        for segment, column_ids in matrix.counted_segment_columns.items():
+            for j in column_ids:
+                self.position_columns.setdefault(matrix.columns[j][1], []).append(j)
+        self._positions = {}
+
+    def __getitem__(self, pos):
+        if pos not in self._positions:
+            proteins = {}
+            for j in self.position_columns[pos]:
+                for i, code in enumerate(self.codes[:, j].tolist()):
+                    if code != SKIP_CODE:
+                        proteins.setdefault(AMINO_ACID_CODES[code], set()).add(self.matrix.entry_names[i])
+            self._positions[pos] = proteins
+        return self._positions[pos]
+
+    def __iter__(self):
+        return iter(self.position_columns)
+
+    def __len__(self):
+        return len(self.position_columns)
+
+    def __reduce__(self):
+        # pickled (cached) as the plain dictionary, without the matrix
+        return (OrderedDict, ([(pos, self[pos]) for pos in self],))
@@ -0,0 +1,154 @@
+"""
+Batched sequence identity/similarity calculations for aligned sequences.
+
+Sequences are encoded as integer arrays and scored against a gap-aware BLOSUM62 matrix, so that one-vs-many and
+all-vs-all comparisons are done with NumPy array operations instead of per position dictionary lookups.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from Bio.SubsMat import MatrixInfo
+
+
+# amino acids in the substitution matrix, the gap is appended as the last index and scores 0 against everything
+SCORE_ALPHABET = 'ARNDCQEGHILKMFPSTWYVBZX'
+GAP_INDEX = len(SCORE_ALPHABET)
+UNKNOWN_INDEX = SCORE_ALPHABET.index('X')
+
+
+def build_score_matrix(matrix=MatrixInfo.blosum62):
+    """Create a (alphabet + gap) x (alphabet + gap) score matrix from a Biopython substitution matrix dict"""
+    scores = np.zeros((GAP_INDEX + 1, GAP_INDEX + 1), dtype=np.int64)
+    for i, aa1 in enumerate(SCORE_ALPHABET):
+        for j, aa2 in enumerate(SCORE_ALPHABET):
+            if (aa1, aa2) in matrix:
+                scores[i, j] = matrix[(aa1, aa2)]
+            else:
+                scores[i, j] = matrix[(aa2, aa1)]
+    return scores
+
+BLOSUM62 = build_score_matrix()
+
+
+def format_percentage(count, total):
+    """Format a percentage as in Alignment.pairwise_similarity, -1 when there are no aligned residues"""
+    if total:
+        return "{:10.0f}".format(count / total * 100)
+    else:
+        return "{:10.0f}".format(-1)
+
+
+class SequenceSimilarity:
+    """Identity, similarity and similarity score between aligned sequences of equal length"""
+    def __init__(self, sequences, gaps=['-', '_'], score_matrix=BLOSUM62, column_block=128):
+        # raw residue characters are used for identity, so that e.g. 'X' is only identical to 'X'
+        self.residues = np.array([np.frombuffer(''.join(s).encode('ascii', 'replace'), dtype=np.uint8)
+                                  for s in sequences]).reshape(len(sequences), -1)
+        self.gaps = np.isin(self.residues, [ord(g) for g in gaps])
+
+        # substitution matrix indices, letters not in the matrix are scored as X
+        lookup = np.full(256, UNKNOWN_INDEX, dtype=np.intp)
+        for i, aa in enumerate(SCORE_ALPHABET):
+            lookup[ord(aa)] = i
+        self.codes = lookup[self.residues]
+        self.codes[self.gaps] = GAP_INDEX
+
+        self.score_matrix = score_matrix
+        self.positive_matrix = (score_matrix > 0).astype(np.float64)
+        self.positive_scores = np.where(score_matrix > 0, score_matrix, 0).astype(np.float64)
+
+        # number of columns processed at once in all-vs-all comparisons (bounds the one-hot matrices)
+        self.column_block = column_block
+
+    def __len__(self):
+        return self.residues.shape[0]
+
+    @classmethod
+    def from_alignment(cls, proteins, gaps=['-', '_']):
+        """Encode the alignment rows (ProteinConformation.alignment) of a list of proteins"""
+        # columns in the order of the first protein, positions missing in a row are treated as gaps
+        columns = OrderedDict()
+        for pc in proteins:
+            for segment, s in pc.alignment.items():
+                for p in s:
+                    if (segment, p[0]) not in columns:
+                        columns[(segment, p[0])] = len(columns)
+
+        sequences = []
+        for pc in proteins:
+            row = [gaps[0]] * len(columns)
+            for segment, s in pc.alignment.items():
+                for p in s:
+                    row[columns[(segment, p[0])]] = p[2]
+            sequences.append(row)
+
+        similarity = cls(sequences, gaps)
+        similarity.columns = list(columns)
+        return similarity
+
+    def one_vs_many(self, reference=0):
+        """Compare a reference row with all rows, returns arrays of identical residues, similar residues
+        (positive score), summed positive scores and compared columns (where not both residues are gaps)"""
+        ref_gaps = self.gaps[reference]
+        compared = ~(self.gaps & ref_gaps)
+        aligned = ~self.gaps & ~ref_gaps
+
+        identities = ((self.residues == self.residues[reference]) & compared).sum(axis=1)
+        scores = self.score_matrix[self.codes, self.codes[reference]]
+        positive = (scores > 0) & aligned
+        similarities = positive.sum(axis=1)
+        similarity_scores = np.where(positive, scores, 0).sum(axis=1)
+        totals = compared.sum(axis=1)
+
+        return identities, similarities, similarity_scores, totals
+
+    def normalized_one_vs_many(self, reference=0):
+        """Compare a reference row with all rows, only taking columns into account where neither sequence is gapped.
+        Similarity scores include negative scores. Returns arrays of identical residues, similar residues, summed scores
+        and compared columns."""
+        aligned = ~self.gaps & ~self.gaps[reference]
+
+        identities = ((self.residues == self.residues[reference]) & aligned).sum(axis=1)
+        scores = np.where(aligned, self.score_matrix[self.codes, self.codes[reference]], 0)
+        similarities = (scores > 0).sum(axis=1)
+        similarity_scores = scores.sum(axis=1)
+        totals = aligned.sum(axis=1)
+
+        return identities, similarities, similarity_scores, totals
+
+    def all_vs_all(self):
+        """Compare all rows with each other, returns square matrices as in one_vs_many"""
+        num_sequences, num_columns = self.residues.shape
+        identities = np.zeros((num_sequences, num_sequences))
+        similarities = np.zeros((num_sequences, num_sequences))
+        similarity_scores = np.zeros((num_sequences, num_sequences))
+
+        # columns where both rows are gaps are not compared
+        gaps = self.gaps.astype(np.float64)
+        totals = num_columns - gaps.dot(gaps.T)
+
+        num_codes = GAP_INDEX + 1
+        residue_values = np.unique(self.residues[~self.gaps])
+        residue_index = np.searchsorted(residue_values, self.residues)
+        for start in range(0, num_columns, self.column_block):
+            block = slice(start, start + self.column_block)
+            width = min(num_columns, start + self.column_block) - start
+
+            # identical (non-gap) residues
+            one_hot = np.zeros((num_sequences, width, len(residue_values)))
+            rows, cols = np.nonzero(~self.gaps[:, block])
+            one_hot[rows, cols, residue_index[:, block][rows, cols]] = 1
+            one_hot = one_hot.reshape(num_sequences, -1)
+            identities += one_hot.dot(one_hot.T)
+
+            # similar residues and their scores, gap rows/columns of the score matrices are zero
+            one_hot = np.zeros((num_sequences, width, num_codes))
+            rows, cols = np.indices((num_sequences, width))
+            one_hot[rows, cols, self.codes[:, block]] = 1
+            flat_one_hot = one_hot.reshape(num_sequences, -1)
+            similarities += one_hot.dot(self.positive_matrix).reshape(num_sequences, -1).dot(flat_one_hot.T)
+            similarity_scores += one_hot.dot(self.positive_scores).reshape(num_sequences, -1).dot(flat_one_hot.T)
+
+        return (np.rint(identities).astype(int), np.rint(similarities).astype(int),
+                np.rint(similarity_scores).astype(int), np.rint(totals).astype(int))
@@ -0,0 +1,512 @@
+"""
+Project cache backend.
+
+TieredCache keeps recently used values in a bounded in-process LRU tier and all values in a sharded on-disk tier.
+Large values are compressed on disk, every shard is kept below its share of MAX_SIZE by evicting the least recently
+used files, and all entries live in a namespace of the current release so a new release never sees old entries.
+Hits, misses and sizes are counted per key prefix and flushed as JSON lines to settings.CACHE_STATS_LOG.
+"""
+from django.conf import settings
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+from common.middleware.stats import record_cache_access
+
+from collections import OrderedDict
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+
+# magic, flags, expiry (0 = never), length of the key prefix
+HEADER = struct.Struct('<4sBdH')
+EXPIRY_OFFSET = 5
+MAGIC = b'PWC1'
+FLAG_COMPRESSED = 1
+
+SHARDS = 256
+RELEASE_FILE = 'RELEASE'
+RELEASE_CHECK_INTERVAL = 60 # seconds
+TOUCH_INTERVAL = 60*60 # seconds between updates of the access time of a file on disk hits
+MAX_PREFIXES = 500
+
+prefix_separators = re.compile(r'[_\-|:&,. ]')
+hashlike = re.compile(r'^[0-9a-fA-F]{16,}$')
+
+
+def key_prefix(key):
+    """Statistics group of a key: the part before the first separator, hashed keys are grouped together"""
+    prefix = prefix_separators.split(str(key), 1)[0]
+    if not prefix or hashlike.match(prefix):
+        return '(hash)'
+    return prefix[:50]
+
+
+class MemoryTier():
+    """Bounded LRU of pickled values, shared by the cache instances (one per thread) of a location"""
+    def __init__(self, max_size, max_entries):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.max_size = max_size
+        self.max_entries = max_entries
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, expiry, signature, data):
+        if len(data) > self.max_size // 8:
+            self.delete(key)
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+            self.entries[key] = (expiry, signature, data)
+            self.size += len(data)
+            while self.size > self.max_size or len(self.entries) > self.max_entries:
+                evicted = self.entries.popitem(last=False)[1]
+                self.size -= len(evicted[2])
+
+    def delete(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class CacheStats():
+    """Per key prefix counters of one cache, flushed periodically as JSON lines"""
+    counters = ['memory_hits', 'disk_hits', 'misses', 'sets', 'set_bytes', 'read_bytes']
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.lock = threading.Lock()
+        self.prefixes = {}
+        self.last_flush = time.time()
+
+    def add(self, prefix, counter, amount=1):
+        with self.lock:
+            if prefix not in self.prefixes:
+                if len(self.prefixes) >= MAX_PREFIXES:
+                    prefix = '(other)'
+                self.prefixes.setdefault(prefix, dict.fromkeys(self.counters, 0))
+            self.prefixes[prefix][counter] += amount
+            flush = time.time() - self.last_flush > getattr(settings, 'STATS_FLUSH_INTERVAL', 60)
+
+        if flush:
+            self.flush()
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            prefixes = self.prefixes
+            if reset:
+                self.prefixes = {}
+                self.last_flush = time.time()
+            else:
+                prefixes = {p: dict(c) for p, c in prefixes.items()}
+        return prefixes
+
+    def flush(self, background=True):
+        prefixes = self.snapshot(reset=True)
+        if not prefixes:
+            return
+        timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        lines = []
+        for prefix, counters in prefixes.items():
+            record = OrderedDict([('time', timestamp), ('pid', os.getpid()), ('cache', self.alias), ('prefix', prefix)])
+            record.update(counters)
+            lines.append(json.dumps(record))
+
+        if background:
+            threading.Thread(target=self.write, args=(lines,), daemon=True).start()
+        else:
+            self.write(lines)
+
+    @staticmethod
+    def write(lines):
+        try:
+            with open(cache_stats_log_path(), "a") as log:
+                log.write('\n'.join(lines) + '\n')
+        except OSError:
+            pass
+
+
+def cache_stats_log_path():
+    return getattr(settings, 'CACHE_STATS_LOG', os.path.join(settings.BASE_DIR, "logs/cache_stats.jsonl"))
+
+
+def read_cache_stats_log(since=None, path=None):
+    """Merge the flushed counters per (cache, prefix), optionally only those written since a datetime"""
+    totals = {}
+    path = path or cache_stats_log_path()
+    if not os.path.isfile(path):
+        return totals
+    since = since.strftime("%Y-%m-%d %H:%M:%S") if since else None
+    with open(path) as log:
+        for line in log:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if since and record['time'] < since:
+                continue
+            counters = totals.setdefault((record['cache'], record['prefix']), dict.fromkeys(CacheStats.counters, 0))
+            for c in CacheStats.counters:
+                counters[c] += record.get(c, 0)
+    return totals
+
+
+# shared between the cache instances of all threads
+_memory_tiers = {}
+_stats = {}
+_shared_lock = threading.Lock()
+
+
+class TieredCache(BaseCache):
+    """
+    In-process LRU tier in front of a sharded on-disk tier.
+
+    OPTIONS:
+        MAX_SIZE            bytes on disk (per release), least recently used files are evicted per shard (None
+                            keeps all entries until they expire)
+        MEMORY_MAX_SIZE     bytes of pickled values kept in process (values over 1/8 of it only go to disk)
+        MEMORY_MAX_ENTRIES  number of values kept in process
+        COMPRESS_MIN_SIZE   pickled values from this size on are zlib compressed on disk
+        COMPRESS_LEVEL      zlib level of the compressed values
+        CULL_EVERY          sets to a shard after which the shard size is checked
+        RELEASE             namespace when no release has been set with set_release()
+    """
+    def __init__(self, location, params):
+        super(TieredCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self._dir = os.path.abspath(location)
+        max_size = options.get('MAX_SIZE', 1024**3)
+        self._max_size = None if max_size is None else int(max_size)
+        self._compress_min_size = int(options.get('COMPRESS_MIN_SIZE', 16*1024))
+        self._compress_level = int(options.get('COMPRESS_LEVEL', 3))
+        self._cull_every = int(options.get('CULL_EVERY', 20))
+        self._default_release = str(options.get('RELEASE', 'default'))
+        self._release = None
+        self._release_checked = 0
+        self._shard_sets = [0] * SHARDS
+
+        with _shared_lock:
+            if self._dir not in _memory_tiers:
+                _memory_tiers[self._dir] = MemoryTier(int(options.get('MEMORY_MAX_SIZE', 64*1024**2)),
+                                                      int(options.get('MEMORY_MAX_ENTRIES', 10000)))
+                _stats[self._dir] = CacheStats(os.path.basename(self._dir))
+        self._memory = _memory_tiers[self._dir]
+        self.stats = _stats[self._dir]
+
+    # release namespace
+
+    @property
+    def release(self):
+        now = time.time()
+        if self._release is None or now - self._release_checked > RELEASE_CHECK_INTERVAL:
+            try:
+                with open(os.path.join(self._dir, RELEASE_FILE)) as f:
+                    release = f.read().strip() or self._default_release
+            except OSError:
+                release = self._default_release
+            if self._release is not None and release != self._release:
+                self._memory.clear()
+            self._release = release
+            self._release_checked = now
+        return self._release
+
+    def set_release(self, release):
+        """Switch all processes to the namespace of a new release and remove the namespaces before the previous one"""
+        release = re.sub(r'[^\w.\-]', '_', str(release))
+        previous = self.release
+        if release == previous:
+            return
+        os.makedirs(self._dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=self._dir, suffix='.tmp', delete=False) as f:
+            f.write(release)
+        os.replace(f.name, os.path.join(self._dir, RELEASE_FILE))
+        self._release = release
+        self._release_checked = time.time()
+        self._memory.clear()
+
+        # processes that have not seen the new release yet keep using the previous namespace for a moment
+        for name in os.listdir(self._dir):
+            path = os.path.join(self._dir, name)
+            if name not in (release, previous) and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    # disk tier
+
+    def _key_to_file(self, key):
+        digest = hashlib.md5(key.encode()).hexdigest()
+        return os.path.join(self._dir, self.release, digest[:2], digest + '.cache')
+
+    @staticmethod
+    def _signature(stat):
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def _read_header(self, f):
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        magic, flags, expiry, prefix_length = HEADER.unpack(header)
+        if magic != MAGIC:
+            return None
+        prefix = f.read(prefix_length).decode('utf-8', 'replace')
+        return flags, expiry, prefix
+
+    def _read_file(self, fname):
+        """Expiry and pickled value of a file, None when missing, expired or unreadable"""
+        try:
+            with open(fname, 'rb') as f:
+                header = self._read_header(f)
+                if header is None:
+                    return None
+                flags, expiry, prefix = header
+                if expiry and expiry < time.time():
+                    f.close()
+                    self._delete_file(fname)
+                    return None
+                data = f.read()
+                stat = os.fstat(f.fileno())
+        except OSError:
+            return None
+        if flags & FLAG_COMPRESSED:
+            try:
+                data = zlib.decompress(data)
+            except zlib.error:
+                return None
+        if time.time() - stat.st_atime > TOUCH_INTERVAL:
+            try:
+                os.utime(fname, ns=(time.time_ns(), stat.st_mtime_ns))
+            except OSError:
+                pass
+        return expiry, self._signature(stat), data, stat.st_size
+
+    def _write_file(self, fname, expiry, prefix, data, replace=True):
+        """Write a value file, with replace=False only when there is no current file (None is returned otherwise)"""
+        flags = 0
+        if len(data) >= self._compress_min_size:
+            compressed = zlib.compress(data, self._compress_level)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= FLAG_COMPRESSED
+        prefix = prefix.encode('utf-8')[:1024]
+
+        shard_dir = os.path.dirname(fname)
+        os.makedirs(shard_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=shard_dir, suffix='.tmp', delete=False) as f:
+            f.write(HEADER.pack(MAGIC, flags, expiry or 0, len(prefix)))
+            f.write(prefix)
+            f.write(data)
+        if replace:
+            os.replace(f.name, fname)
+        else:
+            # linking fails when the file exists, so one process adds a key
+            try:
+                try:
+                    os.link(f.name, fname)
+                except FileExistsError:
+                    # an expired file is removed by _read_file and does not count
+                    if self._read_file(fname) is not None:
+                        return None
+                    os.link(f.name, fname)
+            except FileExistsError:
+                return None
+            finally:
+                os.remove(f.name)
+        stat = os.stat(fname)
+
+        shard = int(os.path.basename(shard_dir), 16)
+        self._shard_sets[shard] += 1
+        if self._shard_sets[shard] >= self._cull_every:
+            self._shard_sets[shard] = 0
+            self._cull_shard(shard_dir)
+        return self._signature(stat), stat.st_size
+
+    def _delete_file(self, fname):
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _cull_shard(self, shard_dir):
+        """Remove expired files of a shard, then the least recently used ones until the shard fits in its share"""
+        now = time.time()
+        files = []
+        size = 0
+        try:
+            entries = list(os.scandir(shard_dir))
+        except OSError:
+            return
+        for entry in entries:
+            if not entry.name.endswith('.cache'):
+                # temporary files left by interrupted writes
+                if entry.name.endswith('.tmp'):
+                    try:
+                        if now - entry.stat().st_mtime > 60*60:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass
+                continue
+            try:
+                stat = entry.stat()
+                with open(entry.path, 'rb') as f:
+                    header = self._read_header(f)
+            except OSError:
+                continue
+            if header is None or (header[1] and header[1] < now):
+                self._delete_file(entry.path)
+                continue
+            files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+            size += stat.st_size
+
+        if self._max_size is None:
+            return
+        limit = self._max_size // SHARDS
+        if size <= limit:
+            return
+        # evict down to 90% to avoid culling on every check
+        files.sort()
+        for accessed, file_size, path in files:
+            if size <= limit * 0.9:
+                break
+            if self._delete_file(path):
+                size -= file_size
+
+    # cache api
+
+    def get(self, key, default=None, version=None):
+        raw_key = key
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        prefix = key_prefix(raw_key)
+        fname = self._key_to_file(key)
+        memory_key = (self.release, key)
+
+        entry = self._memory.get(memory_key)
+        if entry is not None:
+            expiry, signature, data = entry
+            try:
+                # the file is replaced or removed when another process sets or deletes the key
+                current = self._signature(os.stat(fname))
+            except OSError:
+                current = None
+            if current == signature and not (expiry and expiry < time.time()):
+                self.stats.add(prefix, 'memory_hits')
+                record_cache_access(True)
+                return pickle.loads(data)
+            self._memory.delete(memory_key)
+
+        entry = self._read_file(fname)
+        if entry is None:
+            self.stats.add(prefix, 'misses')
+            record_cache_access(False)
+            return default
+        expiry, signature, data, size = entry
+        self._memory.set(memory_key, expiry, signature, data)
+        self.stats.add(prefix, 'disk_hits')
+        self.stats.add(prefix, 'read_bytes', size)
+        record_cache_access(True)
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        raw_key = key
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        prefix = key_prefix(raw_key)
+        expiry = self.get_backend_timeout(timeout)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        signature, size = self._write_file(self._key_to_file(key), expiry, prefix, data)
+        self._memory.set((self.release, key), expiry, signature, data)
+        self.stats.add(prefix, 'sets')
+        self.stats.add(prefix, 'set_bytes', size)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        raw_key = key
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        prefix = key_prefix(raw_key)
+        expiry = self.get_backend_timeout(timeout)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        written = self._write_file(self._key_to_file(key), expiry, prefix, data, replace=False)
+        if written is None:
+            return False
+        signature, size = written
+        self._memory.set((self.release, key), expiry, signature, data)
+        self.stats.add(prefix, 'sets')
+        self.stats.add(prefix, 'set_bytes', size)
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        fname = self._key_to_file(key)
+        if self._read_file(fname) is None:
+            return False
+        try:
+            with open(fname, 'r+b') as f:
+                f.seek(EXPIRY_OFFSET)
+                f.write(struct.pack('<d', self.get_backend_timeout(timeout) or 0))
+        except OSError:
+            return False
+        self._memory.delete((self.release, key))
+        return True
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._memory.delete((self.release, key))
+        return self._delete_file(self._key_to_file(key))
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self._read_file(self._key_to_file(key)) is not None
+
+    def clear(self):
+        """Remove all entries of the current release"""
+        self._memory.clear()
+        shutil.rmtree(os.path.join(self._dir, self.release), ignore_errors=True)
+
+    def disk_usage(self):
+        """Number of files and bytes on disk per key prefix in the current release (reads every file header)"""
+        usage = {}
+        namespace = os.path.join(self._dir, self.release)
+        if not os.path.isdir(namespace):
+            return usage
+        for shard in os.scandir(namespace):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith('.cache'):
+                    continue
+                try:
+                    size = entry.stat().st_size
+                    with open(entry.path, 'rb') as f:
+                        header = self._read_header(f)
+                except OSError:
+                    continue
+                prefix = header[2] if header else '(invalid)'
+                files, total = usage.get(prefix, (0, 0))
+                usage[prefix] = (files + 1, total + size)
+        return usage
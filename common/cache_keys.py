@@ -0,0 +1,232 @@
+"""
+Registry of cache keys of data derived from the database.
+
+Registered keys are namespaced by the generations of the datasets they depend on. Build commands bump the
+generation of the datasets they write (BaseBuild.execute, and build_all for commands without BaseBuild), so a rebuild
+of e.g. the interactions only invalidates the keys depending on them and the rest of the cache stays warm.
+Keys with a warm function are precomputed by the warm_cache command after a build.
+"""
+from django.conf import settings
+from django.core.cache import cache, caches, DEFAULT_CACHE_ALIAS
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from collections import OrderedDict
+from importlib import import_module
+import datetime
+import hashlib
+import logging
+import os
+import time
+
+
+logger = logging.getLogger('protwis')
+
+# datasets and the datasets they are derived from (a new generation of a dataset invalidates all dependents)
+DATASETS = OrderedDict([
+    ('proteins', []),
+    ('structures', ['proteins']),
+    ('signprot', ['proteins', 'structures']),
+    ('distances', ['structures']),
+    ('interactions', ['structures']),
+    ('ligands', ['proteins']),
+    ('mutations', ['proteins']),
+    ('constructs', ['proteins', 'structures']),
+    ('residue_matrix', ['proteins', 'structures']),
+    ('release', []),
+    ])
+
+# datasets written by the build commands
+BUILD_DATASETS = {
+    'build_common': ['proteins'],
+    'build_citations': ['proteins'],
+    'build_human_proteins': ['proteins'],
+    'build_blast_database': ['proteins'],
+    'build_other_proteins': ['proteins'],
+    'build_annotation': ['proteins'],
+    'build_links': ['proteins'],
+    'build_protein_sets': ['proteins'],
+    'build_residue_sets': ['proteins'],
+    'build_consensus_sequences': ['proteins'],
+    'build_dynamine_annotation': ['proteins'],
+    'build_dssp_annotation': ['proteins'],
+    'build_human_residues': ['proteins'],
+    'build_other_residues': ['proteins'],
+    'build_text': ['proteins'],
+    'build_g_proteins': ['proteins', 'signprot'],
+    'build_arrestins': ['proteins', 'signprot'],
+    'build_construct_proteins': ['constructs'],
+    'build_construct_data': ['constructs'],
+    'build_constructs': ['constructs'],
+    'update_construct_mutations': ['constructs'],
+    'build_structures': ['structures'],
+    'build_structure_extra_proteins': ['structures'],
+    'build_structure_model_rmsd': ['structures'],
+    'build_homology_models': ['structures'],
+    'build_complex_models': ['structures', 'signprot'],
+    'assign_structure_states': ['structures'],
+    'build_contact_representative': ['structures'],
+    'build_mammalian_representative': ['structures'],
+    'build_signprot_complex': ['signprot'],
+    'build_g_protein_structures': ['signprot'],
+    'build_signprot_interactions': ['signprot'],
+    'build_structure_angles': ['distances'],
+    'build_distance_representative': ['distances'],
+    'build_crystal_interactions': ['interactions'],
+    'build_complex_interactions': ['interactions'],
+    'build_all_interactions': ['interactions'],
+    'build_contact_fingerprints': ['interactions'],
+    'build_endogenous_ligands': ['ligands'],
+    'build_ligands_from_cache': ['ligands'],
+    'build_ligand_assays': ['ligands'],
+    'build_chembl_data': ['ligands'],
+    'build_drugs': ['ligands'],
+    'build_mutant_data': ['mutations'],
+    'build_mutational_landscape': ['mutations'],
+    'build_nhs': ['mutations'],
+    'build_release_notes': ['release'],
+    'build_residue_matrix': ['residue_matrix'],
+    }
+
+# seconds a process uses the generations it has read before reading them again
+GENERATION_CHECK_INTERVAL = 10
+
+# cache holding the generations, which must not be evicted (evicting one would invalidate its namespaces)
+GENERATIONS_CACHE_ALIAS = 'generations'
+
+_generations = {}
+_generations_read = 0
+
+
+def dependencies(datasets):
+    """The datasets and everything they are derived from"""
+    closure = set()
+    pending = list(datasets)
+    while pending:
+        dataset = pending.pop()
+        if dataset not in DATASETS:
+            raise KeyError('Unknown dataset {}'.format(dataset))
+        if dataset not in closure:
+            closure.add(dataset)
+            pending.extend(DATASETS[dataset])
+    return sorted(closure)
+
+
+def generation_key(dataset):
+    return 'dataset_generation_{}'.format(dataset)
+
+
+def generations_cache():
+    """The cache of the generations, the default cache when no generations cache is configured"""
+    if GENERATIONS_CACHE_ALIAS in settings.CACHES:
+        return caches[GENERATIONS_CACHE_ALIAS]
+    return cache
+
+
+def new_generation():
+    return '{}.{}'.format(datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f'), os.getpid())
+
+
+def get_generations():
+    """Current generation of every dataset, a dataset without one gets a new generation"""
+    global _generations, _generations_read
+    if time.time() - _generations_read > GENERATION_CHECK_INTERVAL:
+        store = generations_cache()
+        stored = store.get_many([generation_key(d) for d in DATASETS])
+        generations = {}
+        for dataset in DATASETS:
+            generation = stored.get(generation_key(dataset))
+            if generation is None:
+                # never expires, the first process to add it wins
+                store.add(generation_key(dataset), new_generation(), None)
+                generation = store.get(generation_key(dataset))
+            generations[dataset] = generation
+        _generations = generations
+        _generations_read = time.time()
+    return _generations
+
+
+def namespace(datasets):
+    """Short token that changes whenever one of the datasets (or a dataset they are derived from) is rebuilt"""
+    generations = get_generations()
+    token = '|'.join(['{}={}'.format(d, generations[d]) for d in dependencies(datasets)])
+    return hashlib.md5(token.encode('utf-8')).hexdigest()[:12]
+
+
+def bump_datasets(datasets):
+    """Start a new generation of the datasets, which invalidates every key depending on them"""
+    global _generations_read
+    for dataset in datasets:
+        if dataset not in DATASETS:
+            raise KeyError('Unknown dataset {}'.format(dataset))
+        generations_cache().set(generation_key(dataset), new_generation(), None)
+    if datasets:
+        logger.info('New cache generation of {}'.format(', '.join(datasets)))
+        if 'release' in datasets:
+            # token of get_data_release
+            cache.delete('data_release')
+    _generations_read = 0
+
+
+def bump_for_command(command_name):
+    """Bump the datasets written by a build command (module name of the command)"""
+    bump_datasets(BUILD_DATASETS.get(command_name, []))
+
+
+class CacheKey():
+    """A registered cache key, arguments are appended to the name and the namespace of the datasets to the end"""
+    def __init__(self, name, datasets, timeout=DEFAULT_TIMEOUT, alias=DEFAULT_CACHE_ALIAS, warm=None, warm_args=None):
+        self.name = name
+        self.datasets = list(datasets)
+        self.timeout = timeout
+        self.alias = alias
+        self.warm = warm
+        self.warm_args = warm_args or [()]
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, *args):
+        parts = '_'.join([str(a) for a in args])
+        if len(parts) > 150:
+            parts = hashlib.md5(parts.encode('utf-8')).hexdigest()
+        return '_'.join([p for p in (self.name, parts, namespace(self.datasets)) if p])
+
+    def get(self, *args, default=None):
+        return self.cache.get(self.key(*args), default)
+
+    def set(self, value, *args):
+        self.cache.set(self.key(*args), value, self.timeout)
+
+    def has_key(self, *args):
+        return self.cache.has_key(self.key(*args))
+
+    def delete(self, *args):
+        return self.cache.delete(self.key(*args))
+
+    def warm_function(self):
+        """The function filling this key (module.function), called with each of warm_args"""
+        module, function = self.warm.rsplit('.', 1)
+        return getattr(import_module(module), function)
+
+
+registry = OrderedDict()
+
+
+def register(name, datasets, timeout=DEFAULT_TIMEOUT, alias=DEFAULT_CACHE_ALIAS, warm=None, warm_args=None):
+    if name in registry:
+        raise KeyError('Cache key {} is already registered'.format(name))
+    registry[name] = CacheKey(name, datasets, timeout, alias, warm, warm_args)
+    return registry[name]
+
+
+TARGET_TABLE = register('target_table', ['proteins', 'signprot', 'ligands'], 60*60*24*7,
+    warm='common.views.getTargetTable')
+ALL_PDBS_AA_PAIRS = register('all_pdbs_aa_pairs', ['interactions'], 60*60*24*7,
+    warm='contactnetwork.views.get_all_pdbs_aa_pairs')
+DISTANCE_MAP = register('distanceMap', ['distances'], 60*60*24*14)
+MUTATION_CLASS_ALIGNMENT = register('mutation_class_alignment', ['proteins', 'mutations'], 60*60*24*7)
+API_STRUCTURE_SUMMARIES = register('api_structure_summaries', ['structures', 'ligands'], 60*60*24*7,
+    warm='api.views.get_structure_summaries')
+SEQSIGN_RECEPTOR_MATRIX = register('seqsign_receptor_matrix', ['proteins', 'residue_matrix'], 60*60*24*7)
+SEQUENCE_HITS = register('sequence_hits', ['proteins'], 60*60*24*7)
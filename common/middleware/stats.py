@@ -1,52 +1,260 @@
 from django.conf import settings
-from django.http import HttpResponse
 from django.db import connection
 
+from collections import OrderedDict
+import atexit
 import time,datetime,os
+import json
+import math
+import threading
+
+
+# histogram buckets (seconds): 1 ms to ~17 minutes, four buckets per doubling
+BUCKET_EDGES = [0.001 * 2**(k/4) for k in range(81)]
+PERCENTILES = [50, 90, 95, 99]
+
+_local = threading.local()
+
+
+def bucket_index(value):
+    if value <= BUCKET_EDGES[0]:
+        return 0
+    return min(int(math.ceil(4 * math.log2(value / BUCKET_EDGES[0]))), len(BUCKET_EDGES)-1)
+
+
+def percentile(buckets, count, p):
+    """Upper edge of the histogram bucket containing percentile p"""
+    if not count:
+        return None
+    threshold = count * p / 100
+    total = 0
+    for i, n in enumerate(buckets):
+        total += n
+        if total >= threshold:
+            return BUCKET_EDGES[i]
+    return BUCKET_EDGES[-1]
+
+
+def stats_log_path():
+    return getattr(settings, 'STATS_LOG', os.path.join(settings.BASE_DIR, "logs/stats.jsonl"))
+
+
+def record_cache_access(hit):
+    """Called by the cache backend (common.cache_backends) to attribute hits and misses to the current request"""
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics[2 if hit else 3] += 1
+
+
+class ViewStats():
+    """Aggregated metrics of one URL name (bytes only of the responses with a known size, counted in sized)"""
+    counters = ['count', 'queries', 'cache_hits', 'cache_misses', 'bytes', 'sized', 'slow', 'errors']
+
+    def __init__(self):
+        for c in self.counters:
+            setattr(self, c, 0)
+        self.wall_sum = 0.0
+        self.db_sum = 0.0
+        self.wall_buckets = [0] * len(BUCKET_EDGES)
+        self.db_buckets = [0] * len(BUCKET_EDGES)
+
+    def add(self, wall, queries, db_time, cache_hits, cache_misses, size):
+        self.count += 1
+        self.queries += queries
+        self.cache_hits += cache_hits
+        self.cache_misses += cache_misses
+        if size is not None:
+            self.bytes += size
+            self.sized += 1
+        self.wall_sum += wall
+        self.db_sum += db_time
+        self.wall_buckets[bucket_index(wall)] += 1
+        self.db_buckets[bucket_index(db_time)] += 1
+        if wall > getattr(settings, 'STATS_SLOW_REQUEST', 5):
+            self.slow += 1
+
+    def merge(self, record):
+        """Add a flushed record (as written to the stats log)"""
+        for c in self.counters:
+            setattr(self, c, getattr(self, c) + record.get(c, 0))
+        if 'sized' not in record:
+            # written before streaming responses were left out of the size
+            self.sized += record['count']
+        self.wall_sum += record['wall_sum']
+        self.db_sum += record['db_sum']
+        self.wall_buckets = [a + b for a, b in zip(self.wall_buckets, record['wall_buckets'])]
+        self.db_buckets = [a + b for a, b in zip(self.db_buckets, record['db_buckets'])]
+
+    def record(self):
+        record = OrderedDict((c, getattr(self, c)) for c in self.counters)
+        record['wall_sum'] = round(self.wall_sum, 6)
+        record['db_sum'] = round(self.db_sum, 6)
+        record['wall_buckets'] = self.wall_buckets
+        record['db_buckets'] = self.db_buckets
+        return record
+
+    def summary(self):
+        count = max(self.count, 1)
+        summary = OrderedDict([('count', self.count)])
+        for p in PERCENTILES:
+            summary['wall_p{}'.format(p)] = percentile(self.wall_buckets, self.count, p)
+        for p in PERCENTILES:
+            summary['db_p{}'.format(p)] = percentile(self.db_buckets, self.count, p)
+        summary['wall_mean'] = self.wall_sum / count
+        summary['db_mean'] = self.db_sum / count
+        summary['python_mean'] = max(self.wall_sum - self.db_sum, 0) / count
+        summary['queries_mean'] = self.queries / count
+        summary['cache_hits'] = self.cache_hits
+        summary['cache_misses'] = self.cache_misses
+        summary['bytes_mean'] = self.bytes / self.sized if self.sized else None
+        summary['slow'] = self.slow
+        summary['errors'] = self.errors
+        return summary
+
+
+class StatsCollector():
+    """In-process request metrics per URL name, flushed periodically as JSON lines to the stats log"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+        self.last_flush = time.time()
+
+    def add(self, view_name, *metrics):
+        with self.lock:
+            if view_name not in self.views:
+                self.views[view_name] = ViewStats()
+            self.views[view_name].add(*metrics)
+            flush = time.time() - self.last_flush > getattr(settings, 'STATS_FLUSH_INTERVAL', 60)
+
+        if flush:
+            self.flush()
+
+    def add_error(self, view_name):
+        with self.lock:
+            if view_name not in self.views:
+                self.views[view_name] = ViewStats()
+            self.views[view_name].errors += 1
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            views = self.views
+            if reset:
+                self.views = {}
+                self.last_flush = time.time()
+            else:
+                views = dict(views)
+        return views
+
+    def flush(self, background=True):
+        """Hand the collected metrics to a writer thread, so the request is not blocked by the file I/O"""
+        views = self.snapshot(reset=True)
+        if not views:
+            return
+        timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        lines = []
+        for view_name, stats in views.items():
+            record = OrderedDict([('time', timestamp), ('pid', os.getpid()), ('view', view_name)])
+            record.update(stats.record())
+            lines.append(json.dumps(record))
+
+        if background:
+            threading.Thread(target=self.write, args=(lines,), daemon=True).start()
+        else:
+            self.write(lines)
+
+    @staticmethod
+    def write(lines):
+        try:
+            with open(stats_log_path(), "a") as log:
+                log.write('\n'.join(lines) + '\n')
+        except OSError:
+            pass
+
+
+collector = StatsCollector()
+# write what is still collected when the worker process exits
+atexit.register(collector.flush, background=False)
+
+
+def read_stats_log(since=None, path=None):
+    """Merge the flushed records per URL name (optionally only those written since a datetime)"""
+    views = {}
+    path = path or stats_log_path()
+    if not os.path.isfile(path):
+        return views
+    since = since.strftime("%Y-%m-%d %H:%M:%S") if since else None
+    with open(path) as log:
+        for line in log:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if since and record['time'] < since:
+                continue
+            if record['view'] not in views:
+                views[record['view']] = ViewStats()
+            views[record['view']].merge(record)
+    return views
+
+
+def summarize(views, include_unflushed=True):
+    """Percentile summary per URL name, slowest (p95) first"""
+    if include_unflushed:
+        for view_name, stats in collector.snapshot().items():
+            if view_name not in views:
+                views[view_name] = ViewStats()
+            views[view_name].merge(stats.record())
+    summaries = [(view_name, stats.summary()) for view_name, stats in views.items()]
+    summaries.sort(key=lambda s: -(s[1]['wall_p95'] or 0))
+    return OrderedDict(summaries)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.view_name:
+        return 'unresolved'
+    return match.view_name
 
-import uuid
 
 class StatsMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
-        # One-time configuration and initialization.
 
     def __call__(self, request):
-        # Code to be executed for each request before
-        # the view (and later middleware) are called.
         start_time = time.time()
+        # queries, db time, cache hits, cache misses
+        metrics = [0, 0.0, 0, 0]
+        _local.metrics = metrics
 
-        request_id = uuid.uuid4().hex
-
-        text_file = open(os.path.join(settings.BASE_DIR, "logs/stats_start_stop.log"), "a")
-        text_file.write('%s %s %s START %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),request.META.get('REMOTE_ADDR'),request_id, request.method, request.path ))
-        text_file.close()
+        def time_query(execute, sql, params, many, context):
+            query_start = time.time()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                metrics[0] += 1
+                metrics[1] += time.time() - query_start
 
-        response = self.get_response(request)
+        try:
+            with connection.execute_wrapper(time_query):
+                response = self.get_response(request)
+        finally:
+            _local.metrics = None
 
-        # Code to be executed for each request/response after
-        # the view is called.
         total = time.time() - start_time
         if settings.DEBUG:
-            print(request.path,"Time to execute", round(total,2), "SQL queries",len(connection.queries))
+            print(request.path,"Time to execute", round(total,2), "SQL queries", metrics[0], "SQL time", round(metrics[1],2))
 
-        text_file = open(os.path.join(settings.BASE_DIR, "logs/stats.log"), "a")
-        text_file.write('%s %s %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), round(total,2),request.META.get('REMOTE_ADDR'), request.method, request.path ))
-        text_file.close()
-
-        text_file = open(os.path.join(settings.BASE_DIR, "logs/stats_start_stop.log"), "a")
-        text_file.write('%s %s %s FINISH %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),request.META.get('REMOTE_ADDR'),request_id, round(total,2), request.method, request.path ))
-        text_file.close()
-
-        if total>5:
-            # If slower than 5 seconds
-            text_file = open(os.path.join(settings.BASE_DIR, "logs/stats_slow.log"), "a")
-            text_file.write('%s %s %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), round(total,2),request.META.get('REMOTE_ADDR'), request.method, request.path ))
-            text_file.close()
+        if response.streaming:
+            # the content is not read here, the size is only known when the response sets it
+            size = int(response['Content-Length']) if response.has_header('Content-Length') else None
+        else:
+            size = len(response.content)
+        collector.add(view_name(request), total, metrics[0], metrics[1], metrics[2], metrics[3], size)
 
         return response
 
     def process_exception(self, request, exception):
+        collector.add_error(view_name(request))
         text_file = open(os.path.join(settings.BASE_DIR, "logs/errors.log"), "a")
         text_file.write('%s %s %s %s "%s"\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),request.META.get('REMOTE_ADDR'), request.method, request.path,str(exception) ))
-        text_file.close()
\ No newline at end of file
+        text_file.close()
@@ -0,0 +1,31 @@
+# Generated by Django 3.0.3 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0003_citation_page_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.CharField(max_length=100)),
+                ('step', models.CharField(max_length=100)),
+                ('command', models.CharField(max_length=100)),
+                ('status', models.CharField(max_length=20)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('duration', models.FloatField(null=True)),
+                ('error', models.TextField(null=True)),
+            ],
+            options={
+                'db_table': 'build_checkpoint',
+                'unique_together': {('run', 'step')},
+            },
+        ),
+    ]
@@ -219,3 +219,22 @@ class ReleaseStatisticsType(models.Model):
     class Meta():
         db_table = 'release_statistics_type'
 
+
+
+class BuildCheckpoint(models.Model):
+    """Completion and timing of one step of a build_all run, used to resume a failed run"""
+    run = models.CharField(max_length=100)
+    step = models.CharField(max_length=100)
+    command = models.CharField(max_length=100)
+    status = models.CharField(max_length=20)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    duration = models.FloatField(null=True)
+    error = models.TextField(null=True)
+
+    def __str__(self):
+        return '{} {} {}'.format(self.run, self.step, self.status)
+
+    class Meta():
+        unique_together = ('run', 'step')
+        db_table = 'build_checkpoint'
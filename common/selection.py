@@ -1,9 +1,24 @@
-﻿from django.conf import settings
+﻿from django.apps import apps
+from django.conf import settings
+from django.db import models
 
+from common.cache_keys import namespace, DATASETS
 from protein.models import Species
 from protein.models import ProteinSource
 from residue.models import ResidueNumberingScheme
 
+from collections import OrderedDict
+
+
+# related objects loaded with the selected items of a model (used in the selection lists and alignments)
+SELECTION_RELATED = {
+    'protein.Protein': ['species', 'source', 'family', 'residue_numbering_scheme'],
+    'residue.ResidueGenericNumberEquivalent': ['default_generic_number', 'scheme'],
+    'structure.Structure': ['pdb_code', 'state', 'protein_conformation__protein'],
+    'structure.StructureModel': ['protein', 'state'],
+    'structure.StructureComplexModel': ['receptor_protein', 'sign_protein'],
+}
+
 
 class SimpleSelection:
     """A class representing the proteins and segments a user has selected. Can be serialized and stored in session"""
@@ -39,6 +54,54 @@ class SimpleSelection:
     def __str__(self):
         return str(self.__dict__)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the data the selected primary keys refer to
+        state['data_namespace'] = namespace(list(DATASETS))
+        return state
+
+    def __setstate__(self, state):
+        data_namespace = state.pop('data_namespace', None)
+        self.__dict__.update(state)
+
+        # items read from the session are resolved in bulk per selection list on first use
+        for value in state.values():
+            if isinstance(value, list):
+                for selection_item in value:
+                    if isinstance(selection_item, SelectionItem):
+                        selection_item.group = value
+
+        # the database was rebuilt since the selection was stored, drop the items that no longer exist
+        if data_namespace != namespace(list(DATASETS)):
+            self.drop_missing()
+
+    def drop_missing(self):
+        """Removes the selected items whose primary key is no longer in the database"""
+        for selection_type, selection_items in list(self.__dict__.items()):
+            if not isinstance(selection_items, list) or not any(isinstance(i, SelectionItem) for i in selection_items):
+                continue
+            self.resolve(selection_type)
+            missing = [i for i in selection_items if isinstance(i, SelectionItem) and i.model and i._item is None]
+            for selection_item in missing:
+                selection_items.remove(selection_item)
+                group_id = selection_item.properties.get('site_residue_group')
+                if group_id and len(self.site_residue_groups) >= group_id and len(self.site_residue_groups[group_id-1]) > 1:
+                    group = self.site_residue_groups[group_id-1]
+                    group.pop()
+                    if group[0] > len(group):
+                        group[0] -= 1
+
+    def ids(self, selection_type, item_type=None):
+        """Primary keys of the selected items of a list (optionally of one item type), without loading them"""
+        return [selection_item.item_id for selection_item in getattr(self, selection_type)
+                if item_type is None or selection_item.type == item_type]
+
+    def resolve(self, selection_type):
+        """Loads the selected items of a list with one query per model"""
+        selection_items = getattr(self, selection_type)
+        for model_label in set(selection_item.model for selection_item in selection_items if selection_item.model):
+            resolve_selection_items(selection_items, model_label)
+
 
 class Selection(SimpleSelection):
     """A class that extends SimpleSelection, and adds methods to process the selection (these methods can not be
@@ -59,7 +122,8 @@ class Selection(SimpleSelection):
 
     def exporter(self):
         """Exports the attributes of Selection to a SimpleSelection object, and returns it"""
-        ss = SimpleSelection()
+        # all attributes are set below, skip the queries for the defaults
+        ss = SimpleSelection.__new__(SimpleSelection)
         ss.reference = self.reference
         ss.targets = self.targets
         ss.segments = self.segments
@@ -112,7 +176,7 @@ class Selection(SimpleSelection):
         group_id = False
         delete_group = False
         for selection_object in selection:
-            if (selection_object.type == selection_subtype and selection_object.item.id == int(selection_id) and 
+            if (selection_object.type == selection_subtype and selection_object.item_id == int(selection_id) and 
                 'site_residue_group' in selection_object.properties and
                 selection_object.properties['site_residue_group']):
                 group_id = selection_object.properties['site_residue_group']
@@ -120,7 +184,7 @@ class Selection(SimpleSelection):
 
         # loop through selected objects and remove the one that matches the subtype and ID
         for selection_object in selection:
-            if not (selection_object.type == selection_subtype and selection_object.item.id == int(selection_id)):
+            if not (selection_object.type == selection_subtype and selection_object.item_id == int(selection_id)):
                 updated_selection.append(selection_object)
                 
                 # check group ID
@@ -169,15 +233,71 @@ class Selection(SimpleSelection):
 
 
 class SelectionItem:
-    """A wrapper class for selectable objects (protein, family, sequence segment etc.) that adds a type attribute"""
+    """A wrapper class for selectable objects (protein, family, sequence segment etc.) that adds a type attribute.
+    Model instances are serialized as their model label and primary key only, and loaded again on first use"""
     def __init__(self, selection_type, selection_object, properties={}):
         self.type = selection_type
         self.type_title = selection_type.replace('_', ' ').capitalize()
-        self.item = selection_object
         self.properties = properties
+        self.item = selection_object
+
+    @property
+    def item(self):
+        if self._item is None and self.model:
+            resolve_selection_items(self.group or [self], self.model)
+            if self._item is None:
+                raise apps.get_model(self.model).DoesNotExist('Selected {} {} not found'.format(self.model,
+                                                                                                self.item_id))
+        return self._item
+
+    @item.setter
+    def item(self, selection_object):
+        if isinstance(selection_object, models.Model):
+            self.model = selection_object._meta.label
+            self.item_id = selection_object.pk
+        else:
+            self.model = self.item_id = None
+        self._item = selection_object
+        self.group = None
+
+    def key(self):
+        """Identity of the selected item (without loading it)"""
+        if self.model:
+            return (self.type, self.model, self.item_id)
+        return (self.type, None, self._item)
+
+    def __getstate__(self):
+        state = {'type': self.type, 'type_title': self.type_title, 'properties': self.properties,
+                 'model': self.model, 'item_id': self.item_id, '_item': None, 'group': None}
+        if not self.model:
+            state['_item'] = self._item
+        return state
+
+    def __setstate__(self, state):
+        if 'item' in state:
+            # selections stored before items were kept as primary keys
+            self.__init__(state['type'], state['item'], state['properties'])
+        else:
+            self.__dict__.update(state)
 
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.__getstate__())
 
     def __eq__(self, other): 
-        return self.__dict__ == other.__dict__
\ No newline at end of file
+        return self.key() == other.key() and self.properties == other.properties
+
+
+def resolve_selection_items(selection_items, model_label):
+    """Loads the instances of all unresolved selection items of a model with one query"""
+    pks = OrderedDict()
+    for selection_item in selection_items:
+        if selection_item.model == model_label and selection_item._item is None:
+            pks[selection_item.item_id] = True
+    if not pks:
+        return
+
+    model = apps.get_model(model_label)
+    objects = model.objects.select_related(*SELECTION_RELATED.get(model_label, [])).in_bulk(list(pks))
+    for selection_item in selection_items:
+        if selection_item.model == model_label and selection_item._item is None:
+            selection_item._item = objects.get(selection_item.item_id)
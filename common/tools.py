@@ -156,4 +156,17 @@ def fetch_from_entrez(index, cache_dir=''):
             # save to cache
             save_to_cache(cache_dir, index_slug, d)
             logger.info('Saved entry for {} in cache'.format(cache_file_path))
-            return d
\ No newline at end of file
+            return d
+
+def get_data_release():
+    """Return a token identifying the current data release, used to version data cached from the database"""
+    release = cache.get('data_release')
+    if release is None:
+        from common.models import ReleaseNotes
+        latest_release = ReleaseNotes.objects.order_by('-date').first()
+        if latest_release:
+            release = latest_release.date.strftime('%Y%m%d')
+        else:
+            release = 'dev'
+        cache.set('data_release', release, 60*60)
+    return release
@@ -36,4 +36,5 @@ urlpatterns = [
     url(r'^importexcel$', views.ImportExcel, name='importexcel'),
     url(r'^convertsvg$', views.ConvertSVG, name='convertsvg'),
     url(r'^targettabledata', views.TargetTableData, name='targettabledata'),
+    url(r'^requeststats$', views.RequestStats, name='requeststats'),
 ]
@@ -1,16 +1,20 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import render
 from django.views.generic import TemplateView
 from django.views.decorators.cache import cache_page
 from django.views.decorators.csrf import csrf_exempt
+from django.contrib.admin.views.decorators import staff_member_required
 from django.conf import settings
 from django.db.models import Count, Case, When, Min
 from django.core.cache import cache
 
+from common.cache_keys import TARGET_TABLE
+
 from common import definitions
+from common.middleware.stats import read_stats_log, summarize
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
-from common.selection import SimpleSelection, Selection, SelectionItem
+from common.selection import SimpleSelection, Selection, SelectionItem, SELECTION_RELATED
 from ligand.models import AssayExperiment
 from structure.models import Structure, StructureModel, StructureComplexModel
 from protein.models import Protein, ProteinFamily, ProteinSegment, Species, ProteinSource, ProteinSet, ProteinGProtein, ProteinGProteinPair
@@ -28,12 +32,13 @@ from collections import OrderedDict
 from io import BytesIO
 import xlsxwriter, xlrd
 import time
+import datetime
 import json
 
 default_schemes_excluded = ["cgn", "ecd", "can"]
 
 def getTargetTable():
-    data_table = cache.get("target_table")
+    data_table = TARGET_TABLE.get()
     if data_table == None:
         proteins = Protein.objects.filter(sequence_type__slug="wt",
                                           family__slug__startswith="00",
@@ -224,7 +229,7 @@ def getTargetTable():
             )
 
         data_table += "</tbody></table>"
-        cache.set("target_table", data_table, 60*60*24*7)
+        TARGET_TABLE.set(data_table)
 
     return data_table
 
@@ -686,12 +691,23 @@ def AddToSelection(request):
 
         elif selection_subtype == 'structure_many':
             selection_subtype = 'structure'
+            pdb_codes = []
             for pdb_code in selection_id.split(","):
                 if 'refined' in pdb_code:
                     sel1, sel2 = pdb_code.split('_')
-                    o.append(Structure.objects.get(pdb_code__index=sel1.upper()+'_refined'))
+                    pdb_codes.append(sel1.upper()+'_refined')
                 else:
-                    o.append(Structure.objects.get(pdb_code__index=pdb_code.upper()))
+                    pdb_codes.append(pdb_code.upper())
+
+            # all structures in one query, added in the selected order
+            structures = {}
+            for structure in Structure.objects.filter(pdb_code__index__in=pdb_codes).select_related(
+                    *SELECTION_RELATED['structure.Structure']):
+                structures[structure.pdb_code.index] = structure
+            for pdb_code in pdb_codes:
+                if pdb_code not in structures:
+                    raise Structure.DoesNotExist('Structure {} not found'.format(pdb_code))
+                o.append(structures[pdb_code])
 
         # elif selection_subtype == 'structure_model_Inactive':
         #     entry_name = '_'.join(selection_id.split('_')[:-1])
@@ -1089,25 +1105,16 @@ def ToggleFamilyTreeNode(request):
         pfs = ProteinFamily.objects.filter(parent=node_id)
 
         # species filter
-        species_list = []
-        for species in selection.species:
-            species_list.append(species.item)
+        species_list = selection.ids('species')
 
         # annotation filter
-        protein_source_list = []
-        for protein_source in selection.annotation:
-            protein_source_list.append(protein_source.item)
+        protein_source_list = selection.ids('annotation')
 
         # preferred g proteins filter
-        pref_g_proteins_list = []
-        for g_protein in selection.pref_g_proteins:
-            pref_g_proteins_list.append(g_protein.item)
-
+        pref_g_proteins_list = selection.ids('pref_g_proteins')
 
         # g proteins filter
-        g_proteins_list = []
-        for g_protein in selection.g_proteins:
-            g_proteins_list.append(g_protein.item)
+        g_proteins_list = selection.ids('g_proteins')
 
         if species_list:
             ps = Protein.objects.order_by('id').filter(family=ppf,
@@ -2167,3 +2174,16 @@ def TargetTableData(request):
     """
 
     return HttpResponse(getTargetTable())
+
+@staff_member_required
+def RequestStats(request):
+    """Percentile summary of the request metrics per URL name (admin only), ?hours= limits the period"""
+    since = None
+    if request.GET.get('hours'):
+        try:
+            since = datetime.datetime.utcnow() - datetime.timedelta(hours=float(request.GET.get('hours')))
+        except (ValueError, OverflowError):
+            return HttpResponseBadRequest('hours must be a number')
+    summaries = summarize(read_stats_log(since))
+
+    return HttpResponse(json.dumps(summaries, indent=2), content_type='application/json')
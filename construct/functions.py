@@ -3,7 +3,7 @@ from django.utils.text import slugify
 from django.db import IntegrityError, connection
 from protein.models import Protein, ProteinConformation
 from residue.models import Residue
-from structure.models import Structure
+from structure.models import Structure, PdbData
 from construct.models import *
 
 from ligand.models import Ligand, LigandType, LigandRole
@@ -120,8 +120,8 @@ def fetch_pdb_info(pdbname,protein,new_xtal=False, ignore_gasper_annotation=Fals
             structure = Structure.objects.filter(pdb_code__index=d['construct_crystal']['pdb'].upper()).get()
 
             if 1==1: #update pdbs
-                structure.pdb_data.pdb = pdbdata_raw
-                structure.pdb_data.save()
+                structure.pdb_data, created = PdbData.get_or_create_pdb(pdbdata_raw)
+                structure.save()
 
             pdb_file = structure.pdb_data.pdb
         except:
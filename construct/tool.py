@@ -1229,14 +1229,6 @@ def mutations(request, slug, **response_kwargs):
 
     if protein_class_slug in ['001','002','003']:
         # Only perform the xtal cons rules for A, B1 and B2
-        xtals_conservation = cache.get("CD_xtal_cons_"+protein_class_slug)
-        if not xtals_conservation:
-            c_proteins = Construct.objects.filter(protein__family__slug__startswith = protein_class_slug).all().values_list('protein__pk', flat = True).distinct()
-            xtal_proteins = Protein.objects.filter(pk__in=c_proteins)
-            print(xtal_proteins)
-            xtals_conservation = calculate_conservation(proteins=xtal_proteins)
-            cache.set("CD_xtal_cons_"+protein_class_slug,xtals_conservation,60*60*24)
-
         xtals_cutoff = 7
         xtals_cutoff_pos = 4
         xtals_conservation_priority = 3
@@ -0,0 +1,94 @@
+"""
+Annotation of hierarchical clusterings of structures (scipy linkage matrices).
+
+The members of every cluster are contiguous in the leaf order of the tree, so the summed distance of a structure to
+all members of a cluster is the difference of two cumulative sums over its row of the distance matrix in leaf order.
+The silhouette index of every cluster follows from these sums in a single pass over the linkage matrix. The tree is
+traversed without recursion, so the size of a clustering is not limited by the recursion limit.
+"""
+import numpy as np
+
+
+def cluster_ranges(Z):
+    """Leaf order of linkage matrix Z (left before right) and the first position and size of every node in it"""
+    n = len(Z) + 1
+    sizes = np.ones(2*n - 1, dtype=np.intp)
+    sizes[n:] = Z[:, 3]
+    starts = np.zeros(2*n - 1, dtype=np.intp)
+
+    # parents come after their children in Z, so walking it backwards visits every parent first
+    for k in range(n - 2, -1, -1):
+        left, right = int(Z[k, 0]), int(Z[k, 1])
+        starts[left] = starts[n + k]
+        starts[right] = starts[n + k] + sizes[left]
+
+    order = np.empty(n, dtype=np.intp)
+    order[starts[:n]] = np.arange(n)
+    return order, starts, sizes
+
+
+def leaf_order(Z):
+    """Order of the structures implied by the tree (as the dendrogram draws them)"""
+    return cluster_ranges(Z)[0].tolist()
+
+
+def silhouette_scores(Z, distance_matrix):
+    """
+    Average silhouette index of every cluster with more than one member compared to its sibling cluster, by node id
+    (0 for the root). Based on Rousseeuw, P.J. J. Comput. Appl. Math. 20 (1987): 53-65
+    """
+    n = len(Z) + 1
+    order, starts, sizes = cluster_ranges(Z)
+
+    # cumulative[i, p] is the summed distance of structure order[i] to the structures at positions before p
+    ordered = np.asarray(distance_matrix, dtype=np.float64)[np.ix_(order, order)]
+    cumulative = np.zeros((n, n + 1))
+    np.cumsum(ordered, axis=1, out=cumulative[:, 1:])
+
+    scores = {2*n - 2: 0}
+    for k in range(n - 1):
+        left, right = int(Z[k, 0]), int(Z[k, 1])
+        for cluster, sibling in ((left, right), (right, left)):
+            if sizes[cluster] < 2:
+                continue
+            members = slice(starts[cluster], starts[cluster] + sizes[cluster])
+            within = cumulative[members, members.stop] - cumulative[members, members.start]
+            other = cumulative[members, starts[sibling] + sizes[sibling]] - cumulative[members, starts[sibling]]
+
+            # average distance within the cluster and to the sibling cluster
+            a = within / (sizes[cluster] - 1)
+            b = other / sizes[sibling]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                scores[cluster] = float(np.mean((b - a) / np.maximum(a, b)))
+    return scores
+
+
+def newick(Z, leaf_names, scores):
+    """Tree in Newick format with the silhouette score of every cluster as its label (right subtree first)"""
+    n = len(Z) + 1
+    root = 2*n - 2
+    heights = np.zeros(2*n - 1)
+    heights[n:] = Z[:, 2]
+
+    parts = []
+    stack = [(root, heights[root])]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+
+        node, parent_height = item
+        if node < n:
+            parts.append("%s:%.2f" % (leaf_names[node], parent_height - heights[node]))
+            continue
+
+        left, right = int(Z[node - n, 0]), int(Z[node - n, 1])
+        if node == root:
+            suffix = ");"
+        else:
+            suffix = ")%.2f:%.2f" % (scores[node], parent_height - heights[node])
+        parts.append("(")
+        stack.extend([suffix, (left, heights[node]), ",", (right, heights[node])])
+
+    return "".join(parts)
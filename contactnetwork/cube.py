@@ -1,10 +1,9 @@
-from Bio.PDB import Selection, PDBParser
+from Bio.PDB import Selection
 from Bio.PDB.NeighborSearch import NeighborSearch
 
 from contactnetwork.interaction import *
 from contactnetwork.pdb import *
 from contactnetwork.models import *
-from io import StringIO
 
 from protein.models import ProteinConformation
 
@@ -17,12 +16,12 @@ import copy
 # Distance between residues in peptide
 NUM_SKIP_RESIDUES = 0
 
-def compute_interactions(pdb_name,save_to_db = False):
+def calculate_interactions(pdb_name):
+    """Classify the residue pairs of a structure (and its G protein complex), returns the structure and both lists"""
 
     do_distances = False ## Distance calculation moved to build_structure_angles
     do_interactions = True
     do_complexes = True
-    distances = []
     classified = []
     classified_complex = []
 
@@ -31,12 +30,11 @@ def compute_interactions(pdb_name,save_to_db = False):
 
     # Get the pdb structure
     struc = Structure.objects.get(protein_conformation__protein__entry_name=pdb_name)
-    pdb_io = StringIO(struc.pdb_data.pdb)
     # Get the preferred chain
     preferred_chain = struc.preferred_chain.split(',')[0]
 
-    # Get the Biopython structure for the PDB
-    s = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', pdb_io)[0]
+    # Get the Biopython structure for the PDB (from the stored parsed atoms)
+    s = struc.get_parsed_pdb().to_biopython('ref')[0]
     #s = pdb_get_structure(pdb_name)[0]
     chain = s[preferred_chain]
     #return classified, distances
@@ -67,22 +65,62 @@ def compute_interactions(pdb_name,save_to_db = False):
     if do_interactions:
         atom_list = Selection.unfold_entities(s[preferred_chain], 'A')
 
-        # Search for all neighbouring residues
+        # Neighbor search for the water-mediated interactions
         ns = NeighborSearch(atom_list)
-        all_neighbors = ns.search_all(6.6, "R")
 
-        # Filter all pairs containing non AA residues
-        all_aa_neighbors = [pair for pair in all_neighbors if is_aa(pair[0]) and is_aa(pair[1])]
+        # Search for all neighbouring AA residues (atom arrays + KD-tree)
+        engine = InteractionEngine([residue for residue in s[preferred_chain] if is_aa(residue)])
+        all_aa_neighbors = engine.neighbor_pairs(6.6)
 
         # Only include contacts between residues more than NUM_SKIP_RESIDUES sequence steps apart
         all_aa_neighbors = [pair for pair in all_aa_neighbors if abs(pair[0].id[1] - pair[1].id[1]) > NUM_SKIP_RESIDUES]
 
         # For each pair of interacting residues, determine the type of interaction
-        interactions = [InteractingPair(res_pair[0], res_pair[1], dbres[res_pair[0].id[1]], dbres[res_pair[1].id[1]], struc) for res_pair in all_aa_neighbors if not is_water(res_pair[0]) and not is_water(res_pair[1]) ]
+        interactions = engine.interacting_pairs(all_aa_neighbors, dbres, dbres, struc)
 
         # Split unto classified and unclassified.
         classified = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
 
+        # Create interaction dictionary
+        interaction_pairs = {}
+        for pair in classified:
+            res_1 = pair.get_residue_1()
+            res_2 = pair.get_residue_2()
+            key =  res_1.get_parent().get_id()+str(res_1.get_id()[1]) + "_" + res_2.get_parent().get_id()+str(res_2.get_id()[1])
+            interaction_pairs[key] = pair
+
+        # POSSIBLE ADDON: support for multiple water-mediated bonds
+        ## Obtain list of water molecules
+        water_list = { water for residue in s[preferred_chain] if residue.get_resname() == "HOH" for water in residue.get_atoms() }
+        if len(water_list) > 0:
+            ## Iterate water molecules over residue atom list
+            water_neighbors = [(water, match_res) for water in water_list
+                            for match_res in ns.search(water.coord, 3.5, "R") if not is_water(match_res) and (is_hba(match_res) or is_hbd(match_res))]
+
+            # intersect between residues sharing the same interacting water
+            for index_one in range(len(water_neighbors)):
+                water_pair_one = water_neighbors[index_one]
+
+                for index_two in [ index for index in range(index_one+1, len(water_neighbors)) if water_pair_one[0]==water_neighbors[index][0] ]:
+                    water_pair_two = water_neighbors[index_two]
+                    res_1 = water_pair_one[1]
+                    res_2 = water_pair_two[1]
+
+                    # TODO: order residues + check minimum spacing between residues
+                    key =  res_1.get_parent().get_id()+str(res_1.get_id()[1]) + "_" + res_2.get_parent().get_id()+str(res_2.get_id()[1])
+
+                    # Verify h-bonds between water and both residues
+                    matches_one = InteractingPair.verify_water_hbond(water_pair_one[1], water_pair_one[0])
+                    matches_two = InteractingPair.verify_water_hbond(water_pair_two[1], water_pair_two[0])
+                    if len(matches_one) > 0 and len(matches_two) > 0:
+                        # if not exists, create residue pair without interactions
+                        if not key in interaction_pairs:
+                            interaction_pairs[key] = InteractingPair(res_1, res_2, dbres[res_1.id[1]], dbres[res_2.id[1]], struc)
+
+                        for a,b in zip(matches_one, matches_two):
+                            # HACK: store water ID as part of first atom name
+                            interaction_pairs[key].interactions.append(WaterMediated(a + "|" + str(water_pair_one[0].get_parent().get_id()[1]), b))
+
     if do_complexes:
         try:
             # check if structure in signprot_complex
@@ -117,7 +155,8 @@ def compute_interactions(pdb_name,save_to_db = False):
                 dblabel_sign[r.sequence_number] = r.generic_number.label
 
             # Find interactions
-            interactions = [InteractingPair(res_pair[0], res_pair[1], dbres[res_pair[0].id[1]], dbres_sign[res_pair[1].id[1]], struc) for res_pair in all_neighbors if res_pair[0].id[1] in dbres and res_pair[1].id[1] in dbres_sign ]
+            complex_engine = InteractionEngine(list({atom.parent for atom in gpcr_atom_list + sign_atom_list}))
+            interactions = complex_engine.interacting_pairs([res_pair for res_pair in all_neighbors if res_pair[0].id[1] in dbres and res_pair[1].id[1] in dbres_sign], dbres, dbres_sign, struc)
 
             # Filter unclassified interactions
             classified_complex = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
@@ -175,63 +214,27 @@ def compute_interactions(pdb_name,save_to_db = False):
             print("No protein conformation definition found for signaling protein of ", pdb_name)
 #            log = "No protein conformation definition found for signaling protein of " + pdb_name
 
+    return struc, classified, classified_complex
+
+def compute_interactions(pdb_name,save_to_db = False):
+    distances = []
+    struc, classified, classified_complex = calculate_interactions(pdb_name)
+
     if save_to_db:
 
-        if do_interactions:
-            # Delete previous for faster load in
-            InteractingResiduePair.objects.filter(referenced_structure=struc).all().delete()
+        # Delete previous for faster load in
+        InteractingResiduePair.objects.filter(referenced_structure=struc).all().delete()
 
-            # bulk_pair = []
-            # for d in distances:
-            #     pair = InteractingResiduePair(res1=d[0], res2=d[1], referenced_structure=struc)
-            #     bulk_pair.append(pair)
+        # bulk_pair = []
+        # for d in distances:
+        #     pair = InteractingResiduePair(res1=d[0], res2=d[1], referenced_structure=struc)
+        #     bulk_pair.append(pair)
 
-            # Create interaction dictionary
-            interaction_pairs = {}
-            for pair in classified:
-                res_1 = pair.get_residue_1()
-                res_2 = pair.get_residue_2()
-                key =  res_1.get_parent().get_id()+str(res_1.get_id()[1]) + "_" + res_2.get_parent().get_id()+str(res_2.get_id()[1])
-                interaction_pairs[key] = pair
+        for p in classified:
+            p.save_into_database()
 
-            # POSSIBLE ADDON: support for multiple water-mediated bonds
-            ## Obtain list of water molecules
-            water_list = { water for residue in s[preferred_chain] if residue.get_resname() == "HOH" for water in residue.get_atoms() }
-            if len(water_list) > 0:
-                ## Iterate water molecules over residue atom list
-                water_neighbors = [(water, match_res) for water in water_list
-                                for match_res in ns.search(water.coord, 3.5, "R") if not is_water(match_res) and (is_hba(match_res) or is_hbd(match_res))]
-
-                # intersect between residues sharing the same interacting water
-                for index_one in range(len(water_neighbors)):
-                    water_pair_one = water_neighbors[index_one]
-
-                    for index_two in [ index for index in range(index_one+1, len(water_neighbors)) if water_pair_one[0]==water_neighbors[index][0] ]:
-                        water_pair_two = water_neighbors[index_two]
-                        res_1 = water_pair_one[1]
-                        res_2 = water_pair_two[1]
-
-                        # TODO: order residues + check minimum spacing between residues
-                        key =  res_1.get_parent().get_id()+str(res_1.get_id()[1]) + "_" + res_2.get_parent().get_id()+str(res_2.get_id()[1])
-
-                        # Verify h-bonds between water and both residues
-                        matches_one = InteractingPair.verify_water_hbond(water_pair_one[1], water_pair_one[0])
-                        matches_two = InteractingPair.verify_water_hbond(water_pair_two[1], water_pair_two[0])
-                        if len(matches_one) > 0 and len(matches_two) > 0:
-                            # if not exists, create residue pair without interactions
-                            if not key in interaction_pairs:
-                                interaction_pairs[key] = InteractingPair(res_1, res_2, dbres[res_1.id[1]], dbres[res_2.id[1]], struc)
-
-                            for a,b in zip(matches_one, matches_two):
-                                # HACK: store water ID as part of first atom name
-                                interaction_pairs[key].interactions.append(WaterMediated(a + "|" + str(water_pair_one[0].get_parent().get_id()[1]), b))
-
-            for p in classified:
-                p.save_into_database()
-
-        if do_complexes:
-            for pair in classified_complex:
-                pair.save_into_database()
+        for pair in classified_complex:
+            pair.save_into_database()
 
         # if do_distances:
         #     # Distance.objects.filter(structure=struc).all().delete()
@@ -245,3 +248,7 @@ def compute_interactions(pdb_name,save_to_db = False):
         #
         #     pairs = Distance.objects.bulk_create(bulk_distances)
     return classified, distances
+
+def interaction_rows(pairs):
+    """Plain (res1 id, res2 id, interactions) tuples of classified pairs, so they can be pickled and written in bulk"""
+    return [(p.dbres1.id, p.dbres2.id, [(i.get_type(), i.get_details(), i.atomname_residue1, i.atomname_residue2, i.get_level()) for i in p.get_interactions()]) for p in pairs]
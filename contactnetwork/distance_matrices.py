@@ -0,0 +1,271 @@
+"""
+Loading of the packed per structure distance matrices (contactnetwork.models.DistanceMatrix).
+
+Matrices of a set of structures are mapped onto a shared generic number index, so that distances for GN pairs can be
+sliced out for all structures at once and aggregated with NumPy instead of fetching one database row per pair.
+"""
+from contactnetwork.models import DistanceMatrix, distance_scaling_factor
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+distance_fields = {'CA': 'distance', 'CB': 'distance_cb', 'HC': 'distance_helix_center'}
+
+# GNs of segments excluded from TM distance calculations (same as the gns_pair__contains filters in Distances)
+excluded_gn_parts = ['8x', '12x', '23x', '34x', '45x']
+
+
+def is_tm_gn(label):
+    return not any(part in label for part in excluded_gn_parts)
+
+
+def condensed_index(n, i, j):
+    """Index of (i, j), i < j, in a condensed upper triangle of an n x n matrix"""
+    return n*i - i*(i+1)//2 + (j - i - 1)
+
+
+def group_statistics(values, groups, num_groups, standard_deviation=False, ddof=1):
+    """Mean (or standard deviation, 0 for single values) of values per group index, also returns the group sizes"""
+    counts = np.bincount(groups, minlength=num_groups)
+    sums = np.bincount(groups, weights=values, minlength=num_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    if not standard_deviation:
+        return means, counts
+
+    deviations = values - means[groups]
+    squares = np.bincount(groups, weights=deviations*deviations, minlength=num_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stdevs = np.sqrt(squares / (counts - ddof))
+    stdevs[counts < 2] = 0
+    return stdevs, counts
+
+
+# upper bound on the number of elements of the intermediate arrays in masked_dissimilarity
+DISSIMILARITY_CHUNK_ELEMENTS = 2**20
+
+
+def masked_dissimilarity(values, present, chunk_size=None, workers=1):
+    """
+    Dissimilarity of every pair of structures (N x N).
+
+    values   per structure the values of all GN pairs (N x K, condensed upper triangle over G GNs)
+    present  per structure which of the G GNs it has (N x G booleans)
+
+    For each pair of structures the absolute differences are summed over the GN pairs of which both structures have
+    both GNs, squared and divided by the squared number of shared GNs (NaN without shared GNs). Pairs are processed in
+    blocks of chunk_size x chunk_size structures (by default at most DISSIMILARITY_CHUNK_ELEMENTS intermediate values),
+    optionally by several threads (NumPy releases the GIL).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    present = np.asarray(present, dtype=bool)
+    n, k = values.shape
+    i, j = np.triu_indices(present.shape[1], 1)
+    if len(i) != k:
+        raise ValueError('{} values per structure do not match {} GNs'.format(k, present.shape[1]))
+
+    # values of GN pairs a structure lacks are zero
+    pair_present = present[:, i] & present[:, j]
+    values = np.where(pair_present, values, 0.0)
+    counts = present.astype(np.float64)
+    shared = counts @ counts.T
+
+    # distances are not negative: |x - y| = x + y - 2*min(x, y), where the minimum is zero unless both structures have
+    # the GN pair, so only the minimum needs a pass over all pairs of structures (the sums are matrix products)
+    nonnegative = not (values < 0).any()
+
+    if chunk_size is None:
+        chunk_size = max(1, int(np.sqrt(DISSIMILARITY_CHUNK_ELEMENTS / max(1, k))))
+
+    def block(rows, cols):
+        if nonnegative:
+            return rows, cols, np.minimum(values[rows, None, :], values[None, cols, :]).sum(axis=2)
+        difference = np.abs(values[rows, None, :] - values[None, cols, :])
+        difference *= pair_present[rows, None, :] & pair_present[None, cols, :]
+        return rows, cols, difference.sum(axis=2)
+
+    # blocks of chunk_size x chunk_size structures in the upper triangle
+    blocks = [(slice(r, min(n, r + chunk_size)), slice(c, min(n, c + chunk_size)))
+              for r in range(0, n, chunk_size) for c in range(r, n, chunk_size)]
+    sums = np.zeros((n, n))
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(lambda b: block(*b), blocks))
+    else:
+        results = (block(*b) for b in blocks)
+    for rows, cols, result in results:
+        sums[rows, cols] = result
+
+    if nonnegative:
+        totals = values @ pair_present.T.astype(np.float64)
+        sums = totals + totals.T - 2*sums
+    sums = np.triu(sums, 1)
+    sums = sums + sums.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dissimilarity = sums * sums / (shared * shared)
+    np.fill_diagonal(dissimilarity, 0)
+    return dissimilarity
+
+
+def split_by_group(values, groups, num_groups):
+    """List with the values of each group index"""
+    order = np.argsort(groups, kind='stable')
+    splits = np.cumsum(np.bincount(groups, minlength=num_groups))[:-1]
+    return np.split(values[order], splits)
+
+
+class DistanceMatrices():
+    """Distance matrices of a set of structures over a shared generic number index"""
+    def __init__(self, distance_type="CA"):
+        self.field = distance_fields.get(distance_type, 'distance')
+        self.structure_ids = []
+        self.pdbs = []
+        self.generic_numbers = []
+        self.gn_index = {}
+
+        # per structure: stored GN order as shared indices, amino acids and condensed distances
+        self.positions = []
+        self.amino_acids = []
+        self.distances = []
+
+    def __len__(self):
+        return len(self.structure_ids)
+
+    def load(self, pdbs=None, structures=None):
+        """Load the matrices for a list of PDB codes and/or Structure objects (or ids)"""
+        matrices = DistanceMatrix.objects.all()
+        if pdbs is not None:
+            matrices = matrices.filter(structure__pdb_code__index__in=pdbs)
+        if structures is not None:
+            matrices = matrices.filter(structure__in=structures)
+        matrices = list(matrices.values_list('structure_id', 'structure__pdb_code__index', 'generic_numbers',
+                                             'amino_acids', self.field))
+
+        labels = set()
+        for m in matrices:
+            labels.update(m[2].split(','))
+        self.generic_numbers = sorted(labels)
+        self.gn_index = {gn: i for i, gn in enumerate(self.generic_numbers)}
+
+        for structure_id, pdb, gns, amino_acids, distances in matrices:
+            self.structure_ids.append(structure_id)
+            self.pdbs.append(pdb)
+            self.positions.append(np.array([self.gn_index[gn] for gn in gns.split(',')], dtype=np.intp))
+            self.amino_acids.append(np.frombuffer(amino_acids.encode('ascii', 'replace'), dtype=np.uint8))
+            self.distances.append(DistanceMatrix.unpack(distances))
+
+        return self
+
+    def local_indices(self, s):
+        """Position of each shared GN in the matrix of structure s (-1 when absent)"""
+        local = np.full(len(self.generic_numbers) + 1, -1, dtype=np.intp)
+        local[self.positions[s]] = np.arange(len(self.positions[s]))
+        return local
+
+    def pair_indices(self, pairs):
+        """Shared GN indices for a list of "gn1_gn2" labels, unknown GNs point to a sentinel position"""
+        unknown = len(self.generic_numbers)
+        first = np.empty(len(pairs), dtype=np.intp)
+        second = np.empty(len(pairs), dtype=np.intp)
+        for p, pair in enumerate(pairs):
+            gn1, _, gn2 = pair.partition('_')
+            first[p] = self.gn_index.get(gn1, unknown)
+            second[p] = self.gn_index.get(gn2, unknown)
+        return first, second
+
+    def pair_values(self, pairs, amino_acids=False):
+        """Scaled distances (structures x pairs, NaN when missing) for a list of "gn1_gn2" labels.
+        With amino_acids also returns the amino acid pair codes (ord(aa1)*256 + ord(aa2)) of each value."""
+        first, second = self.pair_indices(pairs)
+        values = np.full((len(self), len(pairs)), np.nan)
+        codes = np.zeros((len(self), len(pairs)), dtype=np.int64)
+
+        for s in range(len(self)):
+            local = self.local_indices(s)
+            i, j = local[first], local[second]
+            valid = np.flatnonzero((i >= 0) & (j >= 0) & (i < j))
+            n = len(self.positions[s])
+            d = self.distances[s][condensed_index(n, i[valid], j[valid])]
+            present = d >= 0
+            values[s, valid[present]] = d[present]
+            if amino_acids:
+                aas = self.amino_acids[s].astype(np.int64)
+                codes[s, valid] = aas[i[valid]]*256 + aas[j[valid]]
+
+        if amino_acids:
+            return values, codes
+        return values
+
+    def square(self, s, gns):
+        """Scaled distances of structure s (gns x gns, upper triangle in the stored GN order, NaN when missing)"""
+        first = np.array([self.gn_index.get(gn, len(self.generic_numbers)) for gn in gns], dtype=np.intp)
+        square = np.full((len(gns), len(gns)), np.nan)
+
+        local = self.local_indices(s)[first]
+        present = np.flatnonzero(local >= 0)
+        i, j = np.meshgrid(local[present], local[present], indexing='ij')
+        upper = i < j
+        n = len(self.positions[s])
+        d = self.distances[s][condensed_index(n, i[upper], j[upper])].astype(np.float64)
+        d[d < 0] = np.nan
+        rows, cols = np.meshgrid(present, present, indexing='ij')
+        square[rows[upper], cols[upper]] = d
+        return square
+
+    def stack(self, gns):
+        """Scaled distances (structures x gns x gns, upper triangle in the stored GN order, NaN when missing)"""
+        return np.array([self.square(s, gns) for s in range(len(self))]).reshape(len(self), len(gns), len(gns))
+
+    def all_pairs(self, gn_filter=None):
+        """All distances of the loaded structures grouped per "gn1_gn2" label, optionally only pairs where both
+        GNs pass gn_filter. Returns pair labels, pair index per value, structure index per value and scaled values."""
+        num_gns = len(self.generic_numbers)
+        keep = np.array([gn_filter(gn) if gn_filter else True for gn in self.generic_numbers] + [False])
+
+        pair_ids, structure_index, values = [], [], []
+        for s in range(len(self)):
+            positions = self.positions[s]
+            i, j = np.triu_indices(len(positions), 1)
+            d = self.distances[s]
+            selected = keep[positions[i]] & keep[positions[j]] & (d >= 0)
+            pair_ids.append(positions[i[selected]]*num_gns + positions[j[selected]])
+            structure_index.append(np.full(selected.sum(), s, dtype=np.intp))
+            values.append(d[selected])
+
+        if not pair_ids:
+            return [], np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0)
+
+        unique_pairs, pair_index = np.unique(np.concatenate(pair_ids), return_inverse=True)
+        labels = ['{}_{}'.format(self.generic_numbers[p // num_gns], self.generic_numbers[p % num_gns]) for p in unique_pairs]
+        return labels, pair_index, np.concatenate(structure_index), np.concatenate(values).astype(np.float64)
+
+    def grouped_pairs(self, gn_filter=None, scaling_factor=distance_scaling_factor):
+        """Distances (in Angstrom by default) per "gn1_gn2" label as lists (like Distances.data)"""
+        labels, pair_index, _, values = self.all_pairs(gn_filter)
+        grouped = split_by_group(values / scaling_factor, pair_index, len(labels))
+        return OrderedDict((label, d.tolist()) for label, d in zip(labels, grouped))
+
+    def pair_distances(self, pair):
+        """Scaled distances of one "gn1_gn2" pair per PDB code, for the structures where it is present"""
+        values = self.pair_values([pair])[:, 0]
+        return OrderedDict((pdb, values[s]) for s, pdb in enumerate(self.pdbs) if not np.isnan(values[s]))
+
+    def distances_to(self, gn):
+        """Scaled distances from one GN to all other GNs (in either pair order), one dictionary per structure"""
+        results = []
+        for s in range(len(self)):
+            distances = OrderedDict()
+            local = self.local_indices(s)
+            r = local[self.gn_index[gn]] if gn in self.gn_index else -1
+            if r >= 0:
+                n = len(self.positions[s])
+                others = np.array([k for k in range(n) if k != r], dtype=np.intp)
+                d = self.distances[s][condensed_index(n, np.minimum(others, r), np.maximum(others, r))]
+                for k, value in zip(others, d):
+                    if value >= 0:
+                        distances[self.generic_numbers[self.positions[s][k]]] = int(value)
+            results.append(distances)
+        return results
@@ -1,9 +1,9 @@
-from django.db.models import Avg, Variance, Count, Value, StdDev
-from django.contrib.postgres.aggregates import ArrayAgg
-from django.core.cache import cache
+from django.db.models import Count
+from common.cache_keys import DISTANCE_MAP
 
 from structure.models import Structure
 from contactnetwork.models import *
+from contactnetwork.distance_matrices import DistanceMatrices, group_statistics, split_by_group, is_tm_gn, masked_dissimilarity
 from residue.models import Residue, ResidueGenericNumber
 
 from collections import OrderedDict
@@ -44,22 +44,8 @@ class Distances():
 
 
     def fetch_agg(self):
-        ## REQUIRES PSQL SETTINGS TO HAVE MORE MEMORY
-        # sudo nano /etc/postgresql/9.3/main/postgresql.conf
-        # shared_buffers = 2GB
-        # work_mem = 100MB
-        # temp_buffers = 500MB
-        # sudo /etc/init.d/postgresql restart
-
-        ds = list(Distance.objects.filter(structure__in=self.structures) \
-                            .values('gns_pair').annotate(arr=ArrayAgg('distance')).values_list('gns_pair','arr'))
-        # #print(ds)
-        # print(ds.query)
-        # print(len(ds))
-        # for i,d in enumerate(ds):
-        #     print(d)
-        #     if i>100:
-        #         break
+        matrices = DistanceMatrices().load(structures=self.structures)
+        ds = list(matrices.grouped_pairs(scaling_factor=1).items())
         self.data = ds
         self.stats = {}
         self.stats_list = []
@@ -73,31 +59,27 @@ class Distances():
         print(len(self.stats))
 
     def fetch_and_calculate(self, with_arr = False):
-        ## REQUIRES PSQL SETTINGS TO HAVE MORE MEMORY
-        # sudo nano /etc/postgresql/9.3/main/postgresql.conf
-        # shared_buffers = 2GB
-        # work_mem = 100MB
-        # temp_buffers = 500MB
-        # sudo /etc/init.d/postgresql restart
         ds_with_key = {}
+        matrices = DistanceMatrices().load(structures=self.structures)
+        labels, pair_index, structure_index, values = matrices.all_pairs(is_tm_gn)
+        means, counts = group_statistics(values, pair_index, len(labels))
+        stds, _ = group_statistics(values, pair_index, len(labels), standard_deviation=True, ddof=0)
+        selected = np.flatnonzero(counts >= int(0.8*len(self.structures)))
+
+        ds = []
         if with_arr:
-            ds = list(Distance.objects.filter(structure__in=self.structures).exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                            .values('gns_pair') \
-                            .annotate(mean = Avg('distance'), std = StdDev('distance'), c = Count('distance'), dis = Count('distance'),arr=ArrayAgg('distance'),arr2=ArrayAgg('structure__pdb_code__index'),arr3=ArrayAgg('gns_pair')).values_list('gns_pair','mean','std','c','dis','arr','arr2','arr3').filter(c__gte=int(0.8*len(self.structures))))
-            for i,d in enumerate(ds):
-                ds[i] = list(ds[i])
-                ds[i][1] = ds[i][1] / distance_scaling_factor
-                ds[i][2] = ds[i][2] / distance_scaling_factor
-                ds[i][5] = [x / distance_scaling_factor for x in ds[i][5]]
-                ds[i][3] = d[2]/d[1]
-                ds_with_key[d[0]] = ds[i]
+            grouped_values = split_by_group(values, pair_index, len(labels))
+            grouped_pdbs = split_by_group(structure_index, pair_index, len(labels))
+            for p in selected:
+                d = [labels[p], means[p] / distance_scaling_factor, stds[p] / distance_scaling_factor, stds[p]/means[p], int(counts[p]),
+                     (grouped_values[p] / distance_scaling_factor).tolist(), [matrices.pdbs[i] for i in grouped_pdbs[p]], [labels[p]]*int(counts[p])]
+                ds.append(d)
+                ds_with_key[labels[p]] = d
         else:
-            ds = list(Distance.objects.filter(structure__in=self.structures).exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                            .values('gns_pair') \
-                            .annotate(mean = Avg('distance'), std = StdDev('distance'), c = Count('distance')).values_list('gns_pair','mean','std','c').filter(c__gte=int(len(self.structures)*0.8)))
-            for i,d in enumerate(ds):
-                ds[i] += (d[2]/d[1],)
-                ds_with_key[d[0]] = ds[i]
+            for p in selected:
+                d = (labels[p], means[p], stds[p], int(counts[p]), stds[p]/means[p])
+                ds.append(d)
+                ds_with_key[labels[p]] = d
         # # print(ds.query)
         # print(ds[1])
         # Assume that dispersion is always 4
@@ -343,41 +325,19 @@ class Distances():
         self.stats_window_key = stats_window_key
 
     def fetch_distances(self):
-        ds = Distance.objects.filter(structure__in=self.structures).all().values_list('distance','gns_pair')
-        self.data = {}
-        for d in ds:
-            label = d[1]
-            if label not in self.data:
-                self.data[label] = []
-            self.data[label].append(d[0]/distance_scaling_factor)
+        matrices = DistanceMatrices().load(structures=self.structures)
+        self.data = matrices.grouped_pairs()
 
     def fetch_distances_tm(self, distance_type = "CA"):
-#                .filter(gn1__in=self.filter_gns).filter(gn2__in=self.filter_gns) \
-        # ds = Distance.objects.filter(structure__in=self.structures) \
-        #         .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x')
-
-        if distance_type == "HC":
-            ds = Distance.objects.filter(structure__in=self.structures) \
-                .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                .values_list('distance_helix_center','gns_pair')
-        elif distance_type == "CB":
-            ds = Distance.objects.filter(structure__in=self.structures) \
-                .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                .values_list('distance_cb','gns_pair')
-        else:
-            ds = Distance.objects.filter(structure__in=self.structures) \
-                .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                .values_list('distance','gns_pair')
+        matrices = DistanceMatrices(distance_type).load(structures=self.structures)
 
         if self.filtered_gns:
-            ds = ds.filter(gn1__in=self.filter_gns).filter(gn2__in=self.filter_gns) \
+            filter_gns = set(self.filter_gns)
+            gn_filter = lambda gn: is_tm_gn(gn) and gn in filter_gns
+        else:
+            gn_filter = is_tm_gn
 
-        self.data = {}
-        for d in ds:
-            label = d[1]
-            if label not in self.data:
-                self.data[label] = []
-            self.data[label].append(d[0]/distance_scaling_factor)
+        self.data = matrices.grouped_pairs(gn_filter)
 
     def calculate(self):
         self.stats = {}
@@ -396,7 +356,7 @@ class Distances():
         #print(data)
             #print(d.interacting_pair.res1.generic_number.label)
 
-    def get_distance_matrix(self, normalize = True, cache_enabled = True):
+    def get_distance_matrix(self, normalize = True, cache_enabled = True, workers = 1):
         # common GNs
         common_gn = self.fetch_common_gns_tm()
 
@@ -414,88 +374,76 @@ class Distances():
 
         all_gns = sorted(list(all_gns))
 
-        pdb_distance_maps = {}
-        pdb_gns = {}
-        for pdb in self.pdbs:
-            cache_key = "distanceMap-" + pdb
-
-            # Cached?
-            if cache.has_key(cache_key) and cache_enabled:
-                cached_data = cache.get(cache_key)
-                distance_map = cached_data["map"]
-                structure_gn = cached_data["gns"]
-            else:
-                # grab raw distance data per structure
-                temp = Distances()
-                temp.load_pdbs([pdb])
-                temp.fetch_distances_tm()
-
-#                    .filter(generic_number__label__in=self.filter_gns) \
-                structure_gn = Residue.objects.filter(protein_conformation__in=temp.pconfs) \
-                    .exclude(generic_number=None) \
-                    .exclude(generic_number__label__startswith='8x') \
-                    .exclude(generic_number__label__startswith='12x') \
-                    .exclude(generic_number__label__startswith='23x') \
-                    .exclude(generic_number__label__startswith='34x') \
-                    .exclude(generic_number__label__startswith='45x') \
-                    .values_list('generic_number__label',flat=True)
+        distance_maps, pdb_gns = self.fetch_distance_maps(all_gns, cache_enabled)
 
-                if self.filtered_gns:
-                    structure_gn = structure_gn.filter(generic_number__label__in=self.filter_gns)
+        # GN pairs of the common GNs (condensed upper triangle) for all structures
+        all_gn_index = {gn: i for i, gn in enumerate(all_gns)}
+        gn_indices = np.array([ all_gn_index[residue] for residue in common_gn ], dtype=np.intp)
+        i, j = np.triu_indices(len(common_gn), 1)
+        values = np.array([ distance_maps[pdb][gn_indices[i], gn_indices[j]] for pdb in self.pdbs ]).reshape(len(self.pdbs), len(i))
 
-                structure_gn = list(structure_gn)
+        if normalize:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = np.nan_to_num(values/values.mean(axis=0))
 
-                # create distance map
-                distance_map = np.full((len(all_gns), len(all_gns)), 0.0)
+        # GNs each structure has, the dissimilarity of two structures uses the common GNs present in both
+        present = np.array([ np.isin(common_gn, pdb_gns[pdb]) for pdb in self.pdbs ]).reshape(len(self.pdbs), len(common_gn))
 
-                for i,res1 in enumerate(all_gns):
-                    for j in range(i+1, len(all_gns)):
-                        # grab average value
-                        res2 = all_gns[j]
-                        if res1+"_"+res2 in temp.data:
-                            distance_map[i][j] = temp.data[res1+"_"+res2][0]
-
-                # store in cache
-                if cache_enabled:
-                    store = {
-                        "map" : distance_map,
-                        "gns" : structure_gn
-                        }
-                    cache.set(cache_key, store, 60*60*24*14)
-
-            pdb_gns[pdb] = structure_gn
-
-            # Filtering indices to map to common_gns
-            gn_indices = np.array([ all_gns.index(residue) for residue in common_gn ])
-            pdb_distance_maps[pdb] = distance_map[gn_indices,:][:, gn_indices]
-
-            if "average" in pdb_distance_maps:
-                pdb_distance_maps["average"] +=  pdb_distance_maps[pdb]/len(self.pdbs)
-            else:
-                pdb_distance_maps["average"] =  pdb_distance_maps[pdb]/len(self.pdbs)
+        return masked_dissimilarity(values, present, workers=workers)
 
-        # store distance map
-        if normalize:
-            for pdb in self.pdbs:
-                pdb_distance_maps[pdb] = np.nan_to_num(pdb_distance_maps[pdb]/pdb_distance_maps["average"])
+    def fetch_distance_maps(self, all_gns, cache_enabled = True):
+        """Distance map (all_gns x all_gns, upper triangle, 0 when missing) and GNs of the residues of each PDB"""
+        distance_maps = {}
+        pdb_gns = {}
+        for pdb in self.pdbs:
+            # Cached?
+            cached_data = DISTANCE_MAP.get(pdb) if cache_enabled else None
+            if cached_data is not None:
+                distance_maps[pdb] = cached_data["map"]
+                pdb_gns[pdb] = cached_data["gns"]
 
-        # calculate distance matrix
-        distance_matrix = np.full((len(self.pdbs), len(self.pdbs)), 0.0)
-        for i, pdb1 in enumerate(self.pdbs):
-            for j in range(i+1, len(self.pdbs)):
-                pdb2 = self.pdbs[j]
+        missing = [ s for s, pdb in zip(self.structures, self.pdbs) if pdb not in distance_maps ]
+        if not missing:
+            return distance_maps, pdb_gns
 
-                # Get common GNs between two PDBs
-                common_between_pdbs = sorted(list(set(pdb_gns[pdb1]).intersection(pdb_gns[pdb2])))
+        # grab raw distance data and the residue GNs of all remaining structures at once
+        matrices = DistanceMatrices().load(structures=missing)
+        matrix_index = { structure_id: m for m, structure_id in enumerate(matrices.structure_ids) }
 
-                # Get common between above set and the overall common set of GNs
-                common_with_query_gns = sorted(list(set(common_gn).intersection(common_between_pdbs)))
+#                    .filter(generic_number__label__in=self.filter_gns) \
+        pconf_pdbs = { s.protein_conformation_id: s.pdb_code.index for s in missing }
+        structure_gn = Residue.objects.filter(protein_conformation_id__in=list(pconf_pdbs)) \
+            .exclude(generic_number=None) \
+            .exclude(generic_number__label__startswith='8x') \
+            .exclude(generic_number__label__startswith='12x') \
+            .exclude(generic_number__label__startswith='23x') \
+            .exclude(generic_number__label__startswith='34x') \
+            .exclude(generic_number__label__startswith='45x') \
+            .values_list('protein_conformation_id', 'generic_number__label')
 
-                # Get the indices of positions that are shared between two PDBs
-                gn_indices = np.array([ common_gn.index(residue) for residue in common_with_query_gns ])
+        if self.filtered_gns:
+            structure_gn = structure_gn.filter(generic_number__label__in=self.filter_gns)
+
+        for pdb in pconf_pdbs.values():
+            pdb_gns[pdb] = []
+        for pconf, gn in structure_gn:
+            pdb_gns[pconf_pdbs[pconf]].append(gn)
+
+        for s in missing:
+            pdb = s.pdb_code.index
+            # create distance map (in Angstrom, only the upper triangle as stored)
+            if s.pk in matrix_index:
+                distance_map = np.triu(np.nan_to_num(matrices.square(matrix_index[s.pk], all_gns)), 1)/distance_scaling_factor
+            else:
+                distance_map = np.full((len(all_gns), len(all_gns)), 0.0)
+            distance_maps[pdb] = distance_map
 
-                # Get distance between cells that have both GNs.
-                distance = np.sum(np.absolute(pdb_distance_maps[pdb1][gn_indices,:][:, gn_indices] - pdb_distance_maps[pdb2][gn_indices,:][:, gn_indices]))
-                distance_matrix[i, j] = distance_matrix[j, i] = distance * distance/(len(gn_indices)*len(gn_indices))
+            # store in cache
+            if cache_enabled:
+                store = {
+                    "map" : distance_map,
+                    "gns" : pdb_gns[pdb]
+                    }
+                DISTANCE_MAP.set(store, pdb)
 
-        return distance_matrix
+        return distance_maps, pdb_gns
@@ -0,0 +1,330 @@
+"""
+Bit-packed interaction fingerprints of structures (contactnetwork.models.ContactFingerprint).
+
+Every interacting residue pair of a structure has one bit per interaction type, atom class pair and level, so the
+interactions matching any combination of the interaction browser filters (types, strict definitions, inter/intra
+segment backbone/side chain contacts) follow from the bits without querying the interactions. The levels of a type
+and atom class pair are "at least 1, 2, 3 and 4 atom pairs" and "an atom pair at interaction level 0". Atom class
+pairs partition the atom pairs, so the number of atom pairs in any selection of classes (up to STRICT_ATOM_PAIRS)
+is the sum of the count bits of the selected classes. The residues of the structure are stored along with the pairs,
+so the residue data of the browser comes from the same rows. Counts of structures per pair are computed with
+bincount over the selected structures.
+"""
+from django.db.models import F
+
+from common.cache_keys import namespace
+from contactnetwork.models import ContactFingerprint, Interaction
+from residue.models import Residue
+from structure.models import Structure
+
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+
+INTERACTION_TYPES = ['ionic', 'polar', 'aromatic', 'hydrophobic', 'van-der-waals']
+
+# strict definitions: an atom pair at interaction level 0 or at least STRICT_ATOM_PAIRS atom pairs
+STRICT_LEVEL_TYPES = ['polar', 'aromatic']
+STRICT_COUNT_TYPES = ['hydrophobic', 'van-der-waals']
+STRICT_ATOM_PAIRS = 4
+
+# atom classes: backbone (C, O, N), CA (counts as backbone and as side chain) and side chain
+BACKBONE, CA, SIDE_CHAIN = 0, 1, 2
+ATOM_CLASS_PAIRS = [(BACKBONE, BACKBONE), (BACKBONE, CA), (BACKBONE, SIDE_CHAIN), (CA, CA), (CA, SIDE_CHAIN),
+                    (SIDE_CHAIN, SIDE_CHAIN)]
+
+# atom class pairs of the backbone/side chain contact options of the interaction browser
+CONTACT_CLASSES = {
+    'bbbb': [(BACKBONE, BACKBONE), (BACKBONE, CA), (CA, CA)],
+    'scbb': [(BACKBONE, CA), (BACKBONE, SIDE_CHAIN), (CA, CA), (CA, SIDE_CHAIN)],
+    'scsc': [(CA, CA), (CA, SIDE_CHAIN), (SIDE_CHAIN, SIDE_CHAIN)],
+    }
+
+# bits per type and atom class pair: at least 1..STRICT_ATOM_PAIRS atom pairs, an atom pair at level 0
+LEVEL_ZERO = STRICT_ATOM_PAIRS
+LEVELS = STRICT_ATOM_PAIRS + 1
+FINGERPRINT_BITS = len(INTERACTION_TYPES) * len(ATOM_CLASS_PAIRS) * LEVELS
+FINGERPRINT_BYTES = (FINGERPRINT_BITS + 7) // 8
+
+# number of structures of which the unpacked fingerprints are kept
+FINGERPRINT_CACHE_SIZE = 2000
+
+
+def atom_class(atomname):
+    """Atom class of an atom name (None for a missing name, which matches no contact option)"""
+    if atomname is None:
+        return None
+    if atomname in ('C', 'O', 'N'):
+        return BACKBONE
+    if atomname == 'CA':
+        return CA
+    return SIDE_CHAIN
+
+
+def atom_class_pair(atomname1, atomname2):
+    classes = (atom_class(atomname1), atom_class(atomname2))
+    if None in classes:
+        return None
+    return ATOM_CLASS_PAIRS.index(tuple(sorted(classes)))
+
+
+def fingerprint(residue_ids, rows):
+    """
+    Pairs and bits of the interaction rows (res1 id, res2 id, type, level, atomname1, atomname2) of a structure.
+    Returns the residue index pairs (n x 2 int32) and the bits (n x FINGERPRINT_BITS booleans).
+    """
+    index = {residue_id: i for i, residue_id in enumerate(residue_ids)}
+    pairs, types, classes, levels = [], [], [], []
+    for res1, res2, interaction_type, level, atomname1, atomname2 in rows:
+        if res1 not in index or res2 not in index or interaction_type not in INTERACTION_TYPES:
+            continue
+        class_pair = atom_class_pair(atomname1, atomname2)
+        if class_pair is None:
+            continue
+        pairs.append((index[res1], index[res2]))
+        types.append(INTERACTION_TYPES.index(interaction_type))
+        classes.append(class_pair)
+        levels.append(level)
+
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int32), np.zeros((0, FINGERPRINT_BITS), dtype=bool)
+
+    unique_pairs, pair_index = np.unique(np.array(pairs, dtype=np.int32), axis=0, return_inverse=True)
+    pair_index = pair_index.reshape(-1)
+    types, classes = np.array(types), np.array(classes)
+    counts = np.zeros((len(unique_pairs), len(INTERACTION_TYPES), len(ATOM_CLASS_PAIRS)), dtype=np.int32)
+    np.add.at(counts, (pair_index, types, classes), 1)
+    level_zero = np.zeros(counts.shape, dtype=bool)
+    zero = np.array(levels) == 0
+    level_zero[pair_index[zero], types[zero], classes[zero]] = True
+
+    bits = np.zeros(counts.shape + (LEVELS,), dtype=bool)
+    for level in range(STRICT_ATOM_PAIRS):
+        bits[..., level] = counts > level
+    bits[..., LEVEL_ZERO] = level_zero
+    return unique_pairs, bits.reshape(len(unique_pairs), FINGERPRINT_BITS)
+
+
+def build_fingerprint(structure_id):
+    """Stored ContactFingerprint fields of a structure, from its residues and interactions in the database"""
+    protein_conformation_id = Structure.objects.filter(pk=structure_id).values_list('protein_conformation_id', flat=True)[0]
+    residues = list(Residue.objects.filter(protein_conformation_id=protein_conformation_id).exclude(generic_number=None) \
+        .order_by('sequence_number').values_list('pk', 'sequence_number', 'generic_number__label',
+        'display_generic_number__label', 'amino_acid', 'protein_segment__slug'))
+
+    # interactions within the protein, as selected by the interaction browser
+    rows = Interaction.objects.filter(interacting_pair__referenced_structure_id=structure_id,
+        interacting_pair__res1__protein_conformation_id=protein_conformation_id,
+        interacting_pair__res2__protein_conformation_id=protein_conformation_id,
+        interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')).exclude(specific_type='water-mediated') \
+        .values_list('interacting_pair__res1_id', 'interacting_pair__res2_id', 'interaction_type', 'interaction_level',
+                     'atomname_residue1', 'atomname_residue2')
+    pairs, bits = fingerprint([r[0] for r in residues], rows)
+
+    return {
+        'residues': np.array([r[0] for r in residues], dtype='<i8').tobytes(),
+        'sequence_numbers': np.array([r[1] for r in residues], dtype='<i4').tobytes(),
+        'generic_numbers': ','.join([r[2] for r in residues]),
+        'display_generic_numbers': ','.join([r[3] or '' for r in residues]),
+        'amino_acids': ''.join([r[4] for r in residues]),
+        'segments': ','.join([r[5] or '' for r in residues]),
+        'pairs': pairs.astype('<i4').tobytes(),
+        'bits': np.packbits(bits, axis=1).tobytes(),
+        }
+
+
+class StructureFingerprint():
+    """Loaded ContactFingerprint of one structure (bits stay packed)"""
+    def __init__(self, structure_id, pdb, entry_name, residues, sequence_numbers, generic_numbers,
+                 display_generic_numbers, amino_acids, segments, pairs, bits):
+        self.structure_id = structure_id
+        self.pdb = pdb
+        self.entry_name = entry_name
+        self.residues = np.frombuffer(bytes(residues), dtype='<i8')
+        self.sequence_numbers = np.frombuffer(bytes(sequence_numbers), dtype='<i4')
+        self.generic_numbers = generic_numbers.split(',') if generic_numbers else []
+        self.display_generic_numbers = display_generic_numbers.split(',') if generic_numbers else []
+        self.amino_acids = amino_acids
+        self.segments = segments.split(',') if generic_numbers else []
+        self.pairs = np.frombuffer(bytes(pairs), dtype='<i4').reshape(-1, 2)
+        self.bits = np.frombuffer(bytes(bits), dtype=np.uint8).reshape(len(self.pairs), FINGERPRINT_BYTES)
+
+        segments = np.array(self.segments, dtype=object)
+        self.intra_segment = segments[self.pairs[:, 0]] == segments[self.pairs[:, 1]] if len(self.pairs) \
+            else np.zeros(0, dtype=bool)
+
+
+_fingerprints = OrderedDict()
+_fingerprints_namespace = None
+_fingerprints_lock = threading.Lock()
+
+
+def load_fingerprints(pdbs=None, structures=None):
+    """StructureFingerprint of each structure by id, the most recently used are kept until the interactions change.
+    Structures without a stored fingerprint (not built yet) get one from their interactions."""
+    global _fingerprints_namespace
+    rows = Structure.objects.all()
+    if pdbs is not None:
+        rows = rows.filter(pdb_code__index__in=pdbs)
+    if structures is not None:
+        rows = rows.filter(pk__in=structures)
+
+    rows = list(rows.order_by('pk').values_list('pk', 'pdb_code__index', 'protein_conformation__protein__entry_name'))
+    structure_ids = [row[0] for row in rows]
+    current = namespace(['interactions'])
+    with _fingerprints_lock:
+        if current != _fingerprints_namespace:
+            _fingerprints.clear()
+            _fingerprints_namespace = current
+        loaded = OrderedDict((s, _fingerprints[s]) for s in structure_ids if s in _fingerprints)
+
+    missing = [s for s in structure_ids if s not in loaded]
+    if missing:
+        for row in ContactFingerprint.objects.filter(structure_id__in=missing).values_list('structure_id',
+                'structure__pdb_code__index', 'structure__protein_conformation__protein__entry_name', 'residues',
+                'sequence_numbers', 'generic_numbers', 'display_generic_numbers', 'amino_acids', 'segments', 'pairs',
+                'bits'):
+            loaded[row[0]] = StructureFingerprint(*row)
+        for structure_id, pdb, entry_name in rows:
+            if structure_id not in loaded:
+                loaded[structure_id] = StructureFingerprint(structure_id, pdb, entry_name,
+                                                            **build_fingerprint(structure_id))
+
+    with _fingerprints_lock:
+        for structure_id, structure_fingerprint in loaded.items():
+            _fingerprints[structure_id] = structure_fingerprint
+            _fingerprints.move_to_end(structure_id)
+        while len(_fingerprints) > FINGERPRINT_CACHE_SIZE:
+            _fingerprints.popitem(last=False)
+    return [loaded[s] for s in structure_ids if s in loaded]
+
+
+class ContactFingerprints():
+    """Fingerprints of a set of structures with their residue pairs on a shared GN pair index"""
+    def __init__(self):
+        self.structures = []
+        self.structure_ids = []
+        self.pair_labels = []
+        self.pair_index = {}
+
+        # per residue pair of all structures
+        self.structure_index = np.zeros(0, dtype=np.intp)
+        self.pair_ids = np.zeros(0, dtype=np.intp)
+        self.res1 = np.zeros(0, dtype=np.int64)
+        self.res2 = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.structures)
+
+    def load(self, pdbs=None, structures=None):
+        """Load the fingerprints for a list of PDB codes and/or Structure objects (or ids)"""
+        self.structures = load_fingerprints(pdbs, structures)
+        self.structure_ids = [s.structure_id for s in self.structures]
+
+        structure_index, pair_ids, res1, res2 = [], [], [], []
+        for s, structure in enumerate(self.structures):
+            ids = []
+            for i, j in structure.pairs:
+                label = (structure.generic_numbers[i], structure.generic_numbers[j])
+                if label not in self.pair_index:
+                    self.pair_index[label] = len(self.pair_labels)
+                    self.pair_labels.append(label)
+                ids.append(self.pair_index[label])
+            structure_index.append(np.full(len(ids), s, dtype=np.intp))
+            pair_ids.append(np.array(ids, dtype=np.intp))
+            res1.append(structure.residues[structure.pairs[:, 0]])
+            res2.append(structure.residues[structure.pairs[:, 1]])
+
+        if self.structures:
+            self.structure_index = np.concatenate(structure_index)
+            self.pair_ids = np.concatenate(pair_ids)
+            self.res1 = np.concatenate(res1)
+            self.res2 = np.concatenate(res2)
+        return self
+
+    def contacts(self, interaction_types, strict_types=(), contact_options=()):
+        """
+        Which residue pairs interact with each type (pairs x INTERACTION_TYPES booleans) for the interaction browser
+        settings: the selected types, the types with a strict definition and the inter_/intra_ + bbbb/scbb/scsc options.
+        """
+        def class_mask(prefix):
+            mask = np.zeros(len(ATOM_CLASS_PAIRS), dtype=bool)
+            for name, class_pairs in CONTACT_CLASSES.items():
+                if prefix + name in contact_options:
+                    mask[[ATOM_CLASS_PAIRS.index(c) for c in class_pairs]] = True
+            return mask
+        inter_classes, intra_classes = class_mask('inter_'), class_mask('intra_')
+
+        contacts = []
+        for structure in self.structures:
+            present = np.zeros((len(structure.pairs), len(INTERACTION_TYPES)), dtype=bool)
+            if len(structure.pairs):
+                bits = np.unpackbits(structure.bits, axis=1, count=FINGERPRINT_BITS).astype(bool) \
+                    .reshape(len(structure.pairs), len(INTERACTION_TYPES), len(ATOM_CLASS_PAIRS), LEVELS)
+                classes = np.where(structure.intra_segment[:, None], intra_classes, inter_classes)
+                for t, interaction_type in enumerate(INTERACTION_TYPES):
+                    if interaction_type not in interaction_types:
+                        continue
+                    selected = bits[:, t] & classes[:, :, None]
+                    if interaction_type in strict_types and interaction_type in STRICT_LEVEL_TYPES:
+                        present[:, t] = selected[:, :, LEVEL_ZERO].any(axis=1)
+                    elif interaction_type in strict_types and interaction_type in STRICT_COUNT_TYPES:
+                        present[:, t] = selected[:, :, :STRICT_ATOM_PAIRS].sum(axis=(1, 2)) >= STRICT_ATOM_PAIRS
+                    else:
+                        present[:, t] = selected[:, :, 0].any(axis=1)
+            contacts.append(present)
+
+        if not contacts:
+            return np.zeros((0, len(INTERACTION_TYPES)), dtype=bool)
+        return np.concatenate(contacts)
+
+    def counts(self, contacts, weights=None):
+        """
+        Number of structures (or the summed weights of the structures) with each GN pair and type in contacts
+        (pairs x columns booleans), as GN pairs x columns.
+        """
+        contacts = np.asarray(contacts, dtype=bool)
+        if weights is None:
+            pair_weights = np.ones(len(self.pair_ids))
+        else:
+            pair_weights = np.asarray(weights, dtype=np.float64)[self.structure_index]
+        counts = np.zeros((len(self.pair_labels), contacts.shape[1]))
+        for column in range(contacts.shape[1]):
+            selected = contacts[:, column]
+            counts[:, column] = np.bincount(self.pair_ids[selected], weights=pair_weights[selected],
+                                            minlength=len(self.pair_labels))
+        return counts
+
+    def interaction_values(self, contacts):
+        """
+        The interacting residue pairs per type as the values of the grouped interaction query of the interaction
+        browser, with the GN pair index of each ('pair'), by type, structure and residue ids.
+        """
+        pair, type_index = np.nonzero(contacts)
+        structure_ids = np.array(self.structure_ids, dtype=np.int64)[self.structure_index[pair]]
+        order = np.lexsort((self.res2[pair], self.res1[pair], structure_ids, type_index))
+        return [{
+            'interaction_type': INTERACTION_TYPES[type_index[k]],
+            'interacting_pair__referenced_structure__pk': int(structure_ids[k]),
+            'interacting_pair__res1__pk': int(self.res1[pair[k]]),
+            'interacting_pair__res2__pk': int(self.res2[pair[k]]),
+            'pair': int(self.pair_ids[pair[k]]),
+            } for k in order]
+
+    def residue_values(self):
+        """The residues with a generic number of the structures as the values of a residue query"""
+        values = []
+        for structure in self.structures:
+            for i, residue_id in enumerate(structure.residues):
+                values.append({
+                    'pk': int(residue_id),
+                    'sequence_number': int(structure.sequence_numbers[i]),
+                    'generic_number__label': structure.generic_numbers[i],
+                    'display_generic_number__label': structure.display_generic_numbers[i],
+                    'amino_acid': structure.amino_acids[i],
+                    'protein_conformation__protein__entry_name': structure.entry_name,
+                    'protein_segment__slug': structure.segments[i] or None,
+                    })
+        return values
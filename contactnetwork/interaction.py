@@ -4,6 +4,8 @@ from contactnetwork.models import *
 
 from residue.models import Residue
 
+from scipy.spatial import cKDTree
+
 import math
 
 class InteractingPair:
@@ -12,14 +14,20 @@ class InteractingPair:
     NUM_SKIP_BB_INTERACTIONS = 4
 
     'Common base class for all interactions'
-    def __init__(self, res1, res2, dbres1, dbres2, structure):
+    def __init__(self, res1, res2, dbres1, dbres2, structure, compute = True, ring_descriptors = None):
         self.res1 = res1
         self.res2 = res2
         self.dbres1 = dbres1
         self.dbres2 = dbres2
         self.structure = structure
         self.interactions = []
-        self.compute_interactions()
+
+        # optional cache of ring descriptors per residue (shared between pairs by the InteractionEngine)
+        self.ring_descriptors = ring_descriptors
+
+        # the InteractionEngine fills in the interactions itself
+        if compute:
+            self.compute_interactions()
 
     def add_interactions(self, interaction):
         self.interactions.append(interaction)
@@ -58,6 +66,13 @@ class InteractingPair:
     def get_interactions(self):
         return self.interactions
 
+    def get_ring_descriptors(self, res):
+        if self.ring_descriptors is None:
+            return get_ring_descriptors(res)
+        if id(res) not in self.ring_descriptors:
+            self.ring_descriptors[id(res)] = get_ring_descriptors(res)
+        return self.ring_descriptors[id(res)]
+
     def get_residue_1(self):
         return self.res1
 
@@ -292,7 +307,7 @@ class InteractingPair:
             cation = self.res1
 
         if is_aromatic_aa(aromatic) and is_pos_charged(cation):
-            res1_desc = get_ring_descriptors(aromatic)
+            res1_desc = self.get_ring_descriptors(aromatic)
             res2_pos_atom_names = get_pos_charged_atom_names(cation)
 
             # Check if any charged atom is within 6.6 angstroms of any ring centroid
@@ -311,8 +326,8 @@ class InteractingPair:
 
     # Checks if two residues have a face to face interaction
     def face_to_face_interactions(self):
-        res1_desc = get_ring_descriptors(self.res1)
-        res2_desc = get_ring_descriptors(self.res2)
+        res1_desc = self.get_ring_descriptors(self.res1)
+        res2_desc = self.get_ring_descriptors(self.res2)
 
         # Make sure that the acute angle between the planes are less than (or eq.) 30
         # degrees and that the distance between centers is less than  (or eq.) 4.4 Angstrom.
@@ -324,11 +339,11 @@ class InteractingPair:
 
     # Checks if two residues have an edge to face interaction
     def edge_to_face_interactions(self, switch = False):
-        res1_desc = get_ring_descriptors(self.res1)
-        res2_desc = get_ring_descriptors(self.res2)
+        res1_desc = self.get_ring_descriptors(self.res1)
+        res2_desc = self.get_ring_descriptors(self.res2)
         if switch:
             res1_desc = res2_desc
-            res2_desc = get_ring_descriptors(self.res1)
+            res2_desc = self.get_ring_descriptors(self.res1)
 
 
         # Make sure the ring centers are closer than 5.5 angstroms
@@ -350,8 +365,8 @@ class InteractingPair:
             self.edge_to_face_interactions(switch = True)
 
     def loose_aromatic_interactions(self):
-        res1_desc = get_ring_descriptors(self.res1)
-        res2_desc = get_ring_descriptors(self.res2)
+        res1_desc = self.get_ring_descriptors(self.res1)
+        res2_desc = self.get_ring_descriptors(self.res2)
 
         # Make sure the ring centers are closer than 5.5 angstroms, not additional requirements
         for match1, match2 in [[index1, index2] for index1, r1 in enumerate(res1_desc)
@@ -374,6 +389,168 @@ class InteractingPair:
         for match1, match2 in [[a1, a2] for a1 in res1_atoms for a2 in res2_atoms if distance_between(a1.coord, a2.coord) <= ((VDW_RADII[a1.element] + VDW_RADII[a2.element]) * VDW_TRESHOLD_FACTOR)]:
             self.add_interactions(VanDerWaalsInteraction(match1.name, match2.name))
 
+class InteractionEngine:
+    """Classifies the interactions of many residue pairs at once.
+
+    The atoms of all residues are loaded into arrays once, candidate atom pairs are found with a KD-tree and the atom
+    based interaction types (ionic, H-bond, hydrophobic, van der Waals) are determined with masks over all atom pairs.
+    The results are the same InteractingPair objects, with the interactions in the same order, as computed per pair."""
+
+    # Largest atom-atom distance used by the atom based interaction types
+    MAX_ATOM_DISTANCE = 4.5
+
+    # Distances this close to a cut-off are recalculated exactly as in distance_between (float32 coordinates)
+    CUTOFF_TOLERANCE = 1e-4
+
+    def __init__(self, residues):
+        self.residues = list(residues)
+        self.residue_index = {id(res): i for i, res in enumerate(self.residues)}
+        self.ring_descriptors = {}
+
+        atoms, atom_residues = [], []
+        charged_rank, donor_rank, acceptor_rank = [], [], []
+        for i, res in enumerate(self.residues):
+            charged = get_charged_atom_names(res)
+            donors = list(get_hbond_donor_references(res)) if is_hbd(res) else []
+            acceptors = list(get_hbond_acceptors(res)) if is_hba(res) else []
+            for atom in res.child_list:
+                atoms.append(atom)
+                atom_residues.append(i)
+                charged_rank.append(charged.index(atom.name) if atom.name in charged else -1)
+                donor_rank.append(donors.index(atom.name) if atom.name in donors else -1)
+                acceptor_rank.append(acceptors.index(atom.name) if atom.name in acceptors else -1)
+
+        self.atoms = atoms
+        self.coords = numpy.array([atom.coord for atom in atoms], dtype=numpy.float32).reshape(-1, 3)
+        self.atom_residues = numpy.array(atom_residues, dtype=numpy.intp)
+        self.names = [atom.name for atom in atoms]
+        elements = [atom.element for atom in atoms]
+        self.radii = numpy.array([VDW_RADII.get(e, numpy.nan) for e in elements], dtype=numpy.float64)
+        self.hydrophobic = numpy.array([e == 'C' or e == 'S' for e in elements], dtype=bool)
+        self.charged_rank = numpy.array(charged_rank, dtype=numpy.intp)
+        self.donor_rank = numpy.array(donor_rank, dtype=numpy.intp)
+        self.acceptor_rank = numpy.array(acceptor_rank, dtype=numpy.intp)
+
+        self.pos_charged = numpy.array([is_pos_charged(res) for res in self.residues], dtype=bool)
+        self.neg_charged = numpy.array([is_neg_charged(res) for res in self.residues], dtype=bool)
+
+        self.tree = cKDTree(self.coords.astype(numpy.float64)) if len(atoms) else None
+
+    def atom_pairs(self, radius):
+        """All atom index pairs (i < j) of different residues within radius"""
+        if self.tree is None:
+            return numpy.empty((0, 2), dtype=numpy.intp)
+        pairs = self.tree.query_pairs(radius, output_type='ndarray')
+        return pairs[self.atom_residues[pairs[:, 0]] != self.atom_residues[pairs[:, 1]]]
+
+    def neighbor_pairs(self, radius):
+        """Residue pairs with any atoms within radius, ordered within the pair as by NeighborSearch.search_all"""
+        pairs = self.atom_pairs(radius)
+        residue_pairs = numpy.unique(self.atom_residues[pairs], axis=0) if len(pairs) else []
+
+        neighbors = set()
+        for r1, r2 in residue_pairs:
+            res1, res2 = self.residues[r1], self.residues[r2]
+            neighbors.add((res1, res2) if res1 < res2 else (res2, res1))
+        return list(neighbors)
+
+    def distances(self, first, second):
+        diff = self.coords[first].astype(numpy.float64) - self.coords[second].astype(numpy.float64)
+        return numpy.sqrt(numpy.einsum('ij,ij->i', diff, diff))
+
+    def within(self, first, second, distances, cutoff):
+        """Mask of atom pairs within the cut-off, exact for distances close to the cut-off"""
+        cutoff = numpy.broadcast_to(cutoff, distances.shape)
+        mask = distances <= cutoff
+        for k in numpy.flatnonzero(numpy.abs(distances - cutoff) < self.CUTOFF_TOLERANCE):
+            mask[k] = distance_between(self.atoms[first[k]].coord, self.atoms[second[k]].coord) <= cutoff[k]
+        return mask
+
+    def interacting_pairs(self, residue_pairs, dbres1, dbres2, structure):
+        """Classify the interactions of (res1, res2) pairs, dbres1/dbres2 map sequence numbers to DB residues.
+        Returns the InteractingPair objects in the order of residue_pairs."""
+        num_residues = len(self.residues)
+        interacting_pairs = []
+        pair_codes = {}
+        for k, (res1, res2) in enumerate(residue_pairs):
+            interacting_pairs.append(InteractingPair(res1, res2, dbres1[res1.id[1]], dbres2[res2.id[1]], structure,
+                                                     compute=False, ring_descriptors=self.ring_descriptors))
+            pair_codes[self.residue_index[id(res1)]*num_residues + self.residue_index[id(res2)]] = k
+
+        # candidate atom pairs oriented as (res1 atom, res2 atom) of the requested residue pairs
+        pairs = self.atom_pairs(self.MAX_ATOM_DISTANCE + self.CUTOFF_TOLERANCE)
+        pairs = numpy.concatenate([pairs, pairs[:, ::-1]])
+        codes = self.atom_residues[pairs[:, 0]]*num_residues + self.atom_residues[pairs[:, 1]]
+        index = numpy.array([pair_codes.get(code, -1) for code in codes.tolist()], dtype=numpy.intp)
+        selected = index >= 0
+        pair_index, first, second = index[selected], pairs[selected, 0], pairs[selected, 1]
+        distances = self.distances(first, second)
+        r1, r2 = self.atom_residues[first], self.atom_residues[second]
+
+        # Ionic: charged atoms of oppositely charged residues within 4.5A
+        ionic = (self.charged_rank[first] >= 0) & (self.charged_rank[second] >= 0) \
+            & ((self.pos_charged[r1] & self.neg_charged[r2]) | (self.neg_charged[r1] & self.pos_charged[r2]))
+        ionic &= self.within(first, second, distances, 4.5)
+        for c in self.ordered(ionic, pair_index, self.charged_rank[first], self.charged_rank[second]):
+            interaction_class = PosNegIonicInteraction if self.pos_charged[r1[c]] else NegPosIonicInteraction
+            interacting_pairs[pair_index[c]].add_interactions(interaction_class(self.names[first[c]], self.names[second[c]]))
+
+        # H-bonds: strict (3.5A + angle) in both directions, otherwise loose (4A)
+        donor_acceptor = (self.donor_rank[first] >= 0) & (self.acceptor_rank[second] >= 0)
+        acceptor_donor = (self.acceptor_rank[first] >= 0) & (self.donor_rank[second] >= 0)
+        strict = self.within(first, second, distances, 3.5)
+        loose = self.within(first, second, distances, 4)
+
+        found = numpy.zeros(len(interacting_pairs), dtype=bool)
+        strict_hbonds = []
+        for c in self.ordered(donor_acceptor & strict, pair_index, self.donor_rank[first], self.acceptor_rank[second]):
+            pair = interacting_pairs[pair_index[c]]
+            strict_hbonds.append((pair_index[c], 0, InteractingPair.verify_hbond_angle(pair.res1, self.names[first[c]], pair.res2, self.names[second[c]]), c))
+        for c in self.ordered(acceptor_donor & strict, pair_index, self.donor_rank[second], self.acceptor_rank[first]):
+            pair = interacting_pairs[pair_index[c]]
+            strict_hbonds.append((pair_index[c], 1, InteractingPair.verify_hbond_angle(pair.res2, self.names[second[c]], pair.res1, self.names[first[c]]), c))
+        for k, direction, verified, c in sorted(strict_hbonds, key=lambda x: (x[0], x[1])):
+            if verified:
+                found[k] = True
+                if direction == 0:
+                    interacting_pairs[k].add_interactions(HydrogenBondDAInteraction(self.names[first[c]], self.names[second[c]]))
+                else:
+                    interacting_pairs[k].add_interactions(HydrogenBondADInteraction(self.names[first[c]], self.names[second[c]]))
+
+        no_strict = ~found[pair_index]
+        loose_hbonds = [(pair_index[c], 0, c) for c in self.ordered(donor_acceptor & loose & no_strict, pair_index, self.donor_rank[first], self.acceptor_rank[second])]
+        loose_hbonds += [(pair_index[c], 1, c) for c in self.ordered(acceptor_donor & loose & no_strict, pair_index, self.donor_rank[second], self.acceptor_rank[first])]
+        for k, direction, c in sorted(loose_hbonds, key=lambda x: (x[0], x[1])):
+            if direction == 0:
+                interacting_pairs[k].add_interactions(LooseHydrogenBondDAInteraction(self.names[first[c]], self.names[second[c]]))
+            else:
+                interacting_pairs[k].add_interactions(LooseHydrogenBondADInteraction(self.names[first[c]], self.names[second[c]]))
+
+        # Aromatic: only a few residue pairs, uses the shared ring descriptors
+        for pair in interacting_pairs:
+            if is_aromatic_aa(pair.res1) or is_aromatic_aa(pair.res2):
+                pair.aromatic_interactions()
+
+        # Hydrophobic: carbon/sulfur atoms within 4.5A
+        hydrophobic = self.hydrophobic[first] & self.hydrophobic[second] & self.within(first, second, distances, 4.5)
+        for c in self.ordered(hydrophobic, pair_index, first, second):
+            interacting_pairs[pair_index[c]].add_interactions(HydrophobicInteraction(self.names[first[c]], self.names[second[c]]))
+
+        # Van der Waals: within the sum of the radii (times the threshold factor)
+        with numpy.errstate(invalid='ignore'):
+            van_der_waals = self.within(first, second, distances, (self.radii[first] + self.radii[second]) * VDW_TRESHOLD_FACTOR)
+        for c in self.ordered(van_der_waals, pair_index, first, second):
+            interacting_pairs[pair_index[c]].add_interactions(VanDerWaalsInteraction(self.names[first[c]], self.names[second[c]]))
+
+        return interacting_pairs
+
+    @staticmethod
+    def ordered(mask, pair_index, key1, key2):
+        """Indices of the selected atom pairs, sorted per residue pair as the nested loops of InteractingPair"""
+        selected = numpy.flatnonzero(mask)
+        order = numpy.lexsort((key2[selected], key1[selected], pair_index[selected]))
+        return selected[order]
+
 # Make type and detail variables and default functions
 class CI(object):
     def __init__(self, name1, name2):
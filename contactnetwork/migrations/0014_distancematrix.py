@@ -0,0 +1,80 @@
+# Generated by Django 3.0.3 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from itertools import groupby
+
+import numpy as np
+
+
+def pack(distances):
+    return np.asarray(distances, dtype='<i4').tobytes()
+
+
+def backfill_distance_matrices(apps, schema_editor):
+    """One DistanceMatrix per structure from the existing Distance rows, GNs in residue order"""
+    Distance = apps.get_model('contactnetwork', 'Distance')
+    DistanceMatrix = apps.get_model('contactnetwork', 'DistanceMatrix')
+
+    rows = Distance.objects.filter(structure__isnull=False, res1__isnull=False, res2__isnull=False).order_by(
+        'structure_id').values_list('structure_id', 'res1_id', 'res2_id', 'gn1', 'gn2', 'res1__amino_acid',
+        'res2__amino_acid', 'distance', 'distance_cb', 'distance_helix_center').iterator()
+
+    matrices = []
+    for structure_id, distances in groupby(rows, key=lambda r: r[0]):
+        distances = list(distances)
+        residues = {}
+        for _, res1, res2, gn1, gn2, aa1, aa2 in [d[:7] for d in distances]:
+            residues[res1] = (gn1, aa1)
+            residues[res2] = (gn2, aa2)
+        order = sorted(residues)
+        index = {res: i for i, res in enumerate(order)}
+        n = len(order)
+
+        values = np.full((3, n*(n-1)//2), -1, dtype=np.int64)
+        for d in distances:
+            i, j = sorted((index[d[1]], index[d[2]]))
+            if i == j:
+                continue
+            k = n*i - i*(i+1)//2 + (j - i - 1)
+            for field, value in enumerate(d[7:]):
+                if value is not None:
+                    values[field, k] = value
+
+        matrices.append(DistanceMatrix(structure_id=structure_id,
+                                       generic_numbers=','.join([residues[res][0] or '' for res in order]),
+                                       amino_acids=''.join([residues[res][1] or 'X' for res in order]),
+                                       distance=pack(values[0]), distance_cb=pack(values[1]),
+                                       distance_helix_center=pack(values[2])))
+        if len(matrices) >= 100:
+            DistanceMatrix.objects.bulk_create(matrices)
+            matrices = []
+    DistanceMatrix.objects.bulk_create(matrices)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0036_auto_20201126_1704'),
+        ('contactnetwork', '0013_auto_20200602_1710'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistanceMatrix',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generic_numbers', models.TextField()),
+                ('amino_acids', models.TextField()),
+                ('distance', models.BinaryField()),
+                ('distance_cb', models.BinaryField()),
+                ('distance_helix_center', models.BinaryField()),
+                ('structure', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='distance_matrix', to='structure.Structure')),
+            ],
+            options={
+                'db_table': 'distance_matrix',
+            },
+        ),
+        migrations.RunPython(backfill_distance_matrices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.3 on 2026-10-18 16:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0036_auto_20201126_1704'),
+        ('contactnetwork', '0014_distancematrix'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('residues', models.BinaryField()),
+                ('sequence_numbers', models.BinaryField()),
+                ('generic_numbers', models.TextField()),
+                ('display_generic_numbers', models.TextField()),
+                ('amino_acids', models.TextField()),
+                ('segments', models.TextField()),
+                ('pairs', models.BinaryField()),
+                ('bits', models.BinaryField()),
+                ('structure', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='contact_fingerprint', to='structure.Structure')),
+            ],
+            options={
+                'db_table': 'contact_fingerprint',
+            },
+        ),
+    ]
@@ -2,7 +2,6 @@ from structure.models import Structure
 
 from django.db import models
 import numpy as np
-import statistics
 
 
 distance_scaling_factor = 10000
@@ -75,68 +74,104 @@ class Distance(models.Model):
     class Meta():
         db_table = 'distance'
 
+class DistanceMatrix(models.Model):
+    """All pairwise distances between the generic number positions of a structure in one row.
+    Distances are stored as the condensed upper triangle (int32, scaled by distance_scaling_factor, -1 when missing)
+    over the generic numbers in the stored order, so pair gn1_gn2 is only defined when gn1 comes before gn2."""
+    structure = models.OneToOneField('structure.Structure', related_name='distance_matrix', on_delete=models.CASCADE)
+    generic_numbers = models.TextField() # comma separated GN labels (matrix order)
+    amino_acids = models.TextField() # one letter amino acid codes (matrix order)
+    distance = models.BinaryField()
+    distance_cb = models.BinaryField()
+    distance_helix_center = models.BinaryField()
+
+    @classmethod
+    def truncate(cls):
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE TABLE "{0}" RESTART IDENTITY CASCADE'.format(cls._meta.db_table))
+
+    @staticmethod
+    def pack(distances):
+        """Scaled distances (NaN when missing) to the stored int32 bytes"""
+        distances = np.asarray(distances, dtype=np.float64)
+        return np.where(np.isnan(distances), -1, distances).astype('<i4').tobytes()
+
+    @staticmethod
+    def unpack(data):
+        return np.frombuffer(bytes(data), dtype='<i4')
+
+    def get_generic_numbers(self):
+        return self.generic_numbers.split(',') if self.generic_numbers else []
+
+    class Meta():
+        db_table = 'distance_matrix'
+
+class ContactFingerprint(models.Model):
+    """The interactions of a structure as bits per residue pair (layout in contactnetwork.fingerprints).
+    The residues with a generic number of the structure's protein conformation are stored in sequence order, pairs
+    are int32 index pairs into them (first residue with the lower id) with the packed bits of each pair."""
+    structure = models.OneToOneField('structure.Structure', related_name='contact_fingerprint', on_delete=models.CASCADE)
+    residues = models.BinaryField() # residue ids (int64)
+    sequence_numbers = models.BinaryField() # int32
+    generic_numbers = models.TextField() # comma separated GN labels
+    display_generic_numbers = models.TextField() # comma separated display GN labels
+    amino_acids = models.TextField() # one letter amino acid codes
+    segments = models.TextField() # comma separated protein segment slugs
+    pairs = models.BinaryField() # residue index pairs (int32)
+    bits = models.BinaryField() # packed bits of every pair (uint8)
+
+    @classmethod
+    def truncate(cls):
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE TABLE "{0}" RESTART IDENTITY CASCADE'.format(cls._meta.db_table))
+
+    class Meta():
+        db_table = 'contact_fingerprint'
+
 def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, standard_deviation = False, split_by_amino_acid = False):
     ## Returned dataset is in ClassA GNs...
-    matrix = {}
-    group_distances = {}
+    from contactnetwork.distance_matrices import DistanceMatrices, group_statistics
 
     if len(pdbs)==1:
         # Never get SD when only looking at a single pdb...
         standard_deviation = False
 
-    ds = list(Distance.objects.filter(structure__pdb_code__index__in=[ pdb.upper() for pdb in pdbs], gns_pair__in=interaction_keys) \
-                         .values('gns_pair','distance','res1__amino_acid','res2__amino_acid','structure__pk'))
+    interaction_keys = list(interaction_keys)
+    matrices = DistanceMatrices().load(pdbs=[ pdb.upper() for pdb in pdbs])
+    values, aa_codes = matrices.pair_values(interaction_keys, amino_acids=True)
+
+    # one observation per structure and pair present
+    structure_index, pair_index = np.nonzero(~np.isnan(values))
+    dists = values[structure_index, pair_index]
+
+    # group observations per key (GN pair, optionally split by the amino acid pair)
+    if split_by_amino_acid:
+        group_codes = pair_index*65536 + aa_codes[structure_index, pair_index]
+    else:
+        group_codes = pair_index
+    group_codes, groups = np.unique(group_codes, return_inverse=True)
+
+    keys = []
+    for code in group_codes:
+        if split_by_amino_acid:
+            key = '{}{}{}'.format(interaction_keys[code // 65536], chr(code % 65536 // 256), chr(code % 256)).replace("_",",")
+        else:
+            key = interaction_keys[code]
+        keys.append(key)
+
     if not normalized:
-        for d in ds:
-            if split_by_amino_acid:
-                key = '{}{}{}'.format(d['gns_pair'],d['res1__amino_acid'],d['res2__amino_acid']).replace("_",",")
-            else:
-                key = d['gns_pair']
-            if key not in matrix:
-                matrix[key] = []
-            matrix[key].append(d['distance'])
-
-        # Calculate the average of averages
-        for key,dists in matrix.items():
-            if standard_deviation and len(pdbs)>1:
-                if len(dists)==1:
-                    stdevdists = 0
-                else:
-                    stdevdists = statistics.stdev(dists)
-                group_distances[key] = stdevdists/distance_scaling_factor
-            else:
-                group_distances[key] = sum(dists)/len(dists)/distance_scaling_factor
+        group_values, _ = group_statistics(dists, groups, len(keys), standard_deviation and len(pdbs)>1)
     else:
         # NORMALIZE CODE
-        for d in ds:
-            if split_by_amino_acid:
-                key = '{}{}{}'.format(d['gns_pair'],d['res1__amino_acid'],d['res2__amino_acid']).replace("_",",")
-            else:
-                key = d['gns_pair']
-            dist = d['distance']
-            pf = s_lookup[d['structure__pk']][2] # get the "receptor" level of the structure to group these regardless of species
-
-            if key not in matrix:
-                matrix[key] = {}
-            if pf not in matrix[key]:
-                matrix[key][pf] = []
-            matrix[key][pf].append(dist)
-
-        # Calculate the average of averages
-        for key,pfs in matrix.items():
-            # if key=='3x50_5x50':
-            #     print(pfs)
-            means = [sum(dists)/len(dists) for pf,dists in pfs.items() ]
-            if standard_deviation and len(pdbs)>1:
-                if len(means)==1:
-                    stdevofmeans = 0
-                else:
-                    # stdevofmeans = np.std(means, ddof=1)
-                    stdevofmeans = statistics.stdev(means)
-
-                group_distances[key] = stdevofmeans/distance_scaling_factor
-            else:
-                meanofmeans = sum(means)/len(means)
-                group_distances[key] = meanofmeans/distance_scaling_factor
-
-    return group_distances
+        # get the "receptor" level of the structure to group these regardless of species
+        families = {}
+        structure_families = np.array([families.setdefault(s_lookup[pk][2], len(families)) for pk in matrices.structure_ids], dtype=np.int64)
+
+        # first the average per family, then the average (or SD) of the family averages
+        family_codes, family_groups = np.unique(groups*max(len(families),1) + structure_families[structure_index], return_inverse=True)
+        family_means, _ = group_statistics(dists, family_groups, len(family_codes))
+        group_values, _ = group_statistics(family_means, family_codes // max(len(families),1), len(keys), standard_deviation and len(pdbs)>1)
+
+    return {key: float(group_values[i])/distance_scaling_factor for i, key in enumerate(keys)}
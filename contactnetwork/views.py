@@ -14,8 +14,12 @@ import functools
 import hashlib
 import copy
 
+from common.cache_keys import ALL_PDBS_AA_PAIRS
 from contactnetwork.models import *
 from contactnetwork.distances import *
+from contactnetwork.distance_matrices import DistanceMatrices
+from contactnetwork.clustering import leaf_order, newick, silhouette_scores
+from contactnetwork.fingerprints import ContactFingerprints, INTERACTION_TYPES
 from contactnetwork.functions import *
 from structure.models import Structure, StructureVectors, StructureExtraProteins
 from structure.templatetags.structure_extras import *
@@ -529,6 +533,65 @@ def PdbTableData(request):
 
     # return render(request, 'contactnetwork/test.html', {'data_table':data_table})
 
+def get_all_pdbs_aa_pairs():
+    """Structures with each amino acid pair at every interacting pair of generic numbers (cached until the interactions are rebuilt)"""
+    all_pdbs_pairs = ALL_PDBS_AA_PAIRS.get()
+    if all_pdbs_pairs:
+        return all_pdbs_pairs
+
+    def gpcrdb_number_comparator(e1, e2):
+            t1 = e1.split('x')
+            t2 = e2.split('x')
+
+            if e1 == e2:
+                return 0
+
+            if t1[0] == t2[0]:
+                if t1[1] < t2[1]:
+                    return -1
+                else:
+                    return 1
+
+            if t1[0] < t2[0]:
+                return -1
+            else:
+                return 1
+
+    # All interacting GN pairs and the residues of all structures from the contact fingerprints
+    fingerprints = ContactFingerprints().load(structures=Structure.objects.filter(refined=False))
+    all_interaction_residues = set()
+    for gen1, gen2 in fingerprints.pair_labels:
+        all_interaction_residues.add(gen1)
+        all_interaction_residues.add(gen2)
+    all_interaction_residues = sorted(list(all_interaction_residues), key=functools.cmp_to_key(gpcrdb_number_comparator))
+    gn_index = {gn: i for i, gn in enumerate(all_interaction_residues)}
+
+    # amino acid (code point, 0 when absent) of every structure at every GN
+    entry_names = np.array([structure.entry_name for structure in fingerprints.structures], dtype=object)
+    aa_codes = np.zeros((len(fingerprints), len(all_interaction_residues)), dtype=np.int64)
+    for s, structure in enumerate(fingerprints.structures):
+        for gn, aa in zip(structure.generic_numbers, structure.amino_acids):
+            if gn in gn_index:
+                aa_codes[s, gn_index[gn]] = ord(aa)
+
+    all_pdbs_pairs = {}
+    for gen1, gen2 in fingerprints.pair_labels:
+        # pairs in the order of the GN list
+        if gpcrdb_number_comparator(gen1, gen2) >= 0:
+            continue
+        aa1, aa2 = aa_codes[:, gn_index[gen1]], aa_codes[:, gn_index[gen2]]
+        present = np.flatnonzero((aa1 > 0) & (aa2 > 0))
+        if not len(present):
+            continue
+        pair_codes = aa1[present]*256 + aa2[present]
+        coord = '{},{}'.format(gen1,gen2)
+        all_pdbs_pairs[coord] = {}
+        for code in np.unique(pair_codes):
+            pair = '{}{}'.format(chr(code // 256), chr(code % 256))
+            all_pdbs_pairs[coord][pair] = entry_names[present[pair_codes == code]].tolist()
+    ALL_PDBS_AA_PAIRS.set(all_pdbs_pairs)
+    return all_pdbs_pairs
+
 @csrf_exempt
 def InteractionBrowserData(request):
 
@@ -606,95 +669,17 @@ def InteractionBrowserData(request):
     except IndexError:
         strict_interactions = []
 
-    i_types_filter = Q()
-    if i_types:
-        if len(strict_interactions) == 0:
-            i_types_filter |= Q(interaction_type__in=i_types)
-        else:
-            # Merging the interaction filter with filters for the strict settings
-            for int_type in i_types:
-                if int_type in strict_interactions:
-                    if int_type == 'polar' or int_type == 'aromatic':
-                        i_types_filter = i_types_filter | (Q(interaction_type=int_type) & Q(interaction_level=0))
-                    elif int_type == 'hydrophobic' or int_type == 'van-der-waals':
-                        i_types_filter = i_types_filter | (Q(interaction_type=int_type) & Q(atompaircount__gte=4))
-                else:
-                    i_types_filter = i_types_filter | Q(interaction_type=int_type)
-
     # Options settings
     try:
         contact_options = [x.lower() for x in request_method.getlist('options[]')]
     except IndexError:
         contact_options = []
 
-    i_options_filter = Q()
-    # Filter out contact within the same helix
-    #if contact_options and len(contact_options) > 0:
-    # if not contact_options or "intrahelical" not in contact_options:
-    #    i_options_filter = ~Q(interacting_pair__res1__protein_segment=F('interacting_pair__res2__protein_segment'))
-
-    # Filter out contact with backbone atoms
-    # backbone_atoms = ["C", "O", "N", "CA"]
-    # if not contact_options or "backbone" not in contact_options:
-    #    i_options_filter = i_options_filter & ~Q(atomname_residue1__in=backbone_atoms) & ~Q(atomname_residue2__in=backbone_atoms)
-
-    # Filters for inter- and intrasegment contacts + BB/SC filters
-    backbone_atoms = ["C", "O", "N", "CA"]
-    pure_backbone_atoms = ["C", "O", "N"]
-
-    # INTERsegment interactions
-    inter_segments = ~Q(interacting_pair__res1__protein_segment=F('interacting_pair__res2__protein_segment'))
-
-    # Blocking filter for empty settings
-    inter_options_filter = (inter_segments & Q(atomname_residue1="FOO"))
-
-    # BB-BB
-    if contact_options and "inter_bbbb" in contact_options:
-        bbbb = Q(atomname_residue1__in=backbone_atoms) & Q(atomname_residue2__in=backbone_atoms) & inter_segments
-        inter_options_filter = inter_options_filter | bbbb
-
-    # SC-BB
-    if contact_options and "inter_scbb" in contact_options:
-        scbb = ((Q(atomname_residue1__in=backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms)) | (~Q(atomname_residue1__in=pure_backbone_atoms) & Q(atomname_residue2__in=backbone_atoms))) & inter_segments
-        inter_options_filter = inter_options_filter | scbb
-
-    # SC-SC
-    if contact_options and "inter_scsc" in contact_options:
-        scsc = ~Q(atomname_residue1__in=pure_backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms) & inter_segments
-        inter_options_filter = inter_options_filter | scsc
-
-    # INTRAsegment interactions
-    intra_segments = Q(interacting_pair__res1__protein_segment=F('interacting_pair__res2__protein_segment'))
-
-    # Blocking filter for empty settings
-    intra_options_filter = (intra_segments & Q(atomname_residue1="FOO"))
-
-    # BB-BB
-    if contact_options and "intra_bbbb" in contact_options:
-        bbbb = Q(atomname_residue1__in=backbone_atoms) & Q(atomname_residue2__in=backbone_atoms) & intra_segments
-        intra_options_filter = intra_options_filter | bbbb
-
-    # SC-BB
-    if contact_options and "intra_scbb" in contact_options:
-        scbb = ((Q(atomname_residue1__in=backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms)) | (~Q(atomname_residue1__in=pure_backbone_atoms) & Q(atomname_residue2__in=backbone_atoms))) & intra_segments
-        intra_options_filter = intra_options_filter | scbb
-
-    # SC-SC
-    if contact_options and "intra_scsc" in contact_options:
-        scsc = ~Q(atomname_residue1__in=pure_backbone_atoms) & ~Q(atomname_residue2__in=pure_backbone_atoms) & intra_segments
-        intra_options_filter = intra_options_filter | scsc
-
-    i_options_filter = inter_options_filter | intra_options_filter
-
     # DISCUSS: cache hash now takes the normalize along, is this necessary
     normalized = "normalize" in contact_options
 
     forced_class_a = "classa" in contact_options
 
-    # Segment filters are now disabled
-    segment_filter_res1 = Q()
-    segment_filter_res2 = Q()
-
     # Cache
     hash_list = [pdbs1,pdbs2,i_types, strict_interactions, contact_options]
     hash_cache_key = 'interactionbrowserdata_{}'.format(get_hash(hash_list))
@@ -847,46 +832,11 @@ def InteractionBrowserData(request):
             class_mutations = {key: len(value) for key, value in class_mutations.items()}
             cache.set(cache_key, class_mutations, 3600 * 24 * 7)
 
-        # Get the relevant interactions
-        # TODO MAKE SURE ITs only gpcr residues..
-        interactions = Interaction.objects.filter(
-            interacting_pair__referenced_structure__pdb_code__index__in=pdbs_upper
-        ).filter(
-            interacting_pair__res1__protein_conformation_id=F('interacting_pair__res2__protein_conformation_id') # Filter interactions with other proteins
-        ).filter(
-            interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')
-        ).filter(
-            segment_filter_res1 & segment_filter_res2
-        ).values(
-            'interaction_type',
-            'interacting_pair__referenced_structure__pk',
-            'interacting_pair__res1__pk',
-            'interacting_pair__res2__pk',
-        ).distinct(
-        ).annotate(
-             atompaircount=Count('interaction_type'),
-             arr=ArrayAgg('pk')
-        ).exclude(
-            specific_type='water-mediated'
-        ).filter(
-            i_types_filter
-        ).filter(
-            i_options_filter
-        ).order_by(
-            'interaction_type',
-            'interacting_pair__referenced_structure__pk',
-            'interacting_pair__res1__pk',
-            'interacting_pair__res2__pk'
-        )
-
-        # FOR DEBUGGING interaction + strict filters
-        # print(interactions.query)
-        interactions = list(interactions)
-
-        # Grab unique interaction_IDs
-        interaction_ids = []
-        for entry in interactions:
-            interaction_ids.extend(entry['arr'])
+        # Get the relevant interactions (residue pairs of the GPCR per type) from the contact fingerprints,
+        # strict definitions and backbone/side chain options are applied to the atom pairs of each residue pair
+        fingerprints = ContactFingerprints().load(pdbs=pdbs_upper)
+        contacts = fingerprints.contacts(i_types, strict_interactions, contact_options)
+        interactions = fingerprints.interaction_values(contacts)
 
         # Interaction type sort - optimize by statically defining interaction type order
         order = ['ionic', 'polar', 'aromatic', 'hydrophobic', 'van-der-waals','None']
@@ -985,71 +935,8 @@ def InteractionBrowserData(request):
         # TODO, check if can be deleted... it is regenerated later with class_specific numbers
         # distinct_gns = list(Residue.objects.filter(protein_conformation__protein__entry_name__in=pdbs).exclude(generic_number=None).values_list('generic_number__label','protein_segment__slug').distinct().order_by())
 
-        all_pdbs_pairs = cache.get("all_pdbs_aa_pairs")
-        # all_pdbs_pairs = None
-        if not all_pdbs_pairs:
-            # To save less, first figure out all possible interaction pairs
-            pos_interactions = list(Interaction.objects.all(
-            ).values_list(
-                'interacting_pair__res1__generic_number__label',
-                'interacting_pair__res2__generic_number__label',
-            ).filter(interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')).distinct())
-
-            all_interaction_pairs = []
-            all_interaction_residues = set()
-            for i in pos_interactions:
-                all_interaction_pairs.append('{},{}'.format(i[0],i[1]))
-                all_interaction_residues.add(i[0])
-                all_interaction_residues.add(i[1])
-            all_interaction_residues = sorted(list(all_interaction_residues), key=functools.cmp_to_key(gpcrdb_number_comparator))
-
-            all_pdbs = list(Structure.objects.filter(refined=False).values_list('pdb_code__index', flat=True))
-            all_pdbs = [x.lower() for x in all_pdbs]
-            #generic_number__label__in=all_interaction_residues)
-            residues = Residue.objects.filter(protein_conformation__protein__entry_name__in=all_pdbs).exclude(generic_number=None).values(
-                        'pk','sequence_number','display_generic_number__label','generic_number__label','amino_acid','protein_conformation__protein__entry_name','protein_segment__slug').all()
-
-            r_lookup = {}
-            r_pair_lookup = defaultdict(lambda: defaultdict(lambda: []))
-            segm_lookup = {}
-            r_presence_lookup = defaultdict(lambda: [])
-            r_class_translate = {}
-
-            for r in residues:
-                if r['generic_number__label'] not in all_interaction_residues:
-                    continue
-                r_lookup[r['pk']] = r
-                r_pair_lookup[r['generic_number__label']][r['amino_acid']].append(r['protein_conformation__protein__entry_name'])
-                r_presence_lookup[r['generic_number__label']].append(r['protein_conformation__protein__entry_name'])
-                segm_lookup[r['generic_number__label']] = r['protein_segment__slug']
-                r['display_generic_number__label'] = re.sub(r'\.[\d]+', '', r['display_generic_number__label'])
-                r_class_translate[r['generic_number__label']] = r['display_generic_number__label']
-
-            gen_keys = sorted(r_pair_lookup.keys(), key=functools.cmp_to_key(gpcrdb_number_comparator))
-            all_pdbs_pairs = {}
-            for i,gen1 in enumerate(all_interaction_residues):
-                for gen2 in all_interaction_residues[i:]:
-                    if gen1 == gen2:
-                        continue
-                    pairs = {}
-                    v1 = r_pair_lookup[gen1]
-                    v2 = r_pair_lookup[gen2]
-                    coord = '{},{}'.format(gen1,gen2)
-                    if coord not in all_interaction_pairs:
-                        continue
-                    for aa1 in v1.keys():
-                        for aa2 in v2.keys():
-                            pair = '{}{}'.format(aa1,aa2)
-                            p1 = set(v1[aa1])
-                            p2 = set(v2[aa2])
-                            p = list(p1.intersection(p2))
-                            if p:
-                                if coord not in all_pdbs_pairs:
-                                    all_pdbs_pairs[coord] = {}
-                                all_pdbs_pairs[coord][pair] = p
-            cache.set("all_pdbs_aa_pairs",all_pdbs_pairs,60*60*24*7) #Cache results
-        residues = Residue.objects.filter(protein_conformation__protein__entry_name__in=pdbs
-                ).exclude(generic_number=None).values('pk','sequence_number','generic_number__label','amino_acid','protein_conformation__protein__entry_name','protein_segment__slug','display_generic_number__label').all()
+        all_pdbs_pairs = get_all_pdbs_aa_pairs()
+        residues = fingerprints.residue_values()
         r_lookup = {}
         r_pair_lookup = defaultdict(lambda: defaultdict(lambda: []))
         segm_lookup = {}
@@ -1100,6 +987,13 @@ def InteractionBrowserData(request):
         # Dict to keep track of which residue numbers are in use
         number_dict = set()
 
+        # Number of structures in each set with a residue at each generic number
+        presence1 = {gn: len(set(gn_pdbs).intersection(pdbs1)) for gn, gn_pdbs in r_presence_lookup.items()}
+        presence2 = {gn: len(set(gn_pdbs).intersection(pdbs2)) for gn, gn_pdbs in r_presence_lookup.items()}
+
+        # GN pairs of the fingerprints at each coordinate
+        coord_pairs = defaultdict(list)
+
         print('Start going through interactions',time.time()-start_time)
         for i in interactions:
             s = i['interacting_pair__referenced_structure__pk']
@@ -1192,17 +1086,8 @@ def InteractionBrowserData(request):
                             data['interactions'][coord]['types_count'][model][1]['pdbs'].append(pdb_name)
 
                 ## Presence lookup
-                pdbs_with_res1 = r_presence_lookup[res1]
-                pdbs_with_res2 = r_presence_lookup[res2]
-
-                pdbs1_with_res1 = list(set(pdbs_with_res1).intersection(pdbs1))
-                pdbs2_with_res1 = list(set(pdbs_with_res1).intersection(pdbs2))
-
-                pdbs1_with_res2 = list(set(pdbs_with_res2).intersection(pdbs1))
-                pdbs2_with_res2 = list(set(pdbs_with_res2).intersection(pdbs2))
-
-                data['interactions'][coord]['pos1_presence'] = round(100*(len(pdbs1_with_res1) / len(pdbs1))-(100*len(pdbs2_with_res1) / len(pdbs2)))
-                data['interactions'][coord]['pos2_presence'] = round(100*(len(pdbs1_with_res2) / len(pdbs1))-(100*len(pdbs2_with_res2) / len(pdbs2)))
+                data['interactions'][coord]['pos1_presence'] = round(100*(presence1[res1] / len(pdbs1))-(100*presence2[res1] / len(pdbs2)))
+                data['interactions'][coord]['pos2_presence'] = round(100*(presence1[res2] / len(pdbs1))-(100*presence2[res2] / len(pdbs2)))
 
             else:
                 if res1 not in data['tab3']:
@@ -1235,15 +1120,11 @@ def InteractionBrowserData(request):
                     data['interactions'][coord]['types_count'][model]['pdbs'].append(pdb_name)
 
                 ## Presence lookup
-                pdbs_with_res1 = r_presence_lookup[res1]
-                pdbs_with_res2 = r_presence_lookup[res2]
-
-                pdbs1_with_res1 = list(set(pdbs_with_res1).intersection(pdbs1))
-                pdbs1_with_res2 = list(set(pdbs_with_res2).intersection(pdbs1))
-
-                data['interactions'][coord]['pos1_presence'] = round(100*len(pdbs1_with_res1) / len(pdbs1))
-                data['interactions'][coord]['pos2_presence'] = round(100*len(pdbs1_with_res2) / len(pdbs1))
+                data['interactions'][coord]['pos1_presence'] = round(100*presence1[res1] / len(pdbs1))
+                data['interactions'][coord]['pos2_presence'] = round(100*presence1[res2] / len(pdbs1))
             data['interactions'][coord]['class_a_gns'] = classa_coord
+            if i['pair'] not in coord_pairs[coord]:
+                coord_pairs[coord].append(i['pair'])
         data['sequence_numbers'] = sorted(number_dict, key=functools.cmp_to_key(gpcrdb_number_comparator))
 
         ## MAKE TAB 4
@@ -1262,6 +1143,19 @@ def InteractionBrowserData(request):
                         data['missing'][res[0]]['present'].add(pdb)
             data['missing'][res[0]]['present'] = list(data['missing'][res[0]]['present'])
 
+        # Family frequencies: every structure with the interaction adds 1 / the number of structures of its family in
+        # the set, summed per GN pair for each type and for any type (last column) over the contacts of the fingerprints
+        def family_weights(pfs_lookup):
+            pdb_weights = {pdb: 1 / len(pf_pdbs) for pf_pdbs in pfs_lookup.values() for pdb in pf_pdbs}
+            return [pdb_weights.get(structure.entry_name, 0) for structure in fingerprints.structures]
+
+        type_contacts = np.column_stack([contacts, contacts.any(axis=1)])
+        if mode == 'double':
+            pf_weighted = [fingerprints.counts(type_contacts, family_weights(data['pfs1_lookup'])),
+                           fingerprints.counts(type_contacts, family_weights(data['pfs2_lookup']))]
+        else:
+            pf_weighted = [fingerprints.counts(type_contacts, family_weights(data['pfs_lookup']))]
+
         print('Do Secondary data',time.time()-start_time)
         data['secondary'] = {}
         secondary_dict = {'set1':0 , 'set2':0, 'aa_pairs':OrderedDict()}
@@ -1284,47 +1178,15 @@ def InteractionBrowserData(request):
                 v["pdbs_freq_2"] = len(v["pdbs2"]) / len(pdbs2)
 
                 #pf freq
-                v["pf_freq_1"] = 0
-                for pf, pf_pdbs in data['pfs1_lookup'].items():
-                    pf_contribution = 0
-                    for pdb in pf_pdbs:
-                        # if pdb from pf has an interaction, add the fraction of the pf set
-                        if pdb in v["pdbs1"]:
-                            pf_contribution += 1 / len(pf_pdbs)
-                    v["pf_freq_1"] += pf_contribution
-                v["pf_freq_1"] /= len(data['pfs1'])
-
-                v["pf_freq_2"] = 0
-                for pf, pf_pdbs in data['pfs2_lookup'].items():
-                    pf_contribution = 0
-                    for pdb in pf_pdbs:
-                        # if pdb from pf has an interaction, add the fraction of the pf set
-                        if pdb in v["pdbs2"]:
-                            pf_contribution += 1 / len(pf_pdbs)
-                    v["pf_freq_2"] += pf_contribution
-                v["pf_freq_2"] /= len(data['pfs2'])
+                pairs = coord_pairs[c]
+                v["pf_freq_1"] = pf_weighted[0][pairs, -1].sum() / len(data['pfs1'])
+                v["pf_freq_2"] = pf_weighted[1][pairs, -1].sum() / len(data['pfs2'])
 
                 for i_t, vals in v['types_count'].items():
                     vals[0]['pdb_freq'] = len(vals[0]["pdbs"]) / len(pdbs1)
                     vals[1]['pdb_freq'] = len(vals[1]["pdbs"]) / len(pdbs2)
-
-                    for pf, pf_pdbs in data['pfs1_lookup'].items():
-                        pf_contribution = 0
-                        for pdb in pf_pdbs:
-                            # if pdb from pf has an interaction, add the fraction of the pf set
-                            if pdb in vals[0]["pdbs"]:
-                                pf_contribution += 1 / len(pf_pdbs)
-                        vals[0]["pf_freq"] += pf_contribution
-                    vals[0]["pf_freq"] /= len(data['pfs1'])
-
-                    for pf, pf_pdbs in data['pfs2_lookup'].items():
-                        pf_contribution = 0
-                        for pdb in pf_pdbs:
-                            # if pdb from pf has an interaction, add the fraction of the pf set
-                            if pdb in vals[1]["pdbs"]:
-                                pf_contribution += 1 / len(pf_pdbs)
-                        vals[1]["pf_freq"] += pf_contribution
-                    vals[1]["pf_freq"] /= len(data['pfs2'])
+                    vals[0]["pf_freq"] = pf_weighted[0][pairs, INTERACTION_TYPES.index(i_t)].sum() / len(data['pfs1'])
+                    vals[1]["pf_freq"] = pf_weighted[1][pairs, INTERACTION_TYPES.index(i_t)].sum() / len(data['pfs2'])
 
                 for setname,iset in [['set1','secondary1'],['set2','secondary2']]:
                     distinct_aa_pairs = set()
@@ -1423,26 +1285,12 @@ def InteractionBrowserData(request):
                 v["pdbs_freq"] = len(v["pdbs"]) / len(pdbs1)
 
                 #pf freq
-                v["pf_freq"] = 0
-                for pf, pf_pdbs in data['pfs_lookup'].items():
-                    pf_contribution = 0
-                    for pdb in pf_pdbs:
-                        # if pdb from pf has an interaction, add the fraction of the pf set
-                        if pdb in v["pdbs"]:
-                            pf_contribution += 1 / len(pf_pdbs)
-                    v["pf_freq"] += pf_contribution
-                v["pf_freq"] /= len(data['pfs'])
+                pairs = coord_pairs[c]
+                v["pf_freq"] = pf_weighted[0][pairs, -1].sum() / len(data['pfs'])
 
                 for i_t, vals in v['types_count'].items():
                     vals['pdb_freq'] = len(vals["pdbs"]) / len(pdbs1)
-                    for pf, pf_pdbs in data['pfs_lookup'].items():
-                        pf_contribution = 0
-                        for pdb in pf_pdbs:
-                            # if pdb from pf has an interaction, add the fraction of the pf set
-                            if pdb in vals["pdbs"]:
-                                pf_contribution += 1 / len(pf_pdbs)
-                        vals["pf_freq"] += pf_contribution
-                    vals["pf_freq"] /= len(data['pfs'])
+                    vals["pf_freq"] = pf_weighted[0][pairs, INTERACTION_TYPES.index(i_t)].sum() / len(data['pfs'])
 
 
                 for s in v['secondary']:
@@ -1514,7 +1362,6 @@ def InteractionBrowserData(request):
             del data['interactions'][d]
 
         # del class_pair_lookup
-        del r_lookup
         # del r_pair_lookup
 
 
@@ -1677,6 +1524,26 @@ def InteractionBrowserData(request):
                     data['tab4'][gn]['angles'] = gn_values
 
 
+        # Interactions grouped by class A GN pair and amino acid pair
+        def aa_pair_interactions(pdb_set):
+            grouped = OrderedDict()
+            for i in interactions:
+                protein, pdb_name, pf = s_lookup[i['interacting_pair__referenced_structure__pk']]
+                if pdb_name not in pdb_set:
+                    continue
+                res1 = r_lookup[i['interacting_pair__res1__pk']]
+                res2 = r_lookup[i['interacting_pair__res2__pk']]
+                key = (r_class_translate[res1['generic_number__label']], r_class_translate[res2['generic_number__label']], res1['amino_acid'], res2['amino_acid'])
+                if key not in grouped:
+                    grouped[key] = {'gn1': key[0], 'gn2': key[1], 'aa1': key[2], 'aa2': key[3], 'i_types': [], 'structures': [], 'pfs': []}
+                grouped[key]['i_types'].append(i['interaction_type'])
+                grouped[key]['structures'].append(pdb_name.upper())
+                grouped[key]['pfs'].append(pf)
+            for g in grouped.values():
+                g['structuresC'] = len(set(g['structures']))
+                g['pfsC'] = len(set(g['pfs']))
+            return list(grouped.values())
+
         # Tab 2 data generation
         # Get the relevant interactions
         data['tab2'] = {}
@@ -1686,31 +1553,8 @@ def InteractionBrowserData(request):
 
             set_id = 'set1'
             aa_pair_data = data['tab2']
-            interactions = list(Interaction.objects.filter(
-                    interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs1']]
-                ).filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
-            for i in interactions:
+            aa_pairs = aa_pair_interactions(data['pdbs1'])
+            for i in aa_pairs:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
                 if key not in aa_pair_data:
                     aa_pair_data[key] = {'classA':'{},{}'.format(i['gn1'],i['gn2']),'set1':{'interaction_freq':0,'interaction_freq_pf':0, 'types_count':defaultdict(set)}, 'set2':{'interaction_freq':0,'interaction_freq_pf':0, 'types_count':defaultdict(set)}, 'types':[]}
@@ -1728,32 +1572,9 @@ def InteractionBrowserData(request):
             print('Gotten first set occurance calcs',time.time()-start_time)
 
             set_id = 'set2'
-            interactions = list(Interaction.objects.filter(
-                    interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs2']]
-                ).filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
+            aa_pairs = aa_pair_interactions(data['pdbs2'])
 
-            for i in interactions:
+            for i in aa_pairs:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
                 if key not in aa_pair_data:
                     aa_pair_data[key] = {'classA':'{},{}'.format(i['gn1'],i['gn2']),'set1':{'interaction_freq':0,'interaction_freq_pf':0, 'types_count':defaultdict(set)}, 'set2':{'interaction_freq':0,'interaction_freq_pf':0, 'types_count':defaultdict(set)}, 'types':[]}
@@ -1851,30 +1672,9 @@ def InteractionBrowserData(request):
             # Single set!
             # TODO: fix the interaction filter subselection
             aa_pair_data = data['tab2']
-            interactions = list(Interaction.objects.filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
+            aa_pairs = aa_pair_interactions(data['pdbs'])
 
-            for i in interactions:
+            for i in aa_pairs:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
                 if key not in aa_pair_data:
                     aa_pair_data[key] = {'classA':'{},{}'.format(i['gn1'],i['gn2']),'set':{'interaction_freq':0,'interaction_freq_pf':0, 'types_count':defaultdict(set)}, 'types':[]}
@@ -2739,19 +2539,19 @@ def stableResMatrix(pdbs):
     for selclass in ['001', '002', '003', '004', '006']:
         # select all distances to selected residue
         reference = stable_residues[selclass]
-        ds = list(Distance.objects.filter(structure__pdb_code__index__in=pdbs) \
-                                .filter(structure__protein_conformation__protein__family__slug__startswith=selclass) \
-                                .filter(Q(gn1=reference) | Q(gn2=reference)) \
-                                .values('structure__pdb_code__index', 'gns_pair', 'distance'))
+        if not reference:
+            continue
+        matrices = DistanceMatrices().load(pdbs=pdbs, structures=Structure.objects.filter(protein_conformation__protein__family__slug__startswith=selclass))
 
         # create dictionary of all structures and all distances
-        for i,d in enumerate(ds):
-            if not d['structure__pdb_code__index'] in stable_distances:
-                stable_distances[d['structure__pdb_code__index']] = {}
-                pdb_classes[d['structure__pdb_code__index']] = selclass
+        for pdb, distances in zip(matrices.pdbs, matrices.distances_to(reference)):
+            if not distances:
+                continue
+            if not pdb in stable_distances:
+                stable_distances[pdb] = {}
+                pdb_classes[pdb] = selclass
 
-            gn_label = d['gns_pair'].replace(reference, "").replace("_", "")
-            stable_distances[d['structure__pdb_code__index']][gn_label] = d['distance']
+            stable_distances[pdb].update(distances)
 
 
     pdbs = list(stable_distances.keys())
@@ -2879,17 +2679,15 @@ def ClusteringData(request):
 
     # hierarchical clustering
     hclust = sch.linkage(ssd.squareform(distance_matrix), method='average')
-    tree = sch.to_tree(hclust, False)
 
     #inconsistency = sch.inconsistent(hclust)
     #inconsistency = sch.maxinconsts(hclust, inconsistency)
-    silhouette_coefficient = {}
-    getSilhouetteIndex(tree, distance_matrix, silhouette_coefficient)
-    data['tree'] = getNewick(tree, "", tree.dist, pdbs, silhouette_coefficient)
+    silhouette_coefficient = silhouette_scores(hclust, distance_matrix)
+    data['tree'] = newick(hclust, pdbs, silhouette_coefficient)
 
     # Order distance_matrix by hclust
     N = len(distance_matrix)
-    res_order = seriation(hclust, N, N + N-2)
+    res_order = leaf_order(hclust)
     seriated_dist = np.zeros((N,N))
     a,b = np.triu_indices(N,k=1)
     seriated_dist[a,b] = distance_matrix[ [res_order[i] for i in a], [res_order[j] for j in b]]
@@ -2900,87 +2698,6 @@ def ClusteringData(request):
 
     return JsonResponse(data)
 
-# For reordering matrix based on h-tree
-# Borrowed from https://gmarti.gitlab.io/ml/2017/09/07/how-to-sort-distance-matrix.html
-def seriation(Z,N,cur_index):
-    '''
-        input:
-            - Z is a hierarchical tree (dendrogram)
-            - N is the number of points given to the clustering process
-            - cur_index is the position in the tree for the recursive traversal
-        output:
-            - order implied by the hierarchical tree Z
-
-        seriation computes the order implied by a hierarchical tree (dendrogram)
-    '''
-    if cur_index < N:
-        return [cur_index]
-    else:
-        left = int(Z[cur_index-N,0])
-        right = int(Z[cur_index-N,1])
-        return (seriation(Z,N,left) + seriation(Z,N,right))
-
-def getNewick(node, newick, parentdist, leaf_names, silhouette_coefficient):
-    if node.is_leaf():
-        return "%s:%.2f%s" % (leaf_names[node.id], parentdist - node.dist, newick)
-    else:
-        si_node = silhouette_coefficient[node.id]
-        if len(newick) > 0:
-            newick = ")%.2f:%.2f%s" % (si_node, parentdist - node.dist, newick)
-        else:
-            newick = ");"
-        newick = getNewick(node.get_left(), newick, node.dist, leaf_names, silhouette_coefficient)
-        newick = getNewick(node.get_right(), ",%s" % (newick), node.dist, leaf_names, silhouette_coefficient)
-        newick = "(%s" % (newick)
-        return newick
-
-def getSilhouetteIndex(node, distance_matrix, results):
-    # set rootnode (DEBUG purposes)
-    if node.id not in results:
-        results[node.id] = 0
-
-    if not node.is_leaf():
-        # get list of indices cluster left (A)
-        a = node.get_left().pre_order(lambda x: x.id)
-
-        # get list of indices cluster right (B)
-        b = node.get_right().pre_order(lambda x: x.id)
-
-        if len(a) > 1:
-            # calculate average Si - cluster A
-            si_a = calculateSilhouetteIndex(distance_matrix, a, b)
-            results[node.get_left().id] = si_a
-
-            getSilhouetteIndex(node.get_left(), distance_matrix, results)
-
-        if len(b) > 1:
-            # calculate average Si - cluster B
-            si_b = calculateSilhouetteIndex(distance_matrix, b, a)
-            results[node.get_right().id] = si_b
-
-            getSilhouetteIndex(node.get_right(), distance_matrix, results)
-
-# Implementation based on Rousseeuw, P.J. J. Comput. Appl. Math. 20 (1987): 53-65
-def calculateSilhouetteIndex(distance_matrix, a, b):
-    si = 0
-    for i in a:
-        # calculate ai - avg distance within cluster
-        ai = 0
-        for j in a:
-            if i != j:
-                ai += distance_matrix[i,j]/(len(a)-1)
-
-        # calculate bi - avg distance to closest cluster
-        bi = 0
-        for j in b:
-            bi += distance_matrix[i,j]/len(b)
-
-        # silhouette index (averaged)
-        si += (bi-ai)/max(ai,bi)/len(a)
-
-    return si
-
-
 def DistanceData(request):
     def gpcrdb_number_comparator(e1, e2):
             t1 = e1.split('x')
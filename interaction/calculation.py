@@ -0,0 +1,797 @@
+"""
+Ligand-receptor interactions of a PDB structure.
+
+Port of the former python2.7 script (legacy_functions.py): the same interaction classes, thresholds and scoring, but
+the state of one calculation is kept on an InteractionCalculation object and all intermediate PDB files (ligands,
+residues, fragments, complexes) are handled as strings, so calculations can run side by side and return Python objects.
+Calculations are run in a bounded pool of worker processes (run_calculation, run_calculations).
+"""
+from django.conf import settings
+
+from Bio.PDB import PDBParser, PDBIO, Select, Vector
+
+try:
+    from openbabel import pybel # Open Babel 3
+except ImportError:
+    import pybel
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from io import StringIO
+from math import degrees
+import multiprocessing
+import re
+import threading
+import urllib.request
+
+import numpy as np
+
+
+AA = {'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D',
+      'CYS': 'C', 'GLN': 'Q', 'GLU': 'E', 'GLY': 'G',
+      'HIS': 'H', 'ILE': 'I', 'LEU': 'L', 'LYS': 'K',
+      'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S',
+      'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V'}
+
+HBD = {'H', 'K', 'N', 'Q', 'R', 'S', 'T', 'W', 'Y'}
+HBA = {'D', 'E', 'H', 'N', 'Q', 'S', 'T', 'Y'}
+NEGATIVE = {'D', 'E'}
+POSITIVE = {'H', 'K', 'R'}
+
+AROMATIC = {'TYR', 'TRP', 'PHE', 'HIS'}
+
+CHARGEDAA = {'ARG', 'LYS', 'ASP', 'GLU'}  # skip ,'HIS'
+
+HYDROPHOBIC_AA = {'A', 'C', 'F', 'I', 'L', 'M', 'P', 'V', 'W', 'Y'}
+
+ignore_het = ['NA', 'W']  # ignore sodium and water
+
+radius = 5
+hydrophob_radius = 4.5
+
+summary_types = ['score', 'hbond', 'hbondplus', 'hbond_confirmed', 'aromatic', 'aromaticff', 'ionaromatic',
+                 'aromaticion', 'aromaticef', 'aromaticfe', 'hydrophobic', 'waals', 'accessible']
+
+
+def fetch_pdb(pdbname):
+    url = 'http://www.rcsb.org/pdb/files/%s.pdb' % pdbname
+    return urllib.request.urlopen(url).read().decode('utf-8')
+
+
+def read_molecule(pdb):
+    """Open Babel molecule of a PDB string (None when there are no atoms)"""
+    if not pdb.strip():
+        return None
+    try:
+        mol = pybel.readstring('pdb', pdb)
+    except (IOError, OSError):
+        return None
+    if not mol.atoms:
+        return None
+    return mol
+
+
+def neighbours(obatom):
+    return pybel.ob.OBAtomAtomIter(obatom)
+
+
+def is_carboxyl_oxygen(obatom):
+    if hasattr(obatom, 'IsCarboxylOxygen'):
+        return obatom.IsCarboxylOxygen()
+
+    # removed in Open Babel 3, same definition as in 2.x: a terminal oxygen on a carbon with two terminal oxygens
+    if obatom.GetAtomicNum() != 8 or obatom.GetHvyDegree() != 1:
+        return False
+    for carbon in neighbours(obatom):
+        if carbon.GetAtomicNum() == 6:
+            oxygens = [o for o in neighbours(carbon) if o.GetAtomicNum() == 8 and o.GetHvyDegree() == 1]
+            return len(oxygens) == 2
+    return False
+
+
+def aromatic_rings(mol):
+    """Aromatic rings of a molecule as [atom indices, center, normal, atom types, atom vectors]"""
+    ringlist = []
+    for ring in mol.OBMol.GetSSSR():
+        center = Vector(0.0, 0.0, 0.0)
+        members = ring.Size()
+        if ring.IsAromatic():
+            atomlist = []
+            atomnames = []
+            vectorlist = []
+            for atom in mol:
+                if ring.IsMember(atom.OBAtom):
+                    a_vector = Vector(atom.coords)
+                    center += a_vector
+                    atomlist.append(atom.idx)
+                    vectorlist.append(a_vector)
+                    atomnames.append(atom.type)
+            center = center / members
+            normal1 = center - vectorlist[0]
+            normal2 = center - vectorlist[2]
+            normal = Vector(np.cross([normal1[0], normal1[1], normal1[2]], [normal2[0], normal2[1], normal2[2]]))
+            ringlist.append([atomlist, center, normal, atomnames, vectorlist])
+    return ringlist
+
+
+def hydrogens(obatom):
+    return [Vector(pybel.Atom(n).coords) for n in neighbours(obatom) if pybel.Atom(n).type == "H"]
+
+
+def check_unique_ligand_mol(pdb):
+    """Only keep the HETATM records of the first ligand residue"""
+    tempstr = ''
+    ligandid = 0
+    chainid = 0
+    for line in pdb.splitlines(True):
+        if line.startswith('HETATM'):
+            residue_number = line[22:26]
+            chain = line[21]
+
+            if (residue_number != ligandid and ligandid != 0) or (chain != chainid and chainid != 0):
+                continue
+
+            ligandid = residue_number
+            chainid = chain
+
+        tempstr += line
+    return tempstr
+
+
+def find_ligand_full_names(pdb):
+    d = {}
+    for line in pdb.splitlines():
+        if line.startswith('HETSYN'):
+            # need to fix bad PDB formatting where col4 and col5 are put
+            # together for some reason -- usually seen when the id is +1000
+            # NOTE: PDB is a fixed-width column format, so this is normal
+            m = re.match(r"HETSYN[\s]+([\w]{3})[\s]+(.+)", line)
+            if (m):
+                d[m.group(1)] = m.group(2).strip()
+    return d
+
+
+class ResidueNameSelect(Select):
+    def __init__(self, name):
+        self.name = name
+
+    def accept_residue(self, residue):
+        return residue.get_resname().strip() == self.name
+
+
+class ChainSelect(Select):
+    def __init__(self, chain):
+        self.chain = chain
+
+    def accept_residue(self, residue):
+        return residue.get_parent().id == self.chain
+
+
+class ResidueNumberSelect(Select):
+    def __init__(self, number):
+        self.number = number
+
+    def accept_residue(self, residue):
+        return str(residue.get_full_id()[3][1]) == self.number
+
+
+class InteractionCalculation():
+    """Interactions between the ligands (or a peptide chain) of a PDB and the receptor residues"""
+
+    def __init__(self, pdbname, pdb, peptide=None):
+        self.pdbname = pdbname
+        self.pdb = pdb
+        self.lines = pdb.splitlines(True)
+        self.peptideligand = peptide or None
+        self.structure = PDBParser(QUIET=True).get_structure(pdbname, StringIO(pdb))
+
+        self.hetlist = OrderedDict()
+        self.hetlist_display = {}
+        self.ligand_pdbs = {} # ligand with hydrogens added
+        self.ligand_atoms = {}
+        self.ligand_charged = {}
+        self.ligandcenter = {}
+        self.ligand_rings = {}
+        self.ligand_donors = {}
+        self.ligand_acceptors = {}
+        self.inchikeys = {}
+        self.smiles = {}
+        self.results = OrderedDict()
+        self.summary_results = OrderedDict()
+        self.new_results = OrderedDict()
+
+        # rings and donors per residue number, the same for every ligand
+        self.aa_rings = {}
+        self.aa_donors = {}
+        self.het_coordinates = None
+
+    def run(self):
+        """Interactions per ligand: interactions, score, inchikey, smiles, prettyname (when known) and the PDB of
+        the ligand with its binding residues (pdb)"""
+        self.hetlist_display = find_ligand_full_names(self.pdb)
+        self.create_ligands()
+        self.build_ligand_info()
+        self.find_interactions()
+        self.analyze_interactions()
+        return self.pretty_results()
+
+    def write_pdb(self, select):
+        out = StringIO()
+        io = PDBIO()
+        io.set_structure(self.structure)
+        io.save(out, select)
+        return out.getvalue()
+
+    def ligand_flag(self, chain, residue):
+        """Ligand name of a residue (the peptide chain is called 'pep'), None when the residue is not a ligand"""
+        if self.peptideligand:
+            return 'pep' if chain.id == self.peptideligand else None
+        hetflag = residue.get_full_id()[3][0].strip()
+        return hetflag.replace("H_", "").strip() or None
+
+    def create_ligands(self):
+        hetflag_done = set()
+        for model in self.structure:
+            for chain in model:
+                for residue in chain:
+                    hetflag = self.ligand_flag(chain, residue)
+                    if not hetflag or hetflag in ignore_het or hetflag in hetflag_done:
+                        continue
+                    hetflag_done.add(hetflag)
+
+                    if self.peptideligand:
+                        ligand_pdb = self.write_pdb(ChainSelect(self.peptideligand))
+                    else:
+                        ligand_pdb = self.write_pdb(ResidueNameSelect(hetflag))
+                    ligand_pdb = check_unique_ligand_mol(ligand_pdb)
+
+                    mol = read_molecule(ligand_pdb)
+                    if mol is None:
+                        continue
+
+                    obConversion = pybel.ob.OBConversion()
+                    obConversion.SetInAndOutFormats("pdb", "inchi")
+                    obConversion.SetOptions("K", obConversion.OUTOPTIONS)
+                    obmol = pybel.ob.OBMol()
+                    obConversion.ReadString(obmol, ligand_pdb)
+                    self.inchikeys[hetflag] = obConversion.WriteString(obmol).strip()
+
+                    self.smiles[hetflag] = mol.write("smi").split("\t")[0]
+
+                    mol.OBMol.AddHydrogens(False, True, 7.4)
+                    self.ligand_pdbs[hetflag] = mol.write("pdb")
+
+    def build_ligand_info(self):
+        count_atom_ligand = {}
+        for model in self.structure:
+            for chain in model:
+                for residue in chain:
+                    hetresname = residue.get_resname()
+                    hetflag = self.ligand_flag(chain, residue)
+                    if not hetflag or hetflag in ignore_het or hetflag not in self.ligand_pdbs:
+                        continue
+                    if hetflag in self.hetlist and not self.peptideligand:
+                        continue
+
+                    if hetflag not in self.hetlist: #do not recreate for peptides
+                        self.hetlist[hetflag] = []
+                        self.ligand_charged[hetflag] = []
+                        self.ligand_donors[hetflag] = []
+                        self.ligand_acceptors[hetflag] = []
+                        count_atom_ligand[hetflag] = 0
+
+                        mol = read_molecule(self.ligand_pdbs[hetflag])
+                        self.ligand_rings[hetflag] = aromatic_rings(mol)
+
+                        for atom in mol:
+                            if atom.formalcharge != 0:
+                                self.ligand_charged[hetflag].append([atom.type, Vector(atom.coords), atom.formalcharge])
+                            if is_carboxyl_oxygen(atom.OBAtom):
+                                self.ligand_charged[hetflag].append([atom.type, Vector(atom.coords), -1])
+                            if atom.OBAtom.IsHbondDonor():
+                                self.ligand_donors[hetflag].append([atom.type, Vector(atom.coords), hydrogens(atom.OBAtom)])
+                            if atom.OBAtom.IsHbondAcceptor():
+                                self.ligand_acceptors[hetflag].append([atom.type, Vector(atom.coords)])
+
+                    # Function to get ligand centers to maybe skip some residues
+                    center = Vector(0.0, 0.0, 0.0)
+                    if self.peptideligand and hetflag in self.ligandcenter:
+                        center = self.ligandcenter[hetflag][2]
+
+                    for atom in residue:
+                        het_atom = atom.name
+                        atom_vector = atom.get_vector()
+                        center += atom_vector
+                        self.hetlist[hetflag].append([hetresname, het_atom, atom_vector])
+
+                        if not hetflag in self.ligand_atoms:
+                            # make the ligand_atoms ready
+                            self.ligand_atoms[hetflag] = []
+                        self.ligand_atoms[hetflag].append([count_atom_ligand[hetflag], atom_vector, het_atom])
+                        count_atom_ligand[hetflag] += 1
+
+                    center2 = center / count_atom_ligand[hetflag]
+                    self.ligandcenter[hetflag] = [center2, count_atom_ligand[hetflag], center]
+
+    def get_ring_from_aa(self, residueid):
+        if residueid not in self.aa_rings:
+            mol = read_molecule(self.write_pdb(ResidueNumberSelect(residueid)))
+            self.aa_rings[residueid] = aromatic_rings(mol) if mol else []
+        return self.aa_rings[residueid]
+
+    def get_hydrogen_from_aa(self, residueid):
+        if residueid not in self.aa_donors:
+            donors = []
+            mol = read_molecule(self.write_pdb(ResidueNumberSelect(residueid)))
+            if mol:
+                mol.OBMol.AddHydrogens(False, True, 7.4)
+                for atom in mol:
+                    if atom.OBAtom.IsHbondDonor():
+                        donors.append([atom.type, Vector(atom.coords), hydrogens(atom.OBAtom), atom.OBAtom.IsHbondAcceptor()])
+            self.aa_donors[residueid] = donors
+        return self.aa_donors[residueid]
+
+    def fragment_library(self, ligand, atomvector, atomname, residuenr, chain, typeinteraction):
+        """PDB of a residue and the ligand atoms within two bonds of the interacting ligand atom"""
+        chain = chain.strip()
+        listofvectors = []
+        if atomvector is not None:
+            mol = read_molecule(self.ligand_pdbs[ligand])
+            mol.removeh()
+            for atom in mol:
+                if (Vector(atom.coords) - atomvector).norm() > 0.1:
+                    continue
+                listofvectors.append(Vector(atom.coords))
+                for neighbour_atom in neighbours(atom.OBAtom):
+                    listofvectors.append(Vector(pybel.Atom(neighbour_atom).coords))
+                    for neighbour_atom2 in neighbours(neighbour_atom):
+                        listofvectors.append(Vector(pybel.Atom(neighbour_atom2).coords))
+
+        fragment = self.fragment_pdb(listofvectors, residuenr, chain)
+        mol = read_molecule(fragment)
+        return mol.write("pdb") if mol else fragment
+
+    def fragment_library_aromatic(self, ligand, atomvectors, residuenr, chain, ringnr):
+        return self.fragment_pdb(atomvectors, residuenr, chain.strip())
+
+    def fragment_pdb(self, atomvectors, residuenr, chain):
+        """HETATM records at the given positions and the ATOM records of a residue"""
+        if self.het_coordinates is None:
+            self.index_lines()
+        selected = list(self.residue_lines.get((residuenr, chain), []))
+        if atomvectors and len(self.het_lines):
+            for vector in atomvectors:
+                close = np.sqrt(((self.het_coordinates - vector.get_array())**2).sum(axis=1)) < 0.1
+                selected.extend(self.het_lines[close])
+        return ''.join([self.lines[i] for i in sorted(set(selected))])
+
+    def index_lines(self):
+        """Line numbers of the HETATM records (with their coordinates) and of the ATOM records per residue"""
+        het_lines = []
+        het_coordinates = []
+        self.residue_lines = {}
+        for i, line in enumerate(self.lines):
+            if line.startswith('HETATM'):
+                het_lines.append(i)
+                het_coordinates.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+            elif line.startswith('ATOM'):
+                key = (line[22:26].strip(), line[21].strip())
+                if key not in self.residue_lines:
+                    self.residue_lines[key] = []
+                self.residue_lines[key].append(i)
+        self.het_lines = np.array(het_lines, dtype=np.intp)
+        self.het_coordinates = np.array(het_coordinates).reshape(-1, 3)
+
+    def addresiduestoligand(self, ligand, residuelist):
+        """PDB of the ligand (with hydrogens) together with its binding residues"""
+        inserstr = ''
+        for line in self.lines:
+            if line.startswith('ATOM'):
+                aaname = line[17:20].strip() + line[22:26].strip() + line[21]
+                if aaname in residuelist:
+                    inserstr += line
+
+        tempstr = ''
+        inserted = 0
+        for line in self.ligand_pdbs[ligand].splitlines(True):
+            if line.startswith('ATOM'):
+                temp = line.split()
+                if temp[2] == 'H':
+                    continue  # skip hydrogen in model
+
+            if (line.startswith('CONECT') or line.startswith('MASTER') or line.startswith('END')) and inserted == 0:
+                tempstr += inserstr
+                inserted = 1
+            tempstr += line
+        return tempstr
+
+    def remove_hyd(self, aa, ligand):
+        self.new_results[ligand]['interactions'] = [res for res in self.new_results[ligand]['interactions']
+                                                    if not (res[0] == aa and (res[2] == 'HYD' or res[2] == 'hyd'))]
+
+    def check_other_aromatic(self, aa, ligand, info):
+        templist = []
+        check = True
+        for res in self.new_results[ligand]['interactions']:
+            if res[0] == aa and res[4] == 'aromatic':
+                #if the new aromatic interaction has a center-center distance greater than the old one, keep old.
+                if info['Distance'] > res[6]['Distance']:
+                    templist.append(res)
+                    check = False #Do not add the new one.
+                else: #if not, delete the old one, as the new is better.
+                    check = True #add the new one
+                    continue
+            else:
+                templist.append(res)
+        self.new_results[ligand]['interactions'] = templist
+        return check
+
+    def find_interactions(self):
+        """Loop over the receptor residues and find the atoms close to each ligand"""
+        het_arrays = {hetflag: np.array([atom[2].get_array() for atom in atomlist]).reshape(-1, 3)
+                      for hetflag, atomlist in self.hetlist.items()}
+
+        for model in self.structure:
+            for chain in model:
+                chainid = chain.get_id()
+
+                if self.peptideligand and chainid == self.peptideligand:
+                    continue
+                for residue in chain:
+                    aa_resname = residue.get_resname()
+                    aa_seqid = str(residue.get_full_id()[3][1])
+                    hetflagtest = str(residue.get_full_id()[3][0]).strip()
+                    aaname = aa_resname + aa_seqid + chainid
+
+                    if hetflagtest.replace("H_", ""):
+                        continue  # residue is a hetnam
+
+                    aa_atoms = list(residue)
+                    aa_coords = np.array([atom.get_vector().get_array() for atom in aa_atoms]).reshape(-1, 3)
+                    aa_carbon = np.array([atom.name[0] == 'C' for atom in aa_atoms], dtype=bool)
+                    aa_sidechain = np.array([atom.name not in ['C', 'O', 'N'] for atom in aa_atoms], dtype=bool)
+
+                    for hetflag, atomlist in self.hetlist.items():
+                        if not 'CA' in residue:  # prevent errors
+                            continue
+
+                        ca = residue['CA'].get_vector()
+                        if (ca - self.ligandcenter[hetflag][0]).norm() > self.ligandcenter[hetflag][1]:
+                            continue
+
+                        # ligand atoms x residue atoms
+                        distances = np.sqrt(((het_arrays[hetflag][:, None, :] - aa_coords[None, :, :])**2).sum(axis=2))
+
+                        sum = 0
+                        close = distances < radius
+                        if close.any():
+                            if not hetflag in self.results:
+                                self.results[hetflag] = OrderedDict()
+                                self.summary_results[hetflag] = OrderedDict((t, []) for t in summary_types)
+                                self.new_results[hetflag] = {'interactions': []}
+                            if not aaname in self.results[hetflag]:
+                                self.results[hetflag][aaname] = []
+                        for i, j in zip(*np.nonzero(close)):
+                            het_atom = atomlist[i][1]
+                            aa_atom = aa_atoms[j].name
+                            if not (het_atom[0] == 'H' or aa_atom[0] == 'H' or aa_atoms[j].element == 'H'):
+                                self.results[hetflag][aaname].append([het_atom, aa_atom, round(float(distances[i, j]), 2),
+                                    atomlist[i][2], aa_atoms[j].get_vector(), aa_seqid, chainid])
+                                sum += 1
+
+                        # if both are carbon then we are making a hydrophic interaction (counted once per ligand atom)
+                        het_carbon = np.array([atom[1][0] == 'C' for atom in atomlist], dtype=bool)
+                        hydrophobic_count = np.count_nonzero(het_carbon & ((distances < hydrophob_radius) & aa_carbon).any(axis=1))
+
+                        # If within 5 angstrom and not a backbone atom (name C, O, N), then indicate as a residue in vicinity of the ligand
+                        if ((distances < 5) & aa_sidechain).any(): #if accessible!
+                            self.summary_results[hetflag]['accessible'].append([aaname])
+                            fragment = self.fragment_library(hetflag, None, '', aa_seqid, chainid, 'access')
+                            self.new_results[hetflag]['interactions'].append([aaname,fragment,'acc','accessible','hidden',''])
+
+                        if hydrophobic_count > 2 and AA.get(aaname[0:3]) in HYDROPHOBIC_AA:  # min 3 c-c interactions
+                            self.summary_results[hetflag]['hydrophobic'].append([aaname, int(hydrophobic_count)])
+                            fragment = self.fragment_library(hetflag, None, '', aa_seqid, chainid, 'hydrop')
+                            self.new_results[hetflag]['interactions'].append([aaname,fragment,'hyd','hydrophobic','hydrophobic',''])
+
+                        if sum > 1 and aa_resname in AROMATIC:
+                            aarings = self.get_ring_from_aa(aa_seqid)
+                            if not aarings:
+                                continue
+                            self.aromatic_interactions(hetflag, aaname, aa_seqid, chainid, aarings)
+
+    def aromatic_interactions(self, hetflag, aaname, aa_seqid, chainid, aarings):
+        for aaring in aarings:
+            center = aaring[1]
+            count = 0
+            for ring in self.ligand_rings[hetflag]:
+                shortest_center_het_ring_to_res_atom = float(min([10] + [(ring[1] - a).norm() for a in aaring[4]]))
+                shortest_center_aa_ring_to_het_atom = float(min([10] + [(center - a).norm() for a in ring[4]]))
+
+                count += 1
+                # take vector from two centers, and compare against
+                # vector from center to outer point -- this will
+                # give the perpendicular angel.
+                angle = Vector.angle(center - ring[1], ring[2]) #aacenter to ring center vs ring normal
+                angle2 = Vector.angle(center - ring[1], aaring[2]) #aacenter to ring center vs AA normal
+                angle3 = Vector.angle(ring[2], aaring[2]) #two normal vectors against eachother
+                angle_degrees = [round(degrees(angle), 1), round(degrees(angle2), 1), round(degrees(angle3), 1)]
+                distance = float((center - ring[1]).norm())
+                info = {'Distance':round(distance, 2),'ResAtom to center':round(shortest_center_het_ring_to_res_atom,2),
+                        'LigAtom to center': round(shortest_center_aa_ring_to_het_atom,2),'Angles':angle_degrees}
+
+                if distance < 5 and (angle_degrees[2]<20 or abs(angle_degrees[2]-180)<20):  # poseview uses <5
+                    summary_type, interaction = 'aromatic', [aaname,None,'aro_ff','aromatic (face-to-face)','aromatic','none',info]
+                # need to be careful for edge-edge
+                elif (shortest_center_aa_ring_to_het_atom < 4.5) and abs(angle_degrees[0]-90)<30 and abs(angle_degrees[2]-90)<30:
+                    summary_type, interaction = 'aromaticfe', [aaname,None,'aro_fe_protein','aromatic (face-to-edge)','aromatic','protein',info]
+                # need to be careful for edge-edge
+                elif (shortest_center_het_ring_to_res_atom < 4.5) and abs(angle_degrees[1]-90)<30 and abs(angle_degrees[2]-90)<30:
+                    summary_type, interaction = 'aromaticef', [aaname,None,'aro_ef_protein','aromatic (edge-to-face)','aromatic','protein',info]
+                else:
+                    continue
+
+                self.summary_results[hetflag][summary_type].append([aaname, count, round(distance, 2), angle_degrees])
+                interaction[1] = self.fragment_library_aromatic(hetflag, ring[4], aa_seqid, chainid, count)
+                if self.check_other_aromatic(aaname, hetflag, {'Distance':round(distance, 2),'Angles':angle_degrees}):
+                    self.new_results[hetflag]['interactions'].append(interaction)
+                    self.remove_hyd(aaname, hetflag)
+
+            for charged in self.ligand_charged[hetflag]:
+                distance = float((center - charged[1]).norm())
+                # needs max 4.2 distance to make aromatic+
+                if distance < 4.2 and charged[2] > 0:
+                    self.summary_results[hetflag]['aromaticion'].append([aaname, count, round(distance, 2), charged])
+
+                    #FIXME fragment file
+                    self.new_results[hetflag]['interactions'].append([aaname,'','aro_ion_protein','aromatic (pi-cation)','aromatic','protein',{'Distance':round(distance, 2)}])
+                    self.remove_hyd(aaname, hetflag)
+
+    def hydrogen_bond(self, residue, ligand, entry):
+        """Classify a close polar atom pair, returns the type (hbond, hbondplus or waals) and the interaction"""
+        hbondconfirmed = []
+
+        aa_donors = self.get_hydrogen_from_aa(entry[5])
+        hydrogenmatch = 0
+        res_is_acceptor = False
+        res_is_donor = False
+        for donor in aa_donors:
+            d = (donor[1] - entry[4]).norm()
+            if d < 0.5:
+                res_is_acceptor = donor[3]
+                res_is_donor = True
+                for hydrogen in donor[2]:
+                    hydrogenvector = hydrogen - donor[1]
+                    bindingvector = entry[3] - hydrogen
+                    angle = round(degrees(Vector.angle(hydrogenvector, bindingvector)), 2)
+                    distance = round(bindingvector.norm(), 2)
+                    if distance > 2.5 or angle > 60:
+                        continue # too far away or bad angle
+                    hydrogenmatch = 1
+                    hbondconfirmed.append(["D", entry[0], entry[1], angle, distance])
+
+        found_donor = 0
+        for donor in self.ligand_donors[ligand]:
+            d = (donor[1] - entry[3]).norm()
+            if d < 0.5:
+                found_donor = 1
+                for hydrogen in donor[2]:
+                    hydrogenvector = hydrogen - donor[1]
+                    bindingvector = entry[4] - hydrogen
+                    angle = round(degrees(Vector.angle(hydrogenvector, bindingvector)), 2)
+                    distance = round(bindingvector.norm(), 2)
+                    if distance > 2.5 or angle > 60:
+                        continue # too far away or bad angle
+                    hydrogenmatch = 1
+                    hbondconfirmed.append(["A", entry[0], entry[1], angle, distance])
+
+        found_acceptor = 0
+        for acceptor in self.ligand_acceptors[ligand]:
+            d = (acceptor[1] - entry[3]).norm()
+            if d < 0.5:
+                found_acceptor = 1
+                if found_donor==0 and res_is_donor:
+                    hydrogenmatch = 1
+                    hbondconfirmed.append(['D']) #set residue as donor
+
+        if not found_acceptor and found_donor and res_is_acceptor:
+            hydrogenmatch = 1
+            hbondconfirmed.append(['A']) #set residue as acceptor
+
+        if found_acceptor and found_donor:
+            if res_is_donor and not res_is_acceptor:
+                hydrogenmatch = 1
+                hbondconfirmed.append(['D'])
+            elif not res_is_donor and res_is_acceptor:
+                hydrogenmatch = 1
+                hbondconfirmed.append(['A'])
+
+        chargedcheck = 0
+        charge_value = 0
+        res_charge_value = 0
+        doublechargecheck = 0
+        for charged in self.ligand_charged[ligand]:
+            d = (charged[1] - entry[3]).norm()
+            if d < 0.5:
+                chargedcheck = 1
+                hydrogenmatch = 0  # Replace previous match!
+                charge_value = charged[2]
+
+        if residue[0:3] in CHARGEDAA:
+            # Need to check which atoms, but for now assume charged
+            if chargedcheck:
+                doublechargecheck = 1
+            chargedcheck = 1
+            hydrogenmatch = 0  # Replace previous match!
+
+            if AA[residue[0:3]] in POSITIVE:
+                res_charge_value = 1
+            elif AA[residue[0:3]] in NEGATIVE:
+                res_charge_value = -1
+
+        details = [entry[0], entry[1], entry[2]]
+        if entry[1] == 'N' or entry[1] == 'O': #backbone connection!
+            fragment = self.fragment_library(ligand, entry[3], entry[0], entry[5], entry[6], 'HB_backbone')
+            return None, [residue,fragment,'polar_backbone','polar (hydrogen bond with backbone)','polar','protein'] + details
+
+        if hydrogenmatch:
+            fragment = self.fragment_library(ligand, entry[3], entry[0], entry[5], entry[6], 'HB')
+
+            found = 0
+            for x in self.summary_results[ligand]['hbond_confirmed']:
+                if residue == x[0]:
+                    x[1].extend(hbondconfirmed)
+                    found = 1
+            if found == 0:
+                self.summary_results[ligand]['hbond_confirmed'].append([residue, hbondconfirmed])
+
+            interaction = None
+            if hbondconfirmed[0][0]=="D":
+                interaction = [residue,fragment,'polar_donor_protein','polar (hydrogen bond)','polar','protein'] + details
+            if hbondconfirmed[0][0]=="A":
+                interaction = [residue,fragment,'polar_acceptor_protein','polar (hydrogen bond)','polar','protein'] + details
+            return 'hbondplus' if chargedcheck else None, interaction
+
+        if chargedcheck:
+            fragment = self.fragment_library(ligand, entry[3], entry[0], entry[5], entry[6], 'HBC')
+            if doublechargecheck:
+                if (res_charge_value>0):
+                    slug, name, direction = 'polar_double_pos_protein', 'polar (charge-charge)', ''
+                elif (res_charge_value<0):
+                    slug, name, direction = 'polar_double_neg_protein', 'polar (charge-charge)', ''
+                else:
+                    return 'hbondplus', None
+            elif (charge_value>0):
+                slug, name, direction = 'polar_pos_ligand', 'polar (charge-assisted hydrogen bond)', 'ligand'
+            elif (charge_value<0):
+                slug, name, direction = 'polar_neg_ligand', 'polar (charge-assisted hydrogen bond)', 'ligand'
+            elif (res_charge_value>0):
+                slug, name, direction = 'polar_pos_protein', 'polar (charge-assisted hydrogen bond)', 'protein'
+            elif (res_charge_value<0):
+                slug, name, direction = 'polar_neg_protein', 'polar (charge-assisted hydrogen bond)', 'protein'
+            else:
+                slug, name, direction = 'polar_unknown_protein', 'polar (charge-assisted hydrogen bond)', 'protein'
+            return 'hbondplus', [residue,fragment,slug,name,'polar',direction] + details
+
+        fragment = self.fragment_library(ligand, entry[3], entry[0], entry[5], entry[6], 'HB')
+        return 'hbond', [residue,fragment,'polar_unspecified','polar (hydrogen bond)','polar',''] + details
+
+    def analyze_interactions(self):
+        for ligand, result in self.results.items():
+            ligscore = 0
+            for residue, interaction in result.items():
+                sum = 0
+                score = 0
+                hbond = []
+                hbondplus = []
+                type = 'waals'
+                for entry in interaction:
+                    if entry[2] <= 3.5:
+                        if entry[0][0] == 'C' or entry[1][0] == 'C':
+                            continue  # If either atom is C then no hydrogen bonding
+
+                        bond_type, new_interaction = self.hydrogen_bond(residue, ligand, entry)
+                        if bond_type == 'hbondplus':
+                            type = 'hbondplus'
+                            hbondplus.append(entry)
+                        elif bond_type == 'hbond':
+                            type = 'hbond'
+                            hbond.append(entry)
+                        if new_interaction:
+                            self.new_results[ligand]['interactions'].append(new_interaction)
+                        # every polar classification (also without interaction) replaces the hydrophobic one
+                        if new_interaction or bond_type == 'hbondplus':
+                            self.remove_hyd(residue, ligand)
+                        entry[3] = ''
+
+                    if (entry[2] < 4.5):
+                        sum += 1
+                        score += 4.5 - entry[2]
+                score = round(score, 2)
+
+                if type == 'waals' and score > 2:  # mainly no hbond detected
+                    self.summary_results[ligand]['waals'].append([residue, score, sum])
+                elif type == 'hbond':
+                    self.summary_results[ligand]['hbond'].append([residue, score, sum, hbond])
+                elif type == 'hbondplus':
+                    self.summary_results[ligand]['hbondplus'].append([residue, score, sum, hbondplus])
+
+                ligscore += score
+
+            self.summary_results[ligand]['score'].append([ligscore])
+            self.new_results[ligand]['score'] = ligscore
+            self.new_results[ligand]['inchikey'] = self.inchikeys[ligand]
+            self.new_results[ligand]['smiles'] = self.smiles[ligand]
+            if ligand in self.hetlist_display:
+                self.new_results[ligand]['prettyname'] = self.hetlist_display[ligand]
+
+    def pretty_results(self):
+        for ligand, result in self.summary_results.items():
+            bindingresidues = []
+            for type, typelist in result.items():
+                if type == 'waals' or type == 'score':
+                    continue
+                bindingresidues += [entry[0] for entry in typelist]
+            self.new_results[ligand]['pdb'] = self.addresiduestoligand(ligand, bindingresidues)
+        return self.new_results
+
+
+def calculate_interactions(pdbname, pdb, peptide=None):
+    """Interactions per ligand of a PDB (calculated in this process), see InteractionCalculation.run"""
+    return InteractionCalculation(pdbname, pdb, peptide).run()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Worker processes shared by the calculations of this process (INTERACTION_WORKERS, 2 by default)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=getattr(settings, 'INTERACTION_WORKERS', 2))
+        return _pool
+
+
+def reset_pool():
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def run_calculation(pdbname, pdb, peptide=None):
+    """Calculate the interactions of a PDB in the worker pool (in this process when it cannot have children)"""
+    if multiprocessing.current_process().daemon:
+        return calculate_interactions(pdbname, pdb, peptide)
+    try:
+        return get_pool().submit(calculate_interactions, pdbname, pdb, peptide).result()
+    except BrokenProcessPool:
+        # a worker died (e.g. a crash in Open Babel), start with a new pool next time
+        reset_pool()
+        raise
+
+
+def run_calculations(jobs, workers=None):
+    """Batch mode: calculate (pdbname, pdb, peptide) jobs in worker processes, yields (pdbname, results, error) in
+    order of completion. Jobs are read from the iterable as workers become free, so it can be a generator."""
+    workers = workers or getattr(settings, 'INTERACTION_WORKERS', 2)
+    jobs = iter(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while True:
+            for pdbname, pdb, peptide in jobs:
+                running[pool.submit(calculate_interactions, pdbname, pdb, peptide)] = pdbname
+                if len(running) >= 2 * workers:
+                    break
+            if not running:
+                break
+
+            done, pending = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                pdbname = running.pop(future)
+                try:
+                    yield pdbname, future.result(), None
+                except Exception as error:
+                    yield pdbname, None, error
@@ -19,6 +19,11 @@ class ResidueFragmentInteraction(models.Model):
     def get_pdbdata(self):
         return "{!s}\n{!s}".format(self.rotamer.pdbdata, self.fragment.pdbdata)
 
+    def get_parsed_pdbdata(self):
+        """Parsed atoms of get_pdbdata (structure.pdb_store)"""
+        from structure.pdb_store import ParsedStructure
+        return ParsedStructure.join([self.rotamer.pdbdata.get_parsed(), self.fragment.pdbdata.get_parsed()])
+
 
     def generate_filename(self):
 
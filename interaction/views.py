@@ -1,5 +1,5 @@
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.conf import settings
 from django import forms
 from django.db.models import Count, Min, Sum, Avg, Q
@@ -16,7 +16,8 @@ from structure.models import Structure, PdbData, Rotamer, Fragment
 from structure.functions import BlastSearch
 from structure.assign_generic_numbers_gpcr import GenericNumbering
 from protein.models import ProteinConformation, Protein, ProteinSegment
-from residue.models import Residue, ResidueGenericNumber, ResidueGenericNumberEquivalent, ResidueNumberingScheme
+from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme
+from residue.numbering_index import generic_number_index
 from common.models import WebResource
 from common.models import WebLink
 from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
@@ -24,18 +25,15 @@ from common.selection import SimpleSelection, Selection, SelectionItem
 from common import definitions
 from common.views import AbsTargetSelection
 from common.alignment import Alignment
+from interaction.calculation import fetch_pdb, run_calculation, run_calculations
 from protein.models import Protein, ProteinFamily, ProteinGProtein, ProteinGProteinPair
 
 import os
-from os import listdir, devnull, makedirs
-import yaml
 from operator import itemgetter
 from datetime import datetime
 import re
 import json
 import logging
-from subprocess import call, Popen, DEVNULL
-import urllib
 import collections
 from collections import OrderedDict
 from io import StringIO, BytesIO
@@ -364,44 +362,72 @@ def fragment(request):
 
 def updateall(request):
     structures = Structure.objects.values('pdb_code__index').distinct()
+    pdbnames = []
     for s in structures:
         pdbname = s['pdb_code__index']
         check = ResidueFragmentInteraction.objects.filter(
-            structure_ligand_pair__structure__pdb_code__index=pdbname).all()
+            structure_ligand_pair__structure__pdb_code__index=pdbname)
 
-        if check.count() == 0:
-            t1 = datetime.now()
-            runcalculation(pdbname)
-            t2 = datetime.now()
-            delta = t2 - t1
-            seconds = delta.total_seconds()
-            print("Calculation: Total time " +
-                  str(seconds) + " seconds for " + pdbname)
-            t1 = datetime.now()
-            results = parsecalculation(pdbname, False)
-            t2 = datetime.now()
-            delta = t2 - t1
-            seconds = delta.total_seconds()
-            print("Parsing: Total time " +
-                  str(seconds) + " seconds for " + pdbname)
-            check = ResidueFragmentInteraction.objects.filter(
-                structure_ligand_pair__structure__pdb_code__index=pdbname).all()
-            print("Interactions found: " + str(check.count()))
+        if not check.exists():
+            pdbnames.append(pdbname)
         else:
             print(pdbname + " already calculated")
 
+    def jobs():
+        for pdbname in pdbnames:
+            try:
+                pdb = get_pdb_text(pdbname)
+            except Exception as msg:
+                # a structure without PDB file does not stop the others
+                print("Calculation failed for " + pdbname + ": " + str(msg))
+                continue
+            yield pdbname, pdb, None
+
+    # calculate in batch (worker processes), the results are stored as they come in
+    t0 = datetime.now()
+    for pdbname, calculation, error in run_calculations(jobs()):
+        if error is not None:
+            print("Calculation failed for " + pdbname + ": " + str(error))
+            continue
+        t1 = datetime.now()
+        results = parsecalculation(pdbname, calculation, False)
+        t2 = datetime.now()
+        delta = t2 - t1
+        seconds = delta.total_seconds()
+        print("Parsing: Total time " +
+              str(seconds) + " seconds for " + pdbname)
+        check = ResidueFragmentInteraction.objects.filter(
+            structure_ligand_pair__structure__pdb_code__index=pdbname).all()
+        print("Interactions found: " + str(check.count()))
+    print("Calculation: Total time " + str((datetime.now() - t0).total_seconds()) + " seconds for " +
+          str(len(pdbnames)) + " structures")
+
     # return render(request,'interaction/view.html',{'form': form, 'pdbname':
     # pdbname, 'structures': structures})
 
 
+def get_pdb_text(pdbname):
+    """PDB file of a structure from the database (fetched from the RCSB when not available)"""
+    pdb = Structure.objects.filter(pdb_code__index=pdbname, pdb_data__isnull=False).values_list(
+        'pdb_data__pdb', flat=True).first()
+    return pdb or fetch_pdb(pdbname)
+
+
 def runcalculation(pdbname, peptide=""):
-    calc_script = os.sep.join(
-        [os.path.dirname(__file__), 'legacy_functions.py'])
+    """Interactions per ligand (or of the peptide chain) of a structure, see interaction.calculation"""
+    return run_calculation(pdbname, get_pdb_text(pdbname), peptide)
 
-    call(["python2.7", calc_script, "-p", pdbname, "-c", peptide],
-         stdout=open(devnull, 'wb'), stderr=open(devnull, 'wb'))
 
-    return None
+def calculation_results(pdbname, calculation):
+    """Results per ligand as [pdbname, ligand, [result], score, inchikey, smiles], highest score first"""
+    results = []
+    for ligand, output in calculation.items():
+        if 'prettyname' not in output:
+            # use hetsyn name if possible, others 3letter
+            output['prettyname'] = ligand
+        results.append([pdbname, ligand, [output], round(output['score']), output['inchikey'].strip(),
+                        output['smiles'].strip()])
+    return sorted(results, key=itemgetter(3), reverse=True)
 
 
 def check_residue(protein, pos, aa):
@@ -422,11 +448,10 @@ def check_residue(protein, pos, aa):
 
 
 def extract_fragment_rotamer(f, residue, structure, ligand):
-    if os.path.isfile(f):
-        f_in = open(f, 'r')
+    if f:
         rotamer_pdb = ''
         fragment_pdb = ''
-        for line in f_in:
+        for line in f.splitlines(True):
             if line.startswith('HETATM') or line.startswith('CONECT') or line.startswith('MASTER') or line.startswith('END'):
                 fragment_pdb += line
             elif line.startswith('ATOM'):
@@ -434,14 +459,12 @@ def extract_fragment_rotamer(f, residue, structure, ligand):
             else:
                 fragment_pdb += line
                 rotamer_pdb += line
-        f_in.close()
 
-        rotamer_data, created = PdbData.objects.get_or_create(pdb=rotamer_pdb)
+        rotamer_data, created = PdbData.get_or_create_pdb(rotamer_pdb)
         rotamer, created = Rotamer.objects.get_or_create(
             residue=residue, structure=structure, pdbdata=rotamer_data)
 
-        fragment_data, created = PdbData.objects.get_or_create(
-            pdb=fragment_pdb)
+        fragment_data, created = PdbData.get_or_create_pdb(fragment_pdb)
         fragment, created = Fragment.objects.get_or_create(
             ligand=ligand, structure=structure, pdbdata=fragment_data, residue=residue)
     else:
@@ -452,11 +475,9 @@ def extract_fragment_rotamer(f, residue, structure, ligand):
 
 
 # consider skipping non hetsym ligands FIXME
-def parsecalculation(pdbname, debug=True, ignore_ligand_preset=False):
+def parsecalculation(pdbname, calculation, debug=True, ignore_ligand_preset=False):
     logger = logging.getLogger('build')
-    mypath = '/tmp/interactions/results/' + pdbname + '/output'
-    module_dir = '/tmp/interactions'
-    results = []
+    results = calculation_results(pdbname, calculation)
     web_resource, created = WebResource.objects.get_or_create(
         slug='pdb', url='http://www.rcsb.org/pdb/explore/explore.do?structureId=$index')
     web_link, created = WebLink.objects.get_or_create(
@@ -469,178 +490,125 @@ def parsecalculation(pdbname, debug=True, ignore_ligand_preset=False):
         structure = Structure.objects.get(pdb_code=web_link)
 
         if structure.pdb_data is None:
-            f = module_dir + "/pdbs/" + pdbname + ".pdb"
-            if os.path.isfile(f):
-                pdbdata, created = PdbData.objects.get_or_create(
-                    pdb=open(f, 'r').read())  # does this close the file?
-            else:
-                print('quitting due to no pdb in filesystem')
-                quit()
+            pdbdata, created = PdbData.get_or_create_pdb(fetch_pdb(pdbname))
             structure.pdb_data = pdbdata
             structure.save()
 
         protein = structure.protein_conformation
 
-        for f in listdir(mypath):
-            if os.path.isfile(os.path.join(mypath, f)):
-                annotated = 0
-                #print(mypath + "/" +f)
-                result = yaml.load(open(mypath + "/" + f, 'rb'), Loader=yaml.FullLoader)
-                output = result
-                temp = f.replace('.yaml', '').split("_")
-                temp.append([output])
-                temp.append(round(output['score']))
-                temp.append((output['inchikey']).strip())
-                temp.append((output['smiles']).strip())
-
-                results.append(temp)
-
-                if 'prettyname' not in output:
-                    # use hetsyn name if possible, others 3letter
-                    output['prettyname'] = temp[1]
-
-                f = module_dir + "/results/" + pdbname + "/interaction" + \
-                    "/" + pdbname + "_" + temp[1] + ".pdb"
-                if os.path.isfile(f):
-                    pdbdata, created = PdbData.objects.get_or_create(
-                        pdb=open(f, 'r').read())  # does this close the file?
-                    if debug:
-                        print("Found file" + f)
-                else:
-                    print('quitting due to no pdb for fragment in filesystem', f)
-                    quit()
-
-                structureligandinteraction = StructureLigandInteraction.objects.filter(
-                    pdb_reference=temp[1], structure=structure, annotated=True) #, pdb_file=None
-                if structureligandinteraction.exists():  # if the annotated exists
-                    annotated_found = 1
-                    annotated = 1
-                    try:
-                        structureligandinteraction = structureligandinteraction.get()
-                        structureligandinteraction.pdb_file = pdbdata
-                        ligand = structureligandinteraction.ligand
-                        if structureligandinteraction.ligand.properities.inchikey is None:
-                            structureligandinteraction.ligand.properities.inchikey = output['inchikey'].strip()
-                        elif structureligandinteraction.ligand.properities.inchikey != output['inchikey'].strip():
-                            logger.error(
-                                'Ligand/PDB inchikey mismatch (PDB:' + pdbname + ' LIG:' + output['prettyname'] + '): '+structureligandinteraction.ligand.properities.inchikey+' vs '+ output['inchikey'].strip())
-                    except Exception as msg:
-                        print('error with dublication structureligand',temp[1],msg)
-                        break
-                elif StructureLigandInteraction.objects.filter(pdb_reference=temp[1], structure=structure).exists():
-                    try:
-                        structureligandinteraction = StructureLigandInteraction.objects.filter(
-                            pdb_reference=temp[1], structure=structure).get()
-                        structureligandinteraction.pdb_file = pdbdata
-                    except: #already there
-                        structureligandinteraction = StructureLigandInteraction.objects.filter(
-                            pdb_reference=temp[1], structure=structure, pdb_file=pdbdata).get()
-                    ligand = structureligandinteraction.ligand
-                else:  # create ligand and pair
-
-                    ligand = Ligand.objects.filter(
-                        name=output['prettyname'], canonical=True)
-
-                    if ligand.exists():  # if ligand with name (either hetsyn or 3 letter) exists use that.
-                        ligand = ligand.get()
-                    else:  # create it
-                        default_ligand_type = 'N/A'
-                        lt, created = LigandType.objects.get_or_create(slug=slugify(default_ligand_type),
-                                                                       defaults={'name': default_ligand_type})
-
-                        ligand = Ligand()
-                        ligand = ligand.load_from_pubchem(
-                            'inchikey', output['inchikey'].strip(), lt, output['prettyname'])
-                        try:
-                            ligand.save()
-                        except:
-                            #print('ligand save failed, empty ligand?',output['prettyname'])
-                            continue
-
-                    ligandrole, created = LigandRole.objects.get_or_create(
-                        name='unknown', slug='unknown')
-                    structureligandinteraction = StructureLigandInteraction()
-                    structureligandinteraction.ligand = ligand
-                    structureligandinteraction.structure = structure
-                    structureligandinteraction.ligand_role = ligandrole
-                    structureligandinteraction.pdb_file = pdbdata
-                    structureligandinteraction.pdb_reference = temp[1]
-
-                structureligandinteraction.save()
+        for temp in results:
+            annotated = 0
+            output = temp[2][0]
 
-                ResidueFragmentInteraction.objects.filter(structure_ligand_pair=structureligandinteraction).delete()
+            # the ligand with its binding residues
+            pdbdata, created = PdbData.get_or_create_pdb(output['pdb'])
 
-                for interaction in output['interactions']:
-                    # print(interaction)
-                    aa = interaction[0]
-                    aa, pos, chain = regexaa(aa)
-                    residue = check_residue(protein, pos, aa)
-                    f = interaction[1]
-
-                    fragment, rotamer = extract_fragment_rotamer(
-                                    f, residue, structure, ligand)
-
-                    # print(interaction[2],interaction[3],interaction[4],interaction[5])
-                    if fragment!=None:
-                        interaction_type, created = ResidueFragmentInteractionType.objects.get_or_create(
-                                        slug=interaction[2], name=interaction[3], type=interaction[4], direction=interaction[5])
-                        fragment_interaction, created = ResidueFragmentInteraction.objects.get_or_create(
-                                        structure_ligand_pair=structureligandinteraction, interaction_type=interaction_type, fragment=fragment, rotamer=rotamer)
-                #print("Inserted",len(output['interactions']),"interactions","ligand",temp[1],"annotated",annotated)
+            structureligandinteraction = StructureLigandInteraction.objects.filter(
+                pdb_reference=temp[1], structure=structure, annotated=True) #, pdb_file=None
+            if structureligandinteraction.exists():  # if the annotated exists
+                annotated_found = 1
+                annotated = 1
+                try:
+                    structureligandinteraction = structureligandinteraction.get()
+                    structureligandinteraction.pdb_file = pdbdata
+                    ligand = structureligandinteraction.ligand
+                    if structureligandinteraction.ligand.properities.inchikey is None:
+                        structureligandinteraction.ligand.properities.inchikey = output['inchikey'].strip()
+                    elif structureligandinteraction.ligand.properities.inchikey != output['inchikey'].strip():
+                        logger.error(
+                            'Ligand/PDB inchikey mismatch (PDB:' + pdbname + ' LIG:' + output['prettyname'] + '): '+structureligandinteraction.ligand.properities.inchikey+' vs '+ output['inchikey'].strip())
+                except Exception as msg:
+                    print('error with dublication structureligand',temp[1],msg)
+                    break
+            elif StructureLigandInteraction.objects.filter(pdb_reference=temp[1], structure=structure).exists():
+                try:
+                    structureligandinteraction = StructureLigandInteraction.objects.filter(
+                        pdb_reference=temp[1], structure=structure).get()
+                    structureligandinteraction.pdb_file = pdbdata
+                except: #already there
+                    structureligandinteraction = StructureLigandInteraction.objects.filter(
+                        pdb_reference=temp[1], structure=structure, pdb_file=pdbdata).get()
+                ligand = structureligandinteraction.ligand
+            else:  # create ligand and pair
+
+                ligand = Ligand.objects.filter(
+                    name=output['prettyname'], canonical=True)
+
+                if ligand.exists():  # if ligand with name (either hetsyn or 3 letter) exists use that.
+                    ligand = ligand.get()
+                else:  # create it
+                    default_ligand_type = 'N/A'
+                    lt, created = LigandType.objects.get_or_create(slug=slugify(default_ligand_type),
+                                                                   defaults={'name': default_ligand_type})
+
+                    ligand = Ligand()
+                    ligand = ligand.load_from_pubchem(
+                        'inchikey', output['inchikey'].strip(), lt, output['prettyname'])
+                    try:
+                        ligand.save()
+                    except:
+                        #print('ligand save failed, empty ligand?',output['prettyname'])
+                        continue
+
+                ligandrole, created = LigandRole.objects.get_or_create(
+                    name='unknown', slug='unknown')
+                structureligandinteraction = StructureLigandInteraction()
+                structureligandinteraction.ligand = ligand
+                structureligandinteraction.structure = structure
+                structureligandinteraction.ligand_role = ligandrole
+                structureligandinteraction.pdb_file = pdbdata
+                structureligandinteraction.pdb_reference = temp[1]
+
+            structureligandinteraction.save()
+
+            ResidueFragmentInteraction.objects.filter(structure_ligand_pair=structureligandinteraction).delete()
+
+            for interaction in output['interactions']:
+                # print(interaction)
+                aa = interaction[0]
+                aa, pos, chain = regexaa(aa)
+                residue = check_residue(protein, pos, aa)
+                f = interaction[1]
+
+                fragment, rotamer = extract_fragment_rotamer(
+                                f, residue, structure, ligand)
+
+                # print(interaction[2],interaction[3],interaction[4],interaction[5])
+                if fragment!=None:
+                    interaction_type, created = ResidueFragmentInteractionType.objects.get_or_create(
+                                    slug=interaction[2], name=interaction[3], type=interaction[4], direction=interaction[5])
+                    fragment_interaction, created = ResidueFragmentInteraction.objects.get_or_create(
+                                    structure_ligand_pair=structureligandinteraction, interaction_type=interaction_type, fragment=fragment, rotamer=rotamer)
+            #print("Inserted",len(output['interactions']),"interactions","ligand",temp[1],"annotated",annotated)
         # if not annotated_found:
         #     print("No interactions for annotated ligand")
 
     else:
         if debug:
             logger.info("Structure not in DB?!??!")
-        for f in listdir(mypath):
-            if os.path.isfile(os.path.join(mypath, f)):
-                result = yaml.load(open(mypath + "/" + f, 'rb'), Loader=yaml.FullLoader)
-                output = result
-
-                temp = f.replace('.yaml', '').split("_")
-                temp.append([output])
-                temp.append(round(output['score'][0][0]))
-                temp.append((output['inchikey']).strip())
-                temp.append((output['smiles']).strip())
-                results.append(temp)
-
-    results = sorted(results, key=itemgetter(3), reverse=True)
 
     return results
 
 
-def runusercalculation(filename, session):
-    calc_script = os.sep.join(
-        [os.path.dirname(__file__), 'legacy_functions.py'])
-    call(["python2.7", calc_script, "-p", filename, "-s", session])
-    return None
+def user_calculation_key(pdbname, session):
+    return 'interaction_calculation_' + session + '_' + pdbname
 
 
-# consider skipping non hetsym ligands FIXME
-def parseusercalculation(pdbname, session, debug=True, ignore_ligand_preset=False, ):
-    logger = logging.getLogger('build')
-    mypath = '/tmp/interactions/' + session + '/results/' + pdbname + '/output'
-    module_dir = '/tmp/interactions/' + session
-    results = []
+def runusercalculation(pdbname, session, pdb):
+    """Calculate the interactions of a user PDB, the results are kept (cached) for the session"""
+    calculation = run_calculation(pdbname, pdb)
+    cache.set(user_calculation_key(pdbname, session), calculation, 60*60*24)
+    return calculation
 
-    for f in listdir(mypath):
-        if os.path.isfile(os.path.join(mypath, f)):
-            result = yaml.load(open(mypath + "/" + f, 'rb'), Loader=yaml.FullLoader)
-            output = result
 
-            temp = f.replace('.yaml', '').split("_")
-            temp.append([output])
-            temp.append(round(output['score']))
-            temp.append((output['inchikey']).strip())
-            temp.append((output['smiles']).strip())
-            results.append(temp)
-
-            if 'prettyname' not in output:
-                output['prettyname'] = temp[1]
+def parseusercalculation(pdbname, session, debug=True, ignore_ligand_preset=False, ):
+    calculation = cache.get(user_calculation_key(pdbname, session))
+    if calculation is None:
+        # calculate again from the PDB file of the session
+        with open('/tmp/interactions/' + session + '/pdbs/' + pdbname + '.pdb', 'r') as f:
+            calculation = runusercalculation(pdbname, session, f.read())
 
-    results = sorted(results, key=itemgetter(3), reverse=True)
-    return results
+    return calculation_results(pdbname, calculation)
 
 # DEPRECATED
 def showcalculation(request):
@@ -668,7 +636,6 @@ def calculate(request, redirect=None):
             module_dir = os.sep.join([module_dir, session_key])
             module_dirs.append(module_dir)
             module_dirs.append(os.sep.join([module_dir, 'pdbs']))
-            module_dirs.append(os.sep.join([module_dir, 'temp']))
 
             # create dirs and set permissions (needed on some systems)
             for mdir in module_dirs:
@@ -680,13 +647,13 @@ def calculate(request, redirect=None):
                 pdbname = os.path.splitext(str(pdbdata))[0]
                 pdbname = pdbname.replace("_","")
                 print(pdbname)
-                with open(module_dir + '/pdbs/' + str(pdbdata).replace("_",""), 'wb+') as destination:
+                temp_path = module_dir + '/pdbs/' + pdbname + '.pdb'
+                with open(temp_path, 'wb+') as destination:
                     for chunk in pdbdata.chunks():
                         destination.write(chunk)
 
-                temp_path = module_dir + '/pdbs/' + str(pdbdata).replace("_","")
                 pdbdata = open(temp_path, 'r').read()
-                runusercalculation(pdbname, session_key)
+                calculation = runusercalculation(pdbname, session_key, pdbdata)
 
             else:
                 pdbname = form.cleaned_data['pdbname'].strip()
@@ -694,15 +661,13 @@ def calculate(request, redirect=None):
                 temp_path = module_dir + '/pdbs/' + pdbname + '.pdb'
 
                 if not os.path.isfile(temp_path):
-                    url = 'http://www.rcsb.org/pdb/files/%s.pdb' % pdbname
-                    pdbdata = urllib.request.urlopen(
-                        url).read().decode('utf-8')
+                    pdbdata = fetch_pdb(pdbname)
                     f = open(temp_path, 'w')
                     f.write(pdbdata)
                     f.close()
                 else:
                     pdbdata = open(temp_path, 'r').read()
-                runusercalculation(pdbname, session_key)
+                calculation = runusercalculation(pdbname, session_key, pdbdata)
 
             # MAPPING GPCRdb numbering onto pdb.
             generic_numbering = GenericNumbering(temp_path,top_results=1)
@@ -801,8 +766,7 @@ def calculate(request, redirect=None):
                 if line.startswith('REMARK   2 RESOLUTION.'):
                     xtal['resolution'] = line[22:].strip()
 
-            results = parseusercalculation(
-                pdbname, request.session.session_key)
+            results = calculation_results(pdbname, calculation)
 
             simple = collections.OrderedDict()
             simple_generic_number = collections.OrderedDict()
@@ -972,7 +936,7 @@ def calculate(request, redirect=None):
                             continue
 
                         # get residue number equivalent object
-                        rne = ResidueGenericNumberEquivalent.objects.get(label=gn, scheme__slug='gpcrdba')
+                        rne = generic_number_index().equivalent(gn, 'gpcrdba')
 
                         # create a selection item
                         properties = {
@@ -1025,8 +989,11 @@ def download(request):
 
     if session:
         session = request.session.session_key
-        pdbdata = open('/tmp/interactions/' + session + '/results/' + pdbname +
-                       '/interaction/' + pdbname + '_' + ligand + '.pdb', 'r').read()
+        results = parseusercalculation(pdbname, session)
+        pdbdata = [r[2][0]['pdb'] for r in results if r[1] == ligand]
+        if not pdbdata:
+            raise Http404('No ligand {} in {}'.format(ligand, pdbname))
+        pdbdata = pdbdata[0]
         response = HttpResponse(pdbdata, content_type='text/plain')
     else:
 
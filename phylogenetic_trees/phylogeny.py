@@ -0,0 +1,236 @@
+"""
+Phylogenetic trees of aligned protein sequences, in process (the PHYLIP seqboot, protdist, neighbor and consense steps).
+
+Distances are Kimura protein distances over the positions where neither sequence has a gap. Trees are built with
+neighbor joining (unrooted, three branches at the root like neighbor) or UPGMA. Bootstrap replicates resample the
+alignment positions and run in worker processes. They are summarized in an extended majority rule consensus tree
+with the number of replicates containing each group as branch length, like consense. Trees are written as Newick.
+"""
+from django.conf import settings
+
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import squareform
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
+
+import numpy as np
+
+# positions with any other letter (gaps, X, B, Z) are not compared
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+# the Kimura formula is undefined from p = 0.8541, larger differences get the distance of this one
+KIMURA_MAX_DIFFERENCE = 0.85
+
+# seed of the first replicate (the one given to seqboot), replicate i uses BOOTSTRAP_SEED + i
+BOOTSTRAP_SEED = 77
+
+_codes = np.full(256, len(AMINO_ACIDS), dtype=np.uint8)
+for _i, _aa in enumerate(AMINO_ACIDS):
+    _codes[ord(_aa)] = _i
+    _codes[ord(_aa.lower())] = _i
+
+
+def encode_alignment(sequences):
+    """Aligned sequences (equal length) to a sequences x positions array of amino acid codes"""
+    return np.array([_codes[np.frombuffer(s.encode('ascii', 'replace'), dtype=np.uint8)] for s in sequences])
+
+
+def distance_matrix(codes, weights=None):
+    """Kimura protein distances between all encoded sequences, positions weighted by the number of times sampled"""
+    n, length = codes.shape
+    if weights is None:
+        weights = np.ones(length, dtype=np.float32)
+    weights = np.asarray(weights, dtype=np.float32)
+
+    # identical and compared positions of all pairs as matrix products over one-hot amino acids
+    onehot = (codes[:, :, None] == np.arange(len(AMINO_ACIDS), dtype=np.uint8)).astype(np.float32)
+    identical = (onehot * weights[None, :, None]).reshape(n, -1) @ onehot.reshape(n, -1).T
+    valid = (codes < len(AMINO_ACIDS)).astype(np.float32)
+    compared = (valid * weights) @ valid.T
+
+    p = np.ones((n, n))
+    np.divide(compared - identical, compared, out=p, where=compared > 0)
+    p = np.minimum(p, KIMURA_MAX_DIFFERENCE)
+    distances = -np.log(1 - p - 0.2*p*p)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def neighbor_joining(distances):
+    """Unrooted tree (nested lists of (node, branch length), leaves are indices) with three branches at the root"""
+    d = np.array(distances, dtype=np.float64)
+    nodes = list(range(len(d)))
+    while len(nodes) > 3:
+        n = len(nodes)
+        r = d.sum(axis=1)
+        q = (n - 2)*d - r[:, None] - r[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = sorted(np.unravel_index(np.argmin(q), q.shape))
+
+        length_i = 0.5*d[i, j] + (r[i] - r[j]) / (2*(n - 2))
+        length_j = d[i, j] - length_i
+        joined = 0.5*(d[i] + d[j] - d[i, j])
+
+        # the joined node takes the place of i
+        nodes[i] = [(nodes[i], length_i), (nodes[j], length_j)]
+        d[i, :] = joined
+        d[:, i] = joined
+        d[i, i] = 0
+        d = np.delete(np.delete(d, j, axis=0), j, axis=1)
+        del nodes[j]
+
+    if len(nodes) < 3:
+        return [(node, d[0, -1] / len(nodes)) for node in nodes]
+    lengths = [(d[0, 1] + d[0, 2] - d[1, 2]) / 2, (d[0, 1] + d[1, 2] - d[0, 2]) / 2, (d[0, 2] + d[1, 2] - d[0, 1]) / 2]
+    return list(zip(nodes, lengths))
+
+
+def upgma(distances):
+    """Rooted tree (nested lists of (node, branch length), leaves are indices) of average linkage clustering"""
+    n = len(distances)
+    links = linkage(squareform(distances, checks=False), method='average')
+    nodes = list(range(n))
+    heights = [0.0]*n
+    for a, b, distance, _ in links:
+        a, b, height = int(a), int(b), distance / 2
+        nodes.append([(nodes[a], height - heights[a]), (nodes[b], height - heights[b])])
+        heights.append(height)
+    return nodes[-1]
+
+
+def build_tree(distances, use_upgma=False):
+    return upgma(distances) if use_upgma else neighbor_joining(distances)
+
+
+def tree_splits(tree, n):
+    """Splits of the internal branches of a tree as bit sets of leaves, the side without leaf 0"""
+    everything = (1 << n) - 1
+    splits = set()
+    leaves = {}
+    # children before their parents
+    stack, order = [tree], []
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            order.append(node)
+            stack.extend(child for child, _ in node)
+    for node in reversed(order):
+        bits = 0
+        for child, _ in node:
+            bits |= (1 << child) if not isinstance(child, list) else leaves[id(child)]
+        leaves[id(node)] = bits
+        if bits & 1:
+            bits = everything ^ bits
+        if 1 < bin(bits).count('1') < n - 1:
+            splits.add(bits)
+    return splits
+
+
+def bootstrap_splits(codes, use_upgma, replicates):
+    """Splits of the trees of bootstrap replicates (run in the worker processes)"""
+    n, length = codes.shape
+    output = []
+    for replicate in replicates:
+        random = np.random.RandomState(BOOTSTRAP_SEED + replicate)
+        weights = np.bincount(random.randint(0, length, length), minlength=length)
+        output.append(tree_splits(build_tree(distance_matrix(codes, weights), use_upgma), n))
+    return output
+
+
+def consensus_tree(split_sets, n):
+    """Extended majority rule consensus of the splits of trees, groups have the number of trees containing them as
+    branch length and leaf 0 is the first branch at the root (like consense)"""
+    counts = {}
+    for splits in split_sets:
+        for split in splits:
+            counts[split] = counts.get(split, 0) + 1
+
+    # groups of most trees first, each group compatible with all groups taken before
+    chosen = []
+    for split, count in sorted(counts.items(), key=lambda x: (-x[1], -bin(x[0]).count('1'), x[0])):
+        if len(chosen) >= n - 3:
+            break
+        if 2*count > len(split_sets) or all(split & c in (0, split, c) for c in chosen):
+            chosen.append(split)
+
+    # groups are nested or disjoint as none contains leaf 0, smallest first
+    chosen.sort(key=lambda split: bin(split).count('1'))
+    children = OrderedDict((split, []) for split in chosen + [None])
+    for leaf in range(n):
+        parent = next((c for c in chosen if c >> leaf & 1), None)
+        children[parent].append((leaf, float(len(split_sets))))
+    nodes = {}
+    for k, split in enumerate(chosen):
+        parent = next((c for c in chosen[k+1:] if split & c == split), None)
+        nodes[split] = children[split]
+        children[parent].append((nodes[split], float(counts[split])))
+    return children[None]
+
+
+def newick(tree, names, precision=5):
+    """Newick string of a tree (nested lists of (node, branch length), leaves are indices)"""
+    # iterative, deep trees would hit the recursion limit
+    parts = []
+    stack = [('node', tree, None)]
+    while stack:
+        kind, node, length = stack.pop()
+        if kind == 'node' and isinstance(node, list):
+            parts.append('(')
+            stack.append(('close', None, length))
+            for k, (child, child_length) in enumerate(reversed(node)):
+                if k:
+                    stack.append(('separator', None, None))
+                stack.append(('node', child, child_length))
+            continue
+        if kind == 'separator':
+            parts.append(',')
+            continue
+        parts.append(')' if kind == 'close' else names[node])
+        if length is not None:
+            parts.append(':{:.{}f}'.format(length, precision))
+    return ''.join(parts) + ';'
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Worker processes for the bootstrap replicates of this process (PHYLOGENY_WORKERS, 2 by default)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=getattr(settings, 'PHYLOGENY_WORKERS', 2))
+        return _pool
+
+
+def reset_pool():
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def phylogeny(names, sequences, use_upgma=False, bootstrap=0):
+    """Newick tree of aligned sequences: the distance tree, or the consensus of bootstrap replicates"""
+    codes = encode_alignment(sequences)
+    n = len(names)
+    if not bootstrap:
+        return newick(build_tree(distance_matrix(codes), use_upgma), names)
+
+    workers = getattr(settings, 'PHYLOGENY_WORKERS', 2)
+    chunks = [list(range(bootstrap))[k::workers] for k in range(min(workers, bootstrap))]
+    if multiprocessing.current_process().daemon or workers < 2:
+        # no child processes in daemon processes
+        results = [bootstrap_splits(codes, use_upgma, chunk) for chunk in chunks]
+    else:
+        try:
+            futures = [get_pool().submit(bootstrap_splits, codes, use_upgma, chunk) for chunk in chunks]
+            results = [future.result() for future in futures]
+        except BrokenProcessPool:
+            reset_pool()
+            raise
+    return newick(consensus_tree([splits for result in results for splits in result], n), names, 1)
@@ -4,9 +4,8 @@ from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
 from common.diagrams_gprotein import DrawGproteinPlot
 from django.core.cache import cache
 from django.db import models
-from residue.models import (Residue, ResidueDataPoint, ResidueDataType,
-                            ResidueGenericNumberEquivalent,
-                            ResidueNumberingScheme)
+from residue.models import Residue, ResidueDataPoint, ResidueDataType
+from residue.numbering_index import generic_number_index
 
 
 class Protein(models.Model):
@@ -436,6 +435,4 @@ class ProteinGProteinPair(models.Model):
 def dgn(gn, protein_conformation):
     ''' Converts generic number to display generic number.
     '''
-    scheme = ResidueNumberingScheme.objects.get(slug=protein_conformation.protein.residue_numbering_scheme.slug)
-    convert_gn = ResidueGenericNumberEquivalent.objects.get(label=gn, scheme=scheme).default_generic_number.label
-    return Residue.objects.get(protein_conformation=protein_conformation, generic_number__label=convert_gn).display_generic_number.label
+    return generic_number_index().display_generic_number(gn, protein_conformation.pk)
@@ -69,6 +69,14 @@ MIDDLEWARE = (
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+# Request metrics (common.middleware.stats), aggregated per URL name and flushed as JSON lines
+STATS_LOG = os.path.join(BASE_DIR, "logs/stats.jsonl")
+STATS_FLUSH_INTERVAL = 60 # seconds
+STATS_SLOW_REQUEST = 5 # seconds
+
+# Worker processes for ligand interaction calculations (interaction.calculation)
+INTERACTION_WORKERS = 2
+
 ROOT_URLCONF = 'protwis.urls'
 
 # WSGI_APPLICATION = 'protwis.wsgi.application'
@@ -177,21 +185,36 @@ if DEBUG:
 #CACHE
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'BACKEND': 'common.cache_backends.TieredCache',
         'LOCATION': '/tmp/django_cache',
         'OPTIONS': {
-            'MAX_ENTRIES': 10000000
+            'MAX_SIZE': 20 * 1024**3,
+            'MEMORY_MAX_SIZE': 256 * 1024**2,
+            'MEMORY_MAX_ENTRIES': 50000,
         }
     },
     'alignments': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'BACKEND': 'common.cache_backends.TieredCache',
         'LOCATION': '/tmp/django_cache_alignments',
         'OPTIONS': {
-            'MAX_ENTRIES': 1000
+            'MAX_SIZE': 2 * 1024**3,
+            'MEMORY_MAX_SIZE': 64 * 1024**2,
+            'MEMORY_MAX_ENTRIES': 1000,
+        }
+    },
+    # dataset generations of common.cache_keys, never evicted
+    'generations': {
+        'BACKEND': 'common.cache_backends.TieredCache',
+        'LOCATION': '/tmp/django_cache_generations',
+        'OPTIONS': {
+            'MAX_SIZE': None,
         }
     }
 }
 
+# Hit/miss/size counters per cache key prefix (common.cache_backends), flushed as JSON lines
+CACHE_STATS_LOG = os.path.join(BASE_DIR, "logs/cache_stats.jsonl")
+
 # Note that https://www.django-rest-framework.org/community/3.10-announcement
 # So, have to switch from CoreAPI to OpenAPI. Next line will work for now.
 # Uncomment when needed.
@@ -4,6 +4,7 @@ from django.db import IntegrityError
 
 from protein.models import Protein, ProteinAnomaly, ProteinSegment
 from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent
+from residue.numbering_index import generic_number_index
 
 import logging
 from collections import OrderedDict
@@ -616,7 +617,5 @@ def ggn(gn):
 def dgn(gn, protein_conformation):
     ''' Converts generic number to display generic number.
     '''
-    scheme = ResidueNumberingScheme.objects.get(slug=protein_conformation.protein.residue_numbering_scheme.slug)
-    convert_gn = ResidueGenericNumberEquivalent.objects.get(label=gn, scheme=scheme).default_generic_number.label
-    return Residue.objects.get(protein_conformation=protein_conformation, generic_number__label=convert_gn).display_generic_number.label
+    return generic_number_index().display_generic_number(gn, protein_conformation.pk)
     
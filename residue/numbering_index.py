@@ -0,0 +1,218 @@
+"""
+Process-wide index for translating generic numbers between numbering schemes and to the residues of proteins.
+
+The numbering schemes, generic numbers and their equivalents are read with a few bulk queries on first use and kept
+until a build changes the protein data (generation of the 'proteins' dataset, see common.cache_keys). The numbered
+residues of protein conformations are read in bulk when requested and the most recently used ones are kept.
+Lookups that fail raise the DoesNotExist exception of the model the equivalent query would have used.
+"""
+from django.conf import settings
+
+from common.cache_keys import namespace
+from residue.models import Residue, ResidueGenericNumber, ResidueGenericNumberEquivalent, ResidueNumberingScheme
+
+from collections import namedtuple, OrderedDict
+import threading
+
+# number of protein conformations of which the numbered residues are kept
+PROTEIN_NUMBERING_CACHE_SIZE = 1000
+
+Scheme = namedtuple('Scheme', ['id', 'slug', 'short_name', 'name', 'parent_id'])
+
+# scheme and segment are slugs (segment None when not assigned)
+GenericNumber = namedtuple('GenericNumber', ['id', 'scheme', 'label', 'segment'])
+
+# generic_number, display_generic_number: GenericNumber or None, alternative_generic_numbers: tuple of GenericNumber
+NumberedResidue = namedtuple('NumberedResidue', ['id', 'sequence_number', 'amino_acid', 'segment', 'generic_number',
+                                                 'display_generic_number', 'alternative_generic_numbers'])
+
+
+class ProteinNumbering():
+    """The residues of one protein conformation and their generic numbers"""
+    def __init__(self, protein_conformation_id, protein_id, scheme, residues):
+        self.protein_conformation_id = protein_conformation_id
+        self.protein_id = protein_id
+        self.scheme = scheme
+        self.residues = residues
+        self.by_sequence_number = {r.sequence_number: r for r in residues}
+        self.by_generic_number = {r.generic_number.label: r for r in residues if r.generic_number}
+        self.by_display_generic_number = {r.display_generic_number.label: r for r in residues if r.display_generic_number}
+
+    def residue(self, sequence_number=None, generic_number=None, display_generic_number=None):
+        """Residue by sequence number, generic number label or display generic number label"""
+        if sequence_number is not None:
+            residue = self.by_sequence_number.get(sequence_number)
+        elif generic_number is not None:
+            residue = self.by_generic_number.get(generic_number)
+        else:
+            residue = self.by_display_generic_number.get(display_generic_number)
+        if residue is None:
+            raise Residue.DoesNotExist('No residue {} in protein conformation {}'.format(
+                sequence_number or generic_number or display_generic_number, self.protein_conformation_id))
+        return residue
+
+
+class GenericNumberIndex():
+    """Numbering schemes, generic numbers and equivalents, and the numbered residues of protein conformations"""
+    def __init__(self):
+        self.schemes = OrderedDict()
+        self.scheme_lookup = {}
+        for scheme in ResidueNumberingScheme.objects.order_by('id').values_list('id', 'slug', 'short_name', 'name',
+                                                                                'parent_id'):
+            scheme = Scheme(*scheme)
+            self.schemes[scheme.slug] = scheme
+            for key in (scheme.id, str(scheme.id), scheme.short_name, scheme.slug):
+                self.scheme_lookup[key] = scheme
+
+        self.generic_numbers = {}
+        self.generic_number_labels = {}
+        schemes_by_id = {scheme.id: scheme.slug for scheme in self.schemes.values()}
+        for gn_id, scheme_id, label, segment in ResidueGenericNumber.objects.values_list('id', 'scheme_id', 'label',
+                                                                                        'protein_segment__slug'):
+            gn = GenericNumber(gn_id, schemes_by_id[scheme_id], label, segment)
+            self.generic_numbers[gn_id] = gn
+            self.generic_number_labels[(gn.scheme, label)] = gn
+
+        # equivalent (scheme, label) -> (equivalent id, default generic number) and back, a default generic number
+        # with several equivalents in a scheme maps back to the first one created
+        self.equivalents = {}
+        self.equivalent_labels = {}
+        for eq_id, scheme_id, label, default_id in ResidueGenericNumberEquivalent.objects.order_by('id').values_list(
+                'id', 'scheme_id', 'label', 'default_generic_number_id'):
+            default = self.generic_numbers[default_id]
+            self.equivalents[(schemes_by_id[scheme_id], label)] = (eq_id, default)
+            self.equivalent_labels.setdefault((default.label, schemes_by_id[scheme_id]), label)
+
+        self.numberings = OrderedDict()
+        self.lock = threading.Lock()
+
+    def scheme(self, scheme):
+        """Numbering scheme by slug, short name, id or ResidueNumberingScheme object"""
+        if isinstance(scheme, ResidueNumberingScheme):
+            scheme = scheme.id
+        try:
+            return self.scheme_lookup[scheme]
+        except KeyError:
+            raise ResidueNumberingScheme.DoesNotExist('Unknown numbering scheme {}'.format(scheme))
+
+    def generic_number(self, label, scheme=None):
+        """GenericNumber of a label in a scheme (the default scheme when not given)"""
+        scheme = self.scheme(scheme or settings.DEFAULT_NUMBERING_SCHEME).slug
+        try:
+            return self.generic_number_labels[(scheme, label)]
+        except KeyError:
+            raise ResidueGenericNumber.DoesNotExist('No generic number {} in scheme {}'.format(label, scheme))
+
+    def to_default(self, label, scheme):
+        """Default generic number label of the equivalent label in a scheme"""
+        scheme = self.scheme(scheme).slug
+        try:
+            return self.equivalents[(scheme, label)][1].label
+        except KeyError:
+            raise ResidueGenericNumberEquivalent.DoesNotExist('No equivalent {} in scheme {}'.format(label, scheme))
+
+    def to_scheme(self, label, scheme):
+        """Equivalent label in a scheme of a default generic number label (the first created of several)"""
+        scheme = self.scheme(scheme).slug
+        try:
+            return self.equivalent_labels[(label, scheme)]
+        except KeyError:
+            raise ResidueGenericNumberEquivalent.DoesNotExist('No equivalent of {} in scheme {}'.format(label, scheme))
+
+    def equivalent(self, label, scheme):
+        """ResidueGenericNumberEquivalent object (with its scheme and default generic number, without a query)"""
+        scheme = self.scheme(scheme)
+        try:
+            eq_id, default = self.equivalents[(scheme.slug, label)]
+        except KeyError:
+            raise ResidueGenericNumberEquivalent.DoesNotExist('No equivalent {} in scheme {}'.format(label, scheme.slug))
+
+        default_scheme = self.schemes[default.scheme]
+        equivalent = ResidueGenericNumberEquivalent(id=eq_id, label=label, scheme_id=scheme.id,
+                                                    default_generic_number_id=default.id)
+        equivalent.scheme = ResidueNumberingScheme(id=scheme.id, slug=scheme.slug, short_name=scheme.short_name,
+                                                   name=scheme.name, parent_id=scheme.parent_id)
+        equivalent.default_generic_number = ResidueGenericNumber(id=default.id, label=default.label,
+                                                                 scheme_id=default_scheme.id)
+        return equivalent
+
+    def numbering(self, protein_conformation_id):
+        """ProteinNumbering of a protein conformation"""
+        numbering = self.load(protein_conformation_ids=[protein_conformation_id]).get(protein_conformation_id)
+        if numbering is None:
+            raise Residue.DoesNotExist('No residues in protein conformation {}'.format(protein_conformation_id))
+        return numbering
+
+    def protein_numberings(self, protein_ids):
+        """ProteinNumbering of all conformations of the proteins (in one query for those not loaded yet)"""
+        return list(self.load(protein_ids=protein_ids).values())
+
+    def load(self, protein_conformation_ids=None, protein_ids=None):
+        """Numberings by protein conformation id, the ones not loaded yet are read in bulk"""
+        if protein_ids is not None:
+            # the conformations of the proteins are not known without a query
+            numberings = self.read(Residue.objects.filter(protein_conformation__protein_id__in=protein_ids))
+        else:
+            with self.lock:
+                numberings = OrderedDict((pconf_id, self.numberings[pconf_id]) for pconf_id in protein_conformation_ids
+                                         if pconf_id in self.numberings)
+            missing = [pconf_id for pconf_id in protein_conformation_ids if pconf_id not in numberings]
+            if missing:
+                numberings.update(self.read(Residue.objects.filter(protein_conformation_id__in=missing)))
+
+        # keep the most recently used numberings
+        with self.lock:
+            for pconf_id, numbering in numberings.items():
+                self.numberings[pconf_id] = numbering
+                self.numberings.move_to_end(pconf_id)
+            while len(self.numberings) > PROTEIN_NUMBERING_CACHE_SIZE:
+                self.numberings.popitem(last=False)
+        return numberings
+
+    def read(self, residues):
+        """ProteinNumbering of the protein conformations of a residue queryset"""
+        alternatives = {}
+        through = Residue.alternative_generic_numbers.through.objects.filter(residue__in=residues).order_by('id') \
+            .values_list('residue_id', 'residuegenericnumber_id')
+        for residue_id, gn_id in through:
+            if residue_id not in alternatives:
+                alternatives[residue_id] = []
+            alternatives[residue_id].append(self.generic_numbers[gn_id])
+
+        records = OrderedDict()
+        proteins = {}
+        for r in residues.order_by('protein_conformation_id', 'sequence_number').values_list('id',
+                'protein_conformation_id', 'protein_conformation__protein_id',
+                'protein_conformation__protein__residue_numbering_scheme__slug', 'sequence_number', 'amino_acid',
+                'protein_segment__slug', 'generic_number_id', 'display_generic_number_id'):
+            if r[1] not in records:
+                records[r[1]] = []
+                proteins[r[1]] = (r[2], r[3])
+            records[r[1]].append(NumberedResidue(r[0], r[4], r[5], r[6], self.generic_numbers.get(r[7]),
+                self.generic_numbers.get(r[8]), tuple(alternatives.get(r[0], ()))))
+
+        return OrderedDict((pconf_id, ProteinNumbering(pconf_id, proteins[pconf_id][0], proteins[pconf_id][1], rs))
+                           for pconf_id, rs in records.items())
+
+    def display_generic_number(self, label, protein_conformation_id):
+        """Display generic number label of the residue at an equivalent label (in the scheme of the protein)"""
+        numbering = self.numbering(protein_conformation_id)
+        residue = numbering.residue(generic_number=self.to_default(label, numbering.scheme))
+        return residue.display_generic_number.label if residue.display_generic_number else None
+
+
+_index = None
+_index_namespace = None
+_index_lock = threading.Lock()
+
+
+def generic_number_index():
+    """The GenericNumberIndex of the current protein and structure data of this process"""
+    global _index, _index_namespace
+    current = namespace(['proteins', 'structures'])
+    if _index is None or _index_namespace != current:
+        with _index_lock:
+            if _index is None or _index_namespace != current:
+                _index = GenericNumberIndex()
+                _index_namespace = current
+    return _index
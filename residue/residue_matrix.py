@@ -0,0 +1,211 @@
+"""
+Residues of all protein conformations at the generic numbers of a numbering scheme as memory mapped matrices.
+
+build_residue_matrix writes one matrix per scheme of Residue.generic_number for the current data release: protein
+conformations (rows) x generic numbers (columns) with the amino acid (ASCII code) and the sequence number of every
+residue, 0 where a conformation has no residue at a generic number. The rows carry the protein, entry name, family,
+species, sequence type and source of the conformation so whole classes or sets can be sliced without the ORM.
+
+Files in RESIDUE_MATRIX_DIR/<release>/: <scheme>.json with the rows and columns, and the arrays it names
+(<scheme>.<build>.amino_acids.npy, <scheme>.<build>.sequence_numbers.npy). The JSON is replaced last, so readers
+always see a complete build, and the arrays of the previous build are kept for readers that still have its JSON.
+The JSON records the namespace of the protein and structure datasets, a matrix written before these were rebuilt is
+not used.
+"""
+from django.conf import settings
+from django.db.models import Count
+
+from common.cache_keys import namespace
+from common.tools import get_data_release
+from protein.models import ProteinConformation
+from residue.models import Residue, ResidueGenericNumber
+
+import numpy as np
+
+import glob
+import json
+import os
+import threading
+import uuid
+
+# datasets the matrices are read from
+MATRIX_DATASETS = ['proteins', 'structures']
+
+
+def matrix_directory(release=None):
+    root = getattr(settings, 'RESIDUE_MATRIX_DIR', os.sep.join([settings.BUILD_CACHE_DIR, 'residue_matrix']))
+    return os.sep.join([root, release or get_data_release()])
+
+
+def write_residue_matrix(scheme, release=None):
+    """Builds the matrix of a numbering scheme, returns its shape"""
+    # read before the residues, a rebuild while writing leaves the matrix out of date
+    current = namespace(MATRIX_DATASETS)
+    columns = OrderedGenericNumbers(scheme)
+
+    entries = {}
+    pconf_ids, gn_columns, amino_acids, sequence_numbers = [], [], [], []
+    for pconf_id, gn_id, amino_acid, sequence_number in Residue.objects.filter(
+            generic_number__scheme__slug=scheme).values_list('protein_conformation_id', 'generic_number_id',
+            'amino_acid', 'sequence_number').iterator():
+        pconf_ids.append(pconf_id)
+        gn_columns.append(columns.index[gn_id])
+        amino_acids.append(ord(amino_acid[0]) if amino_acid else 0)
+        sequence_numbers.append(sequence_number)
+        entries[pconf_id] = entries.get(pconf_id, 0) + 1
+
+    # rows in family and entry name order, complete when all numbered residues are in this scheme
+    numbered = dict(Residue.objects.filter(generic_number__isnull=False, protein_conformation_id__in=list(entries))
+                    .values_list('protein_conformation_id').annotate(Count('id')))
+    rows = list(ProteinConformation.objects.filter(pk__in=list(entries)).order_by('protein__family__slug',
+        'protein__entry_name', 'pk').values_list('pk', 'protein_id', 'protein__entry_name', 'protein__family__slug',
+        'protein__species__common_name', 'protein__sequence_type__slug', 'protein__source__name'))
+    row_index = {row[0]: i for i, row in enumerate(rows)}
+
+    shape = (len(rows), len(columns.labels))
+    aa_matrix = np.zeros(shape, dtype=np.uint8)
+    sequence_number_matrix = np.zeros(shape, dtype=np.int32)
+    if pconf_ids:
+        row = np.array([row_index[pk] for pk in pconf_ids], dtype=np.intp)
+        col = np.array(gn_columns, dtype=np.intp)
+        aa_matrix[row, col] = amino_acids
+        sequence_number_matrix[row, col] = sequence_numbers
+
+    directory = matrix_directory(release)
+    os.makedirs(directory, exist_ok=True)
+    build = uuid.uuid4().hex[:12]
+    files = {'amino_acids': '{}.{}.amino_acids.npy'.format(scheme, build),
+             'sequence_numbers': '{}.{}.sequence_numbers.npy'.format(scheme, build)}
+    np.save(os.sep.join([directory, files['amino_acids']]), aa_matrix)
+    np.save(os.sep.join([directory, files['sequence_numbers']]), sequence_number_matrix)
+
+    metadata = {
+        'scheme': scheme,
+        'release': release or get_data_release(),
+        'namespace': current,
+        'files': files,
+        'generic_numbers': columns.labels,
+        'segments': columns.segments,
+        'protein_conformations': [r[0] for r in rows],
+        'proteins': [r[1] for r in rows],
+        'entry_names': [r[2] for r in rows],
+        'families': [r[3] for r in rows],
+        'species': [r[4] for r in rows],
+        'sequence_types': [r[5] for r in rows],
+        'sources': [r[6] for r in rows],
+        'complete': [numbered.get(r[0], 0) == entries[r[0]] for r in rows],
+        }
+    path = os.sep.join([directory, '{}.json'.format(scheme)])
+    try:
+        with open(path) as f:
+            previous = list(json.load(f)['files'].values())
+    except (OSError, ValueError, KeyError):
+        previous = []
+    with open(path + '.tmp', 'w') as f:
+        json.dump(metadata, f)
+    os.replace(path + '.tmp', path)
+
+    # arrays of the builds before the previous one (processes that still map them keep their copy)
+    for old in glob.glob(os.sep.join([directory, '{}.*.npy'.format(scheme)])):
+        if os.path.basename(old) not in list(files.values()) + previous:
+            os.unlink(old)
+    return shape
+
+
+class OrderedGenericNumbers():
+    """The generic numbers of a scheme in segment and label order"""
+    def __init__(self, scheme):
+        self.labels, self.segments, self.index = [], [], {}
+        for gn_id, label, segment in ResidueGenericNumber.objects.filter(scheme__slug=scheme).order_by(
+                'protein_segment_id', 'label', 'pk').values_list('pk', 'label', 'protein_segment__slug'):
+            self.index[gn_id] = len(self.labels)
+            self.labels.append(label)
+            self.segments.append(segment)
+
+
+class ResidueMatrix():
+    """The residue matrix of a numbering scheme (arrays are memory mapped and read on access)"""
+    def __init__(self, directory, metadata, modified=None):
+        self.modified = modified
+        self.scheme = metadata['scheme']
+        self.release = metadata['release']
+        self.namespace = metadata.get('namespace')
+        self.amino_acids = np.load(os.sep.join([directory, metadata['files']['amino_acids']]), mmap_mode='r')
+        self.sequence_numbers = np.load(os.sep.join([directory, metadata['files']['sequence_numbers']]),
+                                        mmap_mode='r')
+
+        self.generic_numbers = metadata['generic_numbers']
+        self.segments = metadata['segments']
+        self.gn_index = {gn: i for i, gn in enumerate(self.generic_numbers)}
+
+        self.protein_conformations = np.array(metadata['protein_conformations'], dtype=np.int64)
+        self.proteins = np.array(metadata['proteins'], dtype=np.int64)
+        self.entry_names = metadata['entry_names']
+        self.families = metadata['families']
+        self.species = metadata['species']
+        self.sequence_types = metadata['sequence_types']
+        self.sources = metadata['sources']
+        self.complete = np.array(metadata['complete'], dtype=bool)
+        self.row_index = {pk: i for i, pk in enumerate(metadata['protein_conformations'])}
+
+    def __len__(self):
+        return len(self.protein_conformations)
+
+    def rows(self, family=None, species=None, sequence_types=None, sources=None, proteins=None, entry_names=None):
+        """Row indices (in matrix order) of the conformations matching all given filters: family slug prefix,
+        species common names, sequence type slugs, source names, protein ids or entry names"""
+        mask = np.ones(len(self), dtype=bool)
+        if family is not None:
+            mask &= np.array([f.startswith(family) for f in self.families], dtype=bool)
+        for values, selected in ((self.species, species), (self.sequence_types, sequence_types),
+                                 (self.sources, sources), (self.entry_names, entry_names)):
+            if selected is not None:
+                selected = set(selected)
+                mask &= np.array([v in selected for v in values], dtype=bool)
+        if proteins is not None:
+            mask &= np.isin(self.proteins, list(proteins))
+        return np.flatnonzero(mask)
+
+    def row_indices(self, protein_conformations):
+        """Row index of each protein conformation id (-1 when not in the matrix)"""
+        return np.array([self.row_index.get(pk, -1) for pk in protein_conformations], dtype=np.intp)
+
+    def columns(self, generic_numbers=None, segments=None):
+        """Column index of each generic number label (-1 when not in the scheme), or of all in the segments"""
+        if generic_numbers is None:
+            return np.array([i for i, segment in enumerate(self.segments) if segments is None or segment in segments],
+                            dtype=np.intp)
+        return np.array([self.gn_index.get(gn, -1) for gn in generic_numbers], dtype=np.intp)
+
+    def slice(self, rows=None, columns=None):
+        """(amino acid codes, sequence numbers) of rows x columns (all when None), 0 for -1 indices"""
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.intp)
+        columns = np.arange(len(self.generic_numbers)) if columns is None else np.asarray(columns, dtype=np.intp)
+        index = (np.maximum(rows, 0)[:, None], np.maximum(columns, 0)[None, :])
+        missing = (rows < 0)[:, None] | (columns < 0)[None, :]
+        amino_acids = np.where(missing, 0, self.amino_acids[index])
+        sequence_numbers = np.where(missing, 0, self.sequence_numbers[index])
+        return amino_acids, sequence_numbers
+
+
+_matrices = {}
+_matrices_lock = threading.Lock()
+
+
+def residue_matrix(scheme=None, release=None):
+    """The ResidueMatrix of a scheme (default numbering scheme) and release (current), None when not built or
+    written before the proteins or structures were rebuilt"""
+    directory = matrix_directory(release)
+    path = os.sep.join([directory, '{}.json'.format(scheme or settings.DEFAULT_NUMBERING_SCHEME)])
+    try:
+        modified = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _matrices_lock:
+        if path not in _matrices or _matrices[path].modified != modified:
+            with open(path) as f:
+                _matrices[path] = ResidueMatrix(directory, json.load(f), modified)
+        matrix = _matrices[path]
+    if matrix.namespace != namespace(MATRIX_DATASETS):
+        return None
+    return matrix
@@ -23,7 +23,8 @@ from interaction.models import ResidueFragmentInteraction
 from mutation.models import MutationExperiment
 from mutational_landscape.models import NaturalMutations, CancerMutations, DiseaseMutations, PTMs, NHSPrescribings
 from protein.models import ProteinSegment, Protein, ProteinGProtein, ProteinGProteinPair
-from residue.models import Residue,ResidueNumberingScheme, ResiduePositionSet, ResidueSet
+from residue.models import ResidueNumberingScheme, ResiduePositionSet, ResidueSet
+from residue.numbering_index import generic_number_index
 
 from collections import OrderedDict
 
@@ -63,6 +64,40 @@ class ResidueTablesSelection(AbsTargetSelection):
         }
 
 
+def residue_table_data(proteins, segments, default_scheme):
+    """
+    Generic numbers of the positions in each segment (by scheme slug) and the residue of every protein at them ('seq'),
+    from the generic number index instead of a residue query per segment.
+    """
+    protein_index = {}
+    for i, protein in enumerate(proteins):
+        protein_index.setdefault(protein.id, i)
+    segment_residues = {}
+    for numbering in generic_number_index().protein_numberings(list(protein_index)):
+        for residue in numbering.residues:
+            if residue.generic_number:
+                segment_residues.setdefault(residue.segment, []).append((numbering.protein_id, residue))
+
+    data = OrderedDict()
+    for segment in segments:
+        data[segment.slug] = OrderedDict()
+        residues = segment_residues.get(segment.slug, [])
+        for pos in set([residue.generic_number.label for protein_id, residue in residues]):
+            data[segment.slug][pos] = {default_scheme.slug : pos, 'seq' : ['-']*len(proteins)}
+
+        for protein_id, residue in residues:
+            pos = data[segment.slug][residue.generic_number.label]
+            for alternative in residue.alternative_generic_numbers:
+                # the default scheme is already the key of the position
+                if default_scheme.slug != settings.DEFAULT_NUMBERING_SCHEME or alternative.scheme != residue.generic_number.scheme:
+                    if alternative.scheme not in pos:
+                        pos[alternative.scheme] = alternative.label
+                    if alternative.label not in pos[alternative.scheme]:
+                        pos[alternative.scheme] += " "+alternative.label
+                pos['seq'][protein_index[protein_id]] = residue.amino_acid + str(residue.sequence_number)
+    return data
+
+
 class ResidueTablesDisplay(TemplateView):
     """
     A class rendering the residue numbering table.
@@ -146,40 +181,7 @@ class ResidueTablesDisplay(TemplateView):
         # each segment has a dictionary of positions
         # default_generic_number or first scheme on the list is the key
         # value is a dictionary of other gn positions and residues from selected proteins
-        data = OrderedDict()
-        for segment in segments:
-            data[segment.slug] = OrderedDict()
-            residues = Residue.objects.filter(protein_segment=segment, protein_conformation__protein__in=proteins, generic_number__isnull=False).prefetch_related('protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
-            for scheme in numbering_schemes:
-                if scheme == default_scheme and scheme.slug == settings.DEFAULT_NUMBERING_SCHEME:
-                    for pos in list(set([x.generic_number.label for x in residues if x.protein_segment == segment])):
-                        data[segment.slug][pos] = {scheme.slug : pos, 'seq' : ['-']*len(proteins)}
-                elif scheme == default_scheme:
-                    for pos in list(set([x.generic_number.label for x in residues if x.protein_segment == segment])):
-                            data[segment.slug][pos] = {scheme.slug : pos, 'seq' : ['-']*len(proteins)}
-
-            for residue in residues:
-                alternatives = residue.alternative_generic_numbers.all()
-                pos = residue.generic_number
-                for alternative in alternatives:
-                    scheme = alternative.scheme
-                    if default_scheme.slug == settings.DEFAULT_NUMBERING_SCHEME:
-                        pos = residue.generic_number
-                        if scheme == pos.scheme:
-                            data[segment.slug][pos.label]['seq'][proteins.index(residue.protein_conformation.protein)] = str(residue)
-                        else:
-                            if scheme.slug not in data[segment.slug][pos.label].keys():
-                                data[segment.slug][pos.label][scheme.slug] = alternative.label
-                            if alternative.label not in data[segment.slug][pos.label][scheme.slug]:
-                                data[segment.slug][pos.label][scheme.slug] += " "+alternative.label
-                            data[segment.slug][pos.label]['seq'][proteins.index(residue.protein_conformation.protein)] = str(residue)
-                    else:
-                        if scheme.slug not in data[segment.slug][pos.label].keys():
-                            data[segment.slug][pos.label][scheme.slug] = alternative.label
-                        if alternative.label not in data[segment.slug][pos.label][scheme.slug]:
-                            data[segment.slug][pos.label][scheme.slug] += " "+alternative.label
-                        data[segment.slug][pos.label]['seq'][proteins.index(residue.protein_conformation.protein)] = str(residue)
+        data = residue_table_data(proteins, segments, default_scheme)
 
         # Preparing the dictionary of list of lists. Dealing with tripple nested dictionary in django templates is a nightmare
         flattened_data = OrderedDict.fromkeys([x.slug for x in segments], [])
@@ -684,40 +686,7 @@ def render_residue_table_excel(request):
     # each helix has a dictionary of positions
     # default_generic_number or first scheme on the list is the key
     # value is a dictionary of other gn positions and residues from selected proteins
-    data = OrderedDict()
-    for segment in segments:
-        data[segment.slug] = OrderedDict()
-        residues = Residue.objects.filter(protein_segment=segment, protein_conformation__protein__in=proteins, generic_number__isnull=False).prefetch_related('protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-            'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
-        for scheme in numbering_schemes:
-            if scheme == default_scheme and scheme.slug == settings.DEFAULT_NUMBERING_SCHEME:
-                for pos in list(set([x.generic_number.label for x in residues if x.protein_segment == segment])):
-                    data[segment.slug][pos] = {scheme.slug : pos, 'seq' : ['-']*len(proteins)}
-            elif scheme == default_scheme:
-                for pos in list(set([x.generic_number.label for x in residues if x.protein_segment == segment])):
-                        data[segment.slug][pos] = {scheme.slug : pos, 'seq' : ['-']*len(proteins)}
-
-        for residue in residues:
-            alternatives = residue.alternative_generic_numbers.all()
-            pos = residue.generic_number
-            for alternative in alternatives:
-                scheme = alternative.scheme
-                if default_scheme.slug == settings.DEFAULT_NUMBERING_SCHEME:
-                    pos = residue.generic_number
-                    if scheme == pos.scheme:
-                        data[segment.slug][pos.label]['seq'][proteins.index(residue.protein_conformation.protein)] = str(residue)
-                    else:
-                        if scheme.slug not in data[segment.slug][pos.label].keys():
-                            data[segment.slug][pos.label][scheme.slug] = alternative.label
-                        if alternative.label not in data[segment.slug][pos.label][scheme.slug]:
-                            data[segment.slug][pos.label][scheme.slug] += " "+alternative.label
-                        data[segment.slug][pos.label]['seq'][proteins.index(residue.protein_conformation.protein)] = str(residue)
-                else:
-                    if scheme.slug not in data[segment.slug][pos.label].keys():
-                        data[segment.slug][pos.label][scheme.slug] = alternative.label
-                    if alternative.label not in data[segment.slug][pos.label][scheme.slug]:
-                        data[segment.slug][pos.label][scheme.slug] += " "+alternative.label
-                    data[segment.slug][pos.label]['seq'][proteins.index(residue.protein_conformation.protein)] = str(residue)
+    data = residue_table_data(proteins, segments, default_scheme)
 
     # Preparing the dictionary of list of lists. Dealing with tripple nested dictionary in django templates is a nightmare
     flattened_data = OrderedDict.fromkeys([x.slug for x in segments], [])
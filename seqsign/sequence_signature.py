@@ -13,7 +13,10 @@ Alignment = getattr(__import__(
 from common.definitions import AA_ZSCALES, AMINO_ACIDS, AMINO_ACID_GROUPS, AMINO_ACID_GROUP_NAMES, AMINO_ACID_GROUP_PROPERTIES, ZSCALES
 from protein.models import Protein, ProteinConformation
 from residue.models import Residue
+from residue.residue_matrix import residue_matrix
 from signprot.models import SignprotComplex
+from common.cache_keys import SEQSIGN_RECEPTOR_MATRIX
+
 
 
 from collections import OrderedDict
@@ -24,6 +27,9 @@ import re
 from scipy.stats import t
 import time
 
+# receptors of a class shown with their signature match rows on the match pages (scores are reported for all)
+SIGNATURE_MATCH_ROWS = getattr(settings, 'SIGNATURE_MATCH_ROWS', 100)
+
 class SequenceSignature:
     """
     A class handling the sequence signature.
@@ -1102,6 +1108,78 @@ class SequenceSignature:
 
 
 
+class ReceptorFeatureMatrix():
+    """
+    Amino acids of a set of receptors (rows) at all their generic residue positions (columns), 0 when a receptor has
+    no residue at a position. Signatures are scored against all receptors at once: the receptor x position x feature
+    membership is looked up for the positions of a signature and reduced with a matrix product.
+    """
+
+    def __init__(self, pconf_ids, generic_numbers, amino_acids):
+        self.pconf_ids = pconf_ids
+        self.row_index = dict([(pk, i) for i, pk in enumerate(pconf_ids)])
+        self.generic_numbers = generic_numbers
+        self.gn_index = dict([(gn, i) for i, gn in enumerate(generic_numbers)])
+        # extra empty row and column for unknown receptors and positions
+        self.amino_acids = np.zeros((len(pconf_ids) + 1, len(generic_numbers) + 1), dtype=np.uint8)
+        self.amino_acids[:-1, :-1] = amino_acids
+
+    @classmethod
+    def from_conformations(cls, pconfs):
+        """Build the matrix for a queryset (or list) of protein conformations"""
+        pconf_ids = [pconf.pk for pconf in pconfs]
+
+        # from the residue matrix of the release when it has all numbered residues of the conformations
+        matrix = residue_matrix()
+        if matrix is not None and pconf_ids:
+            rows = matrix.row_indices(pconf_ids)
+            if (rows >= 0).all() and matrix.complete[rows].all():
+                amino_acids, _ = matrix.slice(rows)
+                present = amino_acids.any(axis=0)
+                return cls(pconf_ids, [gn for gn, p in zip(matrix.generic_numbers, present) if p],
+                           amino_acids[:, present])
+
+        residues = Residue.objects.filter(
+            protein_conformation__in=pconf_ids,
+            generic_number__isnull=False
+            ).values_list('protein_conformation_id', 'generic_number__label', 'amino_acid')
+
+        rows = dict([(pk, i) for i, pk in enumerate(pconf_ids)])
+        generic_numbers = OrderedDict()
+        entries = []
+        for pconf_id, label, amino_acid in residues:
+            entries.append((rows[pconf_id], generic_numbers.setdefault(label, len(generic_numbers)), ord(amino_acid[0])))
+
+        amino_acids = np.zeros((len(pconf_ids), len(generic_numbers)), dtype=np.uint8)
+        if entries:
+            row, col, code = np.array(entries).T
+            amino_acids[row, col] = code
+        return cls(pconf_ids, list(generic_numbers.keys()), amino_acids)
+
+    @classmethod
+    def for_class(cls, pclass_slug):
+        """Matrix of all human wild type receptors of a class, cached until the proteins or the residue matrix are rebuilt"""
+        matrix = SEQSIGN_RECEPTOR_MATRIX.get(pclass_slug)
+        if matrix is None:
+            pconfs = ProteinConformation.objects.order_by(
+                'protein__family__slug',
+                'protein__entry_name'
+                ).filter(
+                    protein__species__common_name='Human',
+                    protein__family__slug__startswith=pclass_slug,
+                    protein__sequence_type__slug='wt'
+                    ).exclude(protein__entry_name__endswith='-consensus')
+            matrix = cls.from_conformations(pconfs.only('pk'))
+            SEQSIGN_RECEPTOR_MATRIX.set(matrix, pclass_slug)
+        return matrix
+
+    def select(self, pconf_ids, generic_numbers):
+        """Amino acid codes (receptors x positions) for the given conformations and generic numbers"""
+        rows = np.array([self.row_index.get(pk, -1) for pk in pconf_ids], dtype=np.intp)
+        cols = np.array([self.gn_index.get(gn, -1) for gn in generic_numbers], dtype=np.intp)
+        return self.amino_acids[rows[:, None], cols[None, :]]
+
+
 class SignatureMatch():
 
     def __init__(self, common_positions, numbering_schemes, segments, difference_matrix,
@@ -1128,6 +1206,7 @@ class SignatureMatch():
         self.scored_proteins = []
         self.protein_report = OrderedDict()
         self.protein_signatures = OrderedDict()
+        self.top_report = OrderedDict()
         self.feature_preference = prepare_aa_group_preference()
 
         self.group_lengths = dict([
@@ -1146,7 +1225,13 @@ class SignatureMatch():
                 except KeyError:
                     self.residue_to_feat['-'].add(fidx)
 
+        # feature membership per amino acid code (code 0 is used for missing residues)
+        self.feature_table = np.zeros((256, len(AMINO_ACID_GROUPS)), dtype=bool)
+        for res, feats in self.residue_to_feat.items():
+            self.feature_table[ord(res), list(feats)] = True
+
         self._find_norm()
+        self._find_signature_positions()
         if protein_set_pos:
             self.scores_pos, self.signatures_pos, self.scored_proteins_pos = self.score_protein_set(self.protein_set_pos, signprot)
         if protein_set_neg:
@@ -1236,11 +1321,88 @@ class SignatureMatch():
         self.signature_consensus = signature
 
 
-    def score_protein_class(self, pclass_slug='001', signprot=False):
+    def _find_signature_positions(self):
+        """
+        Preferred feature and value of each signature position (in display order), with the per position weights
+        used to score all receptors with one matrix product (see score_conformations).
+        """
+        group_abbr = list(AMINO_ACID_GROUPS.keys())
+        group_names = list(AMINO_ACID_GROUP_NAMES.values())
+
+        self.signature_gns = []
+        self.signature_segments = []
+        self.signature_labels = []
+        features = []
+        values = []
+        for segment in self.relevant_segments:
+            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
+            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
+            gns = list(self.relevant_gn[self.schemes[0][0]][segment].keys())
+            for idx, pos in enumerate(gns):
+                feat = signature_map[idx]
+                val = self.signature_matrix_filtered[segment][feat][idx]
+                self.signature_gns.append(pos)
+                self.signature_labels.append((group_abbr[feat], group_names[feat], val))
+                features.append(feat)
+                values.append(val)
+            self.signature_segments.append((segment, len(gns)))
+
+        self.signature_features = np.array(features, dtype=np.intp)
+        values = np.array(values, dtype=np.float64)
+        gaps = np.array([label[1] == 'Gap' for label in self.signature_labels], dtype=bool)
+        gap_values = np.where(gaps, values, 0)
+
+        # per position: a residue with the feature adds val if positive, a residue without it subtracts val if
+        # negative and a missing residue adds val at gap positions, i.e.
+        # member * val + present * (max(-val, 0) - gap_val) + gap_val
+        self.member_weights = values
+        self.present_weights = np.maximum(-values, 0) - gap_values
+        self.gap_score = gap_values.sum()
+
+    def score_conformations(self, matrix, pcfs, top=None):
+        """
+        Score a list of protein conformations against the signature. Returns the score report (highest first),
+        the signature match rows for display (only for the first top proteins when given) and the ordered proteins.
+        """
+        amino_acids = matrix.select([pcf.pk for pcf in pcfs], self.signature_gns)
+        member = self.feature_table[amino_acids, self.signature_features[None, :]]
+        present = amino_acids > 0
+        scores = member.dot(self.member_weights) + present.dot(self.present_weights) + self.gap_score
+
+        protein_scores = dict([(pcf, (float(score)/100, float(score)/self.norm*100)) for pcf, score in zip(pcfs, scores)])
+        protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
+        scored_proteins = list(protein_report.keys())
+
+        rows = dict([(pcf, i) for i, pcf in enumerate(pcfs)])
+        protein_signatures = OrderedDict()
+        for pcf in scored_proteins[:top]:
+            i = rows[pcf]
+            protein_signatures[pcf] = self.signature_match_rows(amino_acids[i], member[i])
+
+        return (protein_report, protein_signatures, scored_proteins)
+
+    def signature_match_rows(self, amino_acids, member):
+        """Display rows (per segment) of one receptor, from its amino acid codes and feature membership"""
+        consensus_match = OrderedDict()
+        k = 0
+        for segment, length in self.signature_segments:
+            tmp = []
+            for pos in self.signature_gns[k:k+length]:
+                feat_abr, feat_name, val = self.signature_labels[k]
+                if amino_acids[k]:
+                    color = "#808080" if bool(member[k]) == (val > 0) else "white"
+                    aa = chr(amino_acids[k])
+                else:
+                    color = "#808080" if feat_name == 'Gap' and val > 0 else "white"
+                    aa = '-'
+                tmp.append([feat_abr, feat_name, val, color, aa, pos])
+                k += 1
+            consensus_match[segment] = tmp
+        return consensus_match
+
+    def score_protein_class(self, pclass_slug='001', signprot=False, top=None):
 
         start = time.time()
-        protein_scores = {}
-        protein_signature_match = {}
         class_proteins = Protein.objects.filter(
             species__common_name='Human',
             family__slug__startswith=pclass_slug
@@ -1260,205 +1422,35 @@ class SignatureMatch():
                 protein__sequence_type__slug='wt'
                 ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein','protein__family__parent','protein__species')
 
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
-
-        resi = Residue.objects.filter(
-            protein_conformation__in=class_a_pcf,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number','protein_conformation')
-        resi_dict_all = {}
-        for r in resi:
-            if r.generic_number:
-                pcf = r.protein_conformation.pk
-                if pcf not in resi_dict_all:
-                    resi_dict_all[pcf] = {}
-                resi_dict_all[pcf][r.generic_number.label] = r
-
-        for pcf in class_a_pcf:
-            # p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf, resi_dict_all)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            # p_end = time.time()
-            # print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
+        self.protein_report, self.protein_signatures, self.scored_proteins = self.score_conformations(
+            ReceptorFeatureMatrix.for_class(pclass_slug), list(class_a_pcf), top)
+        # scores of the receptors with display rows
+        self.top_report = OrderedDict([(pcf, self.protein_report[pcf]) for pcf in self.protein_signatures])
         end = time.time()
-        self.protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
-        for prot in self.protein_report.items():
-            self.protein_signatures[prot[0]] = protein_signature_match[prot[0]]
-        self.scored_proteins = list(self.protein_report.keys())
         print("Total time: ", end - start)
 
 
     def score_protein_set(self, protein_set, signprot=False):
 
         start = time.time()
-        protein_scores = {}
-        protein_signature_match = {}
 
         seq_type_slug=['wt']
         if signprot:
             seq_type_slug.append('mod')
 
-        pcfs = ProteinConformation.objects.order_by(
+        pcfs = list(ProteinConformation.objects.order_by(
             'protein__family__slug',
             'protein__entry_name'
             ).filter(
                 protein__in=protein_set,
                 protein__sequence_type__slug__in=seq_type_slug
-                ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein')
-
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
-
-        resi = Residue.objects.filter(
-            protein_conformation__in=pcfs,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number','protein_conformation')
-        resi_dict_all = {}
-        for r in resi:
-            if r.generic_number:
-                pcf = r.protein_conformation.pk
-                if pcf not in resi_dict_all:
-                    resi_dict_all[pcf] = {}
-                resi_dict_all[pcf][r.generic_number.label] = r
-
-        for pcf in pcfs:
-            # p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf,resi_dict_all)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            # p_end = time.time()
-            # print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
+                ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein'))
+
+        report = self.score_conformations(ReceptorFeatureMatrix.from_conformations(pcfs), pcfs)
         end = time.time()
-        protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
-        protein_signatures = OrderedDict()
-        for prot in protein_report.items():
-            protein_signatures[prot[0]] = protein_signature_match[prot[0]]
-        scored_proteins = list(protein_report.keys())
         print("Total time: ", end - start)
 
-        return (protein_report, protein_signatures, scored_proteins)
-
-    def score_protein(self, pcf,resi_dict_all):
-        prot_score = 0.0
-        #norm = 0.0
-        consensus_match = OrderedDict([(x, []) for x in self.relevant_segments])
-
-        if resi_dict_all == None:
-            relevant_gns_total = []
-            for segment in  self.relevant_segments:
-                for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                    relevant_gns_total.append(pos)
-            resi = Residue.objects.filter(
-                protein_conformation=pcf,
-                generic_number__label__in=relevant_gns_total
-                ).prefetch_related('generic_number')
-            resi_dict = {}
-            for r in resi:
-                if r.generic_number:
-                    resi_dict[r.generic_number.label] = r
-        else:
-            resi_dict = resi_dict_all[pcf.pk]
-        for segment in self.relevant_segments:
-            tmp = []
-            # signature_map = self.signature_matrix_filtered[segment].argmax(axis=0)
-            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
-            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
-
-            #norm += np.sum(np.amax(self.signature_matrix_filtered[segment], axis=0))
-
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                feat = signature_map[idx]
-                feat_abr = list(AMINO_ACID_GROUPS.keys())[feat]
-                feat_name = list(AMINO_ACID_GROUP_NAMES.values())[feat]
-                val = self.signature_matrix_filtered[segment][feat][idx]
-                if pos in resi_dict:
-                    res = resi_dict[pos]
-                    if feat in self.residue_to_feat[res.amino_acid]:
-                        if val > 0:
-                            prot_score += val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            #"green",
-                            "#808080",
-                            res.amino_acid, pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                res.amino_acid,
-                                pos
-                                ])
-                    else:
-                        #David doesn't want the negative values in the score
-                        # prot_score -= val
-                        if val < 0:
-                            prot_score -= val #if a receptor does NOT have the negative property, add the score
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            res.amino_acid,
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                # "green",
-                                "#808080",
-                                res.amino_acid,
-                                pos
-                                ])
-                else:
-                    if feat_name == 'Gap':
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "green",
-                            "#808080",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-                        prot_score += val
-                    else:
-                        #David doesn't want the negative values in the score
-                        #prot_score -= val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-            consensus_match[segment] = tmp
-        return (prot_score/100, prot_score/self.norm*100, consensus_match)
+        return report
 
 def signature_score_excel(workbook, scores, protein_signatures, signature_filtered, relevant_gn, relevant_segments, numbering_schemes, scores_positive=None, scores_negative=None, signatures_positive=None, signatures_negative=None):
 
@@ -8,7 +8,7 @@ from common.selection import Selection
 #from common.views import AbsTargetSelection
 from common.views import AbsTargetSelectionTable
 from common.views import AbsSegmentSelection
-from seqsign.sequence_signature import SequenceSignature, SignatureMatch, signature_score_excel
+from seqsign.sequence_signature import SequenceSignature, SignatureMatch, signature_score_excel, SIGNATURE_MATCH_ROWS
 
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
@@ -275,8 +275,8 @@ def render_signature_excel(request):
 
     return response
 
-def render_signature_match_scores(request, cutoff):
-
+def score_signature_match(request, cutoff, top=None):
+    """SignatureMatch of the signature in the session, scored against the class of the first target set"""
     signature_data = request.session.get('signature')
 
     # targets set #1
@@ -293,20 +293,14 @@ def render_signature_match_scores(request, cutoff):
         get_proteins_from_selection(ss_neg),
         cutoff = int(cutoff)
     )
-    signature_match.score_protein_class(get_proteins_from_selection(ss_pos)[0].family.slug[:3])
-    request.session['signature_match'] = {
-        'scores': signature_match.protein_report,
-
-        'scores_pos': signature_match.scores_pos,
-        'scores_neg': signature_match.scores_neg,
-        'protein_signatures': signature_match.protein_signatures,
-        'signatures_pos': signature_match.signatures_pos,
-        'signatures_neg': signature_match.signatures_neg,
-        'signature_filtered': signature_match.signature_consensus,
-        'relevant_gn': signature_match.relevant_gn,
-        'relevant_segments': signature_match.relevant_segments,
-        'numbering_schemes': signature_match.schemes,
-    }
+    signature_match.score_protein_class(get_proteins_from_selection(ss_pos)[0].family.slug[:3], top=top)
+    return signature_match
+
+def render_signature_match_scores(request, cutoff):
+
+    # display rows for the top receptors, the excel file scores again with rows for all
+    signature_match = score_signature_match(request, cutoff, SIGNATURE_MATCH_ROWS)
+    request.session['signature_match'] = {'cutoff': int(cutoff)}
 
     response = render(
         request,
@@ -317,23 +311,23 @@ def render_signature_match_scores(request, cutoff):
 
 def render_signature_match_excel(request):
 
-    scores_data = request.session.get('signature_match', False)
+    signature_match = score_signature_match(request, request.session.get('signature_match')['cutoff'])
 
     outstream = BytesIO()
     wb = xlsxwriter.Workbook(outstream, {'in_memory': True})
 
     signature_score_excel(
         wb,
-        scores_data['scores'],
-        scores_data['protein_signatures'],
-        scores_data['signature_filtered'],
-        scores_data['relevant_gn'],
-        scores_data['relevant_segments'],
-        scores_data['numbering_schemes'],
-        scores_data['scores_pos'],
-        scores_data['scores_neg'],
-        scores_data['signatures_pos'],
-        scores_data['signatures_neg'],
+        signature_match.protein_report,
+        signature_match.protein_signatures,
+        signature_match.signature_consensus,
+        signature_match.relevant_gn,
+        signature_match.relevant_segments,
+        signature_match.schemes,
+        signature_match.scores_pos,
+        signature_match.scores_neg,
+        signature_match.signatures_pos,
+        signature_match.signatures_neg,
 
     )
     wb.close()
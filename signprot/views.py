@@ -16,7 +16,7 @@ from mutation.models import MutationExperiment
 from protein.models import (Gene, Protein, ProteinAlias, ProteinConformation, ProteinFamily, ProteinGProtein,
                             ProteinGProteinPair, ProteinSegment)
 from residue.models import (Residue, ResidueGenericNumberEquivalent, ResiduePositionSet)
-from seqsign.sequence_signature import (SequenceSignature, SignatureMatch)
+from seqsign.sequence_signature import (SequenceSignature, SignatureMatch, SIGNATURE_MATCH_ROWS)
 from signprot.interactions import (get_entry_names, get_generic_numbers, get_ignore_info, get_protein_segments,
                                    get_signature_features, group_signature_features, prepare_signature_match)
 from signprot.models import (SignprotBarcode, SignprotComplex, SignprotStructure)
@@ -1388,7 +1388,8 @@ def IMSignatureMatch(request):
     )
 
     maj_pfam = Counter(pfam).most_common()[0][0]
-    signature_match.score_protein_class(maj_pfam, signprot=True)
+    # only the scores are returned, no display rows
+    signature_match.score_protein_class(maj_pfam, signprot=True, top=0)
     # request.session['signature_match'] = signature_match
 
     signature_match = {
@@ -1429,7 +1430,7 @@ def render_IMSigMat(request):
     )
 
     maj_pfam = Counter(pfam).most_common()[0][0]
-    signature_match.score_protein_class(maj_pfam, signprot=True)
+    signature_match.score_protein_class(maj_pfam, signprot=True, top=SIGNATURE_MATCH_ROWS)
 
     response = render(
         request,
@@ -1,5 +1,4 @@
 ﻿from Bio.Blast import NCBIXML, NCBIWWW
-from Bio.PDB import PDBParser
 from Bio.PDB.PDBIO import Select
 import Bio.PDB.Polypeptide as polypeptide
 from Bio.PDB.AbstractPropertyMap import AbstractPropertyMap
@@ -14,8 +13,10 @@ from common.selection import SimpleSelection
 from common.alignment import Alignment
 from protein.models import Protein, ProteinSegment, ProteinConformation, ProteinState
 from residue.functions import dgn, ggn
-from residue.models import Residue, ResidueGenericNumberEquivalent
+from residue.models import Residue
+from residue.numbering_index import generic_number_index
 from structure.models import Structure, Rotamer
+from structure.sequence_index import search_sequence
 
 from subprocess import Popen, PIPE
 from io import StringIO
@@ -47,7 +48,7 @@ class BlastSearch(object):
 
 
     def __init__ (self, blast_path='blastp',
-        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']), top_results=1):
+        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']), top_results=1, backend=None):
 
         self.blast_path = blast_path
         self.blastdb = blastdb
@@ -55,11 +56,20 @@ class BlastSearch(object):
         #residues it is better to use more results to avoid getting sequence of
         #e.g.  different species
         self.top_results = top_results
+        #'index' searches the k-mer index of the database in process (see structure.sequence_index), 'blast' runs
+        #blastp, the index falls back to blastp when it has not been built
+        self.backend = backend or getattr(settings, 'SEQUENCE_SEARCH_BACKEND', 'index')
 
     #takes Bio.Seq sequence as an input and returns a list of tuples with the
     #alignments
     def run (self, input_seq):
 
+        if self.backend == 'index':
+            output = search_sequence(self.blastdb, input_seq, self.top_results)
+            if output is not None:
+                return output
+            logger.warning('No sequence index for {}, running blastp'.format(self.blastdb))
+
         output = []
         #Windows has problems with Popen and PIPE
         if sys.platform == 'win32':
@@ -382,7 +392,7 @@ class BackboneSelector():
         self.alt_atoms = []
 
         self.ref_atoms = self.select_ref_atoms(fragment, ref_pdbio_struct, use_similar)
-        self.alt_atoms = self.select_alt_atoms(PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(str(fragment.rotamer.pdbdata)))[0])
+        self.alt_atoms = self.select_alt_atoms(fragment.rotamer.pdbdata.get_parsed().to_biopython('ref')[0])
 
 
     def select_ref_atoms(self, fragment, ref_pdbio_struct, use_similar=False):
@@ -965,10 +975,10 @@ class PdbStateIdentifier():
                     self.state = ProteinState.objects.get(slug='active')
         # class B
         elif self.parent_prot_conf.protein.family.slug.startswith('002') or self.parent_prot_conf.protein.family.slug.startswith('003'):
-            tm2_gn_b = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm2_gn, scheme__short_name='GPCRdb(B)').label
-            tm6_gn_b = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm6_gn, scheme__short_name='GPCRdb(B)').label
-            tm3_gn_b = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm3_gn, scheme__short_name='GPCRdb(B)').label
-            tm7_gn_b = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm7_gn, scheme__short_name='GPCRdb(B)').label
+            tm2_gn_b = generic_number_index().to_scheme(self.tm2_gn, 'GPCRdb(B)')
+            tm6_gn_b = generic_number_index().to_scheme(self.tm6_gn, 'GPCRdb(B)')
+            tm3_gn_b = generic_number_index().to_scheme(self.tm3_gn, 'GPCRdb(B)')
+            tm7_gn_b = generic_number_index().to_scheme(self.tm7_gn, 'GPCRdb(B)')
 
             tm6 = self.get_residue_distance(tm2_gn_b, tm6_gn_b)
             tm7 = self.get_residue_distance(tm3_gn_b, tm7_gn_b)
@@ -982,10 +992,10 @@ class PdbStateIdentifier():
                     self.state = ProteinState.objects.get(slug='active')
         # class C
         elif self.parent_prot_conf.protein.family.slug.startswith('004'):
-            tm2_gn_c = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm2_gn, scheme__short_name='GPCRdb(C)').label
-            tm6_gn_c = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm6_gn, scheme__short_name='GPCRdb(C)').label
-            tm3_gn_c = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm3_gn, scheme__short_name='GPCRdb(C)').label
-            tm7_gn_c = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm7_gn, scheme__short_name='GPCRdb(C)').label
+            tm2_gn_c = generic_number_index().to_scheme(self.tm2_gn, 'GPCRdb(C)')
+            tm6_gn_c = generic_number_index().to_scheme(self.tm6_gn, 'GPCRdb(C)')
+            tm3_gn_c = generic_number_index().to_scheme(self.tm3_gn, 'GPCRdb(C)')
+            tm7_gn_c = generic_number_index().to_scheme(self.tm7_gn, 'GPCRdb(C)')
 
             tm6 = self.get_residue_distance(tm2_gn_c, tm6_gn_c)
             tm7 = self.get_residue_distance(tm3_gn_c, tm7_gn_c)
@@ -1001,10 +1011,10 @@ class PdbStateIdentifier():
         #########
         # class F
         elif self.parent_prot_conf.protein.family.slug.startswith('006'):
-            tm2_gn_f = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm2_gn, scheme__short_name='GPCRdb(F)').label
-            tm6_gn_f = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm6_gn, scheme__short_name='GPCRdb(F)').label
-            tm3_gn_f = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm3_gn, scheme__short_name='GPCRdb(F)').label
-            tm7_gn_f = ResidueGenericNumberEquivalent.objects.get(default_generic_number__label=self.tm7_gn, scheme__short_name='GPCRdb(F)').label
+            tm2_gn_f = generic_number_index().to_scheme(self.tm2_gn, 'GPCRdb(F)')
+            tm6_gn_f = generic_number_index().to_scheme(self.tm6_gn, 'GPCRdb(F)')
+            tm3_gn_f = generic_number_index().to_scheme(self.tm3_gn, 'GPCRdb(F)')
+            tm7_gn_f = generic_number_index().to_scheme(self.tm7_gn, 'GPCRdb(F)')
 
             tm6 = self.get_residue_distance(tm2_gn_f, tm6_gn_f)
             tm7 = self.get_residue_distance(tm3_gn_f, tm7_gn_f)
@@ -1041,10 +1051,8 @@ class PdbStateIdentifier():
                 rota2 = Rotamer.objects.filter(structure=self.structure, residue__display_generic_number__label=dgn(residue2, self.structure.protein_conformation))
             rota2 = right_rotamer_select(rota2, self.structure.preferred_chain[0])
             rotas = [rota1, rota2]
-            io1 = StringIO(rotas[0].pdbdata.pdb)
-            rota_struct1 = PDB.PDBParser(QUIET=True).get_structure('structure', io1)[0]
-            io2 = StringIO(rotas[1].pdbdata.pdb)
-            rota_struct2 = PDB.PDBParser(QUIET=True).get_structure('structure', io2)[0]
+            rota_struct1 = rotas[0].pdbdata.get_parsed().to_biopython('structure')[0]
+            rota_struct2 = rotas[1].pdbdata.get_parsed().to_biopython('structure')[0]
 
             for chain1, chain2 in zip(rota_struct1, rota_struct2):
                 for r1, r2 in zip(chain1, chain2):
@@ -1056,12 +1064,9 @@ class PdbStateIdentifier():
             try:
                 res1 = Residue.objects.get(protein_conformation=self.parent_prot_conf, display_generic_number__label=dgn(residue1, self.parent_prot_conf))
                 res2 = Residue.objects.get(protein_conformation=self.parent_prot_conf, display_generic_number__label=dgn(residue2, self.parent_prot_conf))
-                if self.structure_type=='refined':
-                    pdb_data = self.structure.pdb_data.pdb
-                elif self.structure_type=='hommod':
-                    pdb_data = self.structure.pdb_data.pdb
-                io = StringIO(pdb_data)
-                struct = PDB.PDBParser(QUIET=True).get_structure('structure', io)[0]
+                if self.structure_type not in ['refined', 'hommod']:
+                    raise Exception
+                struct = self.structure.pdb_data.get_parsed().to_biopython('structure')[0]
                 for chain in struct:
                     r1 = chain[res1.sequence_number]
                     r2 = chain[res2.sequence_number]
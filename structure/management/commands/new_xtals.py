@@ -213,7 +213,7 @@ class QueryPDB():
                             if line.startswith('JRNL        DOI'):
                                 doi = line[19:].strip()
                             pdb_file+=line
-                        pdb_data, created = PdbData.objects.get_or_create(pdb=pdb_file)
+                        pdb_data, created = PdbData.get_or_create_pdb(pdb_file)
                         d = datetime.strptime(publication_date,'%d-%b-%y')
                         publication_date = d.strftime('%Y-%m-%d')
                         try:
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0036_auto_20201126_1704'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdbdata',
+            name='digest',
+            field=models.CharField(max_length=32, null=True, unique=True),
+        ),
+        # backfill, only the first row of duplicated contents gets the digest
+        migrations.RunSQL(
+            sql='UPDATE structure_pdb_data SET digest = MD5(pdb) WHERE id IN (SELECT MIN(id) FROM structure_pdb_data GROUP BY MD5(pdb))',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
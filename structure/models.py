@@ -1,9 +1,12 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.core.cache import cache
 
 from io import StringIO
+from collections import OrderedDict
 from Bio.PDB import PDBIO
 import re
+import hashlib
+import numpy as np
 from protein.models import ProteinGProteinPair
 
 class Structure(models.Model):
@@ -58,53 +61,58 @@ class Structure(models.Model):
 
         return str(self.signprot_complex.protein)
 
+    def get_parsed_pdb(self):
+        """Parsed atoms of the PDB data (structure.pdb_store), kept on the instance"""
+        if not hasattr(self, '_parsed_pdb'):
+            self._parsed_pdb = self.pdb_data.get_parsed()
+        return self._parsed_pdb
+
+    def get_cleaned_parsed_pdb(self, pref_chain=True, remove_waters=True, ligands_to_keep=None):
+        """Parsed atoms of get_cleaned_pdb (only ATOM/HETATM records)"""
+        parsed = self.get_parsed_pdb()
+        atoms = parsed.atoms
+        # or 'refined' bit needs rework, it fucks up the extraction
+        if not pref_chain or 'refined' in self.pdb_code.index:
+            save = np.ones(len(atoms), dtype=bool)
+        else:
+            save = atoms['chain'] == self.preferred_chain[0].encode('ascii')
+        other_het = atoms['hetatm'] & (atoms['resname'] != b'HOH')
+        if remove_waters:
+            save &= ~(atoms['hetatm'] & (atoms['resname'] == b'HOH'))
+        if ligands_to_keep:
+            keep = np.isin(atoms['resname'], [l.strip().encode('ascii') for l in ligands_to_keep])
+            if pref_chain:
+                keep &= atoms['chain'] == self.preferred_chain[0].encode('ascii')
+            save = np.where(other_het, keep, save)
+        return parsed.select(save)
+
     def get_cleaned_pdb(self, pref_chain=True, remove_waters=True, ligands_to_keep=None, remove_aux=False, aux_range=5.0):
 
+        if pref_chain:
+            # selection on the parsed atoms, only ATOM/HETATM records are returned
+            return self.get_cleaned_parsed_pdb(pref_chain, remove_waters, ligands_to_keep).to_pdb()
+
         tmp = []
         for line in self.pdb_data.pdb.split('\n'):
-            save_line = False
-            if pref_chain:
-                # or 'refined' bit needs rework, it fucks up the extraction
-                if (line.startswith('ATOM') or line.startswith('HET')) and (line[21] == self.preferred_chain[0] or 'refined' in self.pdb_code.index):
-                # if (line.startswith('ATOM') or line.startswith('HET')) and (line[21] == self.preferred_chain[0]):
-                    save_line = True
-            else:
-                save_line = True
+            save_line = True
             if remove_waters and line.startswith('HET') and line[17:20] == 'HOH':
                 save_line = False
             if ligands_to_keep and line.startswith('HET'):
-                if pref_chain:
-                    if line[17:20] != 'HOH' and line[17:20] in ligands_to_keep and line[21] == self.preferred_chain[0]:
-                        save_line = True
-                    elif line[17:20] != 'HOH':
-                        save_line=False
-                else:
-                    if line[17:20] != 'HOH' and line[17:20] in ligands_to_keep:
-                        save_line = True
-                    elif line[17:20] != 'HOH':
-                        save_line=False
+                if line[17:20] != 'HOH' and line[17:20] in ligands_to_keep:
+                    save_line = True
+                elif line[17:20] != 'HOH':
+                    save_line=False
             if save_line:
                 tmp.append(line)
 
         return '\n'.join(tmp)
 
     def get_ligand_pdb(self, ligand):
-
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            if line.startswith('HET') and line[21] == self.preferred_chain[0]:
-                if line[17:20] != 'HOH' and line[17:20] == ligand:
-                    tmp.append(line)
-        return '\n'.join(tmp)
+        return self.get_parsed_pdb().ligands(names=[ligand], chain=self.preferred_chain[0]).to_pdb()
 
     def get_preferred_chain_pdb(self):
-
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            # http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
-            if (line.startswith('ATOM') or line.startswith('HET')) and line[21] == self.preferred_chain[0]:
-                tmp.append(line)
-        return '\n'.join(tmp)
+        # http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
+        return self.get_parsed_pdb().chain(self.preferred_chain[0]).to_pdb()
 
     @property
     def is_refined(self):
@@ -166,6 +174,9 @@ class StructureModel(models.Model):
     def get_cleaned_pdb(self):
         return self.pdb_data.pdb
 
+    def get_cleaned_parsed_pdb(self):
+        return self.pdb_data.get_parsed()
+
 
 class StructureComplexModel(models.Model):
     receptor_protein = models.ForeignKey('protein.Protein', related_name='+', on_delete=models.CASCADE)
@@ -188,6 +199,9 @@ class StructureComplexModel(models.Model):
     def get_cleaned_pdb(self):
         return self.pdb_data.pdb
 
+    def get_cleaned_parsed_pdb(self):
+        return self.pdb_data.get_parsed()
+
     def get_prot_gprot_pair(self):
         pgp = ProteinGProteinPair.objects.filter(protein=self.receptor_protein, g_protein__slug=self.sign_protein.family.parent.slug, source='GuideToPharma')
         if len(pgp)>0:
@@ -369,10 +383,59 @@ class StructureStabilizingAgent(models.Model):
 
 class PdbData(models.Model):
     pdb = models.TextField()
+    # md5 of the pdb text, set on one row per distinct content so that lookups do not have to compare the text
+    digest = models.CharField(max_length=32, unique=True, null=True)
 
     def __str__(self):
         return self.pdb
 
+    def save(self, *args, **kwargs):
+        # rows are shared by all structures and models with the same content, new content gets a new row
+        digest = self.calculate_digest(self.pdb)
+        if self.pk is None:
+            self.digest = digest
+        elif self.digest is not None and self.digest != digest:
+            raise ValueError('PdbData {} is shared by content, use PdbData.get_or_create_pdb for new content'.format(self.pk))
+        super(PdbData, self).save(*args, **kwargs)
+
+    def get_parsed(self):
+        """Parsed atoms of the PDB text (structure.pdb_store)"""
+        from structure.pdb_store import ParsedStructure
+        return ParsedStructure.from_pdb_data(self)
+
+    @staticmethod
+    def calculate_digest(pdb):
+        return hashlib.md5(pdb.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_or_create_pdb(cls, pdb):
+        """Like get_or_create(pdb=pdb), but looked up by digest"""
+        return cls.objects.get_or_create(digest=cls.calculate_digest(pdb), defaults={'pdb': pdb})
+
+    @classmethod
+    def bulk_get_or_create(cls, pdbs):
+        """Resolve a batch of pdb texts to PdbData objects (in the same order) with one lookup query, missing
+        contents are inserted with one bulk_create"""
+        digests = [cls.calculate_digest(pdb) for pdb in pdbs]
+        pdb_data = dict([(p.digest, p) for p in cls.objects.filter(digest__in=set(digests))])
+
+        new = OrderedDict()
+        for pdb, digest in zip(pdbs, digests):
+            if digest not in pdb_data and digest not in new:
+                new[digest] = cls(pdb=pdb, digest=digest)
+
+        if new:
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(list(new.values()))
+                pdb_data.update(new)
+            except IntegrityError:
+                # inserted concurrently by another build process
+                for digest, p in new.items():
+                    pdb_data[digest], created = cls.objects.get_or_create(digest=digest, defaults={'pdb': p.pdb})
+
+        return [pdb_data[digest] for digest in digests]
+
     class Meta():
         db_table = "structure_pdb_data"
 
@@ -0,0 +1,291 @@
+"""
+Parsed coordinates of PdbData entries.
+
+The ATOM/HETATM records of a PDB file are parsed once into a NumPy structured array (one row per atom) and stored as a
+.npy file keyed by the PdbData digest, which later requests and build steps memory-map instead of parsing the text
+again. Selections return new ParsedStructure objects, Biopython objects are only built when a caller asks for them.
+"""
+from django.conf import settings
+
+from Bio.PDB.StructureBuilder import StructureBuilder
+from Bio.PDB.PDBExceptions import PDBConstructionException
+
+from collections import OrderedDict
+from functools import lru_cache
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+
+# bump when the parsing or the layout changes, older files are then ignored
+STORE_VERSION = 1
+
+atom_dtype = np.dtype([
+    ('model', '<i2'),
+    ('hetatm', '?'),
+    ('serial', '<i4'),
+    ('fullname', 'S4'),
+    ('altloc', 'S1'),
+    ('resname', 'S3'),
+    ('chain', 'S1'),
+    ('resseq', '<i4'),
+    ('icode', 'S1'),
+    ('coord', '<f4', (3,)),
+    ('occupancy', '<f4'), # NaN when missing
+    ('bfactor', '<f4'),
+    ('segid', 'S4'),
+    ('element', 'S2'),
+    ('line', 'S80'), # original record, for writing selections back to PDB text
+    ])
+
+# PDB columns of the fixed width fields
+columns = OrderedDict([
+    ('serial', (6, 11)),
+    ('fullname', (12, 16)),
+    ('altloc', (16, 17)),
+    ('resname', (17, 20)),
+    ('chain', (21, 22)),
+    ('resseq', (22, 26)),
+    ('icode', (26, 27)),
+    ('x', (30, 38)),
+    ('y', (38, 46)),
+    ('z', (46, 54)),
+    ('occupancy', (54, 60)),
+    ('bfactor', (60, 66)),
+    ('segid', (72, 76)),
+    ('element', (76, 78)),
+    ])
+
+water_names = [b'HOH', b'WAT']
+
+logger = logging.getLogger('protwis')
+
+
+def _to_number(field, dtype, default):
+    """Convert a column of fixed width text to numbers, unparsable values become default"""
+    try:
+        return np.char.strip(field).astype(dtype)
+    except ValueError:
+        values = np.empty(len(field), dtype=dtype)
+        for i, f in enumerate(field):
+            try:
+                values[i] = dtype(f.strip()) if f.strip() else default
+            except ValueError:
+                values[i] = default
+        return values
+
+
+def parse_pdb(text):
+    """Parse the ATOM/HETATM records of a PDB text into an atom array (like PDBParser, atoms after END or CONECT
+    are ignored and every MODEL starts a new model)"""
+    lines = []
+    models = []
+    model = 0
+    model_open = False
+    started = False
+    for line in text.split('\n'):
+        record = line[0:6]
+        if record == 'ATOM  ' or record == 'HETATM':
+            if not model_open:
+                model_open = True
+                model += 1
+            started = True
+            lines.append(line.rstrip('\r'))
+            models.append(model - 1)
+        elif record == 'MODEL ':
+            model += 1
+            model_open = True
+            started = True
+        elif record == 'ENDMDL':
+            model_open = False
+        elif started and (record == 'END   ' or record == 'CONECT'):
+            break
+
+    atoms = np.zeros(len(lines), dtype=atom_dtype)
+    if not lines:
+        return atoms
+
+    # fixed width byte matrix (atoms x 80) to slice the columns from
+    raw = np.frombuffer(''.join([l[:80].ljust(80) for l in lines]).encode('ascii', 'replace'), dtype='S1').reshape(-1, 80)
+    field = lambda name: np.ascontiguousarray(raw[:, columns[name][0]:columns[name][1]]).view(
+        'S{}'.format(columns[name][1] - columns[name][0])).ravel()
+
+    atoms['model'] = models
+    atoms['hetatm'] = raw[:, 0] == b'H'
+    atoms['serial'] = _to_number(field('serial'), int, 0)
+    atoms['fullname'] = field('fullname')
+    atoms['altloc'] = field('altloc')
+    atoms['resname'] = np.char.strip(field('resname'))
+    atoms['chain'] = field('chain')
+    atoms['resseq'] = _to_number(field('resseq'), int, 0)
+    atoms['icode'] = field('icode')
+    atoms['coord'] = np.stack([_to_number(field(c), float, np.nan) for c in 'xyz'], axis=1)
+    atoms['occupancy'] = _to_number(field('occupancy'), float, np.nan)
+    atoms['bfactor'] = _to_number(field('bfactor'), float, 0.0)
+    atoms['segid'] = [l[72:76].encode('ascii', 'replace') for l in lines]
+    atoms['element'] = np.char.upper(np.char.strip(field('element')))
+    atoms['line'] = [l.encode('ascii', 'replace')[:80] for l in lines]
+    return atoms
+
+
+def store_path(digest):
+    return os.sep.join([settings.BUILD_CACHE_DIR, 'pdb_store', 'v{}'.format(STORE_VERSION), digest[:2], digest + '.npy'])
+
+
+@lru_cache(maxsize=128)
+def load_atoms(digest):
+    """Memory-mapped atom array of a stored PDB (None when not stored yet)"""
+    path = store_path(digest)
+    if os.path.isfile(path):
+        try:
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            logger.warning('Could not read parsed PDB {}'.format(path))
+    return None
+
+
+def save_atoms(digest, atoms):
+    """Store an atom array, written to a temporary file first so readers never see partial files"""
+    path = store_path(digest)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+            np.save(f, atoms)
+        os.replace(f.name, path)
+    except OSError:
+        logger.warning('Could not store parsed PDB {}'.format(path))
+
+
+class ParsedStructure():
+    """Atoms of a PDB file as NumPy arrays, with selections and lazy conversion to Biopython"""
+
+    def __init__(self, atoms):
+        self.atoms = atoms
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(parse_pdb(text))
+
+    @classmethod
+    def from_pdb_data(cls, pdb_data):
+        """Parsed atoms of a PdbData object, from the store when available (parsed and stored otherwise)"""
+        digest = pdb_data.digest or pdb_data.calculate_digest(pdb_data.pdb)
+        atoms = load_atoms(digest)
+        if atoms is None:
+            atoms = parse_pdb(pdb_data.pdb)
+            save_atoms(digest, atoms)
+            load_atoms.cache_clear()
+        return cls(atoms)
+
+    @classmethod
+    def join(cls, parsed):
+        """The atoms of several parsed structures in one (like parsing their concatenated texts)"""
+        return cls(np.concatenate([p.atoms for p in parsed]))
+
+    def __len__(self):
+        return len(self.atoms)
+
+    @property
+    def coordinates(self):
+        return self.atoms['coord']
+
+    @property
+    def atom_names(self):
+        return np.char.strip(self.atoms['fullname'].astype('U4'))
+
+    @property
+    def residue_numbers(self):
+        return self.atoms['resseq']
+
+    def select(self, mask):
+        return ParsedStructure(self.atoms[mask])
+
+    def model(self, model=0):
+        return self.select(self.atoms['model'] == model)
+
+    def chain(self, chains):
+        """Atoms of one or more chains"""
+        chains = [c.encode('ascii') for c in chains]
+        return self.select(np.isin(self.atoms['chain'], chains))
+
+    def residues(self, numbers, chain=None):
+        """Atoms of a list of residue numbers, optionally restricted to one chain"""
+        mask = np.isin(self.atoms['resseq'], list(numbers))
+        if chain is not None:
+            mask &= self.atoms['chain'] == chain.encode('ascii')
+        return self.select(mask)
+
+    def waters(self):
+        return self.select(self.atoms['hetatm'] & np.isin(self.atoms['resname'], water_names))
+
+    def without_waters(self):
+        return self.select(~(self.atoms['hetatm'] & np.isin(self.atoms['resname'], water_names)))
+
+    def ligands(self, names=None, chain=None):
+        """HETATM records other than water, optionally only residue names in names and/or one chain"""
+        mask = self.atoms['hetatm'] & ~np.isin(self.atoms['resname'], water_names)
+        if names is not None:
+            mask &= np.isin(self.atoms['resname'], [n.encode('ascii') for n in names])
+        if chain is not None:
+            mask &= self.atoms['chain'] == chain.encode('ascii')
+        return self.select(mask)
+
+    def to_pdb(self):
+        """The original records of the selected atoms as PDB text"""
+        return '\n'.join([line.decode('ascii') for line in self.atoms['line']])
+
+    def to_biopython(self, structure_id='ref'):
+        """Biopython Structure of the selected atoms (built the same way as by PDBParser)"""
+        builder = StructureBuilder()
+        builder.init_structure(structure_id)
+
+        current_model = None
+        current_segid = None
+        current_chain = None
+        current_residue = None
+        for atom in self.atoms:
+            model = int(atom['model'])
+            if model != current_model:
+                builder.init_model(model)
+                current_model = model
+                current_segid = None
+                current_chain = None
+                current_residue = None
+
+            resname = atom['resname'].decode('ascii')
+            if atom['hetatm']:
+                hetero_flag = 'W' if atom['resname'] in water_names else 'H'
+            else:
+                hetero_flag = ' '
+            residue = (hetero_flag, int(atom['resseq']), atom['icode'].decode('ascii') or ' ', resname)
+            segid = atom['segid'].decode('ascii')
+            chain = atom['chain'].decode('ascii') or ' '
+
+            if segid != current_segid:
+                builder.init_seg(segid)
+                current_segid = segid
+            # PDBParser(PERMISSIVE=True) ignores construction errors as well
+            new_residue = chain != current_chain or residue != current_residue
+            if chain != current_chain:
+                builder.init_chain(chain)
+                current_chain = chain
+            if new_residue:
+                current_residue = residue
+                try:
+                    builder.init_residue(resname, hetero_flag, residue[1], residue[2])
+                except PDBConstructionException:
+                    pass
+
+            try:
+                fullname = atom['fullname'].decode('ascii').ljust(4)
+                name = fullname if len(fullname.split()) != 1 else fullname.strip()
+                occupancy = None if np.isnan(atom['occupancy']) else float(atom['occupancy'])
+                builder.init_atom(name, np.array(atom['coord'], 'f'), float(atom['bfactor']), occupancy,
+                                  atom['altloc'].decode('ascii') or ' ', fullname, int(atom['serial']),
+                                  atom['element'].decode('ascii'))
+            except PDBConstructionException:
+                pass
+
+        return builder.get_structure()
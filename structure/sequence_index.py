@@ -0,0 +1,256 @@
+"""
+In-process identification of protein sequences against the wild type sequences of the database.
+
+build_blast_database writes a k-mer index next to each BLAST database (<blastdb>.kmers.npz). A query shortlists the
+proteins sharing the most k-mers with it and only those are aligned locally (BLOSUM62 with the gap costs of blastp).
+Hits have the attributes of the Bio.Blast.Record alignments parsed from blastp, so the callers of BlastSearch work with
+either backend. Results are cached by the hash of the query sequence until the index is rebuilt.
+"""
+from common.cache_keys import SEQUENCE_HITS
+
+from Bio import Align
+
+import numpy as np
+
+import hashlib
+import logging
+import math
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+KMER_SIZE = 3
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+KMER_CODES = len(AMINO_ACIDS) ** KMER_SIZE
+
+# proteins aligned per query (at least twice the requested number of hits)
+SHORTLIST_SIZE = 20
+
+# blastp defaults: BLOSUM62, gap open 11 and extend 1, Karlin-Altschul parameters of that scoring, E-value cut-off
+GAP_OPEN = 11
+GAP_EXTEND = 1
+KARLIN_LAMBDA = 0.267
+KARLIN_K = 0.041
+MAX_EXPECT = 10
+
+# amino acid codes of all bytes (len(AMINO_ACIDS) for anything else)
+_codes = np.full(256, len(AMINO_ACIDS), dtype=np.int64)
+for _i, _aa in enumerate(AMINO_ACIDS):
+    _codes[ord(_aa)] = _i
+    _codes[ord(_aa.lower())] = _i
+
+
+def index_path(blastdb):
+    return blastdb + '.kmers.npz'
+
+
+def encode(sequence):
+    return _codes[np.frombuffer(sequence.encode('ascii', 'replace'), dtype=np.uint8)]
+
+
+def kmers(codes):
+    """Codes of all k-mers of standard amino acids in an encoded sequence"""
+    if len(codes) < KMER_SIZE:
+        return np.zeros(0, dtype=np.int64)
+    windows = [codes[i:len(codes)-KMER_SIZE+i+1] for i in range(KMER_SIZE)]
+    valid = np.all([w < len(AMINO_ACIDS) for w in windows], axis=0)
+    kmer = np.zeros(len(windows[0]), dtype=np.int64)
+    for w in windows:
+        kmer = kmer*len(AMINO_ACIDS) + w
+    return kmer[valid]
+
+
+def write_index(blastdb, proteins):
+    """Writes the k-mer index of (id, entry name, sequence) tuples next to a BLAST database"""
+    ids, entry_names, sequences = [], [], []
+    for protein_id, entry_name, sequence in proteins:
+        ids.append(protein_id)
+        entry_names.append(entry_name)
+        # letters the substitution matrix does not score are stored as X
+        sequences.append(''.join([aa if aa in AMINO_ACIDS else 'X' for aa in sequence.upper()]))
+
+    # postings: the proteins containing each k-mer, grouped by k-mer
+    protein_kmers = [np.unique(kmers(encode(sequence))) for sequence in sequences]
+    kmer_list = np.concatenate(protein_kmers) if protein_kmers else np.zeros(0, dtype=np.int64)
+    protein_list = np.repeat(np.arange(len(sequences), dtype=np.int32), [len(k) for k in protein_kmers])
+    order = np.argsort(kmer_list, kind='stable')
+    kmer_offsets = np.zeros(KMER_CODES + 1, dtype=np.int64)
+    kmer_offsets[1:] = np.cumsum(np.bincount(kmer_list, minlength=KMER_CODES))
+
+    sequence_offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    sequence_offsets[1:] = np.cumsum([len(sequence) for sequence in sequences])
+
+    path = index_path(blastdb)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, ids=np.array(ids, dtype=np.int64), entry_names=np.array(entry_names, dtype=str),
+                 sequence_data=np.frombuffer(''.join(sequences).encode('ascii', 'replace'), dtype=np.uint8),
+                 sequence_offsets=sequence_offsets, kmer_offsets=kmer_offsets, kmer_proteins=protein_list[order])
+    os.replace(path + '.tmp', path)
+
+
+def substitution_matrix():
+    """BLOSUM62 for PairwiseAligner"""
+    try:
+        from Bio.Align import substitution_matrices
+        return substitution_matrices.load('BLOSUM62')
+    except ImportError:
+        # older Biopython, half matrix
+        from Bio.SubsMat import MatrixInfo
+        matrix = {}
+        for (a, b), score in MatrixInfo.blosum62.items():
+            matrix[(a, b)] = matrix[(b, a)] = score
+        return matrix
+
+
+class SequenceHit():
+    """A protein matching a query (attributes of Bio.Blast.Record.Alignment)"""
+    def __init__(self, hit_id, hit_def, length, hsps):
+        self.hit_id = hit_id
+        self.hit_def = hit_def
+        self.title = '{} {}'.format(hit_id, hit_def)
+        self.length = length
+        self.hsps = hsps
+
+
+class SequenceHitSegment():
+    """A local alignment of a query and a protein (attributes of Bio.Blast.Record.HSP, positions start at 1)"""
+    def __init__(self, score, bits, expect, query, match, sbjct, query_start, sbjct_start):
+        self.score = score
+        self.bits = bits
+        self.expect = expect
+        self.query = query
+        self.match = match
+        self.sbjct = sbjct
+        self.query_start = query_start
+        self.query_end = query_start + len(query) - query.count('-') - 1
+        self.sbjct_start = sbjct_start
+        self.sbjct_end = sbjct_start + len(sbjct) - sbjct.count('-') - 1
+        self.align_length = len(query)
+        self.identities = sum(1 for m in match if m not in ' +')
+        self.positives = self.identities + match.count('+')
+        self.gaps = query.count('-') + sbjct.count('-')
+        self.num_alignments = None
+        self.strand = (None, None)
+        self.frame = ()
+
+
+class SequenceIndex():
+    """The k-mer index of the sequences of a BLAST database"""
+    def __init__(self, path, modified=None):
+        self.modified = modified
+        data = np.load(path, allow_pickle=False)
+        self.ids = data['ids']
+        self.entry_names = data['entry_names']
+        self.sequence_data = data['sequence_data'].tobytes().decode('ascii')
+        self.sequence_offsets = data['sequence_offsets']
+        self.kmer_offsets = data['kmer_offsets']
+        self.kmer_proteins = data['kmer_proteins']
+        self.database_length = len(self.sequence_data)
+
+        self.aligner = Align.PairwiseAligner()
+        self.aligner.mode = 'local'
+        self.aligner.substitution_matrix = substitution_matrix()
+        # the first gap position costs the open and the extension penalty in blastp
+        self.aligner.open_gap_score = -(GAP_OPEN + GAP_EXTEND)
+        self.aligner.extend_gap_score = -GAP_EXTEND
+
+    def __len__(self):
+        return len(self.ids)
+
+    def sequence(self, i):
+        return self.sequence_data[self.sequence_offsets[i]:self.sequence_offsets[i+1]]
+
+    def shortlist(self, sequence, size):
+        """Indices of the proteins sharing the most k-mers with a sequence (most shared first)"""
+        query_kmers = np.unique(kmers(encode(sequence)))
+        starts, ends = self.kmer_offsets[query_kmers], self.kmer_offsets[query_kmers + 1]
+        lengths = ends - starts
+        if not lengths.sum():
+            return np.zeros(0, dtype=np.int64)
+
+        # positions of all postings of the query k-mers
+        postings = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        shared = np.bincount(self.kmer_proteins[postings], minlength=len(self))
+        candidates = np.argsort(-shared, kind='stable')[:size]
+        return candidates[shared[candidates] > 0]
+
+    def search(self, sequence, top_results=1):
+        """(protein id, SequenceHit) of the best local alignments of a sequence, best first"""
+        # letters the matrix does not score are aligned as X, the hits show the query as given
+        query = ''.join([aa if aa in AMINO_ACIDS else 'X' for aa in sequence.upper()])
+        candidates = self.shortlist(query, max(SHORTLIST_SIZE, 2*top_results))
+
+        scores = [(self.aligner.score(query, self.sequence(i)), -n, i) for n, i in enumerate(candidates)]
+        output = []
+        for score, _, i in sorted(scores, reverse=True)[:top_results]:
+            expect = KARLIN_K * len(query) * self.database_length * math.exp(-KARLIN_LAMBDA * score)
+            if expect > MAX_EXPECT:
+                break
+            target = self.sequence(i)
+            alignment = self.aligner.align(query, target)[0]
+            hsp = self.hit_segment(sequence, target, alignment.aligned, score, expect)
+            hit_id = str(self.ids[i])
+            output.append((hit_id, SequenceHit(hit_id, str(self.entry_names[i]), len(target), [hsp])))
+        return output
+
+    def hit_segment(self, sequence, target, aligned, score, expect):
+        """SequenceHitSegment of the aligned blocks of a local alignment"""
+        query, match, sbjct = [], [], []
+        query_blocks, target_blocks = aligned
+        previous = None
+        for (q_start, q_end), (t_start, t_end) in zip(query_blocks, target_blocks):
+            if previous:
+                # gaps between two blocks
+                query.append(sequence[previous[0]:q_start] + '-'*(t_start - previous[1]))
+                sbjct.append('-'*(q_start - previous[0]) + target[previous[1]:t_start])
+                match.append(' '*(q_start - previous[0] + t_start - previous[1]))
+            for q, t in zip(sequence[q_start:q_end], target[t_start:t_end]):
+                if q.upper() == t:
+                    match.append(t)
+                else:
+                    match.append('+' if self.pair_score(q, t) > 0 else ' ')
+            query.append(sequence[q_start:q_end])
+            sbjct.append(target[t_start:t_end])
+            previous = (q_end, t_end)
+
+        bits = (KARLIN_LAMBDA * score - math.log(KARLIN_K)) / math.log(2)
+        return SequenceHitSegment(score, bits, expect, ''.join(query), ''.join(match), ''.join(sbjct),
+                                  int(query_blocks[0][0]) + 1, int(target_blocks[0][0]) + 1)
+
+    def pair_score(self, a, b):
+        a = a.upper() if a.upper() in AMINO_ACIDS else 'X'
+        b = b if b in AMINO_ACIDS else 'X'
+        return self.aligner.substitution_matrix[a, b]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def sequence_index(blastdb):
+    """The SequenceIndex of a BLAST database (loaded again when it is rebuilt), None when it was not built"""
+    path = index_path(blastdb)
+    try:
+        modified = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _indexes_lock:
+        if path not in _indexes or _indexes[path].modified != modified:
+            _indexes[path] = SequenceIndex(path, modified)
+        return _indexes[path]
+
+
+def search_sequence(blastdb, sequence, top_results=1):
+    """(protein id, SequenceHit) of the best hits of a sequence in the index of a BLAST database, None without index"""
+    index = sequence_index(blastdb)
+    if index is None:
+        return None
+
+    sequence = str(sequence).strip()
+    args = (os.path.basename(blastdb), int(index.modified), top_results, hashlib.sha1(sequence.encode('utf-8')).hexdigest())
+    output = SEQUENCE_HITS.get(*args)
+    if output is None:
+        output = index.search(sequence, top_results)
+        SEQUENCE_HITS.set(output, *args)
+    return output
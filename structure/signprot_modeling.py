@@ -468,7 +468,7 @@ class SignprotModeling():
                             self.trimmed_residues.append(key)
 
         # Add Beta and Gamma chains
-        p = PDB.PDBParser(QUIET=True).get_structure('structure', StringIO(self.main_structure.pdb_data.pdb))[0]
+        p = self.main_structure.get_parsed_pdb().to_biopython('structure')[0]
         beta = p[self.signprot_complex.beta_chain]
         gamma = p[self.signprot_complex.gamma_chain]
         self.a.reference_dict['Beta'] = OrderedDict()
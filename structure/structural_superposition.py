@@ -1,5 +1,4 @@
 import os,sys,math,logging
-from io import StringIO
 from collections import OrderedDict
 import numpy as np
 
@@ -133,7 +132,7 @@ class FragmentSuperpose(object):
                 continue
             super_imposer = Superimposer()
             try:
-                fragment_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('alt', StringIO(fragment.get_pdbdata()))[0]
+                fragment_struct = fragment.get_parsed_pdbdata().to_biopython('alt')[0]
                 super_imposer.set_atoms(atom_sel.get_ref_atoms(), atom_sel.get_alt_atoms())
                 super_imposer.apply(fragment_struct)
                 superposed_frags.append([fragment,fragment_struct])
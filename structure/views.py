@@ -13,6 +13,7 @@ from protein.models import Gene, ProteinSegment, IdentifiedSites, ProteinGProtei
 from structure.models import Structure, StructureModel, StructureComplexModel, StructureModelStatsRotamer, StructureComplexModelStatsRotamer, StructureModelSeqSim, StructureComplexModelSeqSim, StructureRefinedStatsRotamer, StructureRefinedSeqSim, StructureExtraProteins, StructureModelRMSD
 from structure.functions import CASelector, SelectionParser, GenericNumbersSelector, SubstructureSelector, check_gn, PdbStateIdentifier
 from structure.assign_generic_numbers_gpcr import GenericNumbering
+from structure.pdb_store import ParsedStructure
 from structure.structural_superposition import ProteinSuperpose,FragmentSuperpose
 from structure.forms import *
 from signprot.models import SignprotComplex, SignprotStructure, SignprotStructureExtraProteins
@@ -1409,7 +1410,7 @@ class SuperpositionWorkflowDownload(View):
 			self.ref_substructure_mapping = gn_assigner.get_substructure_mapping_dict()
 			ref_name = self.request.session['ref_file'].name
 		elif selection.reference != []:
-			ref_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(selection.reference[0].item.get_cleaned_pdb()))[0]
+			ref_struct = selection.reference[0].item.get_cleaned_parsed_pdb().to_biopython('ref')[0]
 			gn_assigner = GenericNumbering(structure=ref_struct)
 			gn_assigner.assign_generic_numbers()
 			self.ref_substructure_mapping = gn_assigner.get_substructure_mapping_dict()
@@ -1775,7 +1776,7 @@ class PDBClean(TemplateView):
 						lig_names = [x.pdb_reference for x in StructureLigandInteraction.objects.filter(structure=selected_struct.item, annotated=True)]
 					else:
 						lig_names = None
-					gn_assigner = GenericNumbering(structure=PDBParser(QUIET=True).get_structure(struct_name, StringIO(selected_struct.item.get_cleaned_pdb(pref, water, lig_names)))[0])
+					gn_assigner = GenericNumbering(structure=selected_struct.item.get_cleaned_parsed_pdb(pref, water, lig_names).to_biopython(struct_name)[0])
 					tmp = StringIO()
 					io.set_structure(gn_assigner.assign_generic_numbers())
 					request.session['substructure_mapping'] = gn_assigner.get_substructure_mapping_dict()
@@ -2118,8 +2119,7 @@ def SingleModelDownload(request, modelname, state, fullness, csv=False):
 			helix_resis = Residue.objects.filter(protein_conformation__protein=hommod.protein_conformation.protein, protein_segment__category='helix').values_list('sequence_number', flat=True)
 		else:
 			helix_resis = Residue.objects.filter(protein_conformation__protein=hommod.protein, protein_segment__category='helix').values_list('sequence_number', flat=True)
-		p = PDBParser(get_header=True)
-		pdb = p.get_structure('pdb', StringIO(pdb_lines))[0]
+		pdb = ParsedStructure.from_pdb_data(hommod.pdb_data).to_biopython('pdb')[0]
 		to_remove = []
 		for chain in pdb:
 			for res in chain:
@@ -2,10 +2,10 @@ from django.core.management.base import BaseCommand, CommandError
 from django.core.management import call_command
 from django.conf import settings
 from django.db import connection
-from django.db.models import Max, Min
 
 from contactnetwork.distances import *
 from contactnetwork.models import *
+from contactnetwork.distance_matrices import DistanceMatrices
 from protein.models import *
 from signprot.models import *
 from structure.models import *
@@ -29,6 +29,7 @@ class Command(BaseCommand):
         class_slugs = list(ProteinFamily.objects.filter(parent__slug="000") \
                             .filter(slug__startswith="00").values_list("slug"))
 
+        all_tm2_tm6_distances = None
         for slug in class_slugs:
             print("Processing class {}".format(slug[0]))
 
@@ -68,13 +69,11 @@ class Command(BaseCommand):
                 class_pair_inactives['005'] = ["2x47_6x37", 1000] #D PLACEHOLDER
                 class_pair_inactives['006'] = ["2x44_6x31", 13] #F
 
-                inactive_ids = list(Distance.objects.filter(distance__lt=class_pair_inactives[slug[0]][1]*distance_scaling_factor) \
-                                    .filter(gns_pair=class_pair_inactives[slug[0]][0]) \
-                                    .filter(structure__pdb_code__index__in=structure_ids) \
-                                    .exclude(structure__pdb_code__index__in=active_ids) \
-                                    .values_list("structure__pdb_code__index"))
+                # distances of the class-specific TM pair for all structures of this class
+                pair_distances = DistanceMatrices().load(pdbs=structure_ids).pair_distances(class_pair_inactives[slug[0]][0])
 
-                inactive_ids = [x[0] for x in inactive_ids]
+                inactive_ids = [pdb for pdb, distance in pair_distances.items() \
+                                    if distance < class_pair_inactives[slug[0]][1]*distance_scaling_factor and pdb not in active_ids]
 
                 # HARDCODED INACTIVE STRUCTURES
                 if slug[0] == "004":
@@ -136,18 +135,10 @@ class Command(BaseCommand):
 
                     # Percentage score for TM2-TM6 opening
                     #range_distance = Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                    range_distance = Distance.objects.filter(gns_pair=class_pair_inactives[slug[0]][0]) \
-                                        .filter(structure__pdb_code__index__in=structure_ids) \
-                                        .aggregate(Max('distance'), Min('distance'))
-
-                    min_open = range_distance['distance__min']
-                    max_open = range_distance['distance__max']
+                    min_open = min(pair_distances.values(), default=None)
+                    max_open = max(pair_distances.values(), default=None)
 
-                    #distances = list(Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                    distances = list(Distance.objects.filter(gns_pair=class_pair_inactives[slug[0]][0]) \
-                                        .filter(structure__pdb_code__index__in=structure_ids) \
-                                        .distinct("gns_pair", "structure") \
-                                        .values_list("structure__pdb_code__index", "distance"))
+                    distances = list(pair_distances.items())
 
                     opening_percentage = {}
                     for entry in distances:
@@ -217,16 +208,14 @@ class Command(BaseCommand):
                         struct.gprot_bound_likeness = gprot_likeness
                         struct.save()
                 elif len(structure_ids) > 0:
-                    distances = list(Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                                        .filter(structure__pdb_code__index__in=structure_ids) \
-                                        .distinct("gns_pair", "structure") \
-                                        .values_list("structure__pdb_code__index", "distance"))
+                    distances = list(DistanceMatrices().load(pdbs=structure_ids).pair_distances("2x46_6x37").items())
 
-                    range_distance = Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                                        .aggregate(Max('distance'), Min('distance'))
+                    # range over all structures, only loaded once
+                    if all_tm2_tm6_distances is None:
+                        all_tm2_tm6_distances = list(DistanceMatrices().load().pair_distances("2x46_6x37").values())
 
-                    min_open = range_distance['distance__min']
-                    max_open = range_distance['distance__max']
+                    min_open = min(all_tm2_tm6_distances, default=None)
+                    max_open = max(all_tm2_tm6_distances, default=None)
                     for entry in distances:
                         # Percentage score
                         percentage = int(round((entry[1]-min_open)/(max_open-min_open)*100))
@@ -1,11 +1,11 @@
 from django.core.management.base import BaseCommand
-from django.db import connection
 
+from build.executor import BuildExecutor
 import contactnetwork.pdb as pdb
 from structure.models import Structure, StructureVectors
 from residue.models import Residue
 from angles.models import ResidueAngle as Angle
-from contactnetwork.models import Distance, distance_scaling_factor
+from contactnetwork.models import Distance, DistanceMatrix, distance_scaling_factor
 
 import Bio.PDB
 import copy
@@ -16,7 +16,6 @@ import math
 import subprocess
 import os
 import re
-import traceback
 
 import numpy as np
 import scipy.stats as stats
@@ -27,8 +26,6 @@ from sklearn.decomposition import PCA
 from numpy.core.umath_tests import inner1d
 
 
-from multiprocessing import Queue, Process, Value, Lock
-
 SASA = True
 HSE  = True
 extra_pca = True
@@ -229,36 +226,6 @@ class Command(BaseCommand):
 
     processes = 2
 
-    def prepare_input(self, proc, items, iteration=1):
-        q = Queue()
-        procs = list()
-        num_items = len(items)
-        num = Value('i', 0)
-        lock = Lock()
-
-        if not num_items:
-            return False
-
-        # make sure not to use more jobs than proteins (chunk size will be 0, which is not good)
-        if proc > num_items:
-            proc = num_items
-
-        chunk_size = int(num_items / proc)
-        connection.close()
-        for i in range(0, proc):
-            first = chunk_size * i
-            if i == proc - 1:
-                last = False
-            else:
-                last = chunk_size * (i + 1)
-
-            p = Process(target=self.main_func, args=([(first, last), iteration,num,lock]))
-            procs.append(p)
-            p.start()
-
-        for p in procs:
-            p.join()
-
     def add_arguments(self, parser):
         parser.add_argument('-p', '--proc',
             type=int,
@@ -285,6 +252,7 @@ class Command(BaseCommand):
         else:
             Angle.objects.all().delete()
             Distance.objects.all().delete()
+            DistanceMatrix.objects.all().delete()
             StructureVectors.objects.all().delete()
             print("All Angle, Distance, and StructureVector data cleaned")
             self.references = Structure.objects.all().exclude(refined=True).prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
@@ -297,9 +265,50 @@ class Command(BaseCommand):
 
         print(len(self.references),'structures')
         self.references = list(self.references)
-        self.prepare_input(self.processes, self.references)
+        self.structures = {reference.pk: reference for reference in self.references}
+        self.res_dict = self.residue_lists(self.references)
+
+        # workers take one structure at a time and return its angles, which are stored from this process
+        BuildExecutor(self.build_angles, self.processes, write=self.write_angles, retries=0, logger=self.logger,
+                      label='structures').run(list(self.structures))
+
+    def residue_lists(self, references):
+        """Residues of the protein of every structure (by PDB code), read once before starting the workers"""
+        def qgen(x, qset):
+            """
+            Helper function to slice a list of all residues of a protein of the
+            list of the residues of all proteins
+            """
+            start = False
+            for i in range(len(qset)-1,0,-1):
+                if not start and qset[i].protein_conformation.protein == x:
+                    start = i
+                if start and qset[i].protein_conformation.protein != x:
+                    if start != len(qset)-1:
+                        del qset[start+1:]
+                        return qset[i+1:]
+                    return qset[i+1:]
+            del qset[start+1:]
+            return qset
+
+
+        pids = [ref.protein_conformation.protein.id for ref in references]
 
-    def main_func(self, positions, iteration,count,lock):
+        qset = Residue.objects.filter(protein_conformation__protein__id__in=pids)
+        if GN_only:
+            qset = qset.filter(generic_number__label__regex=r'^[1-7]x[0-9]+').order_by('-protein_conformation__protein','-generic_number__label')
+        else:
+            qset = qset.order_by('-protein_conformation__protein','-generic_number__label')
+        qset = list(qset.prefetch_related('generic_number', 'protein_conformation__protein','protein_conformation__state'))
+
+        res_dict = {ref.pdb_code.index:qgen(ref.protein_conformation.protein,qset) for ref in references}
+        return res_dict
+
+    def build_angles(self, structure_id):
+        """Calculate the angles and distances of all residues of one structure, returns the Angle objects"""
+        return self.main_func([self.structures[structure_id]])
+
+    def main_func(self, references):
         def recurse(entity,slist):
             """
             filter a pdb structure in a recursive way
@@ -461,24 +470,6 @@ class Command(BaseCommand):
             for r,an in zip(chain.get_list(),angles):
                 for a in r: a.set_bfactor(an)
 
-        def qgen(x, qset):
-            """
-            Helper function to slice a list of all residues of a protein of the
-            list of the residues of all proteins
-            """
-            start = False
-            for i in range(len(qset)-1,0,-1):
-                if not start and qset[i].protein_conformation.protein == x:
-                    start = i
-                if start and qset[i].protein_conformation.protein != x:
-                    if start != len(qset)-1:
-                        del qset[start+1:]
-                        return qset[i+1:]
-                    return qset[i+1:]
-            del qset[start+1:]
-            return qset
-
-
         def calculate_missing_atoms(poly):
             """
             Helper function to calculate missing atoms for all residues in poly
@@ -516,28 +507,9 @@ class Command(BaseCommand):
         ######################### Start of main loop ##########################
         #######################################################################
 
-        failed = []
         dblist = []
 
-        # Get all structures
-        #references = Structure.objects.filter(protein_conformation__protein__family__slug__startswith="001").exclude(refined=True).prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
-        #references = Structure.objects.all().exclude(refined=True).prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
-        # DEBUG for a specific PDB
-        #references = Structure.objects.filter(pdb_code__index="6AK3").exclude(refined=True).prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
-
-        # references = list(references)
-        references = self.references
-
-        pids = [ref.protein_conformation.protein.id for ref in references]
-
-        qset = Residue.objects.filter(protein_conformation__protein__id__in=pids)
-        if GN_only:
-            qset = qset.filter(generic_number__label__regex=r'^[1-7]x[0-9]+').order_by('-protein_conformation__protein','-generic_number__label')
-        else:
-            qset = qset.order_by('-protein_conformation__protein','-generic_number__label')
-        qset = list(qset.prefetch_related('generic_number', 'protein_conformation__protein','protein_conformation__state'))
-
-        res_dict = {ref.pdb_code.index:qgen(ref.protein_conformation.protein,qset) for ref in references}
+        res_dict = self.res_dict
 
         # clean structure vectors table
         # StructureVectors.objects.all().delete()
@@ -548,20 +520,13 @@ class Command(BaseCommand):
         angle_dict = [{},{},{},{}]
         median_dict = [{},{},{},{}]
 
-        #for reference in references:
-        while count.value<len(references):
-            with lock:
-                if count.value<len(references):
-                    reference = references[count.value]
-                    count.value +=1
-                else:
-                    break
+        for reference in references:
             preferred_chain = reference.preferred_chain.split(',')[0]
             pdb_code = reference.pdb_code.index
 #            print(pdb_code)
 
             try:
-                structure = self.load_pdb_var(pdb_code,reference.pdb_data.pdb)
+                structure = reference.get_parsed_pdb().to_biopython(pdb_code)
                 pchain = structure[0][preferred_chain]
                 state_id = reference.protein_conformation.state.id
 
@@ -1226,28 +1191,26 @@ class Command(BaseCommand):
                 # print("pseudo mid, pos=[", center_tm1[0], ",", center_tm1[1], ",", center_tm1[2] ,"];")
                 # print(rotation_angles[key_tm1])
 
-                # triangular matrix for distances
-                up_ind = np.triu_indices(len(gns_ca_list), 1)
-                bulk_distances = []
-
-                for i1, i2 in zip(up_ind[0], up_ind[1]):
-                    key1 = gns_ids_list[i1]
-                    key2 = gns_ids_list[i2]
-                    res1 = full_resdict[str(key1)]
-                    res2 = full_resdict[str(key2)]
+                # triangular matrix for distances, stored packed as one row per structure
+                matrix_keys = [key for key in gns_ids_list if key in gns_ca_list]
+                up_ind = np.triu_indices(len(matrix_keys), 1)
 
-                    ca_dist = int(np.linalg.norm(gns_ca_list[key1] - gns_ca_list[key2])*distance_scaling_factor)
-                    cb_dist = int(np.linalg.norm(gns_cb_list[key1] - gns_cb_list[key2])*distance_scaling_factor)
-                    center_dist = None
-                    if key1 in gns_center_list and key2 in gns_center_list:
-                        center_dist = int(np.linalg.norm(gns_center_list[key1] - gns_center_list[key2])*distance_scaling_factor)
+                ca_coords = np.array([gns_ca_list[key] for key in matrix_keys], dtype=float).reshape(-1, 3)
+                cb_coords = np.array([gns_cb_list[key] for key in matrix_keys], dtype=float).reshape(-1, 3)
+                center_coords = np.array([gns_center_list[key] if key in gns_center_list else [np.nan]*3 for key in matrix_keys], dtype=float).reshape(-1, 3)
 
-                    # residues in gn_reslist, structure in structure
-                    distance = Distance(distance = ca_dist, distance_cb = cb_dist, distance_helix_center = center_dist, res1=res1, res2=res2, gn1=res1.generic_number.label, gn2=res2.generic_number.label, gns_pair='_'.join([res1.generic_number.label, res2.generic_number.label]), structure=reference)
-                    bulk_distances.append(distance)
+                # int() truncation as for the scaled integer distances, NaN when a residue has no helix center
+                ca_dist = np.trunc(np.linalg.norm(ca_coords[up_ind[0]] - ca_coords[up_ind[1]], axis=1)*distance_scaling_factor)
+                cb_dist = np.trunc(np.linalg.norm(cb_coords[up_ind[0]] - cb_coords[up_ind[1]], axis=1)*distance_scaling_factor)
+                center_dist = np.trunc(np.linalg.norm(center_coords[up_ind[0]] - center_coords[up_ind[1]], axis=1)*distance_scaling_factor)
 
-                # Bulk insert
-                Distance.objects.bulk_create(bulk_distances, batch_size=5000)
+                matrix_residues = [full_resdict[str(key)] for key in matrix_keys]
+                DistanceMatrix.objects.update_or_create(structure=reference, defaults={
+                    'generic_numbers': ','.join([res.generic_number.label for res in matrix_residues]),
+                    'amino_acids': ''.join([res.amino_acid for res in matrix_residues]),
+                    'distance': DistanceMatrix.pack(ca_dist),
+                    'distance_cb': DistanceMatrix.pack(cb_dist),
+                    'distance_helix_center': DistanceMatrix.pack(center_dist)})
 
                 ### ANGLES
                 # Center axis to helix axis to CA
@@ -1261,7 +1224,7 @@ class Command(BaseCommand):
 
                 ### freeSASA (only for TM bundle)
                 # SASA calculations - results per atom
-                clean_structure = self.load_pdb_var(pdb_code,reference.pdb_data.pdb)
+                clean_structure = reference.get_parsed_pdb().to_biopython(pdb_code)
                 clean_pchain = clean_structure[0][preferred_chain]
 
                 # PTM residues give an FreeSASA error - remove
@@ -1379,12 +1342,7 @@ class Command(BaseCommand):
                             [asa_list[residue_id], core_distances[residue_id], midpoint_distances[residue_id], mid_membrane_distances[residue_id], rotation_angles[residue_id]])
             except Exception as e:
                 print(pdb_code, " - ERROR - ", e)
-                failed.append(pdb_code)
-                # DEBUGGING
-                if True:
-                    traceback.print_exc()
-#                    exit(0)
-                continue
+                raise
 
 #        for i in range(4):
 #            for key in angle_dict[i]:
@@ -1423,14 +1381,13 @@ class Command(BaseCommand):
                     tau = round(np.rad2deg(tau),3)
                 if tau_angle != None:
                     tau_angle = round(np.rad2deg(tau_angle),3)
-                object_list.append(Angle(residue=res, a_angle=a1, b_angle=a2, structure=ref, sasa=asa, rsa=rsa, hse=hse, phi=phi, psi=psi, theta=theta, tau=tau, tau_angle=tau_angle, chi1=chi_angles[0], chi2=chi_angles[1], chi3=chi_angles[2], chi4=chi_angles[3], chi5=chi_angles[4], missing_atoms=missing, ss_dssp=ss_dssp, ss_stride=ss_stride, outer_angle=outer, core_distance=distance, mid_distance=midpoint_distance, midplane_distance=mid_membrane_distance, rotation_angle=rotation_angle))
+                object_list.append(Angle(residue_id=res.pk, a_angle=a1, b_angle=a2, structure_id=ref.pk, sasa=asa, rsa=rsa, hse=hse, phi=phi, psi=psi, theta=theta, tau=tau, tau_angle=tau_angle, chi1=chi_angles[0], chi2=chi_angles[1], chi3=chi_angles[2], chi4=chi_angles[3], chi5=chi_angles[4], missing_atoms=missing, ss_dssp=ss_dssp, ss_stride=ss_stride, outer_angle=outer, core_distance=distance, mid_distance=midpoint_distance, midplane_distance=mid_membrane_distance, rotation_angle=rotation_angle))
             except Exception as e:
                 print(e)
                 print([ref,res,a1,a2,rsa,hse,phi,psi,theta,tau,ss_dssp,ss_stride,outer,tau_angle,asa,distance,midpoint_distance,mid_membrane_distance])
 
-        print("created list")
-        print(len(object_list))
+        return object_list
 
-        # Store the results
+    def write_angles(self, results):
         # faster than updating: deleting and recreating
-        Angle.objects.bulk_create(object_list,batch_size=5000)
+        Angle.objects.bulk_create([angle for structure_id, angles in results for angle in angles], batch_size=5000)
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+
+from common.cache_backends import TieredCache, read_cache_stats_log, cache_stats_log_path
+
+import datetime
+
+
+class Command(BaseCommand):
+
+    help = "Hits, misses and sizes per cache key prefix (from the log written by common.cache_backends.TieredCache)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=None, help='Only use counters flushed in the last N hours')
+        parser.add_argument('--limit', type=int, default=50, help='Number of prefixes to show per cache (most lookups first)')
+        parser.add_argument('--log', default=None, help='Path of the cache stats log (default: settings.CACHE_STATS_LOG)')
+        parser.add_argument('--disk', action='store_true', default=False,
+                            help='Also report files and bytes on disk per prefix (reads the header of every cache file)')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['hours']:
+            since = datetime.datetime.utcnow() - datetime.timedelta(hours=options['hours'])
+
+        totals = read_cache_stats_log(since, options['log'])
+        if not totals:
+            self.stdout.write('No cache statistics in {}'.format(options['log'] or cache_stats_log_path()))
+        else:
+            header = '{:<25} {:<35} {:>10} {:>8} {:>8} {:>8} {:>10} {:>12} {:>12}'.format(
+                'cache', 'prefix', 'lookups', 'hit %', 'memory %', 'misses', 'sets', 'set MB', 'read MB')
+            self.stdout.write(header)
+            self.stdout.write('-' * len(header))
+            rows = sorted(totals.items(), key=lambda t: -(t[1]['memory_hits'] + t[1]['disk_hits'] + t[1]['misses']))
+            shown = {}
+            for (cache_name, prefix), c in rows:
+                shown[cache_name] = shown.get(cache_name, 0) + 1
+                if shown[cache_name] > options['limit']:
+                    continue
+                hits = c['memory_hits'] + c['disk_hits']
+                lookups = hits + c['misses']
+                self.stdout.write('{:<25} {:<35} {:>10} {:>8} {:>8} {:>8} {:>10} {:>12.1f} {:>12.1f}'.format(
+                    cache_name[:25], prefix[:35], lookups,
+                    '{:.0f}'.format(100 * hits / lookups) if lookups else '-',
+                    '{:.0f}'.format(100 * c['memory_hits'] / hits) if hits else '-',
+                    c['misses'], c['sets'], c['set_bytes'] / 1024**2, c['read_bytes'] / 1024**2))
+
+        if options['disk']:
+            for alias in settings.CACHES:
+                cache = caches[alias]
+                if not isinstance(cache, TieredCache):
+                    continue
+                usage = cache.disk_usage()
+                self.stdout.write('\n{} (release {}): {} files, {:.1f} MB'.format(alias, cache.release,
+                    sum(u[0] for u in usage.values()), sum(u[1] for u in usage.values()) / 1024**2))
+                for prefix, (files, size) in sorted(usage.items(), key=lambda u: -u[1][1])[:options['limit']]:
+                    self.stdout.write('    {:<35} {:>10} {:>12.1f} MB'.format(prefix[:35], files, size / 1024**2))
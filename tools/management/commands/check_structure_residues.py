@@ -1,11 +1,11 @@
 from build.management.commands.base_build import Command as BaseBuild
 from django.conf import settings
 from django.db import connection
-from django.db.models import Count
 
 from protein.models import Protein, ProteinConformation, ProteinAnomaly, ProteinState, ProteinSegment
 from residue.models import Residue, ResidueGenericNumber
 from structure.models import *
+from contactnetwork.models import DistanceMatrix
 
 from collections import OrderedDict
 import os
@@ -24,7 +24,7 @@ class Command(BaseBuild):
         parser.add_argument('--verbose', help='Print specific outliers', default=False, action='store_true')
         
     def handle(self, *args, **options):
-        structures = Structure.objects.filter(refined=False).prefetch_related('protein_conformation__protein__parent','pdb_code').annotate(dc=Count('distances'))
+        structures = Structure.objects.filter(refined=False).prefetch_related('protein_conformation__protein__parent','pdb_code','distance_matrix')
         structures_with_issue = []
         missing_helices = {}
         segments_query_obj = ProteinSegment.objects.filter(proteinfamily="GPCR")
@@ -50,7 +50,13 @@ class Command(BaseBuild):
                 missing_gns_count[gn]['count'] += 1
                 missing_gns_count[gn]['pdbs'].append(str(s))
 
-            print(s,"distances",s.dc,"WT residues",wt_resis.count(),"PDB residues",resis.count(),"WT GNs",wt_gn,"PDB GNs",s_gn,"Fraction",fraction)
+            try:
+                # pairs with a stored distance
+                dc = int((DistanceMatrix.unpack(s.distance_matrix.distance)>=0).sum())
+            except DistanceMatrix.DoesNotExist:
+                dc = 0
+
+            print(s,"distances",dc,"WT residues",wt_resis.count(),"PDB residues",resis.count(),"WT GNs",wt_gn,"PDB GNs",s_gn,"Fraction",fraction)
             # print('missing gns',missing_gns)
             c = 0
             segments = OrderedDict((i,[]) for i in segments_query_obj)
@@ -118,7 +118,7 @@ class Command(BaseCommand):
             # self.purge_contact_network(s)
             current = time.time()
             if self.update:
-                if Distance.objects.filter(structure=s).count():
+                if DistanceMatrix.objects.filter(structure=s).exists():
                     print(s,'already done - skipping')
                     continue
             try:
@@ -127,6 +127,6 @@ class Command(BaseCommand):
             except:
                 print(s,'Failed contact network')
             # current = time.time()
-            #runcalculation(s.pdb_code.index,peptide_chain)
-            #parsecalculation(s.pdb_code.index,False)
+            #calculation = runcalculation(s.pdb_code.index,peptide_chain)
+            #parsecalculation(s.pdb_code.index,calculation,False)
             #print(s,"Ligand Interactions",time.time()-current)
\ No newline at end of file
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from common.middleware.stats import read_stats_log, summarize, stats_log_path
+
+import datetime
+
+
+class Command(BaseCommand):
+
+    help = "Percentile summary of the request metrics per URL name (from the stats log written by StatsMiddleware)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=None, help='Only use metrics flushed in the last N hours')
+        parser.add_argument('--limit', type=int, default=50, help='Number of URL names to show (slowest p95 first)')
+        parser.add_argument('--log', default=None, help='Path of the stats log (default: settings.STATS_LOG)')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['hours']:
+            since = datetime.datetime.utcnow() - datetime.timedelta(hours=options['hours'])
+
+        summaries = summarize(read_stats_log(since, options['log']), include_unflushed=False)
+        if not summaries:
+            self.stdout.write('No request metrics in {}'.format(options['log'] or stats_log_path()))
+            return
+
+        header = '{:<45} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10}'.format(
+            'URL name', 'count', 'p50', 'p95', 'p99', 'db p95', 'python', 'queries', 'cache %', 'kB')
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for name, s in list(summaries.items())[:options['limit']]:
+            lookups = s['cache_hits'] + s['cache_misses']
+            cache_ratio = '{:.0f}'.format(100 * s['cache_hits'] / lookups) if lookups else '-'
+            kb = '{:.1f}'.format(s['bytes_mean']/1024) if s['bytes_mean'] is not None else '-'
+            self.stdout.write('{:<45} {:>8} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.1f} {:>8} {:>10}'.format(
+                name[:45], s['count'], s['wall_p50'], s['wall_p95'], s['wall_p99'], s['db_p95'],
+                s['python_mean'], s['queries_mean'], cache_ratio, kb))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from common.cache_keys import registry, bump_datasets, DATASETS
+
+import logging
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Precompute the expensive cache entries of the registered cache keys (common.cache_keys) after a build"
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keys', nargs='+', default=None, help='Names of the registered keys to warm (default: all)')
+        parser.add_argument('--invalidate', nargs='+', default=None, choices=list(DATASETS.keys()),
+                            help='Start a new generation of these datasets first (for data changed outside the build commands)')
+
+    def handle(self, *args, **options):
+        if options['invalidate']:
+            bump_datasets(options['invalidate'])
+
+        names = options['keys'] or [name for name, key in registry.items() if key.warm]
+        for name in names:
+            if name not in registry:
+                raise CommandError('Unknown cache key {}'.format(name))
+            key = registry[name]
+            if not key.warm:
+                self.stdout.write('{}: no warm function'.format(name))
+                continue
+
+            warm = key.warm_function()
+            for args in key.warm_args:
+                label = '_'.join([name] + [str(a) for a in args])
+                if key.has_key(*args):
+                    self.stdout.write('{}: cached'.format(label))
+                    continue
+                start = time.time()
+                try:
+                    warm(*args)
+                except Exception as e:
+                    # a failing entry is computed on the first request instead
+                    self.logger.error('Warming {} failed: {}'.format(label, e))
+                    self.stdout.write('{}: failed ({})'.format(label, e))
+                    continue
+                self.stdout.write('{}: {:.1f}s'.format(label, time.time() - start))